@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+"""Asynchronous, batched log writing.
+
+Log records go into a queue, and are written to the log file(s) by a
+listener thread, so slow (e.g. network) file systems don't stall the
+imaging thread or the reading of tool output. The files are flushed
+every flushInterval seconds, and straight away for warnings and errors.
+
+Optionally, records are also written as JSON lines to a structured log.
+Records can carry structured fields through logging's extra argument:
+
+logging.warning('read error', extra={'event': 'readError', 'offset': 0})
+"""
+
+import json
+import time
+import queue
+import logging
+import datetime
+import logging.handlers
+
+# Structured fields that are copied from log records to the JSON-lines log
+EVENT_FIELDS = ['event', 'offset', 'size', 'bytesRead', 'rate', 'errors', 'phase',
+                'progress', 'status', 'latency']
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """File handler that leaves flushing to the listener, except for
+    records at or above flushLevel"""
+
+    def __init__(self, fileName, flushInterval=1.0, flushLevel=logging.WARNING):
+        """initialise BufferedFileHandler instance"""
+        logging.FileHandler.__init__(self, fileName, encoding='utf-8')
+        self.flushInterval = flushInterval
+        self.flushLevel = flushLevel
+        self.lastFlush = time.monotonic()
+
+    def emit(self, record):
+        """Write record to stream, flushing only if due"""
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record) + self.terminator)
+            if (record.levelno >= self.flushLevel or
+                    time.monotonic() - self.lastFlush >= self.flushInterval):
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Flush stream"""
+        self.lastFlush = time.monotonic()
+        logging.FileHandler.flush(self)
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Formats records as one JSON object per line"""
+
+    def format(self, record):
+        """Return JSON representation of record"""
+        entry = {'time': datetime.datetime.fromtimestamp(record.created).astimezone().isoformat(),
+                 'level': record.levelname,
+                 'event': 'message',
+                 'message': record.getMessage()}
+        for field in EVENT_FIELDS:
+            if hasattr(record, field):
+                entry[field] = getattr(record, field)
+        return json.dumps(entry)
+
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+    """Queue listener that flushes its handlers whenever the queue has
+    been idle for flushInterval seconds"""
+
+    def __init__(self, logQueue, handlers, flushInterval=1.0):
+        """initialise FlushingQueueListener instance"""
+        logging.handlers.QueueListener.__init__(self, logQueue, *handlers,
+                                                respect_handler_level=True)
+        self.flushInterval = flushInterval
+
+    def dequeue(self, block):
+        """Get next record from the queue, flushing while waiting"""
+        while True:
+            try:
+                return self.queue.get(block, self.flushInterval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+                if not block:
+                    raise
+
+
+def startLogging(logFile, jsonLogFile=None, flushInterval=1.0, level=logging.INFO,
+                 recordFilter=None):
+    """Route records of the root logger through a queue to logFile (and
+    jsonLogFile, if set); only records for which recordFilter (if set)
+    returns True. Returns the listener, which must be passed to stopLogging
+    when done. Raises OSError if a log file can't be opened"""
+    fileHandler = BufferedFileHandler(logFile, flushInterval)
+    fileHandler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    handlers = [fileHandler]
+    if jsonLogFile:
+        try:
+            jsonHandler = BufferedFileHandler(jsonLogFile, flushInterval)
+        except OSError:
+            fileHandler.close()
+            raise
+        jsonHandler.setFormatter(JsonLinesFormatter())
+        handlers.append(jsonHandler)
+
+    logQueue = queue.Queue(-1)
+    listener = FlushingQueueListener(logQueue, handlers, flushInterval)
+    listener.queueHandler = logging.handlers.QueueHandler(logQueue)
+    if recordFilter is not None:
+        listener.queueHandler.addFilter(recordFilter)
+    logger = logging.getLogger()
+    logger.setLevel(level)
+    logger.addHandler(listener.queueHandler)
+    listener.start()
+    return listener
+
+
+def stopLogging(listener):
+    """Write out all queued records, and close the log files"""
+    logging.getLogger().removeHandler(listener.queueHandler)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,384 @@
+#! /usr/bin/env python3
+"""Fixity audit of existing acquisitions.
+
+Walks an output root directory, and checks every file listed in the
+checksum files against its SHA-512 digest. Files are hashed by a pool of
+worker threads that share a bandwidth cap. Results are checkpointed to the
+fixity table of the acquisition index, so an interrupted audit can be
+resumed, and files that passed a recent audit can be skipped.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import logging
+import argparse
+import datetime
+import concurrent.futures
+from . import cancel
+from . import index
+from . import ioprio
+from . import status
+from . import targetio
+from . import throttle
+
+# Results are committed to the index after this many files or seconds
+COMMIT_FILES = 100
+COMMIT_INTERVAL = 10.0
+
+
+def utcNow():
+    """Return current UTC date / time as ISO string"""
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def readChecksumFile(checksumFile):
+    """Return list of (file path, expected SHA-512) pairs in checksumFile"""
+    entries = []
+    dirName = os.path.dirname(checksumFile)
+    with io.open(checksumFile, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            checksum, _, fName = line.partition(' ')
+            # sha512sum marks binary mode with a '*'
+            fName = fName.lstrip(' *')
+            entries.append((os.path.join(dirName, fName), checksum.lower()))
+    return entries
+
+
+def findFiles(rootDir, checksumFileName):
+    """Generate (file path, expected SHA-512, checksum file) for all files
+    listed in checksum files under rootDir"""
+    for dirPath, dirNames, fileNames in os.walk(rootDir):
+        dirNames.sort()
+        if checksumFileName not in fileNames:
+            continue
+        checksumFile = os.path.join(dirPath, checksumFileName)
+        try:
+            entries = readChecksumFile(checksumFile)
+        except (IOError, UnicodeDecodeError) as e:
+            logging.error('cannot read ' + checksumFile + ': ' + str(e))
+            continue
+        for path, checksum in entries:
+            yield path, checksum, checksumFile
+
+
+def hashFile(path, bucket, bufferSize, cancelToken):
+    """Compute SHA-512 of path, honouring bandwidth cap of bucket; stops
+    when cancelToken is cancelled. Returns digest (or None) and number of
+    bytes read, or error message"""
+    m = hashlib.sha512()
+    buf = bytearray(bufferSize)
+    view = memoryview(buf)
+    bytesRead = 0
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError as e:
+        return None, 0, str(e)
+    try:
+        while True:
+            if cancelToken.isCancelled():
+                return None, bytesRead, 'cancelled'
+            bucket.consume(bufferSize)
+            n = os.readv(fd, [view])
+            if n == 0:
+                break
+            m.update(view[:n])
+            bytesRead += n
+        # Keep an audit from evicting everything else from the page cache
+        targetio.dropCache(fd, 0, 0)
+    except OSError as e:
+        return None, bytesRead, str(e)
+    finally:
+        os.close(fd)
+    return m.hexdigest(), bytesRead, None
+
+
+def checkFile(path, expected, bucket, bufferSize, cancelToken):
+    """Check one file; returns dictionary with result"""
+    result = {'path': path, 'expected': expected}
+    if not os.path.isfile(path):
+        result['result'] = 'missing'
+        result['actual'] = None
+        return result
+    actual, bytesRead, error = hashFile(path, bucket, bufferSize, cancelToken)
+    result['actual'] = actual
+    result['bytesRead'] = bytesRead
+    if error is not None:
+        result['result'] = 'unreadable'
+        result['error'] = error
+    elif actual == expected:
+        result['result'] = 'ok'
+    else:
+        result['result'] = 'mismatch'
+    return result
+
+
+class Audit:
+    """Fixity audit of all acquisitions under rootDir"""
+
+    def __init__(self, indexPath, rootDir, checksumFileName, noWorkers=2, bandwidth=0,
+                 bufferSize=1048576, since=None, resume=False, ioPriority='idle'):
+        """initialise Audit instance"""
+        self.indexPath = indexPath
+        self.rootDir = os.path.abspath(rootDir)
+        self.checksumFileName = checksumFileName
+        self.noWorkers = max(1, noWorkers)
+        self.bucket = throttle.TokenBucket(bandwidth, max(bandwidth, bufferSize))
+        self.bufferSize = bufferSize
+        self.since = since
+        self.resume = resume
+        self.ioPriority = ioPriority
+        self.auditId = None
+        self.started = None
+        self.finished = None
+        self.noChecked = 0
+        self.noCheckedBefore = 0
+        self.noSkipped = 0
+        self.bytesRead = 0
+        self.failures = []
+        self.interrupted = False
+        self.resumed = False
+        # Workers stop hashing between chunks once this is cancelled
+        self.cancelToken = cancel.CancelToken()
+
+    def startAudit(self, conn):
+        """Register audit, or pick up the last unfinished one if resuming"""
+        if self.resume:
+            row = conn.execute('SELECT id, started FROM audits WHERE rootDir = ? AND '
+                               'finished IS NULL ORDER BY id DESC LIMIT 1',
+                               (self.rootDir,)).fetchone()
+            if row is not None:
+                self.auditId, self.started = row
+                # Files checked by the interrupted run don't need to be checked again
+                if self.since is None or self.started > self.since:
+                    self.since = self.started
+                self.resumed = True
+                logging.info('resuming audit started at ' + self.started)
+                return
+        self.started = utcNow()
+        with conn:
+            cursor = conn.execute('INSERT INTO audits (rootDir, started) VALUES (?, ?)',
+                                  (self.rootDir, self.started))
+        self.auditId = cursor.lastrowid
+
+    def isVerified(self, conn, path, expected):
+        """Return True if path passed with the same checksum since self.since"""
+        if self.since is None:
+            return False
+        row = conn.execute('SELECT expected, result, verified, auditId FROM fixity '
+                           'WHERE path = ?', (path,)).fetchone()
+        if (row is None or row[0] != expected or row[1] != 'ok' or
+                row[2] < self.since):
+            return False
+        if row[3] != self.auditId:
+            # Files checked by an earlier run of this audit aren't skipped,
+            # they are added from the fixity table by addEarlierResults
+            self.noSkipped += 1
+        return True
+
+    def addEarlierResults(self, conn):
+        """Add results of the earlier, interrupted runs of a resumed audit
+        (from the fixity table) to the counts and failures"""
+        if not self.resumed:
+            return
+        checkedNow = set(f['path'] for f in self.failures)
+        noRows = 0
+        for path, checksumFile, expected, actual, result in conn.execute(
+                'SELECT path, checksumFile, expected, actual, result FROM fixity '
+                'WHERE auditId = ?', (self.auditId,)):
+            noRows += 1
+            if result != 'ok' and path not in checkedNow:
+                self.failures.append({'path': path,
+                                      'expected': expected,
+                                      'actual': actual,
+                                      'result': result,
+                                      'checksumFile': checksumFile})
+        # Files checked again in this run replaced their earlier rows
+        self.noCheckedBefore = max(0, noRows - self.noChecked)
+
+    def record(self, conn, result, checksumFile):
+        """Store result in fixity table"""
+        self.noChecked += 1
+        self.bytesRead += result.get('bytesRead', 0)
+        conn.execute('INSERT OR REPLACE INTO fixity VALUES (?, ?, ?, ?, ?, ?, ?)',
+                     (result['path'], checksumFile, result['expected'], result['actual'],
+                      result['result'], utcNow(), self.auditId))
+        if result['result'] != 'ok':
+            result['checksumFile'] = checksumFile
+            result.pop('bytesRead', None)
+            self.failures.append(result)
+            logging.error(result['result'] + ': ' + result['path'])
+
+    def run(self):
+        """Run audit; returns True if all checked files passed"""
+        conn = index.openIndex(self.indexPath)
+        try:
+            self.startAudit(conn)
+            self.runPool(conn)
+            self.addEarlierResults(conn)
+            if not self.interrupted:
+                self.finished = utcNow()
+                with conn:
+                    conn.execute('UPDATE audits SET finished = ?, noChecked = ?, '
+                                 'noFailed = ? WHERE id = ?',
+                                 (self.finished, self.noChecked + self.noCheckedBefore,
+                                  len(self.failures), self.auditId))
+        finally:
+            conn.close()
+        return not self.failures
+
+    def runPool(self, conn):
+        """Hash files in worker pool, committing results periodically"""
+        pending = {}
+        uncommitted = 0
+        lastCommit = time.monotonic()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.noWorkers,
+                                                         initializer=ioprio.setPriority,
+                                                         initargs=(self.ioPriority,))
+        try:
+            files = findFiles(self.rootDir, self.checksumFileName)
+            exhausted = False
+            while pending or not exhausted:
+                # Keep the queue short, so memory use doesn't grow with the store
+                while not exhausted and len(pending) < 2 * self.noWorkers:
+                    try:
+                        path, expected, checksumFile = next(files)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    if self.isVerified(conn, path, expected):
+                        continue
+                    future = executor.submit(status.job.inherit(checkFile), path, expected,
+                                             self.bucket, self.bufferSize, self.cancelToken)
+                    pending[future] = checksumFile
+                if not pending:
+                    break
+                done, _ = concurrent.futures.wait(pending,
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    self.record(conn, future.result(), pending.pop(future))
+                    uncommitted += 1
+                if (uncommitted >= COMMIT_FILES or
+                        time.monotonic() - lastCommit >= COMMIT_INTERVAL):
+                    conn.commit()
+                    uncommitted = 0
+                    lastCommit = time.monotonic()
+        except KeyboardInterrupt:
+            self.interrupted = True
+            logging.warning('audit interrupted, run again with --resume to continue')
+            # Files that were being hashed are checked again on resume
+            self.cancelToken.cancel()
+        finally:
+            executor.shutdown(wait=not self.interrupted, cancel_futures=True)
+            conn.commit()
+
+    def report(self):
+        """Return machine-readable report as dictionary"""
+        return {'rootDir': self.rootDir,
+                'auditId': self.auditId,
+                'started': self.started,
+                'finished': self.finished,
+                'interrupted': self.interrupted,
+                'resumed': self.resumed,
+                'since': self.since,
+                'filesChecked': self.noChecked + self.noCheckedBefore,
+                'filesCheckedBefore': self.noCheckedBefore,
+                'filesSkipped': self.noSkipped,
+                'bytesRead': self.bytesRead,
+                'failures': self.failures}
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('rootDir',
+                        action='store',
+                        help='output root directory')
+    parser.add_argument('--index', '-i',
+                        action='store',
+                        dest='indexFile',
+                        default=None,
+                        help='index database (default: value from configuration file)')
+    parser.add_argument('--workers', '-w',
+                        action='store',
+                        type=int,
+                        dest='noWorkers',
+                        default=2,
+                        help='number of files that are hashed in parallel')
+    parser.add_argument('--bandwidth', '-b',
+                        action='store',
+                        type=float,
+                        dest='bandwidth',
+                        default=None,
+                        help='maximum total read rate in MB/s (default: hashBandwidth ' +
+                        'from configuration file)')
+    parser.add_argument('--since', '-s',
+                        action='store',
+                        dest='since',
+                        default=None,
+                        help='skip files that passed an audit on or after this (UTC) date')
+    parser.add_argument('--resume', '-r',
+                        action='store_true',
+                        dest='resume',
+                        default=False,
+                        help='resume last unfinished audit of rootDir')
+    parser.add_argument('--report', '-o',
+                        action='store',
+                        dest='reportFile',
+                        default=None,
+                        help='write JSON report to this file (default: stdout)')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Command-line interface to the fixity audit"""
+
+    # Imported here, to keep import of this module light
+    from .disk import Disk
+
+    parser = argparse.ArgumentParser(description='diskimgr fixity audit')
+    args = parseCommandLine(parser)
+
+    disk = Disk()
+    disk.getConfiguration()
+    if not disk.configSuccess:
+        sys.stderr.write('ERROR: cannot read configuration file ' + disk.configFile +
+                         ", run '(sudo) diskimgr-config' to fix this\n")
+        sys.exit(1)
+    indexPath = args.indexFile
+    if indexPath is None:
+        indexPath = disk.indexFile
+
+    bandwidth = disk.hashBandwidth
+    if args.bandwidth is not None:
+        bandwidth = int(args.bandwidth * 1000000)
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    audit = Audit(indexPath, args.rootDir, disk.checksumFileName, args.noWorkers,
+                  bandwidth, disk.nativeBufferSize, args.since, args.resume,
+                  disk.backgroundIOPriority)
+    passedFlag = audit.run()
+    report = audit.report()
+    logging.info('checked ' + str(report['filesChecked']) + ', skipped ' +
+                 str(report['filesSkipped']) + ', failed ' + str(len(report['failures'])))
+
+    if args.reportFile is None:
+        json.dump(report, sys.stdout, indent=4)
+        sys.stdout.write('\n')
+    else:
+        with io.open(args.reportFile, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=4)
+    if not passedFlag or audit.interrupted:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#! /usr/bin/env python3
+"""Fast path for blank media.
+
+Many media arrive blank or factory-filled (all bytes 0x00 or 0xFF). A
+pre-scan reads the same sampled regions as the fingerprint; if they are
+all filled with the same byte, the whole medium is checked with large
+reads and a vectorized uniformity check, which is much faster than
+imaging and hashing it. If the medium is confirmed blank, the image can be
+written as a sparse file (zero fill), written in full from the fill byte
+without reading the medium again, or left out altogether; the metadata
+record the size and fill byte, which is all it takes to recreate it.
+"""
+
+import os
+import time
+import logging
+from . import cancel
+from . import status
+
+# Size of the reads that check the whole medium
+READ_SIZE = 8388608
+# Image output for blank media
+IMAGE_MODES = ['full', 'sparse', 'none']
+
+
+def fillByte(view):
+    """Return the byte that view is filled with, or None if it isn't uniform"""
+    if not view:
+        return None
+    try:
+        # Imported here, so the GUI (which imports this module) starts quickly
+        import numpy
+    except ImportError:
+        numpy = None
+    if numpy is not None:
+        data = numpy.frombuffer(view, dtype=numpy.uint8)
+        if data.min() != data.max():
+            return None
+        return int(data[0])
+    value = view[0]
+    # bytes.count of a single byte runs at memory speed
+    if view.tobytes().count(value) != len(view):
+        return None
+    return value
+
+
+def preScan(source):
+    """Return fill byte if all sampled regions of source are filled with
+    the same byte, and None otherwise"""
+    # Imported here, so the GUI doesn't load it at start-up
+    from . import fingerprint
+    buf = bytearray(max(fingerprint.SAMPLE_SIZE, fingerprint.STRIDE_SIZE))
+    view = memoryview(buf)
+    fill = None
+    for offset, length in fingerprint.sampleRegions(source.size):
+        if source.readinto(view[:length], offset) != length:
+            return None
+        regionFill = fillByte(view[:length])
+        if regionFill is None or (fill is not None and regionFill != fill):
+            return None
+        fill = regionFill
+    return fill
+
+
+def checkMedium(devicePath, cancelToken=None):
+    """Pre-scan device, and if the samples are uniform, check the whole
+    device. Returns dictionary with size and fill byte if the device is
+    blank, and None otherwise (also after a read error, or if cancelToken
+    (cancel.CancelToken) was cancelled)"""
+    # Imported here, so the GUI doesn't load it at start-up
+    from . import pipeline
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
+    t0 = time.perf_counter()
+    try:
+        source = pipeline.openSource(devicePath)
+    except OSError as e:
+        logging.warning('blank check: cannot open ' + devicePath + ': ' + str(e))
+        return None
+    try:
+        if source.size == 0:
+            return None
+        try:
+            fill = preScan(source)
+        except OSError as e:
+            logging.info('blank check: read error in pre-scan (' + str(e) + ')')
+            return None
+        if fill is None:
+            logging.info('blank check: medium is not blank (pre-scan)')
+            return None
+        logging.info('blank check: samples filled with 0x%02x, checking whole medium' % fill)
+
+        buf = bytearray(READ_SIZE)
+        view = memoryview(buf)
+        offset = 0
+        while offset < source.size:
+            if cancelToken.isCancelled():
+                return None
+            noBytes = min(READ_SIZE, source.size - offset)
+            try:
+                bytesRead = source.readinto(view[:noBytes], offset)
+            except OSError as e:
+                logging.info('blank check: read error at offset ' + str(offset) + ' (' +
+                             str(e) + ')')
+                return None
+            if bytesRead == 0 or fillByte(view[:bytesRead]) != fill:
+                logging.info('blank check: medium is not blank (data near offset ' +
+                             str(offset) + ')')
+                return None
+            offset += bytesRead
+            status.job.addBytes(bytesRead)
+    finally:
+        source.close()
+
+    elapsed = time.perf_counter() - t0
+    logging.info('blank check: medium is blank (' + str(source.size) + ' bytes of 0x%02x)'
+                 % fill + ', checked in ' + str(round(elapsed, 3)) + ' s')
+    return {'size': source.size,
+            'fillByte': '0x%02x' % fill,
+            'elapsed': round(elapsed, 3)}
+
+
+def writeImage(imageFile, size, fill, mode):
+    """Write image of a blank medium of size bytes filled with byte fill:
+    'sparse' makes a sparse file (zero fill only, other fills are written
+    in full), 'full' writes every byte, and 'none' writes nothing. Returns
+    the mode that was used. Raises OSError"""
+    if mode == 'none':
+        return mode
+    fd = os.open(imageFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if mode == 'sparse' and fill == 0:
+            os.ftruncate(fd, size)
+            return mode
+        buf = bytes([fill]) * READ_SIZE
+        offset = 0
+        while offset < size:
+            offset += os.pwrite(fd, buf[:min(READ_SIZE, size - offset)], offset)
+    finally:
+        os.close(fd)
+    return 'full'
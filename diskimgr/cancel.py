@@ -0,0 +1,124 @@
+#! /usr/bin/env python3
+"""Per-job cancellation.
+
+Every job has a CancelToken, which is passed to the code that runs it.
+Read loops check the token between reads. External tools (dd, ddrescue)
+are watched by a Supervisor thread, which waits on the token with a
+timeout, so it doesn't depend on the tool writing any output. Once the
+token is cancelled, the supervisor sends SIGINT, and escalates to SIGTERM
+and SIGKILL if the tool doesn't exit within the given deadlines.
+
+The time from the cancel request until the work actually stopped (the
+interrupt latency) is recorded on the token.
+"""
+
+import time
+import signal
+import logging
+import threading
+import subprocess
+from . import status
+
+# Interval at which supervisors check whether their process exited
+POLL_INTERVAL = 0.1
+
+
+class CancelToken:
+    """Cancellation request for one job"""
+
+    def __init__(self):
+        """initialise CancelToken instance"""
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.requestTime = None
+        self.latency = None
+        self.signalsSent = []
+
+    def cancel(self):
+        """Request cancellation; later requests are ignored"""
+        with self.lock:
+            if self.requestTime is None:
+                self.requestTime = time.monotonic()
+                self.event.set()
+
+    def isCancelled(self):
+        """Return True if cancellation was requested"""
+        return self.event.is_set()
+
+    def wait(self, timeout):
+        """Wait up to timeout seconds for cancellation; returns True if
+        cancellation was requested"""
+        return self.event.wait(timeout)
+
+    def reset(self):
+        """Clear cancellation request, before the job is started again"""
+        with self.lock:
+            self.event.clear()
+            self.requestTime = None
+            self.latency = None
+            self.signalsSent = []
+
+    def stopped(self, name):
+        """Record that name stopped after a cancellation request, and log the
+        interrupt latency. Returns the latency in seconds (None if there was
+        no request)"""
+        with self.lock:
+            if self.requestTime is None:
+                return None
+            if self.latency is None:
+                self.latency = time.monotonic() - self.requestTime
+            latency = self.latency
+            signalsSent = list(self.signalsSent)
+        msg = name + ' stopped ' + '%.2f' % latency + ' s after interrupt request'
+        if signalsSent:
+            msg += ' (signals sent: ' + ', '.join(signalsSent) + ')'
+        logging.info(msg, extra={'event': 'interrupted', 'latency': latency})
+        return latency
+
+
+class Supervisor(threading.Thread):
+    """Watches process p, and stops it when cancelToken is cancelled:
+    SIGINT first, SIGTERM if p is still running after termTimeout seconds,
+    and SIGKILL if it is still running killTimeout seconds after that"""
+
+    def __init__(self, p, cancelToken, name, termTimeout=10.0, killTimeout=10.0):
+        """initialise Supervisor instance"""
+        threading.Thread.__init__(self, daemon=True)
+        self.p = p
+        self.cancelToken = cancelToken
+        self.toolName = name
+        self.termTimeout = termTimeout
+        self.killTimeout = killTimeout
+        self.interrupted = False
+        # Logs for the job of the thread that starts it
+        self.watch = status.job.inherit(self.watch)
+
+    def run(self):
+        """Watch process"""
+        self.watch()
+
+    def watch(self):
+        """Wait for exit of process or cancellation, whichever comes first"""
+        while not self.cancelToken.wait(POLL_INTERVAL):
+            if self.p.poll() is not None:
+                return
+        if self.p.poll() is not None:
+            return
+        self.interrupted = True
+        logging.warning('*** ' + self.toolName + ' execution interrupted by user ***')
+        for sig, timeout in [(signal.SIGINT, self.termTimeout),
+                             (signal.SIGTERM, self.killTimeout),
+                             (signal.SIGKILL, None)]:
+            if self.p.poll() is not None:
+                break
+            if sig != signal.SIGINT:
+                logging.warning(self.toolName + ' still running, sending ' + sig.name)
+            self.p.send_signal(sig)
+            with self.cancelToken.lock:
+                self.cancelToken.signalsSent.append(sig.name)
+            if timeout is None:
+                break
+            try:
+                self.p.wait(timeout)
+            except subprocess.TimeoutExpired:
+                pass
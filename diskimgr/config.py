@@ -2,4 +2,3 @@
 """Shared configuration constants"""
 
 version = ''
-interruptFlag = False
@@ -60,6 +60,43 @@ def writeConfigFile(configRootDir, removeFlag):
     configSettings['autoRetry'] = 'False'
     configSettings['timeZone'] = 'Europe/Amsterdam'
     configSettings['defaultDir'] = ''
+    configSettings['nativeBufferSize'] = '1048576'
+    configSettings['nativeMemoryBudget'] = '67108864'
+    configSettings['nativeHashInline'] = 'True'
+    configSettings['nativeKernelCopy'] = 'False'
+    configSettings['targetPreallocate'] = 'True'
+    configSettings['targetSyncInterval'] = '33554432'
+    configSettings['targetDropCache'] = 'True'
+    configSettings['indexFile'] = '~/.local/share/diskimgr/index.sqlite'
+    configSettings['duplicateCheck'] = 'True'
+    configSettings['verifyImage'] = 'False'
+    configSettings['readIOPriority'] = 'be:0'
+    configSettings['backgroundIOPriority'] = 'idle'
+    configSettings['copyBandwidth'] = '0'
+    configSettings['hashBandwidth'] = '0'
+    configSettings['logFlushInterval'] = '1.0'
+    configSettings['structuredLog'] = 'False'
+    configSettings['ddrescueLogInterval'] = '30'
+    configSettings['ddrescueLogStep'] = '1'
+    configSettings['ddrescueFullLog'] = 'False'
+    configSettings['statusAddress'] = ''
+    configSettings['daemonSocket'] = '~/.local/share/diskimgr/daemon.sock'
+    configSettings['queueFile'] = '~/.local/share/diskimgr/queue.json'
+    configSettings['finishWorkers'] = '1'
+    configSettings['daemonOutputRoot'] = ''
+    configSettings['interruptTermTimeout'] = '10'
+    configSettings['interruptKillTimeout'] = '10'
+    configSettings['blockHashSize'] = '0'
+    configSettings['blockHashAlgorithm'] = 'sha256'
+    configSettings['blankCheck'] = 'False'
+    configSettings['blankImage'] = 'sparse'
+    configSettings['detectLayout'] = 'True'
+    configSettings['entropyRegionSize'] = '0'
+    configSettings['treeHashLeafSize'] = '0'
+    configSettings['treeHashWorkers'] = '0'
+    configSettings['sha512Checksums'] = 'True'
+    configSettings['outputSinks'] = []
+    configSettings['sinkMemoryBudget'] = '268435456'
 
     if not removeFlag:
         # Write to configuration file in json format
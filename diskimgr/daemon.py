@@ -0,0 +1,1008 @@
+#! /usr/bin/env python3
+"""Imaging daemon: runs imaging jobs from a queue, independently of any GUI.
+
+Clients talk to the daemon over a local Unix socket, with one JSON object
+per line. Requests are {"command": ...} objects:
+
+submit  {"job": {...}}   add a job to the queue; returns its id
+list                     return all jobs
+cancel  {"id": ...}      cancel a queued job, or interrupt a running one
+status                   return status of the reading job and of the
+                         jobs that finish in the background
+attach  {"id": ...}      stream events (all jobs, if id is not given)
+
+The socket is only accessible to its owner and group. Clients other than
+the daemon's own user may only cancel their own jobs, and jobs can only
+write where the submitting user may write (and, if daemonOutputRoot is
+set in the configuration file, only below that directory), so access to
+a daemon that runs as root doesn't give root's write access.
+
+Events are {"event": "job" | "log" | "status" | "heartbeat", ...} objects.
+Clients can attach and detach at any time; jobs keep running. Jobs read
+one at a time. Once a job has read its medium, the rest of it (output
+sinks, checksums, metadata) can run in the background (state 'finishing')
+while the next job reads; finishWorkers in the configuration file limits
+how many jobs finish at the same time. The queue is saved to disk after
+every change. Jobs that were running when the
+daemon stopped are queued again on the next start; native and ddrescue
+jobs then resume from their map file, once the fingerprint of the medium
+in the drive matches the one taken when the job started (otherwise the
+job fails). Jobs that were finishing are marked failed instead: their
+medium was already read, and may have been swapped since.
+"""
+
+import os
+import io
+import re
+import sys
+import pwd
+import json
+import stat
+import uuid
+import queue
+import signal
+import socket
+import struct
+import shutil
+import time
+import logging
+import argparse
+import datetime
+import threading
+import socketserver
+from . import asynclog
+from . import cancel
+from . import config
+from . import status
+from .diskimgr import __version__
+
+# Job fields that are copied to the Disk instance
+JOB_FIELDS = ['dirOut', 'blockDevice', 'readMethod', 'retries', 'blockSize', 'prefix',
+              'extension', 'identifier', 'description', 'notes', 'rescueDirectDiscMode',
+              'autoRetry', 'previousAcquisition', 'outputSinks']
+FINAL_STATES = ['finished', 'failed', 'interrupted', 'cancelled']
+# Maximum number of events that are kept for a slow client
+CLIENT_QUEUE_SIZE = 1000
+STATUS_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 5.0
+
+
+def timeStamp():
+    """Return local date / time as ISO string"""
+    return datetime.datetime.now().astimezone().isoformat()
+
+
+class JobQueue:
+    """List of jobs, saved to queueFile after every change"""
+
+    def __init__(self, queueFile):
+        """initialise JobQueue instance"""
+        self.queueFile = queueFile
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def load(self):
+        """Load jobs from queueFile; jobs that were running are queued again,
+        and jobs that were finishing fail"""
+        try:
+            with io.open(self.queueFile, 'r', encoding='utf-8') as f:
+                self.jobs = json.load(f)['jobs']
+        except FileNotFoundError:
+            self.jobs = []
+        for job in self.jobs:
+            if job['state'] == 'finishing':
+                # Reading it again could image another medium into its directory
+                job['state'] = 'failed'
+                job['errors'] = ['daemon stopped while the job was finishing; the image ' +
+                                 'was read, but checksums and metadata may be missing']
+                job['finished'] = timeStamp()
+            elif job['state'] == 'running':
+                job['state'] = 'queued'
+                if job.get('readMethod') == 'dd':
+                    # dd can't resume, so its partial image is overwritten
+                    job['overwrite'] = True
+
+    def save(self):
+        """Write jobs to queueFile (called with lock held)"""
+        queueDir = os.path.dirname(self.queueFile)
+        if queueDir and not os.path.isdir(queueDir):
+            os.makedirs(queueDir)
+        tempFile = self.queueFile + '.tmp'
+        with io.open(tempFile, 'w', encoding='utf-8') as f:
+            json.dump({'jobs': self.jobs}, f, indent=4)
+        os.replace(tempFile, self.queueFile)
+
+    def add(self, job):
+        """Add job to queue"""
+        with self.lock:
+            self.jobs.append(job)
+            self.save()
+            self.changed.notify_all()
+
+    def update(self, jobId, **fields):
+        """Update fields of job, and return a copy of it"""
+        with self.lock:
+            job = self.find(jobId)
+            job.update(fields)
+            self.save()
+            self.changed.notify_all()
+            return dict(job)
+
+    def find(self, jobId):
+        """Return job with jobId, or None (called with lock held)"""
+        for job in self.jobs:
+            if job['id'] == jobId:
+                return job
+        return None
+
+    def get(self, jobId):
+        """Return copy of job with jobId, or None"""
+        with self.lock:
+            job = self.find(jobId)
+            return dict(job) if job is not None else None
+
+    def list(self):
+        """Return copies of all jobs"""
+        with self.lock:
+            return [dict(job) for job in self.jobs]
+
+    def next(self, timeout):
+        """Return (copy of) first queued job, waiting up to timeout seconds"""
+        with self.lock:
+            for _ in range(2):
+                for job in self.jobs:
+                    if job['state'] == 'queued':
+                        return dict(job)
+                self.changed.wait(timeout)
+        return None
+
+
+class EventBus:
+    """Passes events on to attached clients, without ever blocking"""
+
+    def __init__(self):
+        """initialise EventBus instance"""
+        self.lock = threading.Lock()
+        self.clients = []
+
+    def subscribe(self, jobId=None):
+        """Return new client queue for events of jobId (or all jobs)"""
+        q = queue.Queue(CLIENT_QUEUE_SIZE)
+        with self.lock:
+            self.clients.append((q, jobId))
+        return q
+
+    def unsubscribe(self, q):
+        """Remove client queue"""
+        with self.lock:
+            self.clients = [c for c in self.clients if c[0] is not q]
+
+    def publish(self, event):
+        """Send event to all interested clients; events for clients that
+        can't keep up are dropped"""
+        with self.lock:
+            clients = list(self.clients)
+        for q, jobId in clients:
+            if jobId is None or jobId == event.get('job'):
+                try:
+                    q.put_nowait(event)
+                except queue.Full:
+                    pass
+
+
+class EventHandler(logging.Handler):
+    """Publishes log records of the running job as events"""
+
+    def __init__(self, bus, jobId):
+        """initialise EventHandler instance"""
+        logging.Handler.__init__(self)
+        self.bus = bus
+        self.jobId = jobId
+
+    def emit(self, record):
+        """Publish record"""
+        self.bus.publish({'event': 'log',
+                          'job': self.jobId,
+                          'level': record.levelname,
+                          'message': record.getMessage()})
+
+
+class Daemon:
+    """Runs queued jobs, and serves clients. Jobs read one at a time, and
+    up to finishWorkers jobs finish in the background (0: jobs run one after
+    another from start to end)"""
+
+    def __init__(self, socketPath, queueFile, finishWorkers=0, outputRoot=''):
+        """initialise Daemon instance"""
+        self.socketPath = socketPath
+        # If set, jobs only write below this directory
+        self.outputRoot = os.path.realpath(outputRoot) if outputRoot else ''
+        self.uid = os.getuid()
+        self.queue = JobQueue(queueFile)
+        self.bus = EventBus()
+        self.runningJob = None
+        # Cancellation token of the job that reads, and tokens of all jobs by id
+        self.cancelToken = cancel.CancelToken()
+        self.cancelTokens = {}
+        # Jobs that finish in the background, and their status by job id
+        self.finishWorkers = finishWorkers
+        self.finishSlots = threading.BoundedSemaphore(max(1, finishWorkers))
+        self.finishStates = {}
+        self.finishThreads = []
+        self.stopFlag = False
+        self.server = None
+
+    def submit(self, fields, peer=None):
+        """Add job with fields to queue for client with credentials peer
+        ((uid, gid); default: the daemon's own user); returns the job.
+        Raises ValueError if the job may not write where it would"""
+        if peer is None:
+            peer = (self.uid, os.getgid())
+        errors = self.pathErrors(fields, *peer)
+        if errors:
+            raise ValueError('; '.join(errors))
+        job = {key: fields[key] for key in JOB_FIELDS if key in fields}
+        job['uid'] = peer[0]
+        job['compare'] = bool(fields.get('compare', False))
+        job['overwrite'] = bool(fields.get('overwrite', False))
+        job['id'] = uuid.uuid4().hex[:12]
+        job['state'] = 'queued'
+        job['submitted'] = timeStamp()
+        self.queue.add(job)
+        self.bus.publish({'event': 'job', 'job': job['id'], 'record': job})
+        return job
+
+    def pathErrors(self, fields, uid, gid):
+        """Return list of errors for the paths that a job with fields would
+        write to, for a client with uid and gid"""
+        errors = []
+        # File name parts must not lead out of the output directory
+        for key in ['identifier', 'prefix', 'extension']:
+            value = str(fields.get(key, ''))
+            if '/' in value or value in ['.', '..']:
+                errors.append(key + ' must not be a path: ' + value)
+        paths = [('output directory', str(fields.get('dirOut', '')))]
+        for spec in fields.get('outputSinks') or []:
+            # Imported here, to keep startup of the client commands light
+            from . import sinks
+            try:
+                template = sinks.parseSpec(spec)[2]
+            except ValueError:
+                # Reported by the validation of the job
+                continue
+            if template != '-':
+                # Placeholders stand for file name parts (see above)
+                paths.append(('output sink', re.sub(r'\{[^}]*\}', 'x', template)))
+        for name, path in paths:
+            if not os.path.isabs(path):
+                errors.append(name + ' must be an absolute path: ' + path)
+                continue
+            realPath = os.path.realpath(path)
+            if self.outputRoot and os.path.commonpath([realPath, self.outputRoot]) != \
+                    self.outputRoot:
+                errors.append(name + ' ' + path + ' is not in ' + self.outputRoot)
+            elif uid != self.uid and not canWrite(realPath, uid, gid):
+                errors.append('no permission to write ' + name + ' ' + path)
+        return errors
+
+    def cancel(self, jobId, peer=None):
+        """Cancel queued job, or interrupt running job, for client with
+        credentials peer; returns True on success"""
+        job = self.queue.get(jobId)
+        if job is None or job['state'] in FINAL_STATES:
+            return False
+        if peer is not None and peer[0] not in [0, self.uid, job.get('uid')]:
+            return False
+        if job['state'] == 'queued':
+            job = self.queue.update(jobId, state='cancelled', finished=timeStamp())
+            self.bus.publish({'event': 'job', 'job': jobId, 'record': job})
+        else:
+            self.queue.update(jobId, cancelRequested=True)
+            cancelToken = self.cancelTokens.get(jobId)
+            if cancelToken is not None:
+                cancelToken.cancel()
+        return True
+
+    def setJobState(self, jobId, **fields):
+        """Update job, and tell clients about it; returns a copy of the job"""
+        job = self.queue.update(jobId, **fields)
+        self.bus.publish({'event': 'job', 'job': jobId, 'record': job})
+        return job
+
+    def recordJob(self, record):
+        """Return id of the job that log record belongs to. Called from the
+        thread that logs it, which is tagged with its job id (see
+        status.ThreadJobState.inherit); untagged threads belong to the job
+        that reads"""
+        jobId = status.job.tag
+        return jobId if jobId is not None else self.runningJob
+
+    def publishStatus(self, jobId, state, done):
+        """Publish status of job (state: status.JobState) until done is set"""
+        while not done.wait(STATUS_INTERVAL):
+            event = state.snapshot()
+            event['event'] = 'status'
+            event['job'] = jobId
+            self.bus.publish(event)
+
+    def checkMedium(self, job):
+        """Fingerprint the medium in the device of job, and store it with the
+        job. A job that was started before (and is resumed after a restart)
+        must find the same medium; returns list of errors"""
+        # Imported here, to keep startup of the client commands light
+        from . import fingerprint
+
+        try:
+            mediumFingerprint = fingerprint.computeFingerprint(job['blockDevice'])
+        except OSError as e:
+            if 'fingerprint' in job:
+                return ['cannot check medium in ' + job['blockDevice'] + ': ' + str(e)]
+            # Reported by the validation of the job
+            return []
+        if 'fingerprint' not in job:
+            self.queue.update(job['id'], fingerprint=mediumFingerprint)
+        elif job['fingerprint'] != mediumFingerprint:
+            return ['medium in ' + job['blockDevice'] + ' is not the one this job ' +
+                    'started reading (swapped while the daemon was stopped?); insert ' +
+                    'that medium and submit the job again']
+        return []
+
+    def prepareDisk(self, job):
+        """Return Disk instance for job, and list of errors"""
+        # Imported here, to keep startup of the client commands light
+        from .disk import Disk
+
+        disk = Disk()
+        disk.getConfiguration()
+        if not disk.configSuccess:
+            return disk, ['cannot read configuration file ' + disk.configFile]
+        for key in JOB_FIELDS:
+            if key in job:
+                setattr(disk, key, job[key])
+        disk.retries = str(disk.retries if 'retries' in job else disk.retriesDefault)
+        disk.blockSize = str(disk.blockSize)
+        disk.autoRetry = str(disk.autoRetry) == 'True'
+        # An automatic retry reads the same medium, so no duplicate check
+        disk.skipDuplicateCheck = job.get('autoRetried', False)
+        if job['compare']:
+            disk.compareFlag = True
+        try:
+            disk.validateInput()
+        except OSError as e:
+            return disk, [str(e)]
+        errors = disk.validationErrors()
+        if errors or job['compare']:
+            return disk, errors
+
+        # Same rules for existing output as in the GUI
+        nativeResumeFlag = disk.readMethod == 'native' and os.path.isfile(disk.mapFile)
+        if disk.outputExistsFlag and (disk.readMethod == 'dd' or
+                                      (disk.readMethod == 'native' and not nativeResumeFlag)):
+            if not job['overwrite']:
+                return disk, ['output exists in ' + disk.dirOut + ' (submit with overwrite)']
+            for fileName in [disk.imageFile, disk.mapFile]:
+                try:
+                    os.remove(fileName)
+                except OSError:
+                    pass
+        elif disk.outputExistsFlag and disk.readMethod == 'ddrescue':
+            if not os.path.isfile(disk.mapFile):
+                try:
+                    os.remove(disk.imageFile)
+                except OSError:
+                    pass
+        return disk, errors
+
+    def runJob(self, job):
+        """Run one job with the same Disk logic as the GUI. With finish
+        workers, the job is handed to a background thread once it has read
+        its medium"""
+        jobId = job['id']
+        self.cancelToken = cancel.CancelToken()
+        if self.stopFlag:
+            self.cancelToken.cancel()
+        self.cancelTokens[jobId] = self.cancelToken
+        self.runningJob = jobId
+        # Threads that this job starts (e.g. sink writers, which carry on
+        # while it finishes) log for this job
+        status.job.bind(None, jobId)
+        self.setJobState(jobId, state='running', started=timeStamp())
+        eventHandler = EventHandler(self.bus, jobId)
+        eventHandler.addFilter(lambda record: self.recordJob(record) == jobId)
+        logger = logging.getLogger()
+        logger.addHandler(eventHandler)
+        logListener = None
+        handedOverFlag = False
+        try:
+            # Before prepareDisk, which may remove the output of an earlier run
+            errors = self.checkMedium(job)
+            if errors:
+                for error in errors:
+                    logging.error(error)
+                self.setJobState(jobId, state='failed', errors=errors, finished=timeStamp())
+                return
+            disk, errors = self.prepareDisk(job)
+            disk.cancelToken = self.cancelToken
+            if errors:
+                for error in errors:
+                    logging.error(error)
+                self.setJobState(jobId, state='failed', errors=errors, finished=timeStamp())
+                return
+            try:
+                logListener = asynclog.startLogging(disk.logFile, disk.structuredLogFile,
+                                                    disk.logFlushInterval,
+                                                    recordFilter=lambda record:
+                                                    self.recordJob(record) == jobId)
+            except OSError as e:
+                self.setJobState(jobId, state='failed', finished=timeStamp(),
+                                 errors=['cannot write log file: ' + str(e)])
+                return
+
+            while True:
+                done = threading.Event()
+                ticker = threading.Thread(target=self.publishStatus,
+                                          args=(jobId, status.job, done), daemon=True)
+                ticker.start()
+                try:
+                    if job['compare']:
+                        disk.compareDuplicate()
+                    else:
+                        results = disk.readDisk()
+                finally:
+                    done.set()
+                if job['compare'] or not self.needsRetry(disk):
+                    break
+                # Same as the GUI: finish this pass, and read again with ddrescue
+                disk.finishDisk(results)
+                logging.info('read errors, retrying automatically with ddrescue')
+                if disk.readMethod == 'dd':
+                    # Move files that were created by dd pass to subdirectory
+                    failedDir = os.path.join(disk.dirOut, 'dd-failed')
+                    os.makedirs(failedDir, exist_ok=True)
+                    for fileName in [disk.imageFile, disk.metadataFile, disk.checksumFile]:
+                        if os.path.exists(fileName):
+                            shutil.move(fileName, failedDir)
+                # The native read method leaves a ddrescue map file, so ddrescue
+                # simply continues where it stopped
+                job = self.setJobState(jobId, readMethod='ddrescue', autoRetried=True)
+                disk, errors = self.prepareDisk(job)
+                disk.cancelToken = self.cancelToken
+                if errors:
+                    for error in errors:
+                        logging.error(error)
+                    self.setJobState(jobId, state='failed', errors=errors,
+                                     finished=timeStamp())
+                    return
+
+            if not job['compare'] and self.finishWorkers > 0 and not disk.interruptedFlag:
+                # The device is free for the next job; waits if all workers are busy
+                self.finishSlots.acquire()
+                status.job.reset()
+                self.setJobState(jobId, state='finishing', successFlag=disk.successFlag,
+                                 readErrorFlag=disk.readErrorFlag,
+                                 interruptedFlag=disk.interruptedFlag)
+                finisher = threading.Thread(target=self.finishJob,
+                                            args=(job, disk, results, eventHandler,
+                                                  logListener),
+                                            name='finish-' + jobId)
+                self.finishThreads = [t for t in self.finishThreads if t.is_alive()]
+                self.finishThreads.append(finisher)
+                finisher.start()
+                handedOverFlag = True
+                return
+            if not job['compare']:
+                disk.finishDisk(results)
+            self.completeJob(job, disk)
+        except Exception as e:
+            # Keep the daemon alive whatever goes wrong in a job
+            logging.exception('job ' + jobId + ' failed')
+            self.setJobState(jobId, state='failed', errors=[str(e)], finished=timeStamp())
+        finally:
+            if not handedOverFlag:
+                self.endJob(jobId, eventHandler, logListener)
+            status.job.unbind()
+            self.runningJob = None
+
+    def needsRetry(self, disk):
+        """Return True if a dd or native read in disk (Disk instance) had
+        errors, and is to be retried with ddrescue (autoRetry)"""
+        return (disk.autoRetry and disk.readErrorFlag and not disk.interruptedFlag and
+                disk.readMethod in ['dd', 'native'])
+
+    def finishJob(self, job, disk, results, eventHandler, logListener):
+        """Finisher thread: finish job that has read its medium, with its own
+        status"""
+        jobId = job['id']
+        state = status.JobState()
+        state.begin(disk.identifier, disk.blockDevice, disk.readMethod, disk.imageFile,
+                    disk.deviceSize)
+        status.job.bind(state, jobId)
+        self.finishStates[jobId] = state
+        done = threading.Event()
+        ticker = threading.Thread(target=self.publishStatus, args=(jobId, state, done),
+                                  daemon=True)
+        ticker.start()
+        try:
+            disk.finishDisk(results)
+            # The medium was read, so the job is never queued to read it again
+            self.completeJob(job, disk, requeueFlag=False)
+        except Exception as e:
+            # Keep the daemon alive whatever goes wrong in a job
+            logging.exception('job ' + jobId + ' failed')
+            self.setJobState(jobId, state='failed', errors=[str(e)], finished=timeStamp())
+        finally:
+            done.set()
+            status.job.unbind()
+            del self.finishStates[jobId]
+            self.endJob(jobId, eventHandler, logListener)
+            self.finishSlots.release()
+
+    def completeJob(self, job, disk, requeueFlag=True):
+        """Set final state of job from the results in disk (Disk instance). An
+        interrupted job is queued again if the daemon is stopping, unless
+        requeueFlag is False"""
+        fields = {'successFlag': disk.successFlag,
+                  'readErrorFlag': disk.readErrorFlag,
+                  'interruptedFlag': disk.interruptedFlag,
+                  'finished': timeStamp()}
+        if job['compare']:
+            fields['successFlag'] = disk.duplicateMatchFlag
+        if disk.interruptedFlag and self.stopFlag and requeueFlag:
+            # Daemon is stopping: run the job again on the next start
+            fields = {'state': 'queued'}
+            if disk.readMethod == 'dd':
+                fields['overwrite'] = True
+        elif disk.interruptedFlag:
+            fields['state'] = 'interrupted'
+        else:
+            fields['state'] = 'finished'
+        self.setJobState(job['id'], **fields)
+
+    def endJob(self, jobId, eventHandler, logListener):
+        """Stop sending log records of job to its clients and log files"""
+        logging.getLogger().removeHandler(eventHandler)
+        if logListener is not None:
+            asynclog.stopLogging(logListener)
+        del self.cancelTokens[jobId]
+
+    def runJobs(self):
+        """Runner thread: run queued jobs until the daemon stops"""
+        while not self.stopFlag:
+            job = self.queue.next(1.0)
+            if job is not None and not self.stopFlag:
+                self.runJob(job)
+
+    def handleRequest(self, request, wfile, peer=None):
+        """Handle one client request from client with credentials peer
+        ((uid, gid)); returns response, or None if the request was handled
+        by streaming events"""
+        command = request.get('command')
+        if command == 'submit':
+            try:
+                job = self.submit(request.get('job', {}), peer)
+            except ValueError as e:
+                return {'ok': False, 'error': str(e)}
+            return {'ok': True, 'id': job['id']}
+        if command == 'list':
+            return {'ok': True, 'jobs': self.queue.list()}
+        if command == 'cancel':
+            return {'ok': self.cancel(request.get('id'), peer)}
+        if command == 'status':
+            state = status.job.snapshot()
+            state['job'] = self.runningJob
+            finishing = []
+            for jobId, jobState in list(self.finishStates.items()):
+                finishing.append(dict(jobState.snapshot(), job=jobId))
+            return {'ok': True, 'status': state, 'finishing': finishing}
+        if command == 'attach':
+            self.streamEvents(request.get('id'), wfile)
+            return None
+        return {'ok': False, 'error': 'unknown command: ' + str(command)}
+
+    def streamEvents(self, jobId, wfile):
+        """Send events to client until it goes away (or its job ends)"""
+        q = self.bus.subscribe(jobId)
+        try:
+            writeLine(wfile, {'ok': True})
+            if jobId is not None:
+                job = self.queue.get(jobId)
+                if job is None:
+                    return
+                writeLine(wfile, {'event': 'job', 'job': jobId, 'record': job})
+                if job['state'] in FINAL_STATES:
+                    return
+            while not self.stopFlag:
+                try:
+                    event = q.get(timeout=HEARTBEAT_INTERVAL)
+                except queue.Empty:
+                    event = {'event': 'heartbeat'}
+                writeLine(wfile, event)
+                if (jobId is not None and event['event'] == 'job' and
+                        event['record']['state'] in FINAL_STATES):
+                    return
+        except OSError:
+            # Client detached
+            pass
+        finally:
+            self.bus.unsubscribe(q)
+
+    def serve(self):
+        """Run daemon until SIGTERM or SIGINT"""
+        self.queue.load()
+        with self.queue.lock:
+            self.queue.save()
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Reads requests, one JSON object per line"""
+
+            def handle(self):
+                """Handle client connection"""
+                peer = peerCredentials(self.request)
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        writeLine(self.wfile, {'ok': False, 'error': 'invalid request'})
+                        continue
+                    response = daemon.handleRequest(request, self.wfile, peer)
+                    if response is None:
+                        break
+                    try:
+                        writeLine(self.wfile, response)
+                    except OSError:
+                        break
+
+        socketDir = os.path.dirname(self.socketPath)
+        if socketDir and not os.path.isdir(socketDir):
+            os.makedirs(socketDir)
+        if os.path.exists(self.socketPath):
+            if isRunning(self.socketPath):
+                raise OSError('daemon already running on ' + self.socketPath)
+            os.remove(self.socketPath)
+        socketserver.ThreadingUnixStreamServer.daemon_threads = True
+        # Operators in the socket's group can use the daemon as well; the
+        # socket is created with these permissions, so others never get in
+        oldUmask = os.umask(0o117)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.socketPath, Handler)
+        finally:
+            os.umask(oldUmask)
+
+        def stop(signum, frame):
+            """Interrupt running job, and stop serving"""
+            self.stopFlag = True
+            self.cancelToken.cancel()
+            threading.Thread(target=self.server.shutdown).start()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        runner = threading.Thread(target=self.runJobs)
+        runner.start()
+        try:
+            self.server.serve_forever()
+        finally:
+            runner.join()
+            # Jobs that finish in the background are completed
+            for finisher in self.finishThreads:
+                finisher.join()
+            self.server.server_close()
+            os.remove(self.socketPath)
+
+
+def peerCredentials(sock):
+    """Return (uid, gid) of the process on the other end of Unix socket sock"""
+    creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    _, uid, gid = struct.unpack('3i', creds)
+    return uid, gid
+
+
+def canWrite(path, uid, gid):
+    """Return True if user uid (primary group gid) may write path, or create
+    it; judged by the permissions of path or of its nearest existing parent"""
+    if uid == 0:
+        return True
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    st = os.stat(path)
+    try:
+        groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+    except KeyError:
+        groups = [gid]
+    if st.st_uid == uid:
+        return bool(st.st_mode & stat.S_IWUSR)
+    if st.st_gid in groups:
+        return bool(st.st_mode & stat.S_IWGRP)
+    return bool(st.st_mode & stat.S_IWOTH)
+
+
+def writeLine(wfile, message):
+    """Write message as one JSON line"""
+    wfile.write((json.dumps(message) + '\n').encode('utf-8'))
+    wfile.flush()
+
+
+def connect(socketPath, timeout=None):
+    """Return socket connected to daemon"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(socketPath)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def request(socketPath, message):
+    """Send request to daemon, and return its response"""
+    with connect(socketPath, 10) as sock:
+        sock.sendall((json.dumps(message) + '\n').encode('utf-8'))
+        with sock.makefile('rb') as f:
+            return json.loads(f.readline().decode('utf-8'))
+
+
+def submitJob(socketPath, fields):
+    """Submit job with fields to daemon; returns its id. Raises ValueError
+    if the daemon refuses the job"""
+    response = request(socketPath, {'command': 'submit', 'job': fields})
+    if not response['ok']:
+        raise ValueError('job refused: ' + response['error'])
+    return response['id']
+
+
+def isRunning(socketPath):
+    """Return True if a daemon answers on socketPath"""
+    try:
+        return request(socketPath, {'command': 'status'}).get('ok', False)
+    except (OSError, ValueError):
+        return False
+
+
+def attach(socketPath, jobId=None, timeout=None):
+    """Generate events from daemon (for jobId, or for all jobs). With a
+    timeout, None is generated whenever no event arrived in time"""
+    with connect(socketPath) as sock:
+        sock.sendall((json.dumps({'command': 'attach', 'id': jobId}) + '\n').encode('utf-8'))
+        sock.settimeout(timeout)
+        buf = b''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            if not data:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                message = json.loads(line.decode('utf-8'))
+                if 'event' in message:
+                    yield message
+
+
+def printEvent(event):
+    """Write event to stdout in readable form"""
+    if event['event'] == 'log':
+        sys.stdout.write(event['level'] + ': ' + event['message'] + '\n')
+    elif event['event'] == 'job':
+        record = event['record']
+        sys.stdout.write('job ' + record['id'] + ': ' + record['state'] + '\n')
+    elif event['event'] == 'status':
+        eta = event['eta']
+        sys.stdout.write('status: ' + event['phase'] + ', ' + str(event['bytesDone']) +
+                         ' of ' + str(event['totalBytes']) + ' bytes, ' +
+                         str(event['readErrors']) + ' read errors' +
+                         (', ' + str(eta) + ' s left' if eta is not None else '') + '\n')
+    sys.stdout.flush()
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('--socket', '-s',
+                        action='store',
+                        dest='socketPath',
+                        default=None,
+                        help='daemon socket (default: value from configuration file)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    subparsers.add_parser('serve', help='run the daemon')
+
+    parserSubmit = subparsers.add_parser('submit', help='add imaging job to queue')
+    parserSubmit.add_argument('dirOut', action='store', help='output directory')
+    parserSubmit.add_argument('blockDevice', action='store', help='block device')
+    addJobArguments(parserSubmit)
+    parserSubmit.add_argument('--identifier', '-i', action='store', dest='identifier')
+    parserSubmit.add_argument('--previous', action='store', dest='previousAcquisition',
+                              help='earlier acquisition of the medium; only blocks that ' +
+                              'changed since are written (native read method only)')
+    parserSubmit.add_argument('--compare', action='store_true', dest='compare',
+                              default=False,
+                              help='compare medium against earlier acquisition')
+    parserSubmit.add_argument('--overwrite', action='store_true', dest='overwrite',
+                              default=False, help='overwrite existing output')
+    parserSubmit.add_argument('--attach', '-a', action='store_true', dest='attachFlag',
+                              default=False, help='follow job after submitting it')
+
+    parserWatch = subparsers.add_parser('watch', help='queue a job for every medium ' +
+                                        'that is inserted')
+    parserWatch.add_argument('rootDir', action='store',
+                             help='directory in which an output directory is made for ' +
+                             'every medium')
+    parserWatch.add_argument('--profile', '-p', action='store', dest='profile',
+                             help='JSON file with job settings (e.g. readMethod, retries, ' +
+                             'prefix); options override it')
+    addJobArguments(parserWatch)
+    parserWatch.add_argument('--match', action='store', dest='pattern', default='*',
+                             help='only watch devices whose name matches this pattern ' +
+                             '(e.g. sd*)')
+    parserWatch.add_argument('--include-fixed', action='store_true', dest='includeFixed',
+                             default=False,
+                             help='also watch devices that are not removable (many USB ' +
+                             'hard disks)')
+    parserWatch.add_argument('--interval', action='store', type=float, dest='interval',
+                             default=1.0, help='poll interval in seconds (default: 1)')
+
+    subparsers.add_parser('list', help='list jobs')
+
+    parserCancel = subparsers.add_parser('cancel', help='cancel or interrupt job')
+    parserCancel.add_argument('id', action='store', help='job id')
+
+    parserAttach = subparsers.add_parser('attach', help='follow job (or all jobs)')
+    parserAttach.add_argument('id', action='store', nargs='?', default=None, help='job id')
+
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def addJobArguments(parser):
+    """Add the job settings that submit and watch share to parser"""
+    parser.add_argument('--method', '-m', action='store', dest='readMethod',
+                        choices=['dd', 'ddrescue', 'native'])
+    parser.add_argument('--retries', '-r', action='store', dest='retries')
+    parser.add_argument('--blocksize', '-b', action='store', dest='blockSize')
+    parser.add_argument('--prefix', action='store', dest='prefix')
+    parser.add_argument('--extension', action='store', dest='extension')
+    parser.add_argument('--description', '-d', action='store', dest='description')
+    parser.add_argument('--notes', '-n', action='store', dest='notes')
+    parser.add_argument('--direct', action='store_true', dest='rescueDirectDiscMode',
+                        default=None, help='direct disc mode')
+    parser.add_argument('--autoretry', action='store_true', dest='autoRetry',
+                        default=None, help='retry with ddrescue after a dd or native ' +
+                        'read with errors')
+    parser.add_argument('--sink', action='append', dest='outputSinks',
+                        help='secondary output (TYPE:PATH, see readme); may be ' +
+                        'repeated, replaces the sinks in the configuration file')
+
+
+def watchMedia(socketPath, rootDir, fields, watcher, interval):
+    """Queue a job with fields for every medium that watcher reports, in a
+    new output directory in rootDir; Ctrl+C stops watching"""
+    # Imported here, to keep startup of the other client commands light
+    from . import shared
+
+    sys.stdout.write('watching for media, Ctrl+C stops\n')
+    sys.stdout.flush()
+    try:
+        while True:
+            for devicePath, noBytes in watcher.poll():
+                identifier = shared.generateIdentifier()
+                dirOut = os.path.join(rootDir, identifier)
+                os.makedirs(dirOut)
+                job = dict(fields, blockDevice=devicePath, dirOut=dirOut, identifier=identifier)
+                jobId = submitJob(socketPath, job)
+                sys.stdout.write('\t'.join([jobId, devicePath,
+                                            shared.sizeof_fmt(noBytes), dirOut]) + '\n')
+                sys.stdout.flush()
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        sys.stdout.write('stopped watching\n')
+
+
+def follow(socketPath, jobId):
+    """Print events of job until it ends; Ctrl+C detaches"""
+    try:
+        for event in attach(socketPath, jobId):
+            printEvent(event)
+    except KeyboardInterrupt:
+        sys.stdout.write('detached\n')
+
+
+def main():
+    """Daemon and command-line client"""
+
+    # Imported here, to keep import of this module light
+    from .disk import Disk
+
+    parser = argparse.ArgumentParser(description='diskimgr imaging daemon')
+    args = parseCommandLine(parser)
+
+    disk = Disk()
+    disk.getConfiguration()
+    if not disk.configSuccess:
+        sys.stderr.write('ERROR: cannot read configuration file ' + disk.configFile +
+                         ", run '(sudo) diskimgr-config' to fix this\n")
+        sys.exit(1)
+    socketPath = args.socketPath
+    if socketPath is None:
+        socketPath = disk.daemonSocket
+
+    if args.command == 'serve':
+        # Version is shown in the log of every job
+        config.version = __version__
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+        try:
+            Daemon(socketPath, disk.queueFile, disk.finishWorkers,
+                   disk.daemonOutputRoot).serve()
+        except OSError as e:
+            sys.stderr.write('ERROR: ' + str(e) + '\n')
+            sys.exit(1)
+        return
+
+    try:
+        if args.command == 'submit':
+            fields = {key: getattr(args, key) for key in JOB_FIELDS + ['compare', 'overwrite']
+                      if getattr(args, key, None) is not None}
+            fields.setdefault('readMethod', 'ddrescue')
+            fields['dirOut'] = os.path.abspath(args.dirOut)
+            if args.previousAcquisition is not None:
+                fields['previousAcquisition'] = os.path.abspath(args.previousAcquisition)
+            try:
+                jobId = submitJob(socketPath, fields)
+            except ValueError as e:
+                sys.stderr.write('ERROR: ' + str(e) + '\n')
+                sys.exit(1)
+            sys.stdout.write(jobId + '\n')
+            if args.attachFlag:
+                follow(socketPath, jobId)
+        elif args.command == 'watch':
+            # Imported here, to keep startup of the other client commands light
+            from . import watch
+            fields = {}
+            if args.profile is not None:
+                try:
+                    with io.open(args.profile, 'r', encoding='utf-8') as f:
+                        fields = json.load(f)
+                except (OSError, ValueError) as e:
+                    sys.stderr.write('ERROR: cannot read profile ' + args.profile + ': ' +
+                                     str(e) + '\n')
+                    sys.exit(1)
+                if not isinstance(fields, dict):
+                    sys.stderr.write('ERROR: profile ' + args.profile +
+                                     ' is not a JSON object\n')
+                    sys.exit(1)
+            fields.update({key: getattr(args, key) for key in JOB_FIELDS
+                           if getattr(args, key, None) is not None})
+            fields.setdefault('readMethod', 'ddrescue')
+            if not isRunning(socketPath):
+                raise OSError('no daemon running')
+            watcher = watch.Watcher(includeFixed=args.includeFixed, pattern=args.pattern)
+            watchMedia(socketPath, os.path.abspath(args.rootDir), fields, watcher,
+                       args.interval)
+        elif args.command == 'list':
+            response = request(socketPath, {'command': 'list'})
+            for job in response['jobs']:
+                sys.stdout.write('\t'.join([job['id'], job['state'], str(job.get('identifier')),
+                                            str(job.get('readMethod')), job['blockDevice'],
+                                            job['dirOut']]) + '\n')
+        elif args.command == 'cancel':
+            if not request(socketPath, {'command': 'cancel', 'id': args.id})['ok']:
+                sys.stderr.write('ERROR: no queued or running job ' + args.id +
+                                 ' of yours\n')
+                sys.exit(1)
+        elif args.command == 'attach':
+            follow(socketPath, args.id)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('ERROR: cannot connect to daemon on ' + socketPath + ': ' +
+                         str(e) + '\n')
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
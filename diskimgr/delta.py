@@ -0,0 +1,353 @@
+#! /usr/bin/env python3
+"""Delta re-imaging: images a medium that was imaged before, writing
+only the blocks that changed since the earlier acquisition.
+
+The new image starts as a copy of the earlier image (a reflink where the
+file system supports it, so no data are copied at all). The medium is
+then read block by block, and each block is compared against the earlier
+image's block-hash manifest (or, if there is none, against the earlier
+image itself). Only blocks that differ are written to the new image, so
+a job is bounded by the read speed of the medium plus the size of the
+change. The changed byte ranges are reported. With a manifest, the blocks
+that are taken from the copy are checked against the data read from the
+medium as well, so damage that the earlier image picked up after its
+manifest was made is repaired instead of inherited.
+"""
+
+import os
+import io
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import logging
+from . import cancel
+from . import manifest
+from . import pipeline
+from . import shared
+from . import simdevice
+from . import targetio
+from . import throttle
+
+# ioctl that clones a whole file (reflink), from linux/fs.h
+FICLONE = 0x40049409
+# Size of compared blocks if the earlier image has no manifest
+COMPARE_SIZE = 1048576
+
+
+def cloneFile(fileIn, fileOut):
+    """Copy fileIn to fileOut, as a reflink if possible; returns name of
+    the method that was used. Raises OSError"""
+    with io.open(fileIn, 'rb') as fIn, io.open(fileOut, 'wb') as fOut:
+        try:
+            fcntl.ioctl(fOut.fileno(), FICLONE, fIn.fileno())
+            return 'reflink'
+        except OSError:
+            # Not supported (e.g. ext4), or across file systems
+            pass
+        size = os.fstat(fIn.fileno()).st_size
+        offset = 0
+        try:
+            while offset < size:
+                copied = os.copy_file_range(fIn.fileno(), fOut.fileno(), size - offset,
+                                            offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+            if offset == size:
+                return 'copy_file_range'
+        except (OSError, AttributeError):
+            pass
+        fIn.seek(0)
+        fOut.seek(0)
+        fOut.truncate()
+        shutil.copyfileobj(fIn, fOut, COMPARE_SIZE)
+        return 'copy'
+
+
+def findPrevious(previousDir, metadataFileName):
+    """Return (image file, metadata) of the acquisition in previousDir.
+    Raises OSError or ValueError"""
+    metadataFile = os.path.join(previousDir, metadataFileName)
+    with io.open(metadataFile, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    imageFile = os.path.join(previousDir, str(metadata.get('prefix')) + '.' +
+                             str(metadata.get('extension')))
+    if not os.path.isfile(imageFile):
+        raise ValueError('no image of earlier acquisition in ' + previousDir)
+    if not metadata.get('successFlag'):
+        raise ValueError('earlier acquisition in ' + previousDir + ' was not successful')
+    return imageFile, metadata
+
+
+class DeltaWriter(pipeline.Consumer):
+    """Compares buffers against the earlier image, and writes blocks that
+    differ to the image file. If previousManifest (manifest.Manifest) is
+    set, blocks are compared by digest, otherwise against the bytes of
+    previousImage. The image file must start as a copy of previousImage"""
+
+    name = 'delta-writer'
+
+    def __init__(self, path, previousImage, previousManifest=None, compareSize=COMPARE_SIZE,
+                 syncInterval=0, dropCache=False):
+        """initialise DeltaWriter instance"""
+        self.path = path
+        self.previousImage = previousImage
+        self.previousManifest = previousManifest
+        self.compareSize = compareSize
+        if previousManifest is not None:
+            self.compareSize = previousManifest.blockSize
+        self.syncInterval = syncInterval
+        self.dropCache = dropCache
+        self.previousSize = 0
+        self.fd = None
+        self.fdPrevious = None
+        self.writeBehind = None
+        self.changedRanges = []
+        self.repairedRanges = []
+        self.bytesCompared = 0
+
+    def open(self):
+        """Open image file and earlier image"""
+        # Read as well, to check the blocks that are kept against the medium
+        self.fd = os.open(self.path, os.O_RDWR)
+        self.writeBehind = targetio.WriteBehind(self.fd, self.syncInterval, self.dropCache)
+        if self.previousManifest is None:
+            self.fdPrevious = os.open(self.previousImage, os.O_RDONLY)
+            self.previousSize = os.fstat(self.fdPrevious).st_size
+        else:
+            self.previousSize = self.previousManifest.imageSize
+
+    def changed(self, data, offset):
+        """Return True if block data at offset differs from the earlier image"""
+        if offset + len(data) > self.previousSize:
+            return True
+        if self.previousManifest is not None:
+            block = offset // self.compareSize
+            return (hashlib.new(self.previousManifest.algorithm, data).digest() !=
+                    self.previousManifest.digest(block))
+        return os.pread(self.fdPrevious, len(data), offset) != data
+
+    def process(self, view, offset):
+        """Write blocks in view that changed"""
+        end = offset + len(view)
+        while offset < end:
+            # Blocks are aligned to compareSize in the image
+            noBytes = min(self.compareSize - offset % self.compareSize, end - offset)
+            block = view[:noBytes]
+            if self.changed(block, offset):
+                self.write(block, offset, self.changedRanges)
+            elif (self.previousManifest is not None and
+                  os.pread(self.fd, noBytes, offset) != block):
+                # The copy doesn't match its manifest (bit rot in the earlier image)
+                self.write(block, offset, self.repairedRanges)
+            self.bytesCompared += noBytes
+            view = view[noBytes:]
+            offset += noBytes
+
+    def write(self, view, offset, ranges):
+        """Write block to image file, and record its range in ranges"""
+        length = len(view)
+        start = offset
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+        self.writeBehind.written(start, length)
+        if ranges and sum(ranges[-1]) == start:
+            ranges[-1][1] += length
+        else:
+            ranges.append([start, length])
+
+    def close(self):
+        """Flush and close files"""
+        if self.fdPrevious is not None:
+            os.close(self.fdPrevious)
+            self.fdPrevious = None
+        if self.fd is not None:
+            try:
+                self.writeBehind.finish()
+            finally:
+                os.close(self.fd)
+                self.fd = None
+
+
+def readDelta(blockDevice, imageFile, previousDir, metadataFileName, bufferSize,
+              memoryBudget, hashAlgorithms, syncInterval=0, dropCache=False, bandwidth=0,
+              cancelToken=None, blockHashSize=0, blockHashAlgorithm='sha256',
+              extraConsumers=None):
+    """Image blockDevice to imageFile, writing only the blocks that differ
+    from the acquisition in previousDir; returns the same items as
+    native.readNative. Digests in hashAlgorithms and a block-hash manifest
+    (if blockHashSize is set) of the new image are computed inline. Reads
+    are limited to bandwidth bytes/s (0: unlimited). extraConsumers
+    (pipeline consumers, e.g. layout.LayoutProbe or sinks.FileSink) see all
+    data that are read. A read error ends the run (use a full read to
+    rescue a damaged medium)"""
+
+    errorFlag = False
+    interruptedFlag = False
+    exitStatus = 0
+    stats = {'checksums': {}}
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
+
+    args = ['native']
+    args.append('if=' + blockDevice)
+    args.append('of=' + imageFile)
+    args.append('bs=' + str(bufferSize))
+    args.append('mem=' + str(memoryBudget))
+    args.append('delta=' + previousDir)
+    if bandwidth > 0:
+        args.append('rate=' + str(bandwidth))
+    cmdLine = ' '.join(args)
+    logging.info('Command: ' + cmdLine)
+
+    try:
+        previousImage, previousMetadata = findPrevious(previousDir, metadataFileName)
+    except (OSError, ValueError) as e:
+        logging.error('cannot use earlier acquisition: ' + str(e))
+        return cmdLine, 1, errorFlag, interruptedFlag, stats
+
+    previousManifest = None
+    manifestFile = previousImage + manifest.MANIFEST_SUFFIX
+    if os.path.isfile(manifestFile):
+        try:
+            previousManifest = manifest.readManifest(manifestFile)
+        except (OSError, ValueError) as e:
+            logging.warning('cannot read block-hash manifest, comparing against image: ' +
+                            str(e))
+        if (previousManifest is not None and
+                previousManifest.imageSize != os.path.getsize(previousImage)):
+            logging.warning('block-hash manifest does not match earlier image, ' +
+                            'comparing against image')
+            previousManifest = None
+
+    try:
+        source = pipeline.openSource(blockDevice)
+    except OSError as e:
+        logging.error('cannot open ' + blockDevice + ': ' + str(e))
+        return cmdLine, 1, True, interruptedFlag, stats
+
+    device = source
+    if bandwidth > 0:
+        source = throttle.ThrottledSource(source,
+                                          throttle.TokenBucket(bandwidth,
+                                                               max(bandwidth, bufferSize)))
+
+    t0 = time.perf_counter()
+    try:
+        cloneMethod = cloneFile(previousImage, imageFile)
+        # The medium may have shrunk or grown since
+        os.truncate(imageFile, source.size)
+    except OSError as e:
+        source.close()
+        logging.error('cannot copy earlier image to ' + imageFile + ': ' + str(e))
+        return cmdLine, 1, errorFlag, interruptedFlag, stats
+    cloneTime = time.perf_counter() - t0
+    logging.info('delta: earlier image ' + previousImage + ' copied by ' + cloneMethod +
+                 ' in ' + str(round(cloneTime, 3)) + ' s')
+
+    writer = DeltaWriter(imageFile, previousImage, previousManifest, COMPARE_SIZE,
+                         syncInterval, dropCache)
+    # Buffers hold whole compared blocks
+    bufferSize = max(writer.compareSize, bufferSize - bufferSize % writer.compareSize)
+    logging.info('delta: comparing blocks of ' + str(writer.compareSize) + ' bytes against ' +
+                 ('block-hash manifest' if previousManifest is not None else 'earlier image'))
+    hashers = [pipeline.Hasher(algorithm) for algorithm in hashAlgorithms]
+    consumers = [writer] + hashers
+    blockHasher = None
+    if blockHashSize > 0:
+        blockHasher = manifest.BlockHasher(blockHashSize, blockHashAlgorithm)
+        consumers.append(blockHasher)
+    if extraConsumers is not None:
+        consumers += extraConsumers
+    p = pipeline.Pipeline(source, consumers, bufferSize, memoryBudget, cancelToken=cancelToken)
+    try:
+        p.run()
+    finally:
+        source.close()
+
+    interruptedFlag = p.interrupted
+    if interruptedFlag:
+        logging.warning('*** native read interrupted by user ***')
+        cancelToken.stopped('native read')
+    for offset, noBytes, error in p.readErrors:
+        logging.error('read error at offset ' + str(offset) + ' (' +
+                      str(noBytes) + ' bytes): ' + error)
+    for name, error in p.consumerErrors:
+        exitStatus = 1
+        logging.error(name + ' error: ' + error)
+    if p.readErrors or (p.bytesRead != source.size and not interruptedFlag):
+        errorFlag = True
+
+    bytesChanged = sum(length for offset, length in writer.changedRanges)
+    rate = p.bytesRead / p.elapsed if p.elapsed > 0 else 0
+    logging.info('native bytes read: ' + str(p.bytesRead))
+    logging.info('native throughput: ' + shared.sizeof_fmt(rate) + '/s',
+                 extra={'event': 'readSummary', 'bytesRead': p.bytesRead, 'rate': round(rate),
+                        'errors': len(p.readErrors)})
+    logging.info('delta: ' + str(bytesChanged) + ' bytes changed in ' +
+                 str(len(writer.changedRanges)) + ' ranges')
+    bytesRepaired = sum(length for offset, length in writer.repairedRanges)
+    if bytesRepaired:
+        logging.warning('delta: earlier image does not match its block-hash manifest in ' +
+                        str(len(writer.repairedRanges)) + ' ranges (' + str(bytesRepaired) +
+                        ' bytes), taken from the medium instead')
+    for name, stageStats in p.stats().items():
+        logging.info('native stage ' + name + ': ' + str(stageStats['stalls']) +
+                     ' stalls, ' + str(stageStats['stallTime']) + ' s stalled, ' +
+                     str(stageStats['busyTime']) + ' s busy')
+    stats['deviceSize'] = source.size
+    stats['bytesRead'] = p.bytesRead
+    stats['elapsed'] = round(p.elapsed, 3)
+    stats['throughput'] = round(rate)
+    stats['bufferSize'] = bufferSize
+    stats['copyMethod'] = 'delta'
+    stats['noBuffers'] = p.ring.noBuffers
+    stats['stages'] = p.stats()
+    stats['bottleneck'] = p.bottleneck()
+    if isinstance(device, simdevice.SimulatedDevice):
+        stats['simulatedDevice'] = device.stats()
+        stats['deviceTime'] = device.simulatedTime
+    if bandwidth > 0:
+        stats['throttleWait'] = round(source.bucket.waitTime, 3)
+    stats['delta'] = {'previousAcquisition': previousDir,
+                      'previousIdentifier': previousMetadata.get('identifier'),
+                      'previousImage': os.path.basename(previousImage),
+                      'cloneMethod': cloneMethod,
+                      'cloneTime': round(cloneTime, 3),
+                      'compareMethod': 'manifest' if previousManifest is not None else 'image',
+                      'compareSize': writer.compareSize,
+                      'bytesCompared': writer.bytesCompared,
+                      'bytesChanged': bytesChanged,
+                      'changedRanges': writer.changedRanges,
+                      'bytesRepaired': bytesRepaired,
+                      'repairedRanges': writer.repairedRanges}
+
+    # Inline digests are only valid if the whole medium was read
+    checksums = {}
+    inlineValid = not errorFlag and exitStatus == 0 and not interruptedFlag
+    if inlineValid:
+        for hasher in hashers:
+            checksums[hasher.algorithm] = hasher.hexdigest()
+    stats['checksums'] = checksums
+    if inlineValid and blockHasher is not None:
+        manifestFile = imageFile + manifest.MANIFEST_SUFFIX
+        try:
+            blockHasher.manifest().write(manifestFile)
+        except IOError:
+            logging.error('error while writing block-hash manifest ' + manifestFile)
+            try:
+                os.remove(manifestFile)
+            except OSError:
+                pass
+
+    if exitStatus == 0:
+        logging.info('native status: ' + str(exitStatus))
+    else:
+        logging.error('native status: ' + str(exitStatus))
+    logging.info('native errorFlag: ' + str(errorFlag))
+
+    return cmdLine, exitStatus, errorFlag, interruptedFlag, stats
@@ -9,9 +9,20 @@ import json
 import time
 import logging
 import glob
+import hashlib
 import pathlib
 from shutil import which
+from . import blank
+from . import cancel
 from . import wrappers
+from . import ioprio
+from . import layout
+from . import manifest
+from . import simdevice
+from . import sinks
+from . import status
+from . import targetio
+from . import treehash
 from . import config
 from . import shared
 
@@ -37,12 +48,89 @@ class Disk:
         self.identifier = ''
         self.description = ''
         self.notes = ''
+        # Native read method settings
+        self.nativeBufferSize = 1048576
+        self.nativeMemoryBudget = 67108864
+        self.nativeHashInline = True
+        self.nativeKernelCopy = False
+        # Target I/O settings
+        self.targetPreallocate = True
+        self.targetSyncInterval = 33554432
+        self.targetDropCache = True
+        # Acquisition index (empty string disables indexing)
+        self.indexFile = os.path.expanduser('~/.local/share/diskimgr/index.sqlite')
+        # Duplicate medium detection
+        self.duplicateCheck = True
+        self.skipDuplicateCheck = False
+        self.fingerprint = ''
+        self.duplicates = []
+        self.compareFlag = False
+        self.duplicateMatchFlag = False
+        # Check for blank media before reading, and image output for blank media
+        # ('full', 'sparse' or 'none')
+        self.blankCheck = False
+        self.blankImage = 'sparse'
+        # Detect partition table and file systems while reading
+        self.detectLayout = True
+        # Region size of entropy map (0: no map; native read method only)
+        self.entropyRegionSize = 0
+        # Earlier acquisition of the same medium; if set, the native read method
+        # only writes blocks that changed since (delta re-imaging)
+        self.previousAcquisition = ''
+        # Secondary outputs (sink specs, see sinks.py), and memory budget
+        # (bytes) of each sink
+        self.outputSinks = []
+        self.sinkMemoryBudget = 268435456
+        # Verification of image against medium after reading
+        self.verifyImage = False
+        # I/O priorities of the device read and of everything that follows it,
+        # and bandwidth limits (bytes/s, 0 means unlimited)
+        self.readIOPriority = 'be:0'
+        self.backgroundIOPriority = 'idle'
+        self.copyBandwidth = 0
+        self.hashBandwidth = 0
+        # Log file flush interval (seconds), and JSON-lines log next to the log file
+        self.logFlushInterval = 1.0
+        self.structuredLog = False
+        self.structuredLogFile = ''
+        # ddrescue status updates are logged every ddrescueLogInterval seconds or
+        # ddrescueLogStep percent, unless ddrescueFullLog is True
+        self.ddrescueLogInterval = 30.0
+        self.ddrescueLogStep = 1.0
+        self.ddrescueFullLog = False
+        # Address of local status endpoint ('host:port' or 'unix:/path'; empty: disabled)
+        self.statusAddress = ''
+        # Imaging daemon socket, and file where the daemon keeps its job queue
+        self.daemonSocket = os.path.expanduser('~/.local/share/diskimgr/daemon.sock')
+        self.queueFile = os.path.expanduser('~/.local/share/diskimgr/queue.json')
+        # Number of daemon jobs that finish (checksums, metadata) in the background
+        # while the next job reads (0: jobs run one after another)
+        self.finishWorkers = 1
+        # If set, daemon jobs only write below this directory
+        self.daemonOutputRoot = ''
+        # Cancellation of this job. dd / ddrescue get SIGTERM if they are still running
+        # interruptTermTimeout seconds after SIGINT, and SIGKILL interruptKillTimeout
+        # seconds after that
+        self.cancelToken = cancel.CancelToken()
+        self.interruptTermTimeout = 10.0
+        self.interruptKillTimeout = 10.0
+        # Block size and algorithm of block-hash manifest (0: no manifest)
+        self.blockHashSize = 0
+        self.blockHashAlgorithm = 'sha256'
+        # Leaf size of BLAKE2b tree hash (0: no tree hash), number of threads that
+        # hash leaves (0: number of cores), and whether the (serial) SHA-512
+        # checksums are computed
+        self.treeHashLeafSize = 0
+        self.treeHashWorkers = 0
+        self.sha512Checksums = True
         # Input validation flags
         self.dirOutIsDirectory = False
         self.outputExistsFlag = False
         self.deviceExistsFlag = False
+        self.simulatedDeviceFlag = False
         self.dirOutIsWritable = False
         self.insufficientSpaceFlag = False
+        self.deviceSize = 0
         # Flags that define if dependencies are installed
         self.ddrescueInstalled = False
         self.ddInstalled = False
@@ -66,6 +154,7 @@ class Disk:
         self.finishedFlag = False
         self.successFlag = True
         self.deviceAccessibleFlag = False
+        self.previousAcquisitionFlag = False
         self.interruptedFlag = False
         self.readErrorFlag = False
         self.configSuccess = True
@@ -105,6 +194,87 @@ class Disk:
             except KeyError:
                 self.configSuccess = False
 
+            # Native read method settings are optional, so older
+            # configuration files remain valid
+            try:
+                self.nativeBufferSize = int(configDict.get('nativeBufferSize',
+                                                           self.nativeBufferSize))
+                self.nativeMemoryBudget = int(configDict.get('nativeMemoryBudget',
+                                                             self.nativeMemoryBudget))
+                self.nativeHashInline = bool(configDict.get('nativeHashInline',
+                                                            str(self.nativeHashInline)) == "True")
+                self.nativeKernelCopy = bool(configDict.get('nativeKernelCopy',
+                                                            str(self.nativeKernelCopy)) == "True")
+                self.targetPreallocate = bool(configDict.get('targetPreallocate',
+                                                             str(self.targetPreallocate)) == "True")
+                self.targetSyncInterval = int(configDict.get('targetSyncInterval',
+                                                             self.targetSyncInterval))
+                self.targetDropCache = bool(configDict.get('targetDropCache',
+                                                           str(self.targetDropCache)) == "True")
+                self.indexFile = os.path.expanduser(configDict.get('indexFile', self.indexFile))
+                self.duplicateCheck = bool(configDict.get('duplicateCheck',
+                                                          str(self.duplicateCheck)) == "True")
+                self.verifyImage = bool(configDict.get('verifyImage',
+                                                       str(self.verifyImage)) == "True")
+                self.readIOPriority = configDict.get('readIOPriority', self.readIOPriority)
+                self.backgroundIOPriority = configDict.get('backgroundIOPriority',
+                                                           self.backgroundIOPriority)
+                ioprio.parsePriority(self.readIOPriority)
+                ioprio.parsePriority(self.backgroundIOPriority)
+                self.copyBandwidth = int(configDict.get('copyBandwidth', self.copyBandwidth))
+                self.hashBandwidth = int(configDict.get('hashBandwidth', self.hashBandwidth))
+                self.logFlushInterval = float(configDict.get('logFlushInterval',
+                                                             self.logFlushInterval))
+                self.structuredLog = bool(configDict.get('structuredLog',
+                                                         str(self.structuredLog)) == "True")
+                self.ddrescueLogInterval = float(configDict.get('ddrescueLogInterval',
+                                                                self.ddrescueLogInterval))
+                self.ddrescueLogStep = float(configDict.get('ddrescueLogStep',
+                                                            self.ddrescueLogStep))
+                self.ddrescueFullLog = bool(configDict.get('ddrescueFullLog',
+                                                           str(self.ddrescueFullLog)) == "True")
+                self.statusAddress = configDict.get('statusAddress', self.statusAddress)
+                self.daemonSocket = os.path.expanduser(configDict.get('daemonSocket',
+                                                                      self.daemonSocket))
+                self.queueFile = os.path.expanduser(configDict.get('queueFile', self.queueFile))
+                self.finishWorkers = int(configDict.get('finishWorkers', self.finishWorkers))
+                self.daemonOutputRoot = os.path.expanduser(configDict.get('daemonOutputRoot',
+                                                                          self.daemonOutputRoot))
+                self.interruptTermTimeout = float(configDict.get('interruptTermTimeout',
+                                                                 self.interruptTermTimeout))
+                self.interruptKillTimeout = float(configDict.get('interruptKillTimeout',
+                                                                 self.interruptKillTimeout))
+                self.blockHashSize = int(configDict.get('blockHashSize', self.blockHashSize))
+                self.blockHashAlgorithm = configDict.get('blockHashAlgorithm',
+                                                         self.blockHashAlgorithm)
+                # Raises ValueError if the algorithm is not supported
+                hashlib.new(self.blockHashAlgorithm)
+                self.treeHashLeafSize = int(configDict.get('treeHashLeafSize',
+                                                           self.treeHashLeafSize))
+                self.treeHashWorkers = int(configDict.get('treeHashWorkers',
+                                                          self.treeHashWorkers))
+                self.blankCheck = bool(configDict.get('blankCheck',
+                                                      str(self.blankCheck)) == "True")
+                self.blankImage = configDict.get('blankImage', self.blankImage)
+                if self.blankImage not in blank.IMAGE_MODES:
+                    raise ValueError('invalid blankImage value ' + self.blankImage)
+                self.detectLayout = bool(configDict.get('detectLayout',
+                                                        str(self.detectLayout)) == "True")
+                self.entropyRegionSize = int(configDict.get('entropyRegionSize',
+                                                            self.entropyRegionSize))
+                self.sha512Checksums = bool(configDict.get('sha512Checksums',
+                                                           str(self.sha512Checksums)) == "True")
+                if self.treeHashLeafSize > 0:
+                    treehash.checkLeafSize(self.treeHashLeafSize)
+                self.outputSinks = list(configDict.get('outputSinks', self.outputSinks))
+                for spec in self.outputSinks:
+                    # Raises ValueError if the spec is invalid
+                    sinks.parseSpec(spec)
+                self.sinkMemoryBudget = int(configDict.get('sinkMemoryBudget',
+                                                           self.sinkMemoryBudget))
+            except ValueError:
+                self.configSuccess = False
+
 
     def validateInput(self):
         """Validate and pre-process input"""
@@ -130,9 +300,11 @@ class Disk:
         self.ddVersion = wrappers.getVersion(['dd'])
         self.ddRescueVersion = wrappers.getVersion(['ddrescue'])
 
-        # Check if selected block device exists
+        # Check if selected block device exists (a simulated device spec
+        # file can stand in for a block device with the native read method)
         p = pathlib.Path(self.blockDevice)
-        self.deviceExistsFlag = p.is_block_device()
+        self.simulatedDeviceFlag = simdevice.isSpecFile(self.blockDevice)
+        self.deviceExistsFlag = p.is_block_device() or self.simulatedDeviceFlag
 
         # Check if device is accessible
         try:
@@ -142,11 +314,36 @@ class Disk:
         except OSError:
             self.deviceAccessibleFlag = False
 
+        # Fingerprint medium, and look it up in the index of earlier acquisitions
+        if self.duplicateCheck and self.deviceAccessibleFlag and not self.skipDuplicateCheck:
+            # Imported here, so the GUI doesn't load them at start-up
+            import sqlite3
+            from . import fingerprint
+            from . import index
+            self.duplicates = []
+            try:
+                self.fingerprint = fingerprint.computeFingerprint(self.blockDevice)
+            except OSError:
+                self.fingerprint = ''
+            if self.fingerprint and self.indexFile and os.path.isfile(self.indexFile):
+                try:
+                    matches = index.query(self.indexFile, fingerprint=self.fingerprint,
+                                          success=True)
+                except sqlite3.Error:
+                    matches = []
+                # An earlier run of this job (e.g. before a retry) is no duplicate
+                dirOut = os.path.realpath(self.dirOut)
+                self.duplicates = [m for m in matches
+                                   if os.path.realpath(m['dirOut']) != dirOut]
+
         # Check size of block device against available disk space
-        sizeDevice = shared.getDeviceSize(self.blockDevice)
+        if self.simulatedDeviceFlag:
+            self.deviceSize = simdevice.deviceSize(self.blockDevice)
+        else:
+            self.deviceSize = shared.getDeviceSize(self.blockDevice)
         st = os.statvfs(self.dirOut)
         sizeAvailable = st.f_bavail * st.f_frsize
-        self.insufficientSpaceFlag = sizeDevice >= sizeAvailable
+        self.insufficientSpaceFlag = self.deviceSize >= sizeAvailable
         #if sizeDevice >= sizeAvailable:
         #    self.insufficientSpaceFlag = True
 
@@ -156,14 +353,73 @@ class Disk:
         # Ddrescue map file
         self.mapFile = os.path.join(self.dirOut, self.prefix + '.map')
 
+        # Earlier acquisition for delta re-imaging (must not be the output directory)
+        if self.previousAcquisition:
+            previousMetadata = os.path.join(self.previousAcquisition, self.metadataFileName)
+            self.previousAcquisitionFlag = (os.path.isfile(previousMetadata) and
+                                            os.path.realpath(self.previousAcquisition) !=
+                                            os.path.realpath(self.dirOut))
+
         # Log file
         self.logFile = os.path.join(self.dirOut, self.logFileName)
+        if self.structuredLog:
+            self.structuredLogFile = os.path.splitext(self.logFile)[0] + '.jsonl'
+
+    def validationErrors(self):
+        """Return list of messages for input that didn't pass validateInput"""
+        errors = []
+        if not self.dirOutIsDirectory:
+            errors.append("Output directory doesn't exist:\n" + self.dirOut)
+        if not self.dirOutIsWritable:
+            errors.append('Cannot write to directory ' + self.dirOut)
+        if not self.deviceExistsFlag:
+            errors.append('Selected device does not exist')
+        if self.simulatedDeviceFlag and self.readMethod != 'native':
+            errors.append('Simulated devices can only be read with the native read method')
+        if self.simulatedDeviceFlag and self.autoRetry:
+            errors.append('Simulated devices cannot be retried automatically (ddrescue '
+                          'cannot read them)')
+        if not self.deviceAccessibleFlag:
+            errors.append('Selected device is not accessible')
+        if self.previousAcquisition and self.readMethod != 'native':
+            errors.append('Delta re-imaging only works with the native read method')
+        if self.previousAcquisition and not self.previousAcquisitionFlag:
+            errors.append('No earlier acquisition (other than the output directory) in ' +
+                          self.previousAcquisition)
+        for spec in self.outputSinks:
+            try:
+                sinks.parseSpec(spec)
+            except ValueError as e:
+                errors.append(str(e))
+        if self.insufficientSpaceFlag:
+            errors.append('Size of ' + self.blockDevice + ' exceeds available space in ' +
+                          self.dirOut)
+        # Only the tools of the selected read method (and of the automatic
+        # ddrescue retry) are needed
+        if self.readMethod == 'dd' and not self.ddInstalled:
+            errors.append("dd not installed!")
+        needsDdrescue = (self.readMethod == 'ddrescue' or
+                         (self.readMethod in ['dd', 'native'] and self.autoRetry))
+        if needsDdrescue and not self.ddrescueInstalled:
+            errors.append("ddrescue not installed!\n"
+                          "install with:\n"
+                          "'sudo apt install gddrescue'")
+        return errors
 
     def processDisk(self):
         """Process a disk"""
+        self.finishDisk(self.readDisk())
 
-        # Create dictionary for storing metadata (which are later written to file)
-        metadata = {}
+    def readDisk(self):
+        """Read the disk and verify the image against it. Returns dictionary
+        with the results that finishDisk needs; everything after this only
+        uses the image, so the device is free for the next medium"""
+
+        # Imported here, so the GUI doesn't load them at start-up
+        from . import delta
+        from . import entropy
+        from . import native
+        from . import verify
 
         # Write some general info to log file
         logging.info('***************************')
@@ -174,51 +430,321 @@ class Disk:
         logging.info('dirOut: ' + self.dirOut)
         logging.info('blockDevice: ' + self.blockDevice)
         logging.info('readMethod: ' + self.readMethod)
+        if self.previousAcquisition:
+            logging.info('previous acquisition (delta re-imaging): ' + self.previousAcquisition)
         logging.info('maxRetries: ' + str(self.retries))
         logging.info('prefix: ' + self.prefix)
         logging.info('extension: ' + self.extension)
         logging.info('direct disc mode (ddrescue only): ' + str(self.rescueDirectDiscMode))
         logging.info('automatically retry with ddrescue on dd failure: ' + str(self.autoRetry))
+        logging.info('preallocate image file: ' + str(self.targetPreallocate))
+        logging.info('write-behind sync interval: ' + str(self.targetSyncInterval))
+        logging.info('drop written pages from cache: ' + str(self.targetDropCache))
+        logging.info('read I/O priority: ' + self.readIOPriority)
+        logging.info('background I/O priority: ' + self.backgroundIOPriority)
+        logging.info('copy bandwidth limit: ' + str(self.copyBandwidth))
+        logging.info('hash bandwidth limit: ' + str(self.hashBandwidth))
+        logging.info('block-hash manifest block size: ' + str(self.blockHashSize))
+        logging.info('SHA-512 checksums: ' + str(self.sha512Checksums))
+        logging.info('tree hash leaf size: ' + str(self.treeHashLeafSize))
+        for spec in self.outputSinks:
+            logging.info('output sink: ' + spec)
+        logging.info('interrupt: SIGTERM after ' + str(self.interruptTermTimeout) +
+                     ' s, SIGKILL after another ' + str(self.interruptKillTimeout) + ' s')
 
         ## Acquisition start date/time
         acquisitionStart = shared.generateDateTime(self.timeZone)
 
         # Unmount disk
-        logging.info('*** Unmounting medium ***')
-        args = ['umount', self.blockDevice]
-        wrappers.umount(args)
+        if not self.simulatedDeviceFlag:
+            logging.info('*** Unmounting medium ***')
+            args = ['umount', self.blockDevice]
+            wrappers.umount(args)
         
-        logging.info('*** Starting image acquisition ***')
-        if self.readMethod == "dd":
-            args = ['dd']
+        status.job.begin(self.identifier, self.blockDevice, self.readMethod,
+                         self.imageFile, self.deviceSize)
+        status.job.setPhase('reading')
+        logging.info('*** Starting image acquisition ***',
+                     extra={'event': 'acquisitionStart'})
+        # Threads and processes started from here inherit the priority. If
+        # it can't be set, run dd / ddrescue under ionice instead
+        ionice = []
+        if not ioprio.setPriority(self.readIOPriority):
+            ionice = ioprio.ioniceArgs(self.readIOPriority)
+
+        # Blank media don't need to be imaged
+        blankInfo = None
+        if self.blankCheck and not self.previousAcquisition:
+            logging.info('*** Checking for blank medium ***')
+            blankInfo = blank.checkMedium(self.blockDevice, self.cancelToken)
+            if blankInfo is None:
+                # Reading starts from zero
+                status.job.setPhase('reading')
+
+        # Analysis stages and sinks, fed with the buffers of the native read method
+        extraConsumers = []
+        layoutProbe = None
+        if self.detectLayout and blankInfo is None:
+            layoutProbe = layout.LayoutProbe()
+            extraConsumers.append(layoutProbe)
+        entropyMapper = None
+        if self.entropyRegionSize > 0 and self.readMethod == 'native' and blankInfo is None:
+            entropyMapper = entropy.EntropyMapper(self.entropyRegionSize)
+            extraConsumers.append(entropyMapper)
+        elif self.entropyRegionSize > 0 and blankInfo is None:
+            logging.warning('entropy map is only computed by the native read method')
+
+        # Secondary outputs; they take the stream of the native read method,
+        # and are written from the image after reading otherwise
+        outputSinks = []
+        sinkFields = {'identifier': self.identifier,
+                      'prefix': self.prefix,
+                      'extension': self.extension,
+                      'dirName': os.path.basename(os.path.normpath(self.dirOut))}
+        for spec in self.outputSinks:
+            try:
+                outputSinks.append(sinks.fromSpec(spec, sinkFields, self.sinkMemoryBudget))
+            except ValueError as e:
+                logging.error(str(e))
+                self.successFlag = False
+        if blankInfo is None:
+            extraConsumers += outputSinks
+
+        nativeStats = {'checksums': {}}
+        if blankInfo is not None:
+            readCmdLine = ('blank if=' + self.blockDevice + ' of=' + self.imageFile +
+                           ' fill=' + blankInfo['fillByte'] + ' image=' + self.blankImage)
+            logging.info('Command: ' + readCmdLine)
+            try:
+                blankInfo['image'] = blank.writeImage(self.imageFile, blankInfo['size'],
+                                                      int(blankInfo['fillByte'], 16),
+                                                      self.blankImage)
+                readExitStatus = 0
+            except OSError as e:
+                logging.error('cannot write image of blank medium: ' + str(e))
+                readExitStatus = 1
+        elif self.readMethod == "dd":
+            if self.targetPreallocate:
+                targetio.preallocateFile(self.imageFile, self.deviceSize)
+            args = ionice + ['dd']
             args.append('if=' + self.blockDevice)
             args.append('of=' + self.imageFile)
             args.append('bs=' + str(self.blockSize))
-            args.append('conv=notrunc')
-            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = wrappers.dd(args)
+            if self.targetDropCache:
+                # dd has no write-behind control, but it can drop written pages
+                args.append('oflag=nocache')
+                args.append('conv=notrunc,fdatasync')
+            else:
+                args.append('conv=notrunc')
+            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = \
+                wrappers.dd(args, self.cancelToken, self.interruptTermTimeout,
+                            self.interruptKillTimeout)
         elif self.readMethod == "ddrescue":
-            args = ['ddrescue']
+            args = ionice + ['ddrescue']
             if self.rescueDirectDiscMode:
                 args.append('-d')
             args.append('-b')
             args.append(str(self.blockSize))
             args.append('-r' + str(self.retries))
+            if self.targetPreallocate:
+                args.append('-p')
+            if self.copyBandwidth > 0:
+                args.append('--max-read-rate=' + str(self.copyBandwidth))
             args.append('-v')
             args.append(self.blockDevice)
             args.append(self.imageFile)
             args.append(self.mapFile)
-            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = wrappers.ddrescue(args)
-        
+            progressInterval = None
+            if not self.ddrescueFullLog:
+                progressInterval = self.ddrescueLogInterval
+            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag = \
+                wrappers.ddrescue(args, progressInterval, self.ddrescueLogStep,
+                                  self.cancelToken, self.interruptTermTimeout,
+                                  self.interruptKillTimeout)
+        elif self.readMethod == "native" and self.previousAcquisition:
+            hashAlgorithms = []
+            if self.nativeHashInline and self.sha512Checksums:
+                hashAlgorithms.append('sha512')
+            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag, nativeStats = \
+                delta.readDelta(self.blockDevice,
+                                self.imageFile,
+                                self.previousAcquisition,
+                                self.metadataFileName,
+                                self.nativeBufferSize,
+                                self.nativeMemoryBudget,
+                                hashAlgorithms,
+                                self.targetSyncInterval,
+                                self.targetDropCache,
+                                self.copyBandwidth,
+                                self.cancelToken,
+                                self.blockHashSize,
+                                self.blockHashAlgorithm,
+                                extraConsumers)
+        elif self.readMethod == "native":
+            hashAlgorithms = []
+            if self.nativeHashInline and self.sha512Checksums:
+                hashAlgorithms.append('sha512')
+            readCmdLine, readExitStatus, self.readErrorFlag, self.interruptedFlag, nativeStats = \
+                native.readNative(self.blockDevice,
+                                  self.imageFile,
+                                  int(self.blockSize),
+                                  self.nativeBufferSize,
+                                  self.nativeMemoryBudget,
+                                  hashAlgorithms,
+                                  self.targetPreallocate,
+                                  self.targetSyncInterval,
+                                  self.targetDropCache,
+                                  self.nativeKernelCopy,
+                                  self.mapFile,
+                                  int(self.retries),
+                                  self.rescueDirectDiscMode,
+                                  self.copyBandwidth,
+                                  self.cancelToken,
+                                  self.blockHashSize,
+                                  self.blockHashAlgorithm,
+                                  extraConsumers)
+
         if readExitStatus != 0:
             self.successFlag = False
 
         if self.readErrorFlag or self.interruptedFlag:
             self.successFlag = False
 
+        # Verification and hashing shouldn't get in the way of other reads
+        ioprio.setPriority(self.backgroundIOPriority)
+
+        # Verify image against medium (only makes sense if the read went well)
+        verification = None
+        if self.verifyImage and self.successFlag and blankInfo is None:
+            status.job.setPhase('verifying')
+            imageChecksum = None
+            if self.readMethod == "native":
+                imageChecksum = nativeStats['checksums'].get('sha512')
+            verifiedFlag, verification = verify.verifyImage(self.blockDevice,
+                                                            self.imageFile,
+                                                            self.nativeBufferSize,
+                                                            self.nativeMemoryBudget,
+                                                            int(self.blockSize),
+                                                            imageChecksum,
+                                                            self.hashBandwidth,
+                                                            self.cancelToken)
+            if not verifiedFlag:
+                self.successFlag = False
+
+        return {'acquisitionStart': acquisitionStart,
+                'readCmdLine': readCmdLine,
+                'nativeStats': nativeStats,
+                'blankInfo': blankInfo,
+                'layoutProbe': layoutProbe,
+                'entropyMapper': entropyMapper,
+                'outputSinks': outputSinks,
+                'verification': verification}
+
+    def finishDisk(self, results):
+        """Finish output sinks, analysis, checksums and metadata of a disk that
+        was read by readDisk (results is what it returned). May run in
+        another thread than readDisk"""
+
+        # Imported here, so the GUI doesn't load them at start-up
+        import sqlite3
+        from . import entropy
+        from . import index
+        from . import rescue
+
+        acquisitionStart = results['acquisitionStart']
+        readCmdLine = results['readCmdLine']
+        nativeStats = results['nativeStats']
+        blankInfo = results['blankInfo']
+        layoutProbe = results['layoutProbe']
+        entropyMapper = results['entropyMapper']
+        outputSinks = results['outputSinks']
+        verification = results['verification']
+
+        # Create dictionary for storing metadata (which are later written to file)
+        metadata = {}
+
+        # I/O priority is set per thread
+        ioprio.setPriority(self.backgroundIOPriority)
+
+        # Finish secondary outputs; what a sink didn't take from the stream is
+        # filled in from the image
+        sinkResults = []
+        if outputSinks:
+            status.job.setPhase('copying')
+            logging.info('*** Finishing output sinks ***')
+            catchUp = os.path.isfile(self.imageFile) and not self.interruptedFlag
+            for sink in outputSinks:
+                sinkResult = sink.finish(self.imageFile, self.deviceSize, catchUp)
+                sinkResults.append(sinkResult)
+                logging.info('output sink ' + sink.path + ': ' +
+                             str(sinkResult['bytesFromStream']) + ' bytes from stream, ' +
+                             str(sinkResult['bytesFromImage']) + ' bytes from image')
+                if not sinkResult['complete']:
+                    logging.error('output sink ' + sink.path + ' is incomplete' +
+                                  (': ' + sinkResult['error'] if 'error' in sinkResult else ''))
+                    self.successFlag = False
+
+        # Partition table and file systems; whatever didn't stream past the
+        # probe (e.g. with dd / ddrescue) is read from the image
+        imageLayout = None
+        if layoutProbe is not None and os.path.isfile(self.imageFile):
+            logging.info('*** Detecting partitions and file systems ***')
+            imageLayout = layoutProbe.result(self.imageFile)
+            for line in layout.summary(imageLayout):
+                logging.info(line)
+
+        # Entropy map; regions that the read stream didn't cover (kernel copy,
+        # resume, later rescue passes) are taken from the image, and regions
+        # that weren't read (e.g. read errors) are marked unread
+        entropySummary = None
+        if entropyMapper is not None:
+            rescueMap = rescue.RescueMap(self.deviceSize)
+            unreadAreas = []
+            if os.path.isfile(self.mapFile) and rescueMap.read(self.mapFile):
+                unreadAreas = [(pos, size) for pos, size, areaStatus in rescueMap.areas
+                               if areaStatus != rescue.FINISHED]
+            entropySummary = entropyMapper.result(self.deviceSize, self.imageFile, unreadAreas)
+            entropyFile = self.imageFile + entropy.MAP_SUFFIX
+            try:
+                entropyMapper.write(entropyFile)
+                entropySummary['file'] = os.path.basename(entropyFile)
+            except IOError:
+                logging.error('error while writing entropy map ' + entropyFile)
+            logging.info('entropy map: ' + ', '.join(name + ' ' + str(noBytes) + ' bytes' for
+                                                     name, noBytes in
+                                                     entropySummary['bytes'].items()))
+
         # Create checksum file
-        logging.info('*** Creating checksum file ***')
+        status.job.setPhase('checksumming')
         self.checksumFile = os.path.join(self.dirOut, self.checksumFileName)
-        writeFlag, checksums = shared.checksumDirectory(self.dirOut, self.extension, self.checksumFile)
+        checksums = {}
+        if self.sha512Checksums:
+            logging.info('*** Creating checksum file ***')
+            knownChecksums = {}
+            if self.readMethod == "native" and 'sha512' in nativeStats['checksums']:
+                # Image was already hashed while it was read
+                knownChecksums[os.path.basename(self.imageFile)] = \
+                    nativeStats['checksums']['sha512']
+            writeFlag, checksums = shared.checksumDirectory(self.dirOut, self.extension,
+                                                            self.checksumFile, knownChecksums,
+                                                            self.hashBandwidth,
+                                                            self.blockHashSize,
+                                                            self.blockHashAlgorithm)
+
+        # Tree hashes, computed on all cores
+        treeHashes = None
+        if self.treeHashLeafSize > 0:
+            logging.info('*** Computing tree hashes ***')
+            treeHashes = shared.treeHashDirectory(self.dirOut, self.extension,
+                                                  self.treeHashLeafSize,
+                                                  self.treeHashWorkers,
+                                                  self.hashBandwidth,
+                                                  self.cancelToken)
+            for fName, hashString in treeHashes.items():
+                logging.info('tree hash of ' + fName + ': ' + hashString)
+            if self.cancelToken.isCancelled():
+                self.interruptedFlag = True
+                self.successFlag = False
 
         # Acquisition end date/time
         acquisitionEnd = shared.generateDateTime(self.timeZone)
@@ -234,6 +760,12 @@ class Disk:
             metadata['readMethodVersion'] = self.ddVersion
         if self.readMethod == "ddrescue":
             metadata['readMethodVersion'] = self.ddRescueVersion
+        if self.readMethod == "native" and blankInfo is None:
+            metadata['readMethodVersion'] = 'diskimgr ' + config.version
+            metadata['nativeStats'] = nativeStats
+        if blankInfo is not None:
+            # Size and fill byte are enough to recreate the image
+            metadata['blank'] = blankInfo
         metadata['readCommandLine'] = readCmdLine
         metadata['maxRetries'] = self.retries
         metadata['rescueDirectDiscMode'] = self.rescueDirectDiscMode
@@ -244,8 +776,33 @@ class Disk:
         metadata['acquisitionEnd'] = acquisitionEnd
         metadata['successFlag'] = self.successFlag
         metadata['interruptedFlag'] = self.interruptedFlag
+        if self.cancelToken.latency is not None:
+            # Seconds from interrupt request until reading / verification stopped
+            metadata['interruptLatency'] = round(self.cancelToken.latency, 3)
+            metadata['interruptSignals'] = self.cancelToken.signalsSent
         metadata['checksums'] = checksums
-        metadata['checksumType'] = 'SHA-512'
+        if self.sha512Checksums:
+            metadata['checksumType'] = 'SHA-512'
+        if treeHashes is not None:
+            # Algorithm and parameters, so anyone can reproduce the values
+            metadata['treeHash'] = {'algorithm': treehash.ALGORITHM,
+                                    'parameters': treehash.parameters(self.treeHashLeafSize),
+                                    'checksums': treeHashes}
+        if self.fingerprint:
+            metadata['fingerprint'] = self.fingerprint
+        if verification is not None:
+            metadata['verification'] = verification
+        if imageLayout is not None:
+            metadata['layout'] = imageLayout
+        if entropySummary is not None:
+            metadata['entropyMap'] = entropySummary
+        if sinkResults:
+            metadata['outputSinks'] = sinkResults
+        manifestFile = self.imageFile + manifest.MANIFEST_SUFFIX
+        if self.blockHashSize > 0 and os.path.isfile(manifestFile):
+            metadata['blockHashManifest'] = {'file': os.path.basename(manifestFile),
+                                             'algorithm': self.blockHashAlgorithm,
+                                             'blockSize': self.blockHashSize}
 
         # Write metadata to file in json format
         logging.info('*** Writing metadata file ***')
@@ -257,7 +814,18 @@ class Disk:
             self.successFlag = False
             logging.error('error while writing metadata file')
 
-        logging.info('Success: ' + str(self.successFlag))
+        # Add metadata to acquisition index
+        if self.indexFile and os.path.isfile(self.metadataFile):
+            try:
+                index.updateIndex(self.indexFile, self.metadataFile)
+                logging.info('updated acquisition index ' + self.indexFile)
+            except (sqlite3.Error, OSError) as e:
+                # Not critical for the acquisition itself
+                logging.warning('could not update acquisition index: ' + str(e))
+
+        logging.info('Success: ' + str(self.successFlag),
+                     extra={'event': 'acquisitionEnd', 'status': self.successFlag})
+        status.job.finish(self.successFlag)
 
         if self.successFlag:
             logging.info('Disk processed without errors')
@@ -270,3 +838,44 @@ class Disk:
 
         # Wait 2 seconds to avoid race condition
         time.sleep(2)
+
+    def compareDuplicate(self):
+        """Compare full hash of medium against the image of the earlier
+        acquisition it was matched to by its fingerprint"""
+
+        from . import fingerprint
+        duplicate = self.duplicates[0]
+        status.job.begin(self.identifier, self.blockDevice, 'compare', '', self.deviceSize)
+        status.job.setPhase('comparing')
+        logging.info('*** Comparing medium against earlier acquisition ***')
+        logging.info('blockDevice: ' + self.blockDevice)
+        logging.info('fingerprint: ' + self.fingerprint)
+        logging.info('earlier acquisition: ' + str(duplicate.get('identifier')) +
+                     ' (' + duplicate['dirOut'] + ')')
+
+        self.duplicateMatchFlag = False
+        imageName = str(duplicate.get('prefix')) + '.' + str(duplicate.get('extension'))
+        storedChecksum = duplicate.get('checksums', {}).get(imageName)
+        if storedChecksum is None:
+            logging.error('no checksum for ' + imageName + ' in earlier acquisition')
+        else:
+            try:
+                deviceChecksum = fingerprint.fullHash(self.blockDevice,
+                                                      self.nativeBufferSize,
+                                                      self.nativeMemoryBudget,
+                                                      self.cancelToken)
+            except OSError as e:
+                deviceChecksum = None
+                logging.error('cannot read ' + self.blockDevice + ': ' + str(e))
+            if deviceChecksum is None:
+                logging.error('could not read complete medium')
+            else:
+                logging.info('SHA-512 of medium: ' + deviceChecksum)
+                logging.info('SHA-512 of earlier image: ' + storedChecksum)
+                self.duplicateMatchFlag = deviceChecksum == storedChecksum
+
+        logging.info('Medium identical to earlier acquisition: ' + str(self.duplicateMatchFlag))
+        status.job.finish(self.duplicateMatchFlag)
+
+        # Set finishedFlag
+        self.finishedFlag = True
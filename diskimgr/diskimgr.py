@@ -6,14 +6,13 @@ Author: Johan van der Knijff
 Research department,  KB / National Library of the Netherlands
 """
 
-from .gui import main as guiLaunch
 from . import config
 
 __version__ = '0.2.0'
 
 def main():
     """Launch GUI"""
+    # Imported here, so importing this module (e.g. for __version__) doesn't load tkinter
+    from .gui import main as guiLaunch
     config.version = __version__
     guiLaunch()
-
-main()
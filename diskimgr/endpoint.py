@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+"""Local HTTP endpoint that serves the job status of the status module.
+
+The endpoint runs in its own threads, so serving a request never holds up
+imaging. It listens on a TCP address ('host:port', normally on localhost)
+or on a Unix socket ('unix:/path/to/socket'), and serves:
+
+/status   job status as JSON
+/metrics  job status in Prometheus text format
+
+Running this module queries an endpoint.
+"""
+
+import os
+import sys
+import json
+import socket
+import argparse
+import threading
+import http.client
+import http.server
+import socketserver
+from . import status
+
+
+class StatusHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /status and /metrics"""
+
+    def do_GET(self):
+        """Handle GET request"""
+        state = status.job.snapshot()
+        if self.path == '/status':
+            body = json.dumps(state).encode('utf-8')
+            contentType = 'application/json'
+        elif self.path == '/metrics':
+            body = status.prometheusText(state).encode('utf-8')
+            contentType = 'text/plain; version=0.0.4'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        """Unix socket clients have no address"""
+        return 'local'
+
+    def log_message(self, format, *args):
+        """Requests are not logged"""
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server on a Unix socket"""
+    daemon_threads = True
+
+    def get_request(self):
+        """Return request with a dummy client address"""
+        request, _ = self.socket.accept()
+        return request, ('local', 0)
+
+
+def startServer(address):
+    """Serve job status on address ('host:port' or 'unix:/path') from a
+    background thread; returns the server. Raises OSError / ValueError"""
+    if address.startswith('unix:'):
+        path = address[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixHTTPServer(path, StatusHandler)
+    else:
+        host, _, port = address.rpartition(':')
+        server = http.server.ThreadingHTTPServer((host or '127.0.0.1', int(port)),
+                                                 StatusHandler)
+        server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP connection over a Unix socket"""
+
+    def __init__(self, path, timeout=5):
+        """initialise UnixHTTPConnection instance"""
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        """Connect to Unix socket"""
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def query(address, path='/status'):
+    """Return response body of endpoint at address as string"""
+    if address.startswith('unix:'):
+        conn = UnixHTTPConnection(address[len('unix:'):])
+    else:
+        host, _, port = address.rpartition(':')
+        conn = http.client.HTTPConnection(host or '127.0.0.1', int(port), timeout=5)
+    try:
+        conn.request('GET', path)
+        response = conn.getresponse()
+        return response.read().decode('utf-8')
+    finally:
+        conn.close()
+
+
+def main():
+    """Query a local status endpoint"""
+    parser = argparse.ArgumentParser(description='query diskimgr status endpoint')
+    parser.add_argument('address',
+                        action='store',
+                        help="endpoint address, 'host:port' or 'unix:/path/to/socket'")
+    parser.add_argument('--metrics', '-m',
+                        action='store_true',
+                        dest='metrics',
+                        default=False,
+                        help='show metrics in Prometheus format instead of JSON status')
+    args = parser.parse_args()
+    try:
+        sys.stdout.write(query(args.address, '/metrics' if args.metrics else '/status'))
+    except (OSError, ValueError, http.client.HTTPException) as e:
+        sys.stderr.write('ERROR: cannot query ' + args.address + ': ' + str(e) + '\n')
+        sys.exit(1)
+    if not args.metrics:
+        sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
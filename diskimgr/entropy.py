@@ -0,0 +1,315 @@
+#! /usr/bin/env python3
+"""Entropy and fill map of a medium, for triage.
+
+An EntropyMapper is a pipeline consumer: for every region of regionSize
+bytes it computes a byte histogram and the Shannon entropy (in bits per
+byte), and classifies the region as zero-filled, 0xFF-filled, ordinary
+data, or random-looking (encrypted or compressed) data. Histograms are
+computed with NumPy if it is installed, and with a slower pure-Python
+fallback otherwise.
+
+The map is a compact binary file next to the image (IMAGE.entropy):
+
+    diskimgr-entropy\\n
+    one line of JSON: regionSize, imageSize, noRegions, classes, entropyScale
+    noRegions bytes: entropy of each region, times entropyScale
+    noRegions bytes: class of each region (index in classes)
+
+Running this module computes the map of an existing image file.
+"""
+
+import os
+import io
+import sys
+import json
+import math
+import logging
+import array
+import argparse
+import collections
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+MAGIC = b'diskimgr-entropy\n'
+MAP_SUFFIX = '.entropy'
+# Region classes; regions that were not read (e.g. read errors) are 'unread'
+CLASSES = ['unread', 'zero', 'ff', 'data', 'random']
+UNREAD, ZERO, FF, DATA, RANDOM = range(len(CLASSES))
+# Regions with at least this entropy (bits per byte) look encrypted or compressed
+RANDOM_THRESHOLD = 7.9
+# Entropy (0-8) is stored as one byte
+ENTROPY_SCALE = 31.875
+
+
+def histogram(view):
+    """Return byte histogram of view (list of 256 counts, or NumPy array)"""
+    if numpy is not None:
+        data = numpy.frombuffer(view, dtype=numpy.uint8)
+        if len(data) and data.min() == data.max():
+            # A uniform fill (most of a blank medium) is counted without a histogram
+            counts = numpy.zeros(256, dtype=numpy.int64)
+            counts[data[0]] = len(data)
+            return counts
+        if len(data) % 2 == 0:
+            # Counting byte pairs halves the number of elements to count
+            pairs = numpy.bincount(data.view(numpy.uint16), minlength=65536).reshape(256, 256)
+            return pairs.sum(0) + pairs.sum(1)
+        return numpy.bincount(data, minlength=256)
+    counts = [0] * 256
+    if view and view.tobytes().count(view[:1].tobytes()) == len(view):
+        counts[view[0]] = len(view)
+        return counts
+    for value, count in collections.Counter(view.tobytes()).items():
+        counts[value] = count
+    return counts
+
+
+def shannonEntropy(counts, noBytes):
+    """Return Shannon entropy in bits per byte of histogram counts"""
+    if noBytes == 0:
+        return 0.0
+    if numpy is not None:
+        p = counts[counts > 0] / noBytes
+        return float(-(p * numpy.log2(p)).sum())
+    return -sum(c / noBytes * math.log2(c / noBytes) for c in counts if c)
+
+
+def classify(counts, noBytes):
+    """Return (entropy, class) of region with histogram counts"""
+    entropy = shannonEntropy(counts, noBytes)
+    if counts[0] == noBytes:
+        regionClass = ZERO
+    elif counts[255] == noBytes:
+        regionClass = FF
+    elif entropy >= RANDOM_THRESHOLD:
+        regionClass = RANDOM
+    else:
+        regionClass = DATA
+    return entropy, regionClass
+
+
+class EntropyMapper:
+    """Computes entropy map of a data stream. Works as a pipeline consumer
+    (see pipeline.Consumer); data may arrive with gaps, but regions must be
+    fed in order"""
+
+    name = 'entropy'
+
+    def __init__(self, regionSize):
+        """initialise EntropyMapper instance"""
+        self.regionSize = regionSize
+        self.entropies = array.array('B')
+        self.classes = array.array('B')
+        self.region = None
+        self.counts = None
+        self.filled = 0
+        self.size = 0
+        self.classBytes = [0] * len(CLASSES)
+        self.entropySum = 0.0
+        # Regions that were only partly seen: (number of bytes, entropy)
+        self.partial = {}
+
+    def open(self):
+        """Nothing to open"""
+
+    def process(self, view, offset):
+        """Add data in view, which starts at offset in the source"""
+        end = offset + len(view)
+        while offset < end:
+            region = offset // self.regionSize
+            noBytes = min(self.regionSize - offset % self.regionSize, end - offset)
+            if region != self.region:
+                self.finishRegion()
+                self.region = region
+            counts = histogram(view[:noBytes])
+            if self.counts is None:
+                self.counts = counts
+            elif numpy is not None:
+                self.counts += counts
+            else:
+                self.counts = [a + b for a, b in zip(self.counts, counts)]
+            self.filled += noBytes
+            view = view[noBytes:]
+            offset += noBytes
+            self.size = max(self.size, offset)
+            if offset % self.regionSize == 0:
+                self.finishRegion()
+
+    def close(self):
+        """Nothing to close; a rescue may feed several pipeline runs, so the
+        last region is only finished by result()"""
+
+    def finishRegion(self):
+        """Classify the current region and add it to the map"""
+        if self.region is None:
+            return
+        noBytes = self.filled
+        entropy, regionClass = classify(self.counts, noBytes)
+        if noBytes < self.regionSize:
+            self.partial[self.region] = (noBytes, entropy)
+        # Regions that were skipped in between stay unread
+        missing = self.region - len(self.classes)
+        self.entropies.extend([0] * missing)
+        self.classes.extend([UNREAD] * missing)
+        self.entropies.append(round(entropy * ENTROPY_SCALE))
+        self.classes.append(regionClass)
+        self.classBytes[regionClass] += noBytes
+        self.entropySum += entropy * noBytes
+        self.region = None
+        self.counts = None
+        self.filled = 0
+
+    def result(self, imageSize=None, imageFile=None, unreadAreas=()):
+        """Finish the last region, and return summary dictionary. Regions
+        up to imageSize that were never read are counted as unread. If
+        imageFile is set, regions that were missed or only partly seen
+        (kernel copy, resume, or areas recovered by later rescue passes) are
+        read from it, leaving out the (position, size) unreadAreas"""
+        self.finishRegion()
+        if imageSize is None:
+            imageSize = self.size
+        noRegions = -(-imageSize // self.regionSize)
+        missing = noRegions - len(self.classes)
+        self.entropies.extend([0] * missing)
+        self.classes.extend([UNREAD] * missing)
+        self.size = imageSize
+        regionsFromImage = 0
+        if imageFile is not None:
+            regionsFromImage = self.fillFromImage(imageFile, unreadAreas)
+        self.classBytes[UNREAD] = max(0, imageSize - sum(self.classBytes[1:]))
+        bytesRead = imageSize - self.classBytes[UNREAD]
+        return {'regionSize': self.regionSize,
+                'noRegions': noRegions,
+                'bytes': dict(zip(CLASSES, self.classBytes)),
+                'meanEntropy': round(self.entropySum / bytesRead, 4) if bytesRead else 0.0,
+                'randomThreshold': RANDOM_THRESHOLD,
+                'regionsFromImage': regionsFromImage}
+
+    def fillFromImage(self, imageFile, unreadAreas):
+        """Classify unread and partly seen regions from the data in
+        imageFile, leaving out unreadAreas; returns number of regions read"""
+        regions = [r for r, regionClass in enumerate(self.classes) if regionClass == UNREAD]
+        regions.extend(r for r, (noBytes, entropy) in self.partial.items()
+                       if noBytes < min(self.regionSize, self.size - r * self.regionSize))
+        if not regions:
+            return 0
+        try:
+            fd = os.open(imageFile, os.O_RDONLY)
+        except OSError as e:
+            logging.warning('cannot read ' + imageFile + ' for entropy map: ' + str(e))
+            return 0
+        try:
+            for region in sorted(regions):
+                start = region * self.regionSize
+                end = min(start + self.regionSize, self.size)
+                # Parts of the region that were read, and are in the image
+                parts = [(start, end)]
+                for pos, size in unreadAreas:
+                    parts = [p for a, b in parts
+                             for p in ((a, min(b, pos)), (max(a, pos + size), b)) if p[0] < p[1]]
+                counts = None
+                filled = 0
+                for a, b in parts:
+                    data = os.pread(fd, b - a, a)
+                    if not data:
+                        continue
+                    partCounts = histogram(memoryview(data))
+                    if counts is None:
+                        counts = partCounts
+                    elif numpy is not None:
+                        counts += partCounts
+                    else:
+                        counts = [x + y for x, y in zip(counts, partCounts)]
+                    filled += len(data)
+                # Take out what was counted from the stream
+                noBytes, entropy = self.partial.pop(region, (0, 0.0))
+                if noBytes:
+                    self.classBytes[self.classes[region]] -= noBytes
+                    self.entropySum -= entropy * noBytes
+                if not filled:
+                    self.entropies[region] = 0
+                    self.classes[region] = UNREAD
+                    continue
+                entropy, regionClass = classify(counts, filled)
+                self.entropies[region] = round(entropy * ENTROPY_SCALE)
+                self.classes[region] = regionClass
+                self.classBytes[regionClass] += filled
+                self.entropySum += entropy * filled
+        finally:
+            os.close(fd)
+        return len(regions)
+
+    def write(self, path):
+        """Write map to path"""
+        header = {'regionSize': self.regionSize,
+                  'imageSize': self.size,
+                  'noRegions': len(self.classes),
+                  'classes': CLASSES,
+                  'entropyScale': ENTROPY_SCALE}
+        with io.open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header, sort_keys=True).encode('utf-8') + b'\n')
+            f.write(self.entropies.tobytes())
+            f.write(self.classes.tobytes())
+
+
+def mapFile(imageFile, regionSize, bufferSize=4194304):
+    """Return EntropyMapper fed with all data in imageFile"""
+    mapper = EntropyMapper(regionSize)
+    buf = bytearray(max(regionSize, bufferSize - bufferSize % regionSize))
+    view = memoryview(buf)
+    offset = 0
+    with io.open(imageFile, 'rb', buffering=0) as f:
+        while True:
+            noBytes = f.readinto(buf)
+            if not noBytes:
+                break
+            mapper.process(view[:noBytes], offset)
+            offset += noBytes
+    return mapper
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('imageFile',
+                        action='store',
+                        help='image file')
+    parser.add_argument('--region-size', '-r',
+                        action='store',
+                        type=int,
+                        dest='regionSize',
+                        default=1048576,
+                        help='region size in bytes (default: 1 MiB)')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Write entropy map of an image file"""
+
+    parser = argparse.ArgumentParser(description='entropy and fill map of image file')
+    args = parseCommandLine(parser)
+
+    if args.regionSize <= 0:
+        sys.stderr.write('ERROR: region size must be larger than 0\n')
+        sys.exit(1)
+    mapPath = args.imageFile + MAP_SUFFIX
+    try:
+        mapper = mapFile(args.imageFile, args.regionSize)
+        summary = mapper.result(os.path.getsize(args.imageFile))
+        mapper.write(mapPath)
+    except OSError as e:
+        sys.stderr.write('ERROR: ' + str(e) + '\n')
+        sys.exit(1)
+    summary['file'] = mapPath
+    json.dump(summary, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
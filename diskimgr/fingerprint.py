@@ -0,0 +1,67 @@
+#! /usr/bin/env python3
+"""Quick fingerprint of a medium, used to detect media that were imaged before.
+
+The fingerprint combines the device size with a hash of a few sampled
+regions (start, end and evenly spaced blocks in between), so it can be
+computed in a second or two even for large devices.
+"""
+
+import hashlib
+from . import pipeline
+
+FINGERPRINT_VERSION = 'fp1'
+# Sizes of the start / end samples and the strided samples, and their number
+SAMPLE_SIZE = 1048576
+STRIDE_SIZE = 65536
+NO_STRIDES = 8
+
+
+def sampleRegions(size, sectorSize=512):
+    """Return list of (offset, length) regions to sample for device of size.
+    Samples are scaled down for small (and slow) media such as floppies"""
+    sampleSize = min(SAMPLE_SIZE, max(sectorSize, size // 64))
+    strideSize = min(STRIDE_SIZE, max(sectorSize, size // 256))
+    sampleSize -= sampleSize % sectorSize
+    strideSize -= strideSize % sectorSize
+    regions = [(0, min(sampleSize, size))]
+    for i in range(1, NO_STRIDES + 1):
+        offset = size * i // (NO_STRIDES + 1)
+        offset -= offset % sectorSize
+        regions.append((offset, min(strideSize, size - offset)))
+    endOffset = max(0, size - sampleSize)
+    endOffset -= endOffset % sectorSize
+    regions.append((endOffset, size - endOffset))
+    return regions
+
+
+def computeFingerprint(devicePath):
+    """Return fingerprint string of device (or simulated device)"""
+    source = pipeline.openSource(devicePath)
+    try:
+        m = hashlib.sha256()
+        m.update(str(source.size).encode())
+        buf = bytearray(max(SAMPLE_SIZE, STRIDE_SIZE))
+        view = memoryview(buf)
+        for offset, length in sampleRegions(source.size):
+            bytesRead = source.readinto(view[:length], offset)
+            m.update(str(offset).encode())
+            m.update(view[:bytesRead])
+    finally:
+        source.close()
+    return FINGERPRINT_VERSION + ':' + str(source.size) + ':' + m.hexdigest()
+
+
+def fullHash(devicePath, bufferSize, memoryBudget, cancelToken=None):
+    """Return SHA-512 of the whole device, or None if it can't be read completely
+    (or cancelToken was cancelled)"""
+    source = pipeline.openSource(devicePath)
+    hasher = pipeline.Hasher('sha512')
+    p = pipeline.Pipeline(source, [hasher], bufferSize, memoryBudget,
+                          cancelToken=cancelToken)
+    try:
+        p.run()
+    finally:
+        source.close()
+    if p.readErrors or p.interrupted or p.bytesRead != source.size:
+        return None
+    return hasher.hexdigest()
@@ -14,7 +14,6 @@ import time
 import threading
 import logging
 import queue
-import uuid
 import json
 from shutil import move
 from pathlib import Path
@@ -23,9 +22,9 @@ from tkinter import filedialog as tkFileDialog
 from tkinter import scrolledtext as ScrolledText
 from tkinter import messagebox as tkMessageBox
 from tkinter import ttk
-from tkfilebrowser import askopendirname
 from .disk import Disk
 from . import shared
+from . import asynclog
 from . import config
 
 
@@ -44,11 +43,24 @@ class omimgrGUI(tk.Frame):
         # Create a logging handler using a queue
         self.log_queue = queue.Queue(-1)
         self.queue_handler = QueueHandler(self.log_queue)
+        self.logListener = None
+        # True if jobs are handed to the imaging daemon
+        self.daemonFlag = False
         # Create disc instance
         self.disk = Disk()
         self.t1 = None
         # Read configuration file
         self.disk.getConfiguration()
+        # Serve job status for monitoring
+        self.statusServer = None
+        if self.disk.statusAddress:
+            try:
+                # Imported on first use, to keep start-up fast
+                from . import endpoint
+                self.statusServer = endpoint.startServer(self.disk.statusAddress)
+            except (OSError, ValueError) as e:
+                tkMessageBox.showwarning("Warning", 'cannot serve status on ' +
+                                         self.disk.statusAddress + ': ' + str(e))
         # Set dirOut, depending on whether value from config is a directory
         if os.path.isdir(self.disk.defaultDir):
             self.disk.dirOut = self.disk.defaultDir
@@ -60,6 +72,9 @@ class omimgrGUI(tk.Frame):
 
     def on_quit(self, event=None):
         """Quit diskimgr"""
+        if self.logListener is not None:
+            # Write out any buffered log records
+            asynclog.stopLogging(self.logListener)
         os._exit(0)
 
     def on_submit(self, event=None):
@@ -92,47 +107,33 @@ class omimgrGUI(tk.Frame):
         self.disk.validateInput()
 
         # Show error message for any parameters that didn't pass validation
-        if not self.disk.dirOutIsDirectory:
-            inputValidateFlag = False
-            msg = ("Output directory doesn't exist:\n" + self.disk.dirOut)
-            tkMessageBox.showerror("ERROR", msg)
-
-        if not self.disk.dirOutIsWritable:
+        for msg in self.disk.validationErrors():
             inputValidateFlag = False
-            msg = ('Cannot write to directory ' + self.disk.dirOut)
             tkMessageBox.showerror("ERROR", msg)
 
-        if not self.disk.deviceExistsFlag:
-            inputValidateFlag = False
-            msg = ('Selected device does not exist')
-            tkMessageBox.showerror("ERROR", msg)
-
-        if not self.disk.deviceAccessibleFlag:
-            inputValidateFlag = False
-            msg = ('Selected device is not accessible')
-            tkMessageBox.showerror("ERROR", msg)
-
-        if self.disk.insufficientSpaceFlag:
-            inputValidateFlag = False
-            msg = ('Size of ' + self.disk.blockDevice + 
-                   ' exceeds available space in ' + self.disk.dirOut)
-            tkMessageBox.showerror("ERROR", msg)
-
-        if not self.disk.ddInstalled:
-            inputValidateFlag = False
-            msg = ("dd not installed!")
-            tkMessageBox.showerror("ERROR", msg)
-
-        if not self.disk.ddrescueInstalled:
-            inputValidateFlag = False
-            msg = ("ddrescue not installed!\n"
-                   "install with:\n"
-                   "'sudo apt install gddrescue'")
-            tkMessageBox.showerror("ERROR", msg)
+        # Warn if this medium was probably imaged before
+        if inputValidateFlag and self.disk.duplicates:
+            duplicate = self.disk.duplicates[0]
+            msg = ('This medium was probably imaged before as ' +
+                   str(duplicate.get('identifier')) + '\n(' + duplicate['dirOut'] + ')\n\n'
+                   'Press Yes to compare the full medium against that image,\n'
+                   'No to image it anyway, or Cancel to stop')
+            duplicateAnswer = tkMessageBox.askyesnocancel("Duplicate medium?", msg)
+            if duplicateAnswer is None:
+                inputValidateFlag = False
+            elif duplicateAnswer:
+                self.disk.compareFlag = True
 
-        # Ask confirmation if dd is used on dir with existing files
+        # Ask confirmation if dd is used on dir with existing files (the native
+        # read method resumes from an existing map file, like ddrescue)
         outDirConfirmFlag = True
-        if self.disk.outputExistsFlag and self.disk.readMethod == 'dd':
+        nativeResumeFlag = self.disk.readMethod == 'native' and os.path.isfile(self.disk.mapFile)
+        if self.disk.compareFlag:
+            # Comparing doesn't write any output besides the log file
+            pass
+        elif self.disk.outputExistsFlag and (self.disk.readMethod == 'dd' or
+                                           (self.disk.readMethod == 'native' and
+                                            not nativeResumeFlag)):
             msg = ('writing to ' + self.disk.dirOut + ' will overwrite existing files!\n'
                    'press OK to continue, otherwise press Cancel')
             outDirConfirmFlag = tkMessageBox.askokcancel("Overwrite files?", msg)
@@ -156,6 +157,10 @@ class omimgrGUI(tk.Frame):
 
         if inputValidateFlag:
 
+            # Hand the job to the imaging daemon, if one is running
+            from . import daemon
+            self.daemonFlag = daemon.isRunning(self.disk.daemonSocket)
+
             # Start logger
             successLogger = True
             try:
@@ -187,6 +192,7 @@ class omimgrGUI(tk.Frame):
                 self.extension_entry.config(state='disabled')
                 self.rbDd.config(state='disabled')
                 self.rbRescue.config(state='disabled')
+                self.rbNative.config(state='disabled')
                 self.identifier_entry.config(state='disabled')
                 self.loadJsonButton.config(state='disabled')
                 self.uuidButton.config(state='disabled')
@@ -195,11 +201,62 @@ class omimgrGUI(tk.Frame):
                 self.start_button.config(state='disabled')
                 self.quit_button.config(state='disabled')
 
+                # Retries run on the same Disk instance, so clear any earlier interrupt
+                self.disk.cancelToken.reset()
                 # Launch disc processing function as subprocess
-                self.t1 = threading.Thread(target=self.disk.processDisk)
+                if self.daemonFlag:
+                    self.t1 = threading.Thread(target=self.runInDaemon)
+                elif self.disk.compareFlag:
+                    self.t1 = threading.Thread(target=self.disk.compareDuplicate)
+                else:
+                    self.t1 = threading.Thread(target=self.disk.processDisk)
                 self.t1.start()
 
 
+    def runInDaemon(self):
+        """Submit job to the imaging daemon, and show its progress until it
+        ends. Closing the GUI only detaches from the job"""
+        from . import daemon
+        socketPath = self.disk.daemonSocket
+        fields = {key: getattr(self.disk, key) for key in daemon.JOB_FIELDS}
+        fields['compare'] = self.disk.compareFlag
+        # The user already confirmed overwriting existing output
+        fields['overwrite'] = True
+        record = {}
+        try:
+            jobId = daemon.submitJob(socketPath, fields)
+            logging.info('submitted job ' + jobId + ' to imaging daemon')
+            cancelSentFlag = False
+            for event in daemon.attach(socketPath, jobId, 0.5):
+                if self.disk.cancelToken.isCancelled() and not cancelSentFlag:
+                    daemon.request(socketPath, {'command': 'cancel', 'id': jobId})
+                    cancelSentFlag = True
+                if event is None:
+                    continue
+                if event['event'] == 'log':
+                    logging.log(getattr(logging, event['level'], logging.INFO), event['message'])
+                elif event['event'] == 'job':
+                    record = event['record']
+                    if record['state'] in daemon.FINAL_STATES:
+                        break
+                    if record['state'] == 'finishing':
+                        # The daemon finishes the job in the background
+                        logging.info('medium read; checksums and metadata are finished ' +
+                                     'by the imaging daemon (job ' + jobId + ')')
+                        break
+        except (OSError, ValueError) as e:
+            # Connection lost, or job refused
+            logging.error('imaging daemon: ' + str(e))
+
+        # The daemon may have retried the job with ddrescue (autoRetry)
+        self.disk.readMethod = record.get('readMethod', self.disk.readMethod)
+        self.disk.successFlag = bool(record.get('successFlag', False))
+        self.disk.readErrorFlag = bool(record.get('readErrorFlag', False))
+        self.disk.interruptedFlag = bool(record.get('interruptedFlag', False))
+        if self.disk.compareFlag:
+            self.disk.duplicateMatchFlag = self.disk.successFlag
+        self.disk.finishedFlag = True
+
     def selectOutputDirectoryOld(self, event=None):
         """Select output directory"""
         dirInit = self.disk.dirOut
@@ -209,6 +266,8 @@ class omimgrGUI(tk.Frame):
 
     def selectOutputDirectory(self, event=None):
         """Select output directory"""
+        # Imported on first use, to keep start-up fast
+        from tkfilebrowser import askopendirname
         dirInit = self.disk.dirOut
         self.disk.dirOut = askopendirname(initialdir=dirInit)
         self.outDirLabel['text'] = self.disk.dirOut
@@ -271,7 +330,7 @@ class omimgrGUI(tk.Frame):
 
     def interruptImaging(self, event=None):
         """Interrupt imaging process"""
-        config.interruptFlag = True
+        self.disk.cancelToken.cancel()
         self.interrupt_button.configure(state='disabled')
 
     def decreaseRetries(self, event=None):
@@ -320,7 +379,7 @@ class omimgrGUI(tk.Frame):
 
     def insertUUID(self, event=None):
         """Insert UUID into identifier field"""
-        myID = str(uuid.uuid1())
+        myID = shared.generateIdentifier()
         self.identifier_entry.delete(0, tk.END)
         self.identifier_entry.insert(tk.END, myID)
 
@@ -413,6 +472,7 @@ class omimgrGUI(tk.Frame):
         self.readMethods = [
             ['dd', 1, 0],
             ['ddrescue', 2, 3],
+            ['native', 3, 0],
         ]
 
         tk.Label(self, text='Read method').grid(column=0, row=7, sticky='w')
@@ -429,36 +489,42 @@ class omimgrGUI(tk.Frame):
                                     value=2)
         self.rbRescue.grid(column=1, row=8, sticky='w')
 
+        self.rbNative = tk.Radiobutton(self,
+                                    text='native',
+                                    variable=self.v,
+                                    value=3)
+        self.rbNative.grid(column=1, row=9, sticky='w')
+
         # Retries
-        tk.Label(self, text='Retries (ddrescue)').grid(column=0, row=9, sticky='w')
+        tk.Label(self, text='Retries (ddrescue / native)').grid(column=0, row=10, sticky='w')
         self.retries_entry = tk.Entry(self, width=20)
         self.retries_entry['background'] = 'white'
         self.retries_entry.insert(tk.END, self.disk.retriesDefault)
-        self.retries_entry.grid(column=1, row=9, sticky='w')
+        self.retries_entry.grid(column=1, row=10, sticky='w')
         self.decreaseRetriesButton = tk.Button(self, text='-',
                                                command=self.decreaseRetries,
                                                width=1)
-        self.decreaseRetriesButton.grid(column=1, row=9, sticky='e')
+        self.decreaseRetriesButton.grid(column=1, row=10, sticky='e')
         self.increaseRetriesButton = tk.Button(self, text='+',
                                                command=self.increaseRetries,
                                                width=1)
-        self.increaseRetriesButton.grid(column=2, row=9, sticky='w')
+        self.increaseRetriesButton.grid(column=2, row=10, sticky='w')
 
         # Direct disc mode
-        tk.Label(self, text='Direct disc mode (ddrescue)').grid(column=0, row=10, sticky='w')
+        tk.Label(self, text='Direct disc mode (ddrescue)').grid(column=0, row=11, sticky='w')
         self.rescueDirectDiscMode = tk.BooleanVar()
         self.rescueDirectDiscMode.set(self.disk.rescueDirectDiscMode)
         self.rescueDirectDiscMode_entry = tk.Checkbutton(self, variable=self.rescueDirectDiscMode)
-        self.rescueDirectDiscMode_entry.grid(column=1, row=10, sticky='w')
+        self.rescueDirectDiscMode_entry.grid(column=1, row=11, sticky='w')
     
         # Direct disc mode
-        tk.Label(self, text='Auto-retry with ddrescue on dd failure').grid(column=0, row=11, sticky='w')
+        tk.Label(self, text='Auto-retry with ddrescue on dd failure').grid(column=0, row=12, sticky='w')
         self.autoRetry = tk.BooleanVar()
         self.autoRetry.set(self.disk.autoRetry)
         self.autoRetry_entry = tk.Checkbutton(self, variable=self.autoRetry)
-        self.autoRetry_entry.grid(column=1, row=11, sticky='w')
+        self.autoRetry_entry.grid(column=1, row=12, sticky='w')
 
-        ttk.Separator(self, orient='horizontal').grid(column=0, row=12, columnspan=4, sticky='ew')
+        ttk.Separator(self, orient='horizontal').grid(column=0, row=13, columnspan=4, sticky='ew')
 
         # Load from json
         self.loadJsonButton = tk.Button(self,
@@ -466,48 +532,48 @@ class omimgrGUI(tk.Frame):
                                             underline=0,
                                             command=self.importMetadata,
                                             width=20)
-        self.loadJsonButton.grid(column=0, row=13, sticky='w')
+        self.loadJsonButton.grid(column=0, row=14, sticky='w')
     
         # Prefix
-        tk.Label(self, text='Prefix').grid(column=0, row=14, sticky='w')
+        tk.Label(self, text='Prefix').grid(column=0, row=15, sticky='w')
         self.prefix_entry = tk.Entry(self, width=20)
         self.prefix_entry['background'] = 'white'
         self.prefix_entry.insert(tk.END, self.disk.prefix)
-        self.prefix_entry.grid(column=1, row=14, sticky='w')
+        self.prefix_entry.grid(column=1, row=15, sticky='w')
 
         # Extension
-        tk.Label(self, text='Extension').grid(column=0, row=15, sticky='w')
+        tk.Label(self, text='Extension').grid(column=0, row=16, sticky='w')
         self.extension_entry = tk.Entry(self, width=20)
         self.extension_entry['background'] = 'white'
         self.extension_entry.insert(tk.END, self.disk.extension)
-        self.extension_entry.grid(column=1, row=15, sticky='w')
+        self.extension_entry.grid(column=1, row=16, sticky='w')
 
         # Identifier entry field
-        tk.Label(self, text='Identifier').grid(column=0, row=16, sticky='w')
+        tk.Label(self, text='Identifier').grid(column=0, row=17, sticky='w')
         self.identifier_entry = tk.Entry(self, width=35)
         self.identifier_entry['background'] = 'white'
         self.identifier_entry.insert(tk.END, self.disk.identifier)
-        self.identifier_entry.grid(column=1, row=16, sticky='w')
+        self.identifier_entry.grid(column=1, row=17, sticky='w')
         self.uuidButton = tk.Button(self, text='UUID',
                                     underline=0, command=self.insertUUID,
                                     width=2)
-        self.uuidButton.grid(column=1, row=16, sticky='e')
+        self.uuidButton.grid(column=1, row=17, sticky='e')
 
         # Description entry field
-        tk.Label(self, text='Description').grid(column=0, row=17, sticky='w')
+        tk.Label(self, text='Description').grid(column=0, row=18, sticky='w')
         self.description_entry = tk.Entry(self, width=45)
         self.description_entry['background'] = 'white'
         self.description_entry.insert(tk.END, self.disk.description)
-        self.description_entry.grid(column=1, row=17, sticky='w', columnspan=1)
+        self.description_entry.grid(column=1, row=18, sticky='w', columnspan=1)
 
         # Notes entry field
-        tk.Label(self, text='Notes').grid(column=0, row=18, sticky='w')
+        tk.Label(self, text='Notes').grid(column=0, row=19, sticky='w')
         self.notes_entry = tk.Text(self, height=3, width=45)
         self.notes_entry['background'] = 'white'
         self.notes_entry.insert(tk.END, self.disk.notes)
-        self.notes_entry.grid(column=1, row=18, sticky='w', columnspan=1)
+        self.notes_entry.grid(column=1, row=19, sticky='w', columnspan=1)
 
-        ttk.Separator(self, orient='horizontal').grid(column=0, row=19, columnspan=4, sticky='ew')
+        ttk.Separator(self, orient='horizontal').grid(column=0, row=20, columnspan=4, sticky='ew')
 
         # Start button
         self.start_button = tk.Button(self,
@@ -515,7 +581,7 @@ class omimgrGUI(tk.Frame):
                                       width=10,
                                       underline=0,
                                       command=self.on_submit)
-        self.start_button.grid(column=1, row=20, sticky='w')
+        self.start_button.grid(column=1, row=21, sticky='w')
 
         # Interrupt button (disabled on startup)
         self.interrupt_button = tk.Button(self,
@@ -523,7 +589,7 @@ class omimgrGUI(tk.Frame):
                                           underline=0,
                                           command=self.interruptImaging,
                                           width=8)
-        self.interrupt_button.grid(column=1, row=20, sticky='')
+        self.interrupt_button.grid(column=1, row=21, sticky='')
         self.interrupt_button.config(state='disabled')
 
         # Exit button
@@ -532,15 +598,15 @@ class omimgrGUI(tk.Frame):
                                      width=10,
                                      underline=0,
                                      command=self.on_quit)
-        self.quit_button.grid(column=1, row=20, sticky='e')
+        self.quit_button.grid(column=1, row=21, sticky='e')
 
-        ttk.Separator(self, orient='horizontal').grid(column=0, row=22, columnspan=4, sticky='ew')
+        ttk.Separator(self, orient='horizontal').grid(column=0, row=23, columnspan=4, sticky='ew')
 
         # Add ScrolledText widget to display logging info
         self.st = ScrolledText.ScrolledText(self, state='disabled', height=8)
         self.st.configure(font='TkFixedFont')
         self.st['background'] = 'white'
-        self.st.grid(column=0, row=23, sticky='ew', columnspan=4)
+        self.st.grid(column=0, row=24, sticky='ew', columnspan=4)
 
         # Define bindings for keyboard shortcuts: buttons
         self.root.bind_all('<Control-Key-d>', self.selectOutputDirectory)
@@ -593,6 +659,7 @@ class omimgrGUI(tk.Frame):
         self.extension_entry.config(state='normal')
         self.rbDd.config(state='normal')
         self.rbRescue.config(state='normal')
+        self.rbNative.config(state='normal')
         self.loadJsonButton.config(state='normal')
         self.identifier_entry.config(state='normal')
         self.uuidButton.config(state='normal')
@@ -623,13 +690,15 @@ class omimgrGUI(tk.Frame):
     def setupLogger(self):
         """Set up logger configuration"""
 
-        # Basic configuration
-        logging.basicConfig(filename=self.disk.logFile,
-                            level=logging.INFO,
-                            format='%(asctime)s - %(levelname)s - %(message)s')
-
-        # Add the handler to logger
+        # Log files are written by a listener thread, off the imaging thread. If
+        # the daemon runs the job, it writes the log files
         self.logger = logging.getLogger()
+        if self.daemonFlag:
+            self.logger.setLevel(logging.INFO)
+        else:
+            self.logListener = asynclog.startLogging(self.disk.logFile,
+                                                     self.disk.structuredLogFile,
+                                                     self.disk.logFlushInterval)
 
         # This sets the console output format (slightly different from basicConfig!)
         formatter = logging.Formatter('%(message)s')
@@ -699,6 +768,7 @@ def main():
     root.protocol('WM_DELETE_WINDOW', myGUI.on_quit)
     retryFromDdFlag = False
     retryFromRescueFlag = False
+    imageAfterCompareFlag = False
 
     while True:
         try:
@@ -707,19 +777,35 @@ def main():
             time.sleep(0.1)
             if myGUI.disk.finishedFlag:
                 myGUI.t1.join()
+                if myGUI.logListener is not None:
+                    asynclog.stopLogging(myGUI.logListener)
+                    myGUI.logListener = None
                 handlers = myGUI.logger.handlers[:]
                 for handler in handlers:
                     handler.close()
                     myGUI.logger.removeHandler(handler)
 
-                if myGUI.disk.successFlag and not myGUI.disk.readErrorFlag:
+                if myGUI.disk.compareFlag:
+                    duplicate = myGUI.disk.duplicates[0]
+                    if myGUI.disk.duplicateMatchFlag:
+                        msg = ('Medium is identical to earlier acquisition ' +
+                               str(duplicate.get('identifier')) + '\n(' +
+                               duplicate['dirOut'] + ')')
+                        tkMessageBox.showinfo("Duplicate medium", msg)
+                    else:
+                        msg = ('Medium could not be matched to earlier acquisition ' +
+                               str(duplicate.get('identifier')) + '\n'
+                               'Image it now?')
+                        if tkMessageBox.askyesno("No match", msg):
+                            imageAfterCompareFlag = True
+                elif myGUI.disk.successFlag and not myGUI.disk.readErrorFlag:
                     # Imaging completed with no errors
                     msg = ('Disk processed without errors')
                     tkMessageBox.showinfo("Success", msg)
-                elif myGUI.disk.readMethod == 'dd' and myGUI.disk.autoRetry:
+                elif myGUI.disk.readMethod in ['dd', 'native'] and myGUI.disk.autoRetry:
                     # Imaging resulted in errors, auto-retry with ddrescue
                     retryFromDdFlag = True
-                elif myGUI.disk.readMethod == 'dd' and not myGUI.disk.autoRetry:
+                elif myGUI.disk.readMethod in ['dd', 'native'] and not myGUI.disk.autoRetry:
                     # Imaging resulted in errors, as if user wants to retry with ddrescue
                     msg = ('Errors occurred while processing this disk\n'
                            'Try again with ddrescue?')
@@ -733,24 +819,36 @@ def main():
                     if tkMessageBox.askyesno("Errors", msg):
                         retryFromRescueFlag = True
 
-                if retryFromDdFlag:
-                    # Reset flags
+                if imageAfterCompareFlag:
+                    # Reset flags, and image medium without asking again
+                    myGUI.disk.compareFlag = False
+                    myGUI.disk.finishedFlag = False
+                    myGUI.disk.skipDuplicateCheck = True
+                    myGUI.on_submit()
+                    imageAfterCompareFlag = False
+                elif retryFromDdFlag:
+                    # Reset flags; a retry is the same medium, so no duplicate check
                     myGUI.disk.readErrorFlag = False
                     myGUI.disk.finishedFlag = False
-                    # Move files that were created by dd pass to subdirectory
-                    failedDir = os.path.join(myGUI.disk.dirOut,'dd-failed')
-                    os.makedirs(failedDir)
-                    move(myGUI.disk.imageFile, failedDir)
-                    move(myGUI.disk.metadataFile, failedDir)
-                    move(myGUI.disk.checksumFile, failedDir)
+                    myGUI.disk.skipDuplicateCheck = True
+                    if myGUI.disk.readMethod == 'dd':
+                        # Move files that were created by dd pass to subdirectory
+                        failedDir = os.path.join(myGUI.disk.dirOut, 'dd-failed')
+                        os.makedirs(failedDir)
+                        move(myGUI.disk.imageFile, failedDir)
+                        move(myGUI.disk.metadataFile, failedDir)
+                        move(myGUI.disk.checksumFile, failedDir)
+                    # The native read method leaves a ddrescue map file, so
+                    # ddrescue simply continues where it stopped
                     # Set readMethod to ddrescue
                     myGUI.v.set(2)
                     myGUI.on_submit()
                     retryFromDdFlag = False
                 elif retryFromRescueFlag:
-                    # Reset flags
+                    # Reset flags; a retry is the same medium, so no duplicate check
                     myGUI.disk.readErrorFlag = False
                     myGUI.disk.finishedFlag = False
+                    myGUI.disk.skipDuplicateCheck = True
                     # Enable entry widgets
                     myGUI.omDevice_entry.config(state='normal')
                     myGUI.retries_entry.config(state='normal')
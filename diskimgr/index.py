@@ -0,0 +1,319 @@
+#! /usr/bin/env python3
+"""SQLite index of the metadata files of all acquisitions under an output root.
+
+Scans are incremental: metadata files whose modification time and size
+haven't changed since the last scan are not parsed again.
+"""
+
+import os
+import io
+import sys
+import json
+import sqlite3
+import datetime
+import argparse
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS acquisitions (
+    path TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    dirOut TEXT,
+    identifier TEXT,
+    description TEXT,
+    blockDevice TEXT,
+    readMethod TEXT,
+    successFlag INTEGER,
+    interruptedFlag INTEGER,
+    acquisitionStart TEXT,
+    acquisitionEnd TEXT,
+    startUTC TEXT,
+    metadata TEXT,
+    fingerprint TEXT
+);
+CREATE TABLE IF NOT EXISTS checksums (
+    path TEXT,
+    fileName TEXT,
+    checksum TEXT,
+    PRIMARY KEY (path, fileName)
+);
+CREATE TABLE IF NOT EXISTS audits (
+    id INTEGER PRIMARY KEY,
+    rootDir TEXT,
+    started TEXT,
+    finished TEXT,
+    noChecked INTEGER,
+    noFailed INTEGER
+);
+CREATE TABLE IF NOT EXISTS fixity (
+    path TEXT PRIMARY KEY,
+    checksumFile TEXT,
+    expected TEXT,
+    actual TEXT,
+    result TEXT,
+    verified TEXT,
+    auditId INTEGER
+);
+CREATE INDEX IF NOT EXISTS idxIdentifier ON acquisitions (identifier);
+CREATE INDEX IF NOT EXISTS idxBlockDevice ON acquisitions (blockDevice);
+CREATE INDEX IF NOT EXISTS idxReadMethod ON acquisitions (readMethod);
+CREATE INDEX IF NOT EXISTS idxSuccess ON acquisitions (successFlag);
+CREATE INDEX IF NOT EXISTS idxStartUTC ON acquisitions (startUTC);
+CREATE INDEX IF NOT EXISTS idxChecksum ON checksums (checksum);
+CREATE INDEX IF NOT EXISTS idxFingerprint ON acquisitions (fingerprint);
+CREATE INDEX IF NOT EXISTS idxFixityResult ON fixity (result);
+"""
+
+# Columns that were added after the first version of the schema
+ADDED_COLUMNS = [('fingerprint', 'TEXT')]
+
+
+def openIndex(indexFile):
+    """Open (and if needed create) index database"""
+    indexDir = os.path.dirname(indexFile)
+    if indexDir and not os.path.isdir(indexDir):
+        os.makedirs(indexDir)
+    conn = sqlite3.connect(indexFile)
+    # Upgrade index created by an older version before creating the indexes
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(acquisitions)')]
+    if columns:
+        with conn:
+            for name, columnType in ADDED_COLUMNS:
+                if name not in columns:
+                    conn.execute('ALTER TABLE acquisitions ADD COLUMN ' + name + ' ' + columnType)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def toUTC(dateTimeString):
+    """Convert ISO date / time string with time zone info to UTC, so
+    acquisitions from different time zones sort correctly"""
+    try:
+        dateTime = datetime.datetime.fromisoformat(dateTimeString)
+    except (TypeError, ValueError):
+        return None
+    if dateTime.tzinfo is None:
+        return dateTime.isoformat()
+    return dateTime.astimezone(datetime.timezone.utc).isoformat()
+
+
+def addMetadataFile(conn, metadataFile, st):
+    """Parse one metadata file and add / replace its entries in the index;
+    returns True on success"""
+    try:
+        with io.open(metadataFile, 'r', encoding='utf-8') as f:
+            metadata = json.load(f)
+    except (IOError, ValueError):
+        return False
+    if not isinstance(metadata, dict):
+        return False
+
+    conn.execute('DELETE FROM checksums WHERE path = ?', (metadataFile,))
+    conn.execute('INSERT OR REPLACE INTO acquisitions (path, mtime, size, dirOut, '
+                 'identifier, description, blockDevice, readMethod, successFlag, '
+                 'interruptedFlag, acquisitionStart, acquisitionEnd, startUTC, metadata, '
+                 'fingerprint) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                 (metadataFile,
+                  st.st_mtime,
+                  st.st_size,
+                  os.path.dirname(metadataFile),
+                  metadata.get('identifier'),
+                  metadata.get('description'),
+                  metadata.get('blockDevice'),
+                  metadata.get('readMethod'),
+                  metadata.get('successFlag'),
+                  metadata.get('interruptedFlag'),
+                  metadata.get('acquisitionStart'),
+                  metadata.get('acquisitionEnd'),
+                  toUTC(metadata.get('acquisitionStart')),
+                  json.dumps(metadata, sort_keys=True),
+                  metadata.get('fingerprint')))
+    checksums = metadata.get('checksums', {})
+    if isinstance(checksums, dict):
+        conn.executemany('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?)',
+                         [(metadataFile, fName, checksum)
+                          for fName, checksum in checksums.items()])
+    return True
+
+
+def updateIndex(indexPath, metadataFile):
+    """Add or update a single metadata file (called at the end of processDisk)"""
+    metadataFile = os.path.abspath(metadataFile)
+    conn = openIndex(indexPath)
+    try:
+        with conn:
+            addMetadataFile(conn, metadataFile, os.stat(metadataFile))
+    finally:
+        conn.close()
+
+
+def scanRoot(indexPath, rootDir, metadataFileName):
+    """Incrementally index all metadata files under rootDir. Returns number
+    of files that were (re)indexed, unchanged, failed and removed"""
+    rootDir = os.path.abspath(rootDir)
+    conn = openIndex(indexPath)
+    noIndexed = 0
+    noUnchanged = 0
+    noFailed = 0
+    noRemoved = 0
+    try:
+        # Known files under this root, with their mtime and size
+        known = {}
+        prefix = os.path.join(rootDir, '')
+        for path, mtime, size in conn.execute('SELECT path, mtime, size FROM acquisitions '
+                                              'WHERE substr(path, 1, ?) = ?',
+                                              (len(prefix), prefix)):
+            known[path] = (mtime, size)
+
+        with conn:
+            for dirPath, dirNames, fileNames in os.walk(rootDir):
+                if metadataFileName not in fileNames:
+                    continue
+                metadataFile = os.path.join(dirPath, metadataFileName)
+                try:
+                    st = os.stat(metadataFile)
+                except OSError:
+                    continue
+                if known.pop(metadataFile, None) == (st.st_mtime, st.st_size):
+                    noUnchanged += 1
+                elif addMetadataFile(conn, metadataFile, st):
+                    noIndexed += 1
+                else:
+                    noFailed += 1
+
+            # Anything left in known no longer exists
+            for path in known:
+                conn.execute('DELETE FROM acquisitions WHERE path = ?', (path,))
+                conn.execute('DELETE FROM checksums WHERE path = ?', (path,))
+                noRemoved += 1
+    finally:
+        conn.close()
+    return noIndexed, noUnchanged, noFailed, noRemoved
+
+
+def query(indexPath, identifier=None, checksum=None, blockDevice=None, readMethod=None,
+          success=None, since=None, until=None, fingerprint=None):
+    """Return list of metadata dictionaries of acquisitions that match all
+    given criteria; since and until are (UTC) ISO dates or date / times"""
+    conditions = []
+    values = []
+    if identifier is not None:
+        conditions.append('identifier = ?')
+        values.append(identifier)
+    if checksum is not None:
+        conditions.append('path IN (SELECT path FROM checksums WHERE checksum = ?)')
+        values.append(checksum.lower())
+    if blockDevice is not None:
+        conditions.append('blockDevice = ?')
+        values.append(blockDevice)
+    if readMethod is not None:
+        conditions.append('readMethod = ?')
+        values.append(readMethod)
+    if success is not None:
+        conditions.append('successFlag = ?')
+        values.append(int(success))
+    if fingerprint is not None:
+        conditions.append('fingerprint = ?')
+        values.append(fingerprint)
+    if since is not None:
+        conditions.append('startUTC >= ?')
+        values.append(since)
+    if until is not None:
+        conditions.append('startUTC < ?')
+        values.append(until)
+
+    sql = 'SELECT dirOut, metadata FROM acquisitions'
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY startUTC'
+
+    conn = openIndex(indexPath)
+    try:
+        results = []
+        for dirOut, metadataString in conn.execute(sql, values):
+            metadata = json.loads(metadataString)
+            metadata['dirOut'] = dirOut
+            results.append(metadata)
+    finally:
+        conn.close()
+    return results
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('--index', '-i',
+                        action='store',
+                        dest='indexFile',
+                        default=None,
+                        help='index database (default: value from configuration file)')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    parserScan = subparsers.add_parser('scan', help='(re)index output root directory')
+    parserScan.add_argument('rootDir',
+                            action='store',
+                            help='output root directory')
+
+    parserQuery = subparsers.add_parser('query', help='query index')
+    parserQuery.add_argument('--identifier', action='store', default=None)
+    parserQuery.add_argument('--checksum', action='store', default=None)
+    parserQuery.add_argument('--device', action='store', dest='blockDevice', default=None)
+    parserQuery.add_argument('--method', action='store', dest='readMethod', default=None)
+    parserQuery.add_argument('--success', action='store_true', dest='success', default=None,
+                             help='only successful acquisitions')
+    parserQuery.add_argument('--errors', action='store_false', dest='success', default=None,
+                             help='only acquisitions with errors')
+    parserQuery.add_argument('--since', action='store', default=None,
+                             help='acquired on or after this (UTC) date, e.g. 2026-09-01')
+    parserQuery.add_argument('--until', action='store', default=None,
+                             help='acquired before this (UTC) date')
+    parserQuery.add_argument('--json', action='store_true', dest='jsonFlag', default=False,
+                             help='write full metadata as JSON')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Command-line interface to the acquisition index"""
+
+    # Imported here, to keep import of this module light
+    from .disk import Disk
+
+    parser = argparse.ArgumentParser(description='diskimgr acquisition index')
+    args = parseCommandLine(parser)
+
+    disk = Disk()
+    disk.getConfiguration()
+    if not disk.configSuccess:
+        sys.stderr.write('ERROR: cannot read configuration file ' + disk.configFile +
+                         ", run '(sudo) diskimgr-config' to fix this\n")
+        sys.exit(1)
+    indexPath = args.indexFile
+    if indexPath is None:
+        indexPath = disk.indexFile
+
+    if args.command == 'scan':
+        noIndexed, noUnchanged, noFailed, noRemoved = scanRoot(indexPath, args.rootDir,
+                                                               disk.metadataFileName)
+        sys.stderr.write('INFO: indexed ' + str(noIndexed) + ', unchanged ' +
+                         str(noUnchanged) + ', failed ' + str(noFailed) +
+                         ', removed ' + str(noRemoved) + '\n')
+    elif args.command == 'query':
+        results = query(indexPath, args.identifier, args.checksum, args.blockDevice,
+                        args.readMethod, args.success, args.since, args.until)
+        if args.jsonFlag:
+            json.dump(results, sys.stdout, indent=4, sort_keys=True)
+            sys.stdout.write('\n')
+        else:
+            for metadata in results:
+                sys.stdout.write('\t'.join([str(metadata.get('identifier')),
+                                            str(metadata.get('readMethod')),
+                                            str(metadata.get('successFlag')),
+                                            str(metadata.get('acquisitionStart')),
+                                            metadata['dirOut']]) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+#! /usr/bin/env python3
+"""I/O scheduling priority of threads and child processes.
+
+Priorities are written as 'class:level' strings, e.g. 'be:0' (best effort,
+highest level), 'rt:4' (real time, needs root) or 'idle' (only gets disk
+time when nobody else needs it). The priority is set for the calling
+thread with the ioprio_set syscall; threads and processes started from
+it inherit it. Priorities only have an effect with an I/O scheduler that
+supports them (bfq, or cfq on older kernels).
+"""
+
+import os
+import shutil
+import ctypes
+import logging
+import platform
+
+CLASSES = {'none': 0, 'rt': 1, 'be': 2, 'idle': 3}
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1
+
+# ioprio_set syscall number by architecture
+SYSCALL_NUMBERS = {'x86_64': 251,
+                   'i386': 289,
+                   'i686': 289,
+                   'aarch64': 30,
+                   'riscv64': 30,
+                   'armv7l': 314,
+                   'ppc64le': 273,
+                   's390x': 282}
+
+
+def parsePriority(priority):
+    """Return (class, level) tuple for priority string, or None for an
+    empty string. Raises ValueError if priority is not valid"""
+    if not priority:
+        return None
+    className, _, level = priority.partition(':')
+    if className not in CLASSES:
+        raise ValueError('unknown I/O priority class: ' + className)
+    if className in ['none', 'idle']:
+        return CLASSES[className], 0
+    level = int(level or 4)
+    if not 0 <= level <= 7:
+        raise ValueError('I/O priority level must be between 0 and 7')
+    return CLASSES[className], level
+
+
+def setPriority(priority):
+    """Set I/O priority (string) of the calling thread; returns True on success"""
+    parsed = parsePriority(priority)
+    if parsed is None:
+        return True
+    ioClass, level = parsed
+    nr = SYSCALL_NUMBERS.get(platform.machine())
+    if nr is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    value = ioClass << IOPRIO_CLASS_SHIFT | level
+    if libc.syscall(nr, IOPRIO_WHO_PROCESS, 0, value) != 0:
+        errno = ctypes.get_errno()
+        logging.warning('cannot set I/O priority ' + priority + ': ' + os.strerror(errno))
+        return False
+    return True
+
+
+def ioniceArgs(priority):
+    """Return ionice command prefix for priority, or an empty list if
+    no priority is set or ionice is not available"""
+    parsed = parsePriority(priority)
+    if parsed is None or shutil.which('ionice') is None:
+        return []
+    ioClass, level = parsed
+    args = ['ionice', '-c', str(ioClass)]
+    if ioClass in [CLASSES['rt'], CLASSES['be']]:
+        args += ['-n', str(level)]
+    return args
@@ -0,0 +1,355 @@
+#! /usr/bin/env python3
+"""Partition table and file system detection.
+
+A LayoutProbe is a pipeline consumer: it keeps a copy of the first
+HEAD_SIZE bytes of the medium as they stream past, parses the partition
+table (MBR, including logical partitions, or GPT) from them, and then
+watches for the first bytes of every partition, where it recognises
+common file system superblocks (FAT, exFAT, NTFS, ext2/3/4, ISO 9660,
+HFS / HFS+). Bytes that did not stream past in order (e.g. with the dd
+or ddrescue read methods, or after read errors) are read from the image
+afterwards, which only takes a few small reads.
+"""
+
+import os
+import uuid
+import struct
+import logging
+
+# Bytes from the start of the medium / a partition that are kept; covers
+# the GPT header and entries, and the ISO 9660 primary volume descriptor
+HEAD_SIZE = 65536
+# Maximum size of GPT partition entry array, and number of logical partitions
+GPT_MAX_ENTRIES_SIZE = 1048576
+MAX_LOGICAL = 128
+
+MBR_TYPES = {0x01: 'FAT12', 0x04: 'FAT16 (<32 MiB)', 0x05: 'Extended', 0x06: 'FAT16',
+             0x07: 'NTFS / exFAT / HPFS', 0x0b: 'FAT32 (CHS)', 0x0c: 'FAT32 (LBA)',
+             0x0e: 'FAT16 (LBA)', 0x0f: 'Extended (LBA)', 0x82: 'Linux swap',
+             0x83: 'Linux', 0x85: 'Linux extended', 0x8e: 'Linux LVM',
+             0xa5: 'FreeBSD', 0xa6: 'OpenBSD', 0xa8: 'Apple UFS', 0xaf: 'Apple HFS / HFS+',
+             0xee: 'GPT protective', 0xef: 'EFI system', 0xfd: 'Linux RAID'}
+EXTENDED_TYPES = {0x05, 0x0f, 0x85}
+
+GPT_TYPES = {'c12a7328-f81f-11d2-ba4b-00a0c93ec93b': 'EFI system',
+             'e3c9e316-0b5c-4db8-817d-f92df00215ae': 'Microsoft reserved',
+             'ebd0a0a2-b9e5-4433-87c0-68b6b72699c7': 'Microsoft basic data',
+             'de94bba4-06d1-4d40-a16a-bfd50179d6ac': 'Windows recovery',
+             '0fc63daf-8483-4772-8e79-3d69d8477de4': 'Linux filesystem',
+             '0657fd6d-a4ab-43c4-84e5-0933c84b4f4f': 'Linux swap',
+             'e6d6d379-f507-44c2-a23c-238f2a3df928': 'Linux LVM',
+             'a19d880f-05fc-4d3b-a006-743f0f84911e': 'Linux RAID',
+             '21686148-6449-6e6f-744e-656564454649': 'BIOS boot',
+             '48465300-0000-11aa-aa11-00306543ecac': 'Apple HFS+',
+             '7c3457ef-0000-11aa-aa11-00306543ecac': 'Apple APFS',
+             '426f6f74-0000-11aa-aa11-00306543ecac': 'Apple boot'}
+
+
+def text(data, encoding='ascii'):
+    """Return data as stripped string"""
+    return data.decode(encoding, errors='replace').strip(' \x00')
+
+
+def detectFilesystem(data):
+    """Return dictionary with type and properties of the file system that
+    starts at data (the first bytes of a volume), or None"""
+    if len(data) < 2048:
+        return None
+
+    # NTFS / exFAT boot sector
+    if data[3:11] == b'NTFS    ':
+        bytesPerSector = struct.unpack_from('<H', data, 11)[0]
+        totalSectors = struct.unpack_from('<Q', data, 0x28)[0]
+        return {'type': 'NTFS',
+                'size': bytesPerSector * totalSectors,
+                'serial': '%016X' % struct.unpack_from('<Q', data, 0x48)[0]}
+    if data[3:11] == b'EXFAT   ':
+        return {'type': 'exFAT',
+                'size': struct.unpack_from('<Q', data, 72)[0] << data[108],
+                'serial': '%08X' % struct.unpack_from('<I', data, 100)[0]}
+
+    # FAT boot sector with a valid BIOS parameter block
+    bytesPerSector, sectorsPerCluster, reservedSectors, noFats = struct.unpack_from('<HBHB',
+                                                                                   data, 11)
+    if (data[510:512] == b'\x55\xaa' and bytesPerSector in (512, 1024, 2048, 4096) and
+            sectorsPerCluster and sectorsPerCluster & (sectorsPerCluster - 1) == 0 and
+            reservedSectors > 0 and noFats in (1, 2) and data[0] in (0xeb, 0xe9)):
+        totalSectors = struct.unpack_from('<H', data, 19)[0]
+        if totalSectors == 0:
+            totalSectors = struct.unpack_from('<I', data, 32)[0]
+        if data[82:87] == b'FAT32':
+            fs = {'type': 'FAT32', 'label': text(data[71:82]),
+                  'serial': '%08X' % struct.unpack_from('<I', data, 67)[0]}
+        elif data[54:59] == b'FAT12' or data[54:59] == b'FAT16' or data[54:62] == b'FAT     ':
+            fs = {'type': text(data[54:62]), 'label': text(data[43:54]),
+                  'serial': '%08X' % struct.unpack_from('<I', data, 39)[0]}
+        else:
+            fs = {'type': 'FAT'}
+        fs['size'] = bytesPerSector * totalSectors
+        return fs
+
+    # ext2/3/4 superblock at 1024
+    if struct.unpack_from('<H', data, 1024 + 56)[0] == 0xef53:
+        compat, incompat = struct.unpack_from('<II', data, 1024 + 92)
+        if incompat & 0x2c0:
+            # Extents, 64-bit or flex_bg
+            fsType = 'ext4'
+        elif compat & 0x4:
+            # Has journal
+            fsType = 'ext3'
+        else:
+            fsType = 'ext2'
+        blocksCount = struct.unpack_from('<I', data, 1024 + 4)[0]
+        blockSize = 1024 << struct.unpack_from('<I', data, 1024 + 24)[0]
+        return {'type': fsType,
+                'size': blocksCount * blockSize,
+                'label': text(data[1024 + 120:1024 + 136], 'utf-8'),
+                'uuid': str(uuid.UUID(bytes=bytes(data[1024 + 104:1024 + 120])))}
+
+    # HFS+ / HFSX volume header, or HFS master directory block, at 1024
+    signature = data[1024:1026]
+    if signature in (b'H+', b'HX'):
+        blockSize, totalBlocks = struct.unpack_from('>II', data, 1024 + 40)
+        return {'type': 'HFS+' if signature == b'H+' else 'HFSX',
+                'size': blockSize * totalBlocks}
+    if signature == b'BD':
+        noBlocks, blockSize = struct.unpack_from('>HI', data, 1024 + 18)
+        fs = {'type': 'HFS', 'size': noBlocks * blockSize,
+              'label': text(data[1024 + 37:1024 + 37 + min(data[1024 + 36], 27)], 'mac_roman')}
+        if data[1024 + 0x7c:1024 + 0x7e] == b'H+':
+            fs['type'] = 'HFS+ (HFS wrapper)'
+        return fs
+
+    # ISO 9660 primary volume descriptor in sector 16
+    if len(data) >= 34816 and data[32768] == 1 and data[32769:32774] == b'CD001':
+        volumeSize = struct.unpack_from('<I', data, 32768 + 80)[0]
+        blockSize = struct.unpack_from('<H', data, 32768 + 128)[0]
+        return {'type': 'ISO 9660',
+                'size': volumeSize * blockSize,
+                'label': text(data[32768 + 40:32768 + 72])}
+    return None
+
+
+class Capture:
+    """Region of the medium that the probe keeps a copy of"""
+
+    def __init__(self, start, size, kind, info=None):
+        """initialise Capture instance"""
+        self.start = start
+        self.size = size
+        self.kind = kind
+        self.info = info
+        self.buf = bytearray(size)
+        self.received = 0
+
+    def complete(self):
+        """Return True if all bytes were received"""
+        return self.received >= self.size
+
+
+class LayoutProbe:
+    """Detects partition table and file systems from the data stream.
+    Works as a pipeline consumer (see pipeline.Consumer)"""
+
+    name = 'layout'
+
+    def __init__(self, sectorSize=512):
+        """initialise LayoutProbe instance"""
+        self.sectorSize = sectorSize
+        self.layout = {'partitionTable': None, 'filesystem': None, 'partitions': []}
+        self.pending = [Capture(0, HEAD_SIZE, 'head')]
+        self.noLogical = 0
+
+    def open(self):
+        """Nothing to open"""
+
+    def process(self, view, offset):
+        """Copy data in view that falls in a pending capture"""
+        end = offset + len(view)
+        captures = list(self.pending)
+        while captures:
+            noPending = len(self.pending)
+            for capture in captures:
+                start = max(offset, capture.start)
+                stop = min(end, capture.start + capture.size)
+                if start >= stop:
+                    continue
+                capture.buf[start - capture.start:stop - capture.start] = \
+                    view[start - offset:stop - offset]
+                capture.received += stop - start
+                if capture.complete():
+                    self.pending.remove(capture)
+                    noPending -= 1
+                    self.parse(capture)
+            # Captures found by parsing may start in this same view
+            captures = self.pending[noPending:]
+
+    def close(self):
+        """Nothing to close"""
+
+    def add(self, start, size, kind, info=None):
+        """Watch for size bytes at start"""
+        if size > 0:
+            self.pending.append(Capture(start, size, kind, info))
+
+    def parse(self, capture):
+        """Interpret a completed capture"""
+        try:
+            if capture.kind == 'head':
+                self.parseHead(capture.buf)
+            elif capture.kind == 'gptEntries':
+                self.parseGptEntries(capture.buf, capture.info)
+            elif capture.kind == 'ebr':
+                self.parseEbr(capture.buf, capture.start, capture.info)
+            elif capture.kind == 'partition':
+                capture.info['filesystem'] = detectFilesystem(capture.buf)
+        except (struct.error, IndexError, ValueError) as e:
+            logging.warning('cannot parse ' + capture.kind + ' at offset ' +
+                            str(capture.start) + ': ' + str(e))
+
+    def parseHead(self, data):
+        """Parse start of medium: whole-medium file system and partition table"""
+        fs = detectFilesystem(data)
+        self.layout['filesystem'] = fs
+        if fs is not None and fs['type'] in ('FAT12', 'FAT16', 'FAT32', 'FAT', 'exFAT', 'NTFS'):
+            # Boot sector, so no partition table
+            return
+        for sectorSize in sorted({self.sectorSize, 512, 4096}):
+            if data[sectorSize:sectorSize + 8] == b'EFI PART':
+                self.parseGptHeader(data, sectorSize)
+                return
+        if data[510:512] == b'\x55\xaa':
+            self.parseMbr(data)
+
+    def addPartition(self, partition):
+        """Add partition, and watch for its first bytes"""
+        self.layout['partitions'].append(partition)
+        partition['filesystem'] = None
+        self.add(partition['offset'], min(HEAD_SIZE, partition['size']), 'partition', partition)
+
+    def mbrEntries(self, data):
+        """Return list of (bootable, type, start LBA, number of sectors) for
+        the non-empty entries of the MBR / EBR in data. Raises ValueError if
+        it doesn't look like a partition table"""
+        entries = []
+        for i in range(4):
+            status, partType, startLba, noSectors = struct.unpack_from('<B3xB3xII', data,
+                                                                       446 + 16 * i)
+            if partType == 0 or noSectors == 0:
+                continue
+            if status not in (0x00, 0x80):
+                raise ValueError('invalid partition table entry')
+            entries.append((status == 0x80, partType, startLba, noSectors))
+        return entries
+
+    def parseMbr(self, data):
+        """Parse MBR partition table"""
+        try:
+            entries = self.mbrEntries(data)
+        except ValueError:
+            return
+        if not entries:
+            return
+        self.layout['partitionTable'] = 'MBR'
+        self.layout['sectorSize'] = self.sectorSize
+        self.layout['diskSignature'] = '%08X' % struct.unpack_from('<I', data, 440)[0]
+        for number, (bootable, partType, startLba, noSectors) in enumerate(entries, 1):
+            offset = startLba * self.sectorSize
+            size = noSectors * self.sectorSize
+            if partType in EXTENDED_TYPES:
+                self.layout['partitions'].append({'number': number, 'offset': offset,
+                                                  'size': size, 'type': '0x%02x' % partType,
+                                                  'typeName': MBR_TYPES[partType]})
+                self.add(offset, 512, 'ebr', startLba)
+                continue
+            self.addPartition({'number': number, 'offset': offset, 'size': size,
+                               'type': '0x%02x' % partType,
+                               'typeName': MBR_TYPES.get(partType, 'unknown'),
+                               'bootable': bootable})
+
+    def parseEbr(self, data, ebrOffset, extendedStartLba):
+        """Parse extended boot record: one logical partition, and a link to
+        the next EBR (relative to the start of the extended partition)"""
+        if data[510:512] != b'\x55\xaa':
+            return
+        for bootable, partType, startLba, noSectors in self.mbrEntries(data):
+            if partType in EXTENDED_TYPES:
+                self.noLogical += 1
+                if self.noLogical < MAX_LOGICAL:
+                    self.add((extendedStartLba + startLba) * self.sectorSize, 512, 'ebr',
+                             extendedStartLba)
+            else:
+                self.addPartition({'number': 5 + self.noLogical,
+                                   'offset': ebrOffset + startLba * self.sectorSize,
+                                   'size': noSectors * self.sectorSize,
+                                   'type': '0x%02x' % partType,
+                                   'typeName': MBR_TYPES.get(partType, 'unknown'),
+                                   'bootable': bootable})
+
+    def parseGptHeader(self, data, sectorSize):
+        """Parse GPT header at sectorSize, and watch for its partition entries"""
+        diskGuid = uuid.UUID(bytes_le=bytes(data[sectorSize + 56:sectorSize + 72]))
+        entriesLba, noEntries, entrySize = struct.unpack_from('<QII', data, sectorSize + 72)
+        if entrySize < 128 or noEntries * entrySize > GPT_MAX_ENTRIES_SIZE:
+            raise ValueError('invalid GPT header')
+        self.layout['partitionTable'] = 'GPT'
+        self.layout['sectorSize'] = sectorSize
+        self.layout['diskGUID'] = str(diskGuid)
+        self.add(entriesLba * sectorSize, noEntries * entrySize, 'gptEntries',
+                 (sectorSize, entrySize))
+
+    def parseGptEntries(self, data, info):
+        """Parse GPT partition entries"""
+        sectorSize, entrySize = info
+        for number, pos in enumerate(range(0, len(data), entrySize), 1):
+            entry = bytes(data[pos:pos + entrySize])
+            if entry[:16] == bytes(16):
+                # Unused entry
+                continue
+            typeGuid = str(uuid.UUID(bytes_le=entry[:16]))
+            firstLba, lastLba = struct.unpack_from('<QQ', entry, 32)
+            self.addPartition({'number': number,
+                               'offset': firstLba * sectorSize,
+                               'size': (lastLba - firstLba + 1) * sectorSize,
+                               'type': typeGuid,
+                               'typeName': GPT_TYPES.get(typeGuid, 'unknown'),
+                               'name': text(entry[56:128], 'utf-16-le'),
+                               'guid': str(uuid.UUID(bytes_le=entry[16:32]))})
+
+    def result(self, imageFile=None):
+        """Return layout dictionary. Captures that didn't stream past are
+        read from imageFile (if set)"""
+        if imageFile is not None:
+            try:
+                fd = os.open(imageFile, os.O_RDONLY)
+            except OSError as e:
+                logging.warning('cannot read ' + imageFile + ' for layout detection: ' + str(e))
+                fd = None
+            try:
+                while fd is not None and self.pending:
+                    capture = self.pending.pop(0)
+                    data = os.pread(fd, capture.size, capture.start)
+                    capture.buf[:len(data)] = data
+                    if data:
+                        self.parse(capture)
+            finally:
+                if fd is not None:
+                    os.close(fd)
+        self.layout['partitions'].sort(key=lambda p: p['number'])
+        return self.layout
+
+
+def summary(layout):
+    """Return list of lines that describe layout, for the log"""
+    lines = ['partition table: ' + str(layout['partitionTable'])]
+    if layout['filesystem'] is not None:
+        lines.append('file system on medium: ' + layout['filesystem']['type'])
+    for partition in layout['partitions']:
+        line = ('partition ' + str(partition['number']) + ': offset ' +
+                str(partition['offset']) + ', size ' + str(partition['size']) + ', ' +
+                partition['typeName'])
+        if 'filesystem' in partition:
+            fs = partition['filesystem']
+            line += ', file system: ' + (fs['type'] if fs is not None else 'unknown')
+        lines.append(line)
+    return lines
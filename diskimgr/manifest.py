@@ -0,0 +1,291 @@
+#! /usr/bin/env python3
+"""Block-hash manifests, for verifying (parts of) an image quickly.
+
+A manifest holds a digest for every blockSize bytes of an image (the last
+block may be shorter). It is computed in the same read pass as the image's
+SHA-512, either while reading the medium (native read method) or while the
+checksum file is made. With a manifest, any byte range of the image can be
+checked by hashing only the blocks that overlap it, and a full check can
+hash blocks on all cores in parallel. Damaged blocks are reported by their
+offset.
+
+File format (compact binary, next to the image as IMAGE.blockhash):
+
+    diskimgr-blockhash\\n
+    one line of JSON: algorithm, blockSize, imageSize, digestSize, noBlocks
+    noBlocks digests of digestSize bytes, in block order
+
+Running this module verifies an image against its manifest.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import hashlib
+import argparse
+import concurrent.futures
+from . import status
+
+MAGIC = b'diskimgr-blockhash\n'
+MANIFEST_SUFFIX = '.blockhash'
+# Number of blocks that a verification worker checks per task
+BLOCKS_PER_TASK = 64
+
+
+class Manifest:
+    """Per-block digests of an image"""
+
+    def __init__(self, algorithm, blockSize, imageSize=0, digests=b''):
+        """initialise Manifest instance"""
+        self.algorithm = algorithm
+        self.blockSize = blockSize
+        self.imageSize = imageSize
+        self.digestSize = hashlib.new(algorithm).digest_size
+        self.digests = digests
+
+    def noBlocks(self):
+        """Return number of blocks"""
+        return len(self.digests) // self.digestSize
+
+    def digest(self, block):
+        """Return digest of block"""
+        start = block * self.digestSize
+        return self.digests[start:start + self.digestSize]
+
+    def blockRange(self, block):
+        """Return (offset, size) of block in the image"""
+        offset = block * self.blockSize
+        return offset, min(self.blockSize, self.imageSize - offset)
+
+    def blocksIn(self, start, end):
+        """Return range of blocks that overlap bytes [start, end) of the image"""
+        end = min(end, self.imageSize)
+        if end <= start:
+            return range(0)
+        return range(start // self.blockSize, (end - 1) // self.blockSize + 1)
+
+    def write(self, path):
+        """Write manifest to path"""
+        header = {'algorithm': self.algorithm,
+                  'blockSize': self.blockSize,
+                  'imageSize': self.imageSize,
+                  'digestSize': self.digestSize,
+                  'noBlocks': self.noBlocks()}
+        with io.open(path, 'wb') as f:
+            f.write(MAGIC)
+            f.write(json.dumps(header, sort_keys=True).encode('utf-8') + b'\n')
+            f.write(self.digests)
+
+
+def readManifest(path):
+    """Return Manifest read from path. Raises OSError if it can't be read,
+    and ValueError if it isn't a valid manifest"""
+    with io.open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError(path + ' is not a block-hash manifest')
+        header = json.loads(f.readline().decode('utf-8'))
+        digests = f.read()
+    try:
+        manifest = Manifest(header['algorithm'], int(header['blockSize']),
+                            int(header['imageSize']), digests)
+        noBlocks = int(header['noBlocks'])
+    except (KeyError, TypeError) as e:
+        raise ValueError(path + ': missing or invalid header field ' + str(e))
+    if manifest.blockSize <= 0 or manifest.digestSize != header.get('digestSize'):
+        raise ValueError(path + ': invalid block or digest size')
+    if len(digests) != noBlocks * manifest.digestSize:
+        raise ValueError(path + ': truncated manifest')
+    return manifest
+
+
+class BlockHasher:
+    """Computes per-block digests of a data stream that is fed in order.
+    Works as a pipeline consumer (see pipeline.Consumer), and can also be
+    fed directly with update()"""
+
+    name = 'hash-blocks'
+
+    def __init__(self, blockSize, algorithm='sha256'):
+        """initialise BlockHasher instance"""
+        self.blockSize = blockSize
+        self.algorithm = algorithm
+        self.m = hashlib.new(algorithm)
+        self.digests = bytearray()
+        self.filled = 0
+        self.size = 0
+
+    def open(self):
+        """Nothing to open"""
+
+    def process(self, view, offset):
+        """Add data in view (pipeline consumer interface)"""
+        self.update(view)
+
+    def close(self):
+        """Nothing to close; a rescue may feed several pipeline runs, so the
+        last block is only finished by manifest()"""
+
+    def update(self, data):
+        """Add data, completing blocks as they fill up"""
+        view = memoryview(data)
+        while view:
+            noBytes = min(len(view), self.blockSize - self.filled)
+            self.m.update(view[:noBytes])
+            self.filled += noBytes
+            self.size += noBytes
+            view = view[noBytes:]
+            if self.filled == self.blockSize:
+                self.digests += self.m.digest()
+                self.m = hashlib.new(self.algorithm)
+                self.filled = 0
+
+    def finish(self):
+        """Add digest of the last, partial block"""
+        if self.filled:
+            self.digests += self.m.digest()
+            self.m = hashlib.new(self.algorithm)
+            self.filled = 0
+
+    def manifest(self):
+        """Return Manifest of everything that was added"""
+        self.finish()
+        return Manifest(self.algorithm, self.blockSize, self.size, bytes(self.digests))
+
+
+def checkBlocks(fd, manifest, blocks):
+    """Hash blocks (iterable of block numbers) of image fd; returns list of
+    (block, error) for blocks that don't match (error is None for a
+    digest mismatch)"""
+    damaged = []
+    for block in blocks:
+        offset, size = manifest.blockRange(block)
+        try:
+            data = os.pread(fd, size, offset)
+        except OSError as e:
+            damaged.append((block, str(e)))
+            continue
+        if len(data) != size:
+            damaged.append((block, 'image is truncated'))
+        elif hashlib.new(manifest.algorithm, data).digest() != manifest.digest(block):
+            damaged.append((block, None))
+    return damaged
+
+
+def verifyImage(imageFile, manifest, ranges=None, noWorkers=None):
+    """Verify imageFile against manifest. If ranges (list of (start, end)
+    byte ranges) is set, only the blocks overlapping them are checked.
+    Blocks are hashed by noWorkers threads (default: number of cores).
+    Returns dictionary with the results"""
+    t0 = time.perf_counter()
+    if ranges is None:
+        ranges = [(0, manifest.imageSize)]
+    blocks = set()
+    for start, end in ranges:
+        blocks.update(manifest.blocksIn(start, end))
+    blocks = sorted(blocks)
+    tasks = [blocks[i:i + BLOCKS_PER_TASK] for i in range(0, len(blocks), BLOCKS_PER_TASK)]
+    if noWorkers is None:
+        noWorkers = os.cpu_count() or 1
+
+    result = {'image': imageFile,
+              'imageSize': os.path.getsize(imageFile),
+              'manifestImageSize': manifest.imageSize,
+              'algorithm': manifest.algorithm,
+              'blockSize': manifest.blockSize,
+              'blocksChecked': len(blocks),
+              'bytesChecked': sum(manifest.blockRange(block)[1] for block in blocks)}
+    damaged = []
+    fd = os.open(imageFile, os.O_RDONLY)
+    try:
+        # hashlib releases the GIL for large buffers, so threads use all cores
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, noWorkers)) as executor:
+            check = status.job.inherit(lambda task: checkBlocks(fd, manifest, task))
+            for taskResult in executor.map(check, tasks):
+                damaged += taskResult
+    finally:
+        os.close(fd)
+
+    result['damagedBlocks'] = []
+    for block, error in damaged:
+        offset, size = manifest.blockRange(block)
+        entry = {'block': block, 'offset': offset, 'size': size}
+        if error is not None:
+            entry['error'] = error
+        result['damagedBlocks'].append(entry)
+    result['elapsed'] = round(time.perf_counter() - t0, 3)
+    result['verified'] = not damaged and result['imageSize'] == manifest.imageSize
+    return result
+
+
+def parseRange(rangeString):
+    """Return (start, end) for range 'START:END' (END exclusive, either
+    may be omitted). Raises ValueError"""
+    start, sep, end = rangeString.partition(':')
+    if not sep:
+        raise ValueError('range must be START:END')
+    start = int(start) if start else 0
+    end = int(end) if end else sys.maxsize
+    if start < 0 or end < start:
+        raise ValueError('invalid range ' + rangeString)
+    return start, end
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('imageFile',
+                        action='store',
+                        help='image file')
+    parser.add_argument('--manifest', '-m',
+                        action='store',
+                        dest='manifestFile',
+                        default=None,
+                        help='block-hash manifest (default: IMAGE' + MANIFEST_SUFFIX + ')')
+    parser.add_argument('--range', '-r',
+                        action='append',
+                        dest='ranges',
+                        default=None,
+                        help='only check byte range START:END (END exclusive); can be ' +
+                        'repeated (default: whole image)')
+    parser.add_argument('--workers', '-w',
+                        action='store',
+                        type=int,
+                        dest='noWorkers',
+                        default=None,
+                        help='number of blocks that are hashed in parallel ' +
+                        '(default: number of cores)')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Verify an image against its block-hash manifest"""
+
+    parser = argparse.ArgumentParser(description='verify image against block-hash manifest')
+    args = parseCommandLine(parser)
+
+    manifestFile = args.manifestFile
+    if manifestFile is None:
+        manifestFile = args.imageFile + MANIFEST_SUFFIX
+    try:
+        ranges = None
+        if args.ranges is not None:
+            ranges = [parseRange(r) for r in args.ranges]
+        manifest = readManifest(manifestFile)
+        result = verifyImage(args.imageFile, manifest, ranges, args.noWorkers)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('ERROR: ' + str(e) + '\n')
+        sys.exit(2)
+
+    result['manifest'] = manifestFile
+    json.dump(result, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    if not result['verified']:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+#! /usr/bin/env python3
+"""Native read method: images the device from Python, without
+wrapping around an external tool"""
+
+import os
+import time
+import errno
+import fcntl
+import logging
+from . import cancel
+from . import manifest
+from . import pipeline
+from . import rescue
+from . import shared
+from . import simdevice
+from . import status
+from . import targetio
+from . import throttle
+
+# Errors that mean a copy primitive is not supported for this source / target
+UNSUPPORTED_ERRORS = {errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EBADF,
+                      errno.ESPIPE, errno.EOPNOTSUPP, errno.ENOTSUP}
+
+# Errors that are caused by the target rather than the source
+TARGET_ERRORS = {errno.ENOSPC, errno.EDQUOT, errno.EFBIG}
+
+
+class KernelCopy:
+    """Copies source to image file without passing the data through user
+    space, using copy_file_range, sendfile or splice (whichever works first).
+    Exposes the same result attributes as pipeline.Pipeline"""
+
+    def __init__(self, source, fdOut, chunkSize, writeBehind, start=0, end=None,
+                 cancelToken=None):
+        """initialise KernelCopy instance"""
+        self.source = source
+        self.fdOut = fdOut
+        self.chunkSize = chunkSize
+        self.writeBehind = writeBehind
+        self.start = start
+        if end is None:
+            end = source.size
+        self.end = end
+        self.methods = []
+        if hasattr(os, 'copy_file_range'):
+            self.methods.append(('copy_file_range', self.copyFileRange))
+        if hasattr(os, 'sendfile'):
+            self.methods.append(('sendfile', self.sendFile))
+        if hasattr(os, 'splice'):
+            self.methods.append(('splice', self.splice))
+        self.method = None
+        self.pipe = None
+        self.bytesRead = 0
+        self.elapsed = 0.0
+        self.readErrors = []
+        self.consumerErrors = []
+        self.interrupted = False
+        if cancelToken is None:
+            cancelToken = cancel.CancelToken()
+        self.cancelToken = cancelToken
+
+    def copyFileRange(self, offset, count):
+        """Copy chunk with copy_file_range"""
+        return os.copy_file_range(self.source.fileno(), self.fdOut, count, offset, offset)
+
+    def sendFile(self, offset, count):
+        """Copy chunk with sendfile, which writes at the current target position"""
+        os.lseek(self.fdOut, offset, os.SEEK_SET)
+        return os.sendfile(self.fdOut, self.source.fileno(), offset, count)
+
+    def splice(self, offset, count):
+        """Copy chunk with splice, through a pipe"""
+        if self.pipe is None:
+            self.pipe = os.pipe()
+            try:
+                fcntl.fcntl(self.pipe[1], fcntl.F_SETPIPE_SZ, self.chunkSize)
+            except (OSError, AttributeError):
+                pass
+        pipeRead, pipeWrite = self.pipe
+        inPipe = os.splice(self.source.fileno(), pipeWrite, count, offset_src=offset)
+        written = 0
+        while written < inPipe:
+            written += os.splice(pipeRead, self.fdOut, inPipe - written,
+                                 offset_dst=offset + written)
+        return inPipe
+
+    def run(self):
+        """Copy until end of source, interrupt or error"""
+        t0 = time.perf_counter()
+        offset = self.start
+        methods = list(self.methods)
+        while offset < self.end and methods:
+            if self.cancelToken.isCancelled():
+                self.interrupted = True
+                break
+            name, copyChunk = methods[0]
+            count = min(self.chunkSize, self.end - offset)
+            try:
+                copied = copyChunk(offset, count)
+            except OSError as e:
+                if e.errno in UNSUPPORTED_ERRORS:
+                    # Try next method from the same offset
+                    methods.pop(0)
+                    continue
+                if e.errno in TARGET_ERRORS:
+                    self.consumerErrors.append(('writer', str(e)))
+                else:
+                    self.readErrors.append((offset, count, str(e)))
+                break
+            if copied == 0:
+                # Some primitives report EOF for block devices (st_size is 0)
+                methods.pop(0)
+                continue
+            self.method = name
+            self.writeBehind.written(offset, copied)
+            status.job.addBytes(copied)
+            offset += copied
+        self.bytesRead = offset - self.start
+        if self.pipe is not None:
+            os.close(self.pipe[0])
+            os.close(self.pipe[1])
+        self.elapsed = time.perf_counter() - t0
+
+
+def copyKernel(source, imageFile, chunkSize, preallocate, syncInterval, dropCache,
+               cancelToken=None):
+    """Run a KernelCopy from source to imageFile, and return it"""
+    fdOut = os.open(imageFile, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if preallocate:
+            targetio.preallocate(fdOut, source.size)
+        writeBehind = targetio.WriteBehind(fdOut, syncInterval, dropCache)
+        k = KernelCopy(source, fdOut, chunkSize, writeBehind, cancelToken=cancelToken)
+        k.run()
+        try:
+            writeBehind.finish()
+        except OSError as e:
+            k.consumerErrors.append(('writer', str(e)))
+    finally:
+        os.close(fdOut)
+    return k
+
+
+def readNative(blockDevice, imageFile, blockSize, bufferSize, memoryBudget,
+               hashAlgorithms, preallocate=False, syncInterval=0, dropCache=False,
+               kernelCopy=False, mapFile=None, retries=0, direct=False, bandwidth=0,
+               cancelToken=None, blockHashSize=0, blockHashAlgorithm='sha256',
+               extraConsumers=None):
+    """Image blockDevice to imageFile; returns the same items as the
+    wrapper functions, plus a dictionary with acquisition statistics.
+    If kernelCopy is True, data are copied inside the kernel where possible
+    (no inline hashing in that case). Read errors are handled with the
+    strategy in rescue.py, and progress is kept in mapFile. If direct is
+    True, the device is read with O_DIRECT (like ddrescue's direct disc mode).
+    Reads are limited to bandwidth bytes/s (0: unlimited). Reading stops
+    when cancelToken (cancel.CancelToken) is cancelled. If blockHashSize is
+    set, a block-hash manifest is computed inline as well (see manifest.py).
+    extraConsumers (pipeline consumers, e.g. layout.LayoutProbe or
+    sinks.FileSink) see the data of the first pass"""
+
+    errorFlag = False
+    interruptedFlag = False
+    exitStatus = 0
+    stats = {'checksums': {}}
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
+
+    # Buffer size must be a multiple of the block size
+    bufferSize = max(blockSize, bufferSize - bufferSize % blockSize)
+
+    if bandwidth > 0 and kernelCopy:
+        logging.warning('kernel copy cannot be throttled, using user-space copy')
+        kernelCopy = False
+
+    # Logging
+    args = ['native']
+    args.append('if=' + blockDevice)
+    args.append('of=' + imageFile)
+    args.append('bs=' + str(bufferSize))
+    if kernelCopy:
+        args.append('copy=kernel')
+    else:
+        args.append('mem=' + str(memoryBudget))
+    args.append('retries=' + str(retries))
+    if mapFile:
+        args.append('map=' + mapFile)
+    if direct:
+        args.append('iflag=direct')
+    if bandwidth > 0:
+        args.append('rate=' + str(bandwidth))
+    cmdLine = ' '.join(args)
+    logging.info('Command: ' + cmdLine)
+
+    try:
+        source = pipeline.openSource(blockDevice, direct)
+    except OSError as e:
+        logging.error('cannot open ' + blockDevice + ': ' + str(e))
+        return cmdLine, 1, True, interruptedFlag, stats
+
+    if direct and not source.direct:
+        logging.warning('direct disc mode not supported for ' + blockDevice)
+
+    device = source
+    if bandwidth > 0:
+        source = throttle.ThrottledSource(source,
+                                          throttle.TokenBucket(bandwidth,
+                                                               max(bandwidth, bufferSize)))
+
+    rescueMap = rescue.mapFromFile(mapFile, source.size)
+    resumed = rescueMap.sizeWith(rescue.NON_TRIED) != source.size
+    if resumed:
+        status.job.setBytes(rescueMap.sizeWith(rescue.FINISHED))
+
+    k = None
+    r = None
+    hashers = []
+    blockHasher = None
+    readErrors = []
+    consumerErrors = []
+    try:
+        if kernelCopy and not resumed:
+            try:
+                k = copyKernel(source, imageFile, bufferSize, preallocate,
+                               syncInterval, dropCache, cancelToken)
+            except OSError as e:
+                logging.error('cannot open ' + imageFile + ': ' + str(e))
+                return cmdLine, 1, errorFlag, interruptedFlag, stats
+            if k.method is None and k.bytesRead == 0 and not k.interrupted:
+                logging.warning('kernel copy not supported for this device / file system, '
+                                'falling back to user-space copy')
+                k = None
+            else:
+                rescueMap.mark(0, k.bytesRead, rescue.FINISHED)
+                readErrors += k.readErrors
+                consumerErrors += k.consumerErrors
+                interruptedFlag = k.interrupted
+                if mapFile and not rescueMap.isFinished():
+                    rescueMap.write(mapFile, k.bytesRead, rescue.NON_TRIED, 1)
+        if not rescueMap.isFinished() and not interruptedFlag and not consumerErrors:
+            if k is None and not resumed:
+                # Inline hashing only works for a single pass over the whole source
+                hashers = [pipeline.Hasher(algorithm) for algorithm in hashAlgorithms]
+                if blockHashSize > 0:
+                    blockHasher = manifest.BlockHasher(blockHashSize, blockHashAlgorithm)
+            consumers = list(hashers)
+            if blockHasher is not None:
+                consumers.append(blockHasher)
+            if extraConsumers is not None:
+                consumers += extraConsumers
+            preallocateSize = 0
+            if preallocate:
+                preallocateSize = source.size
+            writer = pipeline.FileWriter(imageFile, preallocateSize, syncInterval, dropCache)
+            r = rescue.Rescue(source, writer, rescueMap, mapFile, blockSize, bufferSize,
+                              memoryBudget, retries, consumers, cancelToken)
+            r.run()
+            readErrors += [(offset, noBytes, 'read error') for offset, noBytes in r.readErrors]
+            consumerErrors += r.consumerErrors
+            interruptedFlag = r.interrupted
+    finally:
+        source.close()
+
+    if interruptedFlag:
+        logging.warning('*** native read interrupted by user ***')
+        cancelToken.stopped('native read')
+
+    if k is not None:
+        for offset, noBytes, error in k.readErrors:
+            logging.error('read error at offset ' + str(offset) + ' (' +
+                          str(noBytes) + ' bytes): ' + error)
+
+    for name, error in consumerErrors:
+        exitStatus = 1
+        logging.error(name + ' error: ' + error)
+
+    if readErrors or (not rescueMap.isFinished() and not interruptedFlag):
+        errorFlag = True
+
+    bytesRead = 0
+    elapsed = 0.0
+    for run in [k, r]:
+        if run is not None:
+            bytesRead += run.bytesRead
+            elapsed += run.elapsed
+    rate = bytesRead / elapsed if elapsed > 0 else 0
+    logging.info('native bytes read: ' + str(bytesRead))
+    logging.info('native bytes rescued: ' + str(rescueMap.sizeWith(rescue.FINISHED)) +
+                 ' of ' + str(source.size))
+    logging.info('native throughput: ' + shared.sizeof_fmt(rate) + '/s',
+                 extra={'event': 'readSummary', 'bytesRead': bytesRead, 'rate': round(rate),
+                        'errors': len(readErrors)})
+    stats['deviceSize'] = source.size
+    stats['bytesRead'] = bytesRead
+    stats['elapsed'] = round(elapsed, 3)
+    stats['throughput'] = round(rate)
+    stats['bufferSize'] = bufferSize
+
+    if k is not None:
+        logging.info('native copy method: ' + str(k.method))
+        stats['copyMethod'] = k.method
+    else:
+        stats['copyMethod'] = 'pipeline'
+    if r is not None and r.pipelines:
+        # Buffer statistics of the first (and normally only large) pipeline run
+        p = r.pipelines[0]
+        logging.info('native buffers: ' + str(p.ring.noBuffers) + ' x ' +
+                     shared.sizeof_fmt(bufferSize))
+        for name, stageStats in p.stats().items():
+            logging.info('native stage ' + name + ': ' + str(stageStats['stalls']) +
+                         ' stalls, ' + str(stageStats['stallTime']) + ' s stalled, ' +
+                         str(stageStats['busyTime']) + ' s busy')
+        logging.info('native bottleneck: ' + p.bottleneck())
+        stats['noBuffers'] = p.ring.noBuffers
+        stats['stages'] = p.stats()
+        stats['bottleneck'] = p.bottleneck()
+    if r is not None:
+        stats['rescue'] = r.stats()
+    if isinstance(device, simdevice.SimulatedDevice):
+        stats['simulatedDevice'] = device.stats()
+        stats['deviceTime'] = device.simulatedTime
+    if bandwidth > 0:
+        stats['throttleWait'] = round(source.bucket.waitTime, 3)
+
+    # Inline digests are only valid if the image holds exactly the bytes read
+    checksums = {}
+    inlineValid = False
+    if (hashers or blockHasher) and not errorFlag and exitStatus == 0 and not interruptedFlag:
+        try:
+            inlineValid = os.path.getsize(imageFile) == source.size
+        except OSError:
+            pass
+    if inlineValid:
+        for hasher in hashers:
+            checksums[hasher.algorithm] = hasher.hexdigest()
+    stats['checksums'] = checksums
+    if inlineValid and blockHasher is not None:
+        manifestFile = imageFile + manifest.MANIFEST_SUFFIX
+        try:
+            blockHasher.manifest().write(manifestFile)
+        except IOError:
+            # Checksumming makes a new one
+            logging.error('error while writing block-hash manifest ' + manifestFile)
+            try:
+                os.remove(manifestFile)
+            except OSError:
+                pass
+
+    if exitStatus == 0:
+        logging.info('native status: ' + str(exitStatus))
+        logging.info('native errorFlag: ' + str(errorFlag))
+    else:
+        logging.error('native status: ' + str(exitStatus))
+        logging.info('native errorFlag: ' + str(errorFlag))
+
+    return cmdLine, exitStatus, errorFlag, interruptedFlag, stats
@@ -0,0 +1,355 @@
+#! /usr/bin/env python3
+"""Threaded read / write pipeline used by the native read method.
+
+A reader thread fills preallocated buffers from the source device, and
+hands them to one thread per consumer (image writer, hashers) through a
+bounded ring. Buffers are passed around as memoryview slices, and go back
+to the ring once every consumer is done with them, so no data is copied
+or allocated per block.
+"""
+
+import os
+import mmap
+import time
+import queue
+import threading
+import hashlib
+from . import cancel
+from . import shared
+from . import simdevice
+from . import status
+from . import targetio
+
+
+class StageStats:
+    """Throughput and stall counters for one pipeline stage"""
+
+    def __init__(self, name):
+        """initialise StageStats instance"""
+        self.name = name
+        self.bytes = 0
+        self.blocks = 0
+        self.stalls = 0
+        self.stallTime = 0.0
+        self.busyTime = 0.0
+
+    def asDict(self):
+        """Return counters as dictionary"""
+        return {'bytes': self.bytes,
+                'blocks': self.blocks,
+                'stalls': self.stalls,
+                'stallTime': round(self.stallTime, 3),
+                'busyTime': round(self.busyTime, 3)}
+
+
+def allocateBuffer(size, aligned):
+    """Return buffer of size bytes. Direct (O_DIRECT) reads need page-aligned
+    memory, which an anonymous mmap provides"""
+    if aligned:
+        return mmap.mmap(-1, size)
+    return bytearray(size)
+
+
+class Slot:
+    """Preallocated buffer that cycles through the ring"""
+
+    def __init__(self, size, aligned=False):
+        """initialise Slot instance"""
+        self.buffer = allocateBuffer(size, aligned)
+        self.view = memoryview(self.buffer)
+        self.offset = 0
+        self.length = 0
+        self.refCount = 0
+
+
+class BufferRing:
+    """Fixed set of buffers shared by the reader and the consumers"""
+
+    def __init__(self, bufferSize, memoryBudget, aligned=False):
+        """initialise BufferRing instance"""
+        self.bufferSize = bufferSize
+        # Need at least 2 buffers, otherwise reader and consumers cannot overlap
+        self.noBuffers = max(2, memoryBudget // bufferSize)
+        self.slots = [Slot(bufferSize, aligned) for _ in range(self.noBuffers)]
+        self.free = queue.Queue()
+        self.lock = threading.Lock()
+        for slot in self.slots:
+            self.free.put(slot)
+
+    def acquire(self, stats):
+        """Return a free slot, blocking until one is available"""
+        return timedGet(self.free, stats)
+
+    def release(self, slot):
+        """Return slot to free list once all consumers have released it"""
+        with self.lock:
+            slot.refCount -= 1
+            isFree = slot.refCount == 0
+        if isFree:
+            self.free.put(slot)
+
+
+def timedGet(q, stats):
+    """Get item from queue, and record a stall in stats if we had to wait"""
+    try:
+        return q.get_nowait()
+    except queue.Empty:
+        stats.stalls += 1
+        t0 = time.perf_counter()
+        item = q.get()
+        stats.stallTime += time.perf_counter() - t0
+        return item
+
+
+def openSource(path, direct=False):
+    """Return source for path: a simulated device if path is a simulator
+    spec file, and a BlockSource otherwise"""
+    if simdevice.isSpecFile(path):
+        return simdevice.fromSpecFile(path, direct)
+    return BlockSource(path, direct)
+
+
+class BlockSource:
+    """Read-only source (block device or image file) with positional reads.
+    If direct is True, reads bypass the page cache (O_DIRECT), so one bad
+    sector doesn't fail the read of the whole cache page around it"""
+
+    def __init__(self, path, direct=False):
+        """initialise BlockSource instance"""
+        self.path = path
+        self.direct = False
+        if direct:
+            try:
+                self.fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+                self.direct = True
+            except OSError:
+                # Not supported by this device / file system
+                self.fd = os.open(path, os.O_RDONLY)
+        else:
+            self.fd = os.open(path, os.O_RDONLY)
+        try:
+            self.size = shared.getDeviceSize(path)
+        except OSError:
+            # Not a block device, so use file size instead
+            self.size = os.fstat(self.fd).st_size
+
+    def fileno(self):
+        """Return file descriptor"""
+        return self.fd
+
+    def readinto(self, view, offset):
+        """Read into view at offset, return number of bytes read"""
+        return os.preadv(self.fd, [view], offset)
+
+    def close(self):
+        """Close source"""
+        os.close(self.fd)
+
+
+class Consumer:
+    """Base class for pipeline stages that receive filled buffers"""
+
+    name = 'consumer'
+
+    def open(self):
+        """Called from the consumer thread before the first buffer"""
+
+    def process(self, view, offset):
+        """Handle data in view, which starts at offset in the source"""
+        raise NotImplementedError
+
+    def close(self):
+        """Called from the consumer thread after the last buffer"""
+
+
+class FileWriter(Consumer):
+    """Writes buffers to the image file at their source offset. If
+    preallocateSize is set, disk space is reserved up front; syncInterval
+    and dropCache control write-behind (see targetio.WriteBehind)"""
+
+    name = 'writer'
+
+    def __init__(self, path, preallocateSize=0, syncInterval=0, dropCache=False):
+        """initialise FileWriter instance"""
+        self.path = path
+        self.preallocateSize = preallocateSize
+        self.syncInterval = syncInterval
+        self.dropCache = dropCache
+        self.fd = None
+        self.writeBehind = None
+
+    def open(self):
+        """Open image file (existing data is not truncated, like conv=notrunc)"""
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT, 0o644)
+        if self.preallocateSize:
+            targetio.preallocate(self.fd, self.preallocateSize)
+        self.writeBehind = targetio.WriteBehind(self.fd, self.syncInterval, self.dropCache)
+
+    def process(self, view, offset):
+        """Write view to image file"""
+        length = len(view)
+        start = offset
+        while view:
+            written = os.pwrite(self.fd, view, offset)
+            view = view[written:]
+            offset += written
+        self.writeBehind.written(start, length)
+
+    def close(self):
+        """Flush and close image file"""
+        if self.fd is not None:
+            try:
+                self.writeBehind.finish()
+            finally:
+                os.close(self.fd)
+                self.fd = None
+
+
+class Hasher(Consumer):
+    """Computes a digest of the data stream"""
+
+    def __init__(self, algorithm):
+        """initialise Hasher instance"""
+        self.algorithm = algorithm
+        self.name = 'hash-' + algorithm
+        self.m = hashlib.new(algorithm)
+
+    def process(self, view, offset):
+        """Update digest"""
+        self.m.update(view)
+
+    def hexdigest(self):
+        """Return digest as hexadecimal string"""
+        return self.m.hexdigest()
+
+
+class Pipeline:
+    """Reader thread plus one thread per consumer, connected by a BufferRing"""
+
+    def __init__(self, source, consumers, bufferSize, memoryBudget, start=0, end=None,
+                 errorHandler=None, cancelToken=None):
+        """initialise Pipeline instance. If errorHandler is set, it is called
+        with the offset and size of any block that can't be read, and returns
+        the offset where reading continues. Otherwise a read error ends the run.
+        Reading stops when cancelToken (cancel.CancelToken) is cancelled"""
+        self.source = source
+        self.consumers = consumers
+        self.ring = BufferRing(bufferSize, memoryBudget, source.direct)
+        self.start = start
+        if end is None:
+            end = source.size
+        self.end = end
+        self.errorHandler = errorHandler
+        self.offset = start
+        self.queues = [queue.Queue() for _ in consumers]
+        self.readerStats = StageStats('reader')
+        self.consumerStats = [StageStats(c.name) for c in consumers]
+        self.bytesRead = 0
+        self.elapsed = 0.0
+        self.readErrors = []
+        self.consumerErrors = []
+        self.interrupted = False
+        self.abortFlag = False
+        if cancelToken is None:
+            cancelToken = cancel.CancelToken()
+        self.cancelToken = cancelToken
+
+    def run(self):
+        """Run pipeline until end of source, interrupt or error"""
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=status.job.inherit(self.consume), args=(i,))
+                   for i in range(len(self.consumers))]
+        threads.append(threading.Thread(target=status.job.inherit(self.read)))
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.elapsed = time.perf_counter() - t0
+
+    def read(self):
+        """Reader thread: fill free buffers from source and pass them on"""
+        stats = self.readerStats
+        offset = self.start
+        while offset < self.end and not self.abortFlag:
+            if self.cancelToken.isCancelled():
+                self.interrupted = True
+                break
+            slot = self.ring.acquire(stats)
+            noBytes = min(self.ring.bufferSize, self.end - offset)
+            t1 = time.perf_counter()
+            try:
+                bytesRead = self.source.readinto(slot.view[:noBytes], offset)
+            except OSError as e:
+                self.readErrors.append((offset, noBytes, str(e)))
+                self.ring.free.put(slot)
+                if self.errorHandler is None:
+                    break
+                offset = self.errorHandler(offset, noBytes)
+                continue
+            stats.busyTime += time.perf_counter() - t1
+            if bytesRead == 0:
+                # Unexpected end of source
+                self.ring.free.put(slot)
+                break
+            slot.offset = offset
+            slot.length = bytesRead
+            slot.refCount = len(self.queues)
+            stats.bytes += bytesRead
+            stats.blocks += 1
+            status.job.addBytes(bytesRead)
+            for q in self.queues:
+                q.put(slot)
+            offset += bytesRead
+        self.offset = min(offset, self.end)
+        self.bytesRead = stats.bytes
+        for q in self.queues:
+            q.put(None)
+
+    def consume(self, index):
+        """Consumer thread: process filled buffers and release them"""
+        consumer = self.consumers[index]
+        stats = self.consumerStats[index]
+        q = self.queues[index]
+        failed = False
+        try:
+            consumer.open()
+        except OSError as e:
+            self.fail(consumer, e)
+            failed = True
+        while True:
+            slot = timedGet(q, stats)
+            if slot is None:
+                break
+            if not failed:
+                t1 = time.perf_counter()
+                try:
+                    consumer.process(slot.view[:slot.length], slot.offset)
+                except Exception as e:
+                    self.fail(consumer, e)
+                    failed = True
+                stats.busyTime += time.perf_counter() - t1
+                stats.bytes += slot.length
+                stats.blocks += 1
+            # Keep draining after a failure, otherwise the reader blocks forever
+            self.ring.release(slot)
+        try:
+            consumer.close()
+        except OSError as e:
+            self.fail(consumer, e)
+
+    def fail(self, consumer, error):
+        """Record consumer error and tell the reader to stop"""
+        self.consumerErrors.append((consumer.name, str(error)))
+        self.abortFlag = True
+
+    def stats(self):
+        """Return stage statistics as dictionary"""
+        stages = {self.readerStats.name: self.readerStats.asDict()}
+        for stats in self.consumerStats:
+            stages[stats.name] = stats.asDict()
+        return stages
+
+    def bottleneck(self):
+        """Return name of the stage that spent most time doing actual work"""
+        allStats = [self.readerStats] + self.consumerStats
+        return max(allStats, key=lambda s: s.busyTime).name
@@ -0,0 +1,415 @@
+#! /usr/bin/env python3
+"""Skip-on-error read strategy for the native read method.
+
+Modelled on ddrescue: the good areas of the medium are copied first,
+skipping ahead exponentially after a read error. Only then are the
+skipped and failed areas revisited: failed blocks are trimmed from both
+edges, the remainder is scraped one sector at a time, and sectors that
+are still unreadable are retried a limited number of times. Progress is
+kept in a ddrescue-compatible map file, so a run can be continued by
+either the native read method or ddrescue. Like ddrescue, the map file is
+also saved while a phase runs, so a crash loses little progress; areas
+only count as finished once they were written to the image.
+"""
+
+import os
+import io
+import time
+import logging
+import threading
+from . import cancel
+from . import pipeline
+from . import status
+
+# Area status characters, as used in ddrescue map files
+NON_TRIED = '?'
+NON_TRIMMED = '*'
+NON_SCRAPED = '/'
+BAD = '-'
+FINISHED = '+'
+
+# Minimum skip size after a read error in the copy phase
+SKIP_MIN = 65536
+# Seconds between saves of the map file while a phase runs (as ddrescue)
+MAP_SAVE_INTERVAL = 30.0
+
+
+class RescueMap:
+    """Ordered list of [position, size, status] areas that covers the source"""
+
+    def __init__(self, size):
+        """initialise RescueMap instance"""
+        self.size = size
+        self.areas = [[0, size, NON_TRIED]]
+
+    def mark(self, pos, size, status):
+        """Set status of the area at pos, splitting / merging areas as needed"""
+        end = min(pos + size, self.size)
+        if end <= pos:
+            return
+        newAreas = []
+        for aPos, aSize, aStatus in self.areas:
+            aEnd = aPos + aSize
+            if aEnd <= pos or aPos >= end:
+                newAreas.append([aPos, aSize, aStatus])
+                continue
+            if aPos < pos:
+                newAreas.append([aPos, pos - aPos, aStatus])
+            if aEnd > end:
+                newAreas.append([end, aEnd - end, aStatus])
+        newAreas.append([pos, end - pos, status])
+        newAreas.sort()
+        # Merge adjacent areas with the same status
+        self.areas = []
+        for area in newAreas:
+            if self.areas and self.areas[-1][2] == area[2]:
+                self.areas[-1][1] += area[1]
+            else:
+                self.areas.append(area)
+
+    def areasWith(self, status):
+        """Return list of (position, size) tuples of areas with status"""
+        return [(pos, size) for pos, size, aStatus in self.areas if aStatus == status]
+
+    def sizeWith(self, status):
+        """Return total size of areas with status"""
+        return sum(size for pos, size, aStatus in self.areas if aStatus == status)
+
+    def isFinished(self):
+        """Return True if the whole source was read"""
+        return self.sizeWith(FINISHED) == self.size
+
+    def write(self, mapFile, currentPos, currentStatus, currentPass):
+        """Write map in ddrescue map file format; the map is written to a
+        temporary file that replaces mapFile, so a crash never leaves a
+        damaged map"""
+        tempFile = mapFile + '.tmp'
+        try:
+            with io.open(tempFile, 'w', encoding='utf-8') as f:
+                f.write('# Mapfile. Created by diskimgr (native read method)\n')
+                f.write('# current_pos  current_status  current_pass\n')
+                f.write('0x%08X     %s               %d\n' %
+                        (currentPos, currentStatus, currentPass))
+                f.write('#      pos        size  status\n')
+                for pos, size, areaStatus in self.areas:
+                    f.write('0x%08X  0x%08X  %s\n' % (pos, size, areaStatus))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tempFile, mapFile)
+        except IOError:
+            logging.error('error while writing map file ' + mapFile)
+
+    def read(self, mapFile):
+        """Load areas from a ddrescue map file; returns True on success"""
+        areas = []
+        statusLineRead = False
+        try:
+            with io.open(mapFile, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'):
+                        continue
+                    if not statusLineRead:
+                        statusLineRead = True
+                        continue
+                    items = line.split()
+                    areas.append([int(items[0], 0), int(items[1], 0), items[2]])
+        except (IOError, ValueError, IndexError):
+            return False
+        if not areas or areas[-1][0] + areas[-1][1] != self.size:
+            # Map doesn't match this source
+            return False
+        self.areas = areas
+        return True
+
+
+class BorrowedWriter(pipeline.Consumer):
+    """Passes buffers on to a writer that stays open between pipeline runs,
+    and reports every write to written(offset, size)"""
+
+    def __init__(self, writer, written):
+        """initialise BorrowedWriter instance"""
+        self.writer = writer
+        self.written = written
+        self.name = writer.name
+
+    def process(self, view, offset):
+        """Write view"""
+        self.writer.process(view, offset)
+        self.written(offset, len(view))
+
+
+class Rescue:
+    """Runs the copy, trim, scrape and retry phases on a RescueMap"""
+
+    def __init__(self, source, writer, rescueMap, mapFile, sectorSize, bufferSize,
+                 memoryBudget, retries, consumers=None, cancelToken=None):
+        """initialise Rescue instance"""
+        self.source = source
+        self.fileWriter = writer
+        self.writer = BorrowedWriter(writer, self.written)
+        self.map = rescueMap
+        self.mapFile = mapFile
+        # The writer thread marks the map while the reader marks errors
+        self.lock = threading.RLock()
+        self.mapStatus = (NON_TRIED, 1)
+        self.lastSave = time.monotonic()
+        self.sectorSize = sectorSize
+        self.bufferSize = bufferSize
+        self.memoryBudget = memoryBudget
+        self.retries = retries
+        # Extra consumers (e.g. hashers) only see the first copy pass
+        if consumers is None:
+            consumers = []
+        self.consumers = consumers
+        self.skipMax = max(SKIP_MIN, rescueMap.size // 100)
+        self.skipSize = SKIP_MIN
+        self.runStart = 0
+        self.lastErrorEnd = -1
+        self.sector = pipeline.allocateBuffer(sectorSize, source.direct)
+        self.sectorView = memoryview(self.sector)
+        self.pipelines = []
+        self.readErrors = []
+        self.consumerErrors = []
+        self.interrupted = False
+        if cancelToken is None:
+            cancelToken = cancel.CancelToken()
+        self.cancelToken = cancelToken
+        self.phaseTimes = {}
+        self.bytesRead = 0
+        self.elapsed = 0.0
+        self.offset = 0
+
+    def run(self):
+        """Run all phases, stopping early on interrupt or write error"""
+        t0 = time.perf_counter()
+        try:
+            self.fileWriter.open()
+        except OSError as e:
+            self.consumerErrors.append((self.writer.name, str(e)))
+            return
+        phases = [('copy', self.copy),
+                  ('copy non-tried', self.copyNonTried),
+                  ('trim', self.trim),
+                  ('scrape', self.scrape),
+                  ('retry', self.retry)]
+        for name, phase in phases:
+            if self.interrupted or self.consumerErrors:
+                break
+            t1 = time.perf_counter()
+            phase()
+            self.phaseTimes[name] = round(time.perf_counter() - t1, 3)
+            logging.info('rescue phase ' + name + ' done, finished: ' +
+                         str(self.map.sizeWith(FINISHED)) + ' bytes, bad: ' +
+                         str(self.map.sizeWith(BAD)) + ' bytes',
+                         extra={'event': 'phase', 'phase': name,
+                                'bytesRead': self.map.sizeWith(FINISHED),
+                                'errors': len(self.readErrors)})
+        try:
+            self.fileWriter.close()
+        except OSError as e:
+            self.consumerErrors.append((self.writer.name, str(e)))
+        self.elapsed = time.perf_counter() - t0
+
+    def checkInterrupt(self):
+        """Return True if the job was cancelled"""
+        if self.cancelToken.isCancelled():
+            self.interrupted = True
+        return self.interrupted
+
+    def saveMap(self, currentStatus, currentPass):
+        """Write map file, if we have one"""
+        if self.mapFile:
+            with self.lock:
+                self.map.write(self.mapFile, self.offset, currentStatus, currentPass)
+                self.lastSave = time.monotonic()
+
+    def checkpoint(self):
+        """Save map file if it wasn't saved for MAP_SAVE_INTERVAL seconds. The
+        image is flushed first, so the map never claims unwritten data"""
+        if not self.mapFile or time.monotonic() - self.lastSave < MAP_SAVE_INTERVAL:
+            return
+        fd = getattr(self.fileWriter, 'fd', None)
+        if fd is not None:
+            try:
+                os.fdatasync(fd)
+            except OSError as e:
+                logging.warning('cannot flush image before saving map file: ' + str(e))
+                return
+        self.saveMap(*self.mapStatus)
+
+    def written(self, offset, size):
+        """Mark area that was written to the image as finished"""
+        with self.lock:
+            self.map.mark(offset, size, FINISHED)
+            self.offset = offset
+            self.checkpoint()
+
+    def runPipeline(self, start, end, consumers, errorHandler):
+        """Copy [start, end) through a pipeline; returns the pipeline"""
+        self.runStart = start
+        p = pipeline.Pipeline(self.source, consumers, self.bufferSize, self.memoryBudget,
+                              start, end, errorHandler, self.cancelToken)
+        p.run()
+        self.pipelines.append(p)
+        self.interrupted = self.interrupted or p.interrupted
+        self.consumerErrors += p.consumerErrors
+        self.bytesRead += p.bytesRead
+        # Areas that were read are marked finished by the writer
+        self.offset = p.offset
+        return p
+
+    def skipOnError(self, offset, size):
+        """Error handler for the copy phase: skip ahead exponentially"""
+        self.logError(offset, size)
+        with self.lock:
+            self.map.mark(offset, size, NON_TRIMMED)
+        if offset == self.lastErrorEnd:
+            # Consecutive error, so double the skip size
+            self.skipSize = min(self.skipSize * 2, self.skipMax)
+        else:
+            self.skipSize = SKIP_MIN
+        # Skipped area stays non-tried, and is read in the next phase
+        nextOffset = offset + size + self.skipSize
+        nextOffset -= nextOffset % self.sectorSize
+        self.lastErrorEnd = nextOffset
+        self.runStart = nextOffset
+        return nextOffset
+
+    def markOnError(self, offset, size):
+        """Error handler for the non-tried phase: no skipping"""
+        self.logError(offset, size)
+        with self.lock:
+            self.map.mark(offset, size, NON_TRIMMED)
+        self.runStart = offset + size
+        return offset + size
+
+    def logError(self, offset, size):
+        """Record read error"""
+        self.readErrors.append((offset, size))
+        status.job.addError()
+        logging.warning('read error at offset ' + str(offset) + ' (' + str(size) + ' bytes)',
+                        extra={'event': 'readError', 'offset': offset, 'size': size})
+
+    def copy(self):
+        """Copy phase: read all non-tried areas, skipping after errors"""
+        self.mapStatus = (NON_TRIED, 1)
+        consumers = [self.writer] + self.consumers
+        for pos, size in self.map.areasWith(NON_TRIED):
+            self.runPipeline(pos, pos + size, consumers, self.skipOnError)
+            if self.interrupted or self.consumerErrors:
+                break
+        self.saveMap(NON_TRIED, 1)
+
+    def copyNonTried(self):
+        """Read areas that were skipped in the copy phase, without skipping"""
+        self.mapStatus = (NON_TRIED, 2)
+        for pos, size in self.map.areasWith(NON_TRIED):
+            self.runPipeline(pos, pos + size, [self.writer], self.markOnError)
+            if self.interrupted or self.consumerErrors:
+                break
+        self.saveMap(NON_TRIED, 2)
+
+    def readSector(self, pos):
+        """Read one sector at pos and write it to the image; returns True on success"""
+        size = min(self.sectorSize, self.map.size - pos)
+        view = self.sectorView[:size]
+        try:
+            bytesRead = self.source.readinto(view, pos)
+        except OSError:
+            return False
+        if bytesRead != size:
+            return False
+        try:
+            self.writer.process(view, pos)
+        except OSError as e:
+            self.consumerErrors.append((self.writer.name, str(e)))
+            return False
+        self.bytesRead += size
+        self.offset = pos
+        return True
+
+    def trim(self):
+        """Trim phase: read failed blocks sector by sector from both edges"""
+        self.mapStatus = (NON_TRIMMED, 1)
+        for pos, size in self.map.areasWith(NON_TRIMMED):
+            end = pos + size
+            # Forward from the leading edge
+            while pos < end and not self.checkInterrupt():
+                if not self.readSector(pos):
+                    self.map.mark(pos, self.sectorSize, BAD)
+                    pos += self.sectorSize
+                    break
+                self.map.mark(pos, self.sectorSize, FINISHED)
+                pos += self.sectorSize
+                self.checkpoint()
+            # Backward from the trailing edge
+            while end > pos and not self.checkInterrupt():
+                sectorPos = end - self.sectorSize
+                if not self.readSector(sectorPos):
+                    self.map.mark(sectorPos, self.sectorSize, BAD)
+                    end = sectorPos
+                    break
+                self.map.mark(sectorPos, self.sectorSize, FINISHED)
+                end = sectorPos
+                self.checkpoint()
+            if self.interrupted or self.consumerErrors:
+                break
+            self.map.mark(pos, end - pos, NON_SCRAPED)
+        self.saveMap(NON_TRIMMED, 1)
+
+    def scrape(self):
+        """Scrape phase: read remaining areas one sector at a time"""
+        self.mapStatus = (NON_SCRAPED, 1)
+        for pos, size in self.map.areasWith(NON_SCRAPED):
+            for sectorPos in range(pos, pos + size, self.sectorSize):
+                if self.checkInterrupt() or self.consumerErrors:
+                    break
+                if self.readSector(sectorPos):
+                    self.map.mark(sectorPos, self.sectorSize, FINISHED)
+                else:
+                    self.map.mark(sectorPos, self.sectorSize, BAD)
+                self.checkpoint()
+        self.saveMap(NON_SCRAPED, 1)
+
+    def retry(self):
+        """Retry phase: at most retries passes over the bad sectors"""
+        for retryPass in range(1, self.retries + 1):
+            badAreas = self.map.areasWith(BAD)
+            if not badAreas:
+                break
+            self.mapStatus = (BAD, retryPass)
+            for pos, size in badAreas:
+                for sectorPos in range(pos, pos + size, self.sectorSize):
+                    if self.checkInterrupt() or self.consumerErrors:
+                        break
+                    if self.readSector(sectorPos):
+                        self.map.mark(sectorPos, self.sectorSize, FINISHED)
+                    self.checkpoint()
+            self.saveMap(BAD, retryPass)
+            if self.interrupted:
+                break
+        if self.map.isFinished():
+            self.saveMap(FINISHED, 1)
+
+    def stats(self):
+        """Return rescue statistics as dictionary"""
+        return {'finished': self.map.sizeWith(FINISHED),
+                'nonTried': self.map.sizeWith(NON_TRIED),
+                'nonTrimmed': self.map.sizeWith(NON_TRIMMED),
+                'nonScraped': self.map.sizeWith(NON_SCRAPED),
+                'bad': self.map.sizeWith(BAD),
+                'badAreas': len(self.map.areasWith(BAD)),
+                'readErrors': len(self.readErrors),
+                'phaseTimes': self.phaseTimes}
+
+
+def mapFromFile(mapFile, size):
+    """Return RescueMap for source of size, resumed from mapFile if it exists"""
+    rescueMap = RescueMap(size)
+    if mapFile and os.path.isfile(mapFile):
+        if rescueMap.read(mapFile):
+            logging.info('resuming from map file ' + mapFile)
+        else:
+            logging.warning('ignoring map file ' + mapFile + ' (does not match device)')
+    return rescueMap
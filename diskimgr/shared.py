@@ -3,15 +3,23 @@
 
 import os
 import glob
+import uuid
 import hashlib
+import logging
 import datetime
-import pytz
+import zoneinfo
 import fcntl
 import struct
 from os.path import basename, dirname
+from . import manifest
+from . import status
+from . import throttle
+from . import treehash
 
-def generate_file_sha512(fileIn):
-    """Generate sha512 hash of file"""
+def generate_file_sha512(fileIn, bucket=None, blockHasher=None):
+    """Generate sha512 hash of file; if bucket (throttle.TokenBucket) is
+    set, reads are limited to its bandwidth. If blockHasher
+    (manifest.BlockHasher) is set, it gets the same data"""
 
     # fileIn is read in chunks to ensure it will work with (very) large files as well
     # Adapted from: http://stackoverflow.com/a/1131255/1209004
@@ -20,15 +28,25 @@ def generate_file_sha512(fileIn):
     m = hashlib.sha512()
     with open(fileIn, "rb") as f:
         while True:
+            if bucket is not None:
+                bucket.consume(blocksize)
             buf = f.read(blocksize)
             if not buf:
                 break
             m.update(buf)
+            if blockHasher is not None:
+                blockHasher.update(buf)
+            status.job.addBytes(len(buf))
     return m.hexdigest()
 
 
-def checksumDirectory(directory, extension, checksumFile):
-    """Calculate checksums for all files in directory"""
+def checksumDirectory(directory, extension, checksumFile, knownChecksums=None,
+                      bandwidth=0, blockHashSize=0, blockHashAlgorithm='sha256'):
+    """Calculate checksums for all files in directory. Files listed in
+    knownChecksums (file name: SHA-512) were hashed already and are skipped.
+    Reads are limited to bandwidth bytes/s (0: unlimited). If blockHashSize
+    is set, a block-hash manifest is written for every file (in the same
+    read pass), unless it was already written while reading the medium"""
 
     # All files in directory
     allFiles = glob.glob(directory + "/*." + extension)
@@ -36,10 +54,30 @@ def checksumDirectory(directory, extension, checksumFile):
     # Dictionary for storing results
     checksums = {}
 
+    if knownChecksums is None:
+        knownChecksums = {}
+
+    bucket = None
+    if bandwidth > 0:
+        bucket = throttle.TokenBucket(bandwidth, max(bandwidth, 2**20))
+
     for thisFile in allFiles:
-        hashString = generate_file_sha512(thisFile)
         fName = os.path.basename(thisFile)
+        manifestFile = thisFile + manifest.MANIFEST_SUFFIX
+        blockHasher = None
+        if blockHashSize > 0 and not (fName in knownChecksums and
+                                      os.path.isfile(manifestFile)):
+            blockHasher = manifest.BlockHasher(blockHashSize, blockHashAlgorithm)
+        if fName in knownChecksums and blockHasher is None:
+            hashString = knownChecksums[fName]
+        else:
+            hashString = generate_file_sha512(thisFile, bucket, blockHasher)
         checksums[fName] = hashString
+        if blockHasher is not None:
+            try:
+                blockHasher.manifest().write(manifestFile)
+            except IOError:
+                logging.error('error while writing block-hash manifest ' + manifestFile)
 
     # Write checksum file
     try:
@@ -54,12 +92,41 @@ def checksumDirectory(directory, extension, checksumFile):
 
     return wroteChecksums, checksums
 
+def treeHashDirectory(directory, extension, leafSize, noWorkers=0, bandwidth=0,
+                      cancelToken=None):
+    """Calculate BLAKE2b tree hashes of all files in directory, hashing the
+    leaves of each file with noWorkers threads (0: number of cores). Reads
+    are limited to bandwidth bytes/s (0: unlimited). Returns dictionary
+    (file name: tree hash); files that could not be hashed are left out"""
+
+    bucket = None
+    if bandwidth > 0:
+        bucket = throttle.TokenBucket(bandwidth, max(bandwidth, 2**20))
+
+    treeHashes = {}
+    for thisFile in glob.glob(directory + "/*." + extension):
+        try:
+            hashString = treehash.hashFile(thisFile, leafSize, noWorkers=noWorkers,
+                                           bucket=bucket, cancelToken=cancelToken,
+                                           progress=status.job.addBytes)
+        except OSError as e:
+            logging.error('cannot compute tree hash of ' + thisFile + ': ' + str(e))
+            continue
+        if hashString is None:
+            logging.warning('tree hash of ' + thisFile + ' interrupted')
+            continue
+        treeHashes[os.path.basename(thisFile)] = hashString
+    return treeHashes
+
+def generateIdentifier():
+    """Generate identifier for a medium (time-based UUID)"""
+    return str(uuid.uuid1())
+
 def generateDateTime(timeZone):
     """Generate date / time string in ISO format with added time zone info"""
 
-    dateTime = datetime.datetime.now()
-    pst = pytz.timezone(timeZone)
-    dateTime = pst.localize(dateTime)
+    # ZoneInfo caches time zones by name, so the tz database is only read once
+    dateTime = datetime.datetime.now(zoneinfo.ZoneInfo(timeZone))
     dateTimeFormatted = dateTime.isoformat()
     return dateTimeFormatted
 
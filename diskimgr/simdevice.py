@@ -0,0 +1,262 @@
+#! /usr/bin/env python3
+"""Simulated block device with injected faults and latency.
+
+A simulated device wraps an image file, and is described by a spec file
+(any file name ending in '.simdev.json') that can be used instead of a
+block device path with the native read method (dd and ddrescue cannot
+read it, so it cannot be used with those, or with automatic retries).
+Example:
+
+{
+    "image": "/path/to/image.img",
+    "sectorSize": 512,
+    "badRanges": [[1048576, 1050624]],
+    "intermittentErrorRate": 0.001,
+    "latency": 0.0005,
+    "errorLatency": 0.5,
+    "throughput": 20000000,
+    "pageSize": 4096,
+    "seed": 1,
+    "realTime": false
+}
+
+badRanges are [start, end) byte ranges that can never be read. Other reads
+fail at random with probability intermittentErrorRate (these succeed on a
+retry). Every read costs latency seconds, plus its size divided by
+throughput (bytes/s; 0 means unlimited); failed reads cost errorLatency.
+Without direct mode, errors are widened to pageSize, as happens when reads
+go through the page cache. If realTime is false, the device keeps a
+simulated clock instead of sleeping, so benchmarks are fast and repeatable.
+
+Running this module benchmarks the native read method against a spec file
+for a range of block sizes and retry settings. Its --autoretry option
+approximates an automatic retry with a second native pass on the same map
+file; it does not run ddrescue.
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import errno
+import random
+import logging
+import argparse
+import tempfile
+
+SPEC_SUFFIX = '.simdev.json'
+
+
+def isSpecFile(path):
+    """Return True if path is a simulated device spec file"""
+    return path.endswith(SPEC_SUFFIX) and os.path.isfile(path)
+
+
+def fromSpecFile(specFile, direct=False):
+    """Return SimulatedDevice described by specFile"""
+    with io.open(specFile, 'r', encoding='utf-8') as f:
+        spec = json.load(f)
+    return SimulatedDevice(spec['image'],
+                           sectorSize=spec.get('sectorSize', 512),
+                           badRanges=spec.get('badRanges', []),
+                           intermittentErrorRate=spec.get('intermittentErrorRate', 0.0),
+                           latency=spec.get('latency', 0.0),
+                           errorLatency=spec.get('errorLatency', 0.0),
+                           throughput=spec.get('throughput', 0),
+                           pageSize=spec.get('pageSize', 4096),
+                           seed=spec.get('seed', 0),
+                           realTime=spec.get('realTime', False),
+                           direct=direct)
+
+
+def deviceSize(specFile):
+    """Return size of simulated device"""
+    device = fromSpecFile(specFile)
+    device.close()
+    return device.size
+
+
+class SimulatedDevice:
+    """Image file that behaves like a (damaged, slow) block device. Has
+    the same interface as pipeline.BlockSource"""
+
+    def __init__(self, image, sectorSize=512, badRanges=None, intermittentErrorRate=0.0,
+                 latency=0.0, errorLatency=0.0, throughput=0, pageSize=4096, seed=0,
+                 realTime=False, direct=False):
+        """initialise SimulatedDevice instance"""
+        self.path = image
+        self.fd = os.open(image, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.sectorSize = sectorSize
+        if badRanges is None:
+            badRanges = []
+        self.badRanges = sorted((start, end) for start, end in badRanges)
+        self.intermittentErrorRate = intermittentErrorRate
+        self.latency = latency
+        self.errorLatency = errorLatency
+        self.throughput = throughput
+        self.pageSize = pageSize
+        self.random = random.Random(seed)
+        self.realTime = realTime
+        self.direct = direct
+        # Counters
+        self.simulatedTime = 0.0
+        self.reads = 0
+        self.failedReads = 0
+        self.bytesRead = 0
+
+    def fileno(self):
+        """No file descriptor, so kernel-side copies can't bypass the faults"""
+        raise OSError(errno.EBADF, 'simulated device has no file descriptor')
+
+    def spend(self, seconds):
+        """Advance the (simulated or real) clock"""
+        self.simulatedTime += seconds
+        if self.realTime and seconds > 0:
+            time.sleep(seconds)
+
+    def isBad(self, offset, size):
+        """Return True if [offset, offset + size) touches a bad range"""
+        end = offset + size
+        if not self.direct:
+            # Page cache reads whole pages, so a bad sector fails its neighbours
+            offset -= offset % self.pageSize
+            end += -end % self.pageSize
+        for start, badEnd in self.badRanges:
+            if start >= end:
+                break
+            if badEnd > offset:
+                return True
+        return False
+
+    def readinto(self, view, offset):
+        """Read into view at offset, return number of bytes read"""
+        self.reads += 1
+        size = len(view)
+        if self.isBad(offset, size) or self.random.random() < self.intermittentErrorRate:
+            self.failedReads += 1
+            self.spend(self.latency + self.errorLatency)
+            raise OSError(errno.EIO, os.strerror(errno.EIO))
+        bytesRead = os.preadv(self.fd, [view], offset)
+        seconds = self.latency
+        if self.throughput > 0:
+            seconds += bytesRead / self.throughput
+        self.spend(seconds)
+        self.bytesRead += bytesRead
+        return bytesRead
+
+    def stats(self):
+        """Return counters as dictionary"""
+        return {'reads': self.reads,
+                'failedReads': self.failedReads,
+                'bytesRead': self.bytesRead,
+                'simulatedTime': round(self.simulatedTime, 3)}
+
+    def close(self):
+        """Close image file"""
+        os.close(self.fd)
+
+
+def benchmark(specFile, blockSizes, retriesList, direct, autoRetry, bufferSize,
+              memoryBudget):
+    """Run the native read method on specFile for every combination of block
+    size and retries; returns a list of result dictionaries"""
+
+    # Imported here, as pipeline imports this module
+    from . import native
+
+    results = []
+    for blockSize in blockSizes:
+        for retries in retriesList:
+            with tempfile.TemporaryDirectory() as tempDir:
+                imageFile = os.path.join(tempDir, 'sim.img')
+                mapFile = os.path.join(tempDir, 'sim.map')
+                passes = []
+                if autoRetry:
+                    # First pass without retries, then a second pass on the same
+                    # map, as after an auto-retry
+                    passes.append(0)
+                passes.append(retries)
+                simulatedTime = 0.0
+                t0 = time.perf_counter()
+                for passRetries in passes:
+                    _, _, errorFlag, _, stats = native.readNative(specFile, imageFile,
+                                                                  blockSize, bufferSize,
+                                                                  memoryBudget, [],
+                                                                  mapFile=mapFile,
+                                                                  retries=passRetries,
+                                                                  direct=direct)
+                    simulatedTime += stats.get('deviceTime', 0.0)
+                result = {'blockSize': blockSize,
+                          'retries': retries,
+                          'direct': direct,
+                          'autoRetry': autoRetry,
+                          'wallTime': round(time.perf_counter() - t0, 3),
+                          'deviceTime': round(simulatedTime, 3),
+                          'errorFlag': errorFlag}
+                result.update(stats.get('rescue', {}))
+                results.append(result)
+    return results
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('specFile',
+                        action='store',
+                        help='simulated device spec file (*' + SPEC_SUFFIX + ')')
+    parser.add_argument('--blocksizes', '-b',
+                        action='store',
+                        dest='blockSizes',
+                        default='512',
+                        help='comma-separated list of block sizes')
+    parser.add_argument('--retries', '-r',
+                        action='store',
+                        dest='retries',
+                        default='0,4',
+                        help='comma-separated list of retry settings')
+    parser.add_argument('--direct', '-d',
+                        action='store_true',
+                        dest='direct',
+                        default=False,
+                        help='read in direct disc mode')
+    parser.add_argument('--autoretry', '-a',
+                        action='store_true',
+                        dest='autoRetry',
+                        default=False,
+                        help='do a native pass without retries first, then a second '
+                             'native pass with retries on the same map (approximates '
+                             'an automatic retry, which would use ddrescue)')
+    parser.add_argument('--buffersize',
+                        action='store',
+                        type=int,
+                        dest='bufferSize',
+                        default=1048576,
+                        help='native read method buffer size')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Benchmark the native read method on a simulated device"""
+
+    parser = argparse.ArgumentParser(description='diskimgr simulated device benchmark')
+    args = parseCommandLine(parser)
+
+    if not isSpecFile(args.specFile):
+        sys.stderr.write('ERROR: ' + args.specFile + ' is not a simulated device spec file\n')
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.ERROR)
+    blockSizes = [int(b) for b in args.blockSizes.split(',')]
+    retriesList = [int(r) for r in args.retries.split(',')]
+    results = benchmark(args.specFile, blockSizes, retriesList, args.direct,
+                        args.autoRetry, args.bufferSize, 8 * args.bufferSize)
+    json.dump(results, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
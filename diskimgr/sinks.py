@@ -0,0 +1,478 @@
+#! /usr/bin/env python3
+"""Secondary output sinks: extra copies of the image, written while the
+medium is read.
+
+A sink is a pipeline consumer that writes the data stream to another
+destination: a plain file (e.g. on a separate volume), split files, a
+compressed container (gzip, bz2 or xz), or a named pipe / stdout. Every
+sink copies the buffers it receives into its own queue, which is written
+by its own thread, so a slow destination doesn't hold up the read or the
+other outputs. Data that arrive while a sink is more than its memory
+budget behind are left out, and so are the areas that the native read
+method skips after a read error (they are only read in later rescue
+passes, which don't feed the sinks); once reading is done, only these
+ranges are filled in from the image file. Plain and split files are
+written at the offsets of the data. Compressed and pipe sinks can only
+write in order, so after a gap they hold the data that follow it in
+memory (within the budget), and write them when the gap has been filled
+in. With the dd and ddrescue read methods, which don't use the pipeline,
+sinks are written from the image file after reading. Sinks carry exactly the bytes of the
+image, so the image's checksums apply to them as well; nothing is hashed
+twice.
+
+Sinks are defined by a spec string TYPE:PATH, where PATH may contain
+{identifier}, {prefix}, {extension} and {dirName} (name of the output
+directory):
+
+    file:PATH           plain copy
+    split:SIZE:PATH     files PATH.000, PATH.001, ... of SIZE bytes
+    gzip:PATH, bz2:PATH, xz:PATH
+                        compressed copy
+    pipe:PATH           named pipe (or - for stdout)
+"""
+
+import os
+import io
+import sys
+import time
+import bisect
+import errno
+import queue
+import select
+import threading
+from . import status
+
+SINK_TYPES = ['file', 'split', 'gzip', 'bz2', 'xz', 'pipe']
+# Size of reads from the image when a sink catches up
+CATCH_UP_SIZE = 8388608
+# Seconds a pipe sink waits for a reader
+PIPE_OPEN_TIMEOUT = 300
+# Seconds a sink may write nothing before finish() gives up on it
+STALL_TIMEOUT = 300
+
+
+def parseSpec(spec):
+    """Return (type, split size, path template) for a sink spec. Raises ValueError"""
+    sinkType, sep, rest = spec.partition(':')
+    if not sep or sinkType not in SINK_TYPES:
+        raise ValueError('invalid output sink ' + spec + ' (type must be one of ' +
+                         ', '.join(SINK_TYPES) + ')')
+    splitSize = 0
+    if sinkType == 'split':
+        size, sep, rest = rest.partition(':')
+        if size.isdigit():
+            splitSize = int(size)
+        if not sep or splitSize <= 0:
+            raise ValueError('invalid output sink ' + spec + ' (use split:SIZE:PATH)')
+    if not rest:
+        raise ValueError('invalid output sink ' + spec + ' (no path)')
+    return sinkType, splitSize, rest
+
+
+def addRange(ranges, start, end):
+    """Add [start, end) to ranges (sorted list of disjoint [start, end] lists)"""
+    if ranges and ranges[-1][0] <= start <= ranges[-1][1]:
+        # Common case: the stream continues
+        ranges[-1][1] = max(ranges[-1][1], end)
+        return
+    i = bisect.bisect_left(ranges, [start, end])
+    if i > 0 and ranges[i - 1][1] >= start:
+        i -= 1
+    j = i
+    while j < len(ranges) and ranges[j][0] <= end:
+        start = min(start, ranges[j][0])
+        end = max(end, ranges[j][1])
+        j += 1
+    ranges[i:j] = [[start, end]]
+
+
+def missingRanges(ranges, size):
+    """Return list of (start, end) ranges in [0, size) that are not in ranges"""
+    missing = []
+    pos = 0
+    for start, end in ranges:
+        if start > pos:
+            missing.append((pos, min(start, size)))
+        pos = max(pos, end)
+        if pos >= size:
+            break
+    if pos < size:
+        missing.append((pos, size))
+    return missing
+
+
+def fromSpec(spec, fields, memoryBudget):
+    """Return sink for spec, with the placeholders in its path filled in from
+    fields (dictionary). Raises ValueError"""
+    sinkType, splitSize, template = parseSpec(spec)
+    try:
+        path = template.format(**fields)
+    except (KeyError, IndexError) as e:
+        raise ValueError('unknown placeholder ' + str(e) + ' in output sink ' + spec)
+    if sinkType == 'file':
+        return FileSink(path, memoryBudget)
+    if sinkType == 'split':
+        return SplitSink(path, memoryBudget, splitSize)
+    if sinkType == 'pipe':
+        return PipeSink(path, memoryBudget)
+    return CompressedSink(path, memoryBudget, sinkType)
+
+
+class Sink:
+    """Base class for sinks; works as a pipeline consumer (see
+    pipeline.Consumer). Subclasses implement openOutput, write (or writeAt,
+    if seekable) and closeOutput, which are only called from the sink's own
+    thread (or from finish)"""
+
+    sinkType = 'sink'
+    # Seekable sinks write data at their offsets, in any order
+    seekable = False
+
+    def __init__(self, path, memoryBudget):
+        """initialise Sink instance"""
+        self.path = path
+        self.name = 'sink-' + self.sinkType
+        self.memoryBudget = memoryBudget
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.queued = 0
+        # End of the data that a sequential sink has queued for writing
+        self.offset = 0
+        # Ranges of the stream that the sink took ([start, end] lists)
+        self.taken = []
+        # (offset, data) that a sequential sink holds until the gap before
+        # them is filled in from the image
+        self.held = []
+        self.error = None
+        self.thread = None
+        self.outputOpen = False
+        self.bytesWritten = 0
+        self.bytesCaughtUp = 0
+
+    def open(self):
+        """Start the writer thread; a rescue feeds several pipeline runs, so
+        this is only done once"""
+        if self.thread is None:
+            self.thread = threading.Thread(target=status.job.inherit(self.writeLoop),
+                                           daemon=True)
+            self.thread.start()
+
+    def process(self, view, offset):
+        """Queue copy of view (or hold it, if a sequential sink can't write
+        it yet), if it fits in the budget; data that are left out are
+        filled in from the image file after reading"""
+        if self.error is not None:
+            return
+        size = len(view)
+        if not self.seekable:
+            end = self.held[-1][0] + len(self.held[-1][1]) if self.held else self.offset
+            if offset < end:
+                # Behind the data that are already queued or held
+                return
+        with self.lock:
+            if self.queued + size > self.memoryBudget:
+                return
+            self.queued += size
+        addRange(self.taken, offset, offset + size)
+        if self.seekable or (offset == self.offset and not self.held):
+            self.queue.put((offset, bytes(view)))
+            if not self.seekable:
+                self.offset = offset + size
+        else:
+            self.held.append((offset, bytes(view)))
+
+    def close(self):
+        """Nothing to close; outputs are closed by finish()"""
+
+    def openOutputOnce(self):
+        """Open output on first use"""
+        if not self.outputOpen:
+            parent = os.path.dirname(self.path)
+            if self.path != '-' and parent:
+                os.makedirs(parent, exist_ok=True)
+            self.openOutput()
+            self.outputOpen = True
+
+    def writeLoop(self):
+        """Writer thread: write queued data until finish() sends None"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            offset, data = item
+            if self.error is None:
+                try:
+                    self.openOutputOnce()
+                    if self.seekable:
+                        self.writeAt(offset, data)
+                    else:
+                        self.write(data)
+                    self.bytesWritten += len(data)
+                except (OSError, ValueError) as e:
+                    self.error = str(e)
+            with self.lock:
+                self.queued -= len(data)
+
+    def finish(self, imageFile, size, catchUp=True):
+        """Wait until all queued data are written, fill in the ranges that
+        the sink didn't take from imageFile (unless catchUp is False), and
+        close the output. Returns dictionary with the result"""
+        stalled = False
+        if self.thread is not None:
+            self.queue.put(None)
+            stalled = not self.waitForWriter()
+        if catchUp and self.error is None and (self.held or missingRanges(self.taken, size)):
+            try:
+                self.openOutputOnce()
+                with io.open(imageFile, 'rb', buffering=0) as f:
+                    if self.seekable:
+                        for start, end in missingRanges(self.taken, size):
+                            self.copyFromImage(f, start, end)
+                    else:
+                        # Held data go in between the gaps, in order
+                        for offset, data in self.held:
+                            self.copyFromImage(f, self.offset, offset)
+                            self.write(data)
+                            self.bytesWritten += len(data)
+                            self.offset = offset + len(data)
+                        self.held = []
+                        self.copyFromImage(f, self.offset, size)
+            except (OSError, ValueError) as e:
+                self.error = str(e)
+        if self.outputOpen and not stalled:
+            try:
+                self.closeOutput()
+            except (OSError, ValueError) as e:
+                if self.error is None:
+                    self.error = str(e)
+        result = {'type': self.sinkType,
+                  'path': self.path,
+                  'bytesFromStream': self.bytesWritten,
+                  'bytesFromImage': self.bytesCaughtUp,
+                  'complete': self.error is None and not missingRanges(self.taken, size)}
+        if self.error is not None:
+            result['error'] = self.error
+        return result
+
+    def copyFromImage(self, f, start, end):
+        """Write [start, end) of the stream from image file object f"""
+        f.seek(start)
+        pos = start
+        while pos < end:
+            data = f.read(min(CATCH_UP_SIZE, end - pos))
+            if not data:
+                raise OSError('image file ' + f.name + ' is truncated')
+            if self.seekable:
+                self.writeAt(pos, data)
+            else:
+                self.write(data)
+            pos += len(data)
+            self.bytesCaughtUp += len(data)
+        if end > start:
+            addRange(self.taken, start, end)
+        if not self.seekable:
+            self.offset = max(self.offset, end)
+
+    def waitForWriter(self):
+        """Wait until the writer thread ends; returns False if it wrote
+        nothing for STALL_TIMEOUT seconds (the output is left alone then,
+        as the thread may still be using it)"""
+        bytesWritten = self.bytesWritten
+        deadline = time.monotonic() + STALL_TIMEOUT
+        while True:
+            self.thread.join(timeout=1.0)
+            if not self.thread.is_alive():
+                return True
+            if self.bytesWritten != bytesWritten:
+                bytesWritten = self.bytesWritten
+                deadline = time.monotonic() + STALL_TIMEOUT
+            elif time.monotonic() > deadline:
+                self.error = 'no data written in ' + str(STALL_TIMEOUT) + ' seconds'
+                return False
+
+    def openOutput(self):
+        """Open destination"""
+        raise NotImplementedError
+
+    def write(self, data):
+        """Write data to destination, after the data before them"""
+        raise NotImplementedError
+
+    def writeAt(self, offset, data):
+        """Write data to seekable destination at offset"""
+        raise NotImplementedError
+
+    def closeOutput(self):
+        """Close destination"""
+        raise NotImplementedError
+
+
+class FileSink(Sink):
+    """Plain copy of the image"""
+
+    sinkType = 'file'
+    seekable = True
+
+    def openOutput(self):
+        """Open file"""
+        self.f = io.open(self.path, 'wb')
+
+    def writeAt(self, offset, data):
+        """Write to file at offset"""
+        if self.f.tell() != offset:
+            self.f.seek(offset)
+        self.f.write(data)
+
+    def closeOutput(self):
+        """Flush file to disk and close it"""
+        try:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        finally:
+            self.f.close()
+
+
+class SplitSink(Sink):
+    """Copy of the image in files of splitSize bytes (PATH.000, PATH.001, ...)"""
+
+    sinkType = 'split'
+    seekable = True
+
+    def __init__(self, path, memoryBudget, splitSize):
+        """initialise SplitSink instance"""
+        Sink.__init__(self, path, memoryBudget)
+        self.splitSize = splitSize
+        self.parts = set()
+        self.f = None
+        self.part = None
+
+    @property
+    def files(self):
+        """Paths of the parts that were written, in order"""
+        return [self.partPath(part) for part in sorted(self.parts)]
+
+    def partPath(self, part):
+        """Return path of part number part"""
+        return self.path + '.%03d' % part
+
+    def openOutput(self):
+        """Files are opened as they are needed"""
+
+    def writeAt(self, offset, data):
+        """Write data at offset, in the parts that it spans"""
+        view = memoryview(data)
+        while view:
+            part, partOffset = divmod(offset, self.splitSize)
+            if part != self.part:
+                self.closeOutput()
+                # A part may be written again when a gap in it is filled in
+                mode = 'r+b' if part in self.parts else 'wb'
+                self.f = io.open(self.partPath(part), mode)
+                self.parts.add(part)
+                self.part = part
+            noBytes = min(len(view), self.splitSize - partOffset)
+            if self.f.tell() != partOffset:
+                self.f.seek(partOffset)
+            self.f.write(view[:noBytes])
+            offset += noBytes
+            view = view[noBytes:]
+
+    def closeOutput(self):
+        """Flush current part to disk and close it"""
+        if self.f is not None:
+            try:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+            finally:
+                self.f.close()
+                self.f = None
+                self.part = None
+
+    def finish(self, imageFile, size, catchUp=True):
+        """Finish, and add the names of the parts to the result"""
+        result = Sink.finish(self, imageFile, size, catchUp)
+        result['files'] = [os.path.basename(f) for f in self.files]
+        return result
+
+
+class CompressedSink(Sink):
+    """Compressed copy of the image (gzip, bz2 or xz)"""
+
+    def __init__(self, path, memoryBudget, sinkType):
+        """initialise CompressedSink instance"""
+        self.sinkType = sinkType
+        Sink.__init__(self, path, memoryBudget)
+
+    def openOutput(self):
+        """Open compressed file"""
+        # Imported here, so the GUI doesn't load them at start-up
+        import bz2
+        import gzip
+        import lzma
+        openers = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+        self.f = openers[self.sinkType](self.path, 'wb')
+
+    def write(self, data):
+        """Compress data (zlib, bz2 and lzma release the GIL while they work)"""
+        self.f.write(data)
+
+    def closeOutput(self):
+        """Finish compressed stream and close file"""
+        self.f.close()
+
+
+class PipeSink(Sink):
+    """Stream of the image to a named pipe, or to stdout (path -)"""
+
+    sinkType = 'pipe'
+
+    def openOutput(self):
+        """Open pipe without blocking; waits up to PIPE_OPEN_TIMEOUT seconds
+        for a reader"""
+        self.fd = None
+        if self.path == '-':
+            self.f = sys.stdout.buffer
+            return
+        deadline = time.monotonic() + PIPE_OPEN_TIMEOUT
+        while True:
+            try:
+                # O_CREAT: a path that doesn't exist yet becomes a plain file
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_NONBLOCK, 0o666)
+                return
+            except OSError as e:
+                # ENXIO: pipe has no reader yet
+                if e.errno != errno.ENXIO:
+                    raise
+            if time.monotonic() > deadline:
+                raise OSError(errno.ETIMEDOUT, 'no reader on pipe ' + self.path + ' in ' +
+                              str(PIPE_OPEN_TIMEOUT) + ' seconds')
+            time.sleep(0.5)
+
+    def write(self, data):
+        """Write to pipe; fails if the reader takes nothing for
+        STALL_TIMEOUT seconds"""
+        if self.fd is None:
+            self.f.write(data)
+            return
+        view = memoryview(data)
+        deadline = time.monotonic() + STALL_TIMEOUT
+        while view:
+            try:
+                noBytes = os.write(self.fd, view)
+            except BlockingIOError:
+                noBytes = 0
+            if noBytes:
+                view = view[noBytes:]
+                deadline = time.monotonic() + STALL_TIMEOUT
+            elif time.monotonic() > deadline:
+                raise OSError(errno.ETIMEDOUT, 'pipe reader took no data in ' +
+                              str(STALL_TIMEOUT) + ' seconds')
+            else:
+                select.select([], [self.fd], [], 1.0)
+
+    def closeOutput(self):
+        """Close pipe (stdout is only flushed)"""
+        if self.fd is None:
+            self.f.flush()
+        else:
+            os.close(self.fd)
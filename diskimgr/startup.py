@@ -0,0 +1,152 @@
+#! /usr/bin/env python3
+"""Start-up time checks.
+
+Measures (with python -X importtime) how long importing diskimgr.disk takes,
+checks that it doesn't pull in modules that are only needed later (tkinter,
+the status endpoint, the acquisition code), and measures the time until the
+GUI has drawn its first frame. Exits with status 1 if a budget is exceeded,
+so it can guard against start-up regressions.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+# Modules that importing diskimgr.disk must not load
+DEFERRED_MODULES = ['tkinter', 'tkfilebrowser', 'pytz', 'sqlite3', 'http.client',
+                    'http.server', 'socketserver', 'diskimgr.endpoint', 'diskimgr.daemon',
+                    'diskimgr.fingerprint', 'diskimgr.index', 'diskimgr.native',
+                    'diskimgr.pipeline', 'diskimgr.verify', 'diskimgr.entropy', 'numpy']
+
+# Run in a child process; shows the GUI, and exits after the first frame
+FIRST_FRAME_CODE = """
+import os
+import tkinter as tk
+from diskimgr import gui
+root = tk.Tk()
+myGUI = gui.omimgrGUI(root)
+root.update()
+print('firstFrame', flush=True)
+os._exit(0)
+"""
+
+
+def importProfile(module):
+    """Import module in a fresh interpreter; returns dictionary with the
+    cumulative import time (in microseconds) of every module it loaded"""
+    p = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       universal_newlines=True, check=True)
+    profile = {}
+    for line in p.stderr.splitlines():
+        # Format: 'import time: self [us] | cumulative | imported package'
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            profile[fields[2].strip()] = int(fields[1])
+        except (IndexError, ValueError):
+            # Header line
+            pass
+    return profile
+
+
+def importTime(module, noRuns):
+    """Return best import time of module in ms over noRuns runs, and the
+    modules that were loaded"""
+    best = None
+    for _ in range(noRuns):
+        profile = importProfile(module)
+        if best is None or profile[module] < best[module]:
+            best = profile
+    return best[module] / 1000, sorted(best)
+
+
+def firstFrameTime(timeout):
+    """Return time in ms from starting the GUI until its first frame was
+    drawn, or None if the GUI could not be started (e.g. no display)"""
+    start = time.perf_counter()
+    try:
+        p = subprocess.run([sys.executable, '-c', FIRST_FRAME_CODE],
+                           stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                           universal_newlines=True, timeout=timeout)
+    except subprocess.TimeoutExpired:
+        return None
+    if 'firstFrame' not in p.stdout:
+        return None
+    return (time.perf_counter() - start) * 1000
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('--runs', '-n',
+                        action='store',
+                        type=int,
+                        dest='noRuns',
+                        default=5,
+                        help='number of runs (the best one counts)')
+    parser.add_argument('--max-import',
+                        action='store',
+                        type=float,
+                        dest='maxImport',
+                        default=100,
+                        help='budget for importing diskimgr.disk in ms')
+    parser.add_argument('--max-first-frame',
+                        action='store',
+                        type=float,
+                        dest='maxFirstFrame',
+                        default=1500,
+                        help='budget for time to first GUI frame in ms')
+    parser.add_argument('--no-gui',
+                        action='store_true',
+                        dest='noGui',
+                        default=False,
+                        help='skip GUI time to first frame')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Check start-up time against budgets"""
+
+    parser = argparse.ArgumentParser(description='diskimgr start-up time check')
+    args = parseCommandLine(parser)
+
+    # Measure the package on the path, also when run from a source tree
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    os.environ['PYTHONPATH'] = os.pathsep.join(filter(None, [packageRoot,
+                                                             os.environ.get('PYTHONPATH')]))
+
+    importMs, loaded = importTime('diskimgr.disk', max(1, args.noRuns))
+    deferredLoaded = [m for m in DEFERRED_MODULES if m in loaded]
+    results = {'importDisk': round(importMs, 1),
+               'maxImportDisk': args.maxImport,
+               'deferredModulesLoaded': deferredLoaded,
+               'firstFrame': None,
+               'maxFirstFrame': args.maxFirstFrame}
+    passedFlag = importMs <= args.maxImport and not deferredLoaded
+
+    if not args.noGui:
+        times = [firstFrameTime(60) for _ in range(max(1, args.noRuns))]
+        times = [t for t in times if t is not None]
+        if times:
+            results['firstFrame'] = round(min(times), 1)
+            passedFlag = passedFlag and min(times) <= args.maxFirstFrame
+        else:
+            sys.stderr.write('WARNING: cannot start GUI (no display?), time to ' +
+                             'first frame not measured\n')
+
+    results['passed'] = passedFlag
+    json.dump(results, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+    if not passedFlag:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
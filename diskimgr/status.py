@@ -0,0 +1,221 @@
+#! /usr/bin/env python3
+"""Job status, for monitoring.
+
+The imaging code updates the module-level job object (phase changes, bytes
+read, read errors); updates only take a short lock, so they never hold up
+imaging. A thread that finishes a job in the background (see the daemon)
+binds its own JobState to the job object, so its progress doesn't mix with
+that of the job that reads. Threads that work for a job (pipeline stages,
+hashing workers, sink writers) run their target through job.inherit, so
+they report to the same JobState, and carry the same job tag (which the
+daemon uses to route log records) as the thread that started them.
+
+The job status is served by the local HTTP endpoint in the endpoint
+module. Running this module queries an endpoint.
+"""
+
+import os
+import time
+import threading
+
+PHASES = ['idle', 'reading', 'verifying', 'copying', 'checksumming', 'comparing',
+          'finished']
+# Units in ddrescue status lines
+UNITS = {'B': 1, 'kB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12,
+         'KiB': 2**10, 'MiB': 2**20, 'GiB': 2**30, 'TiB': 2**40}
+
+
+def parseSize(value, unit):
+    """Return number of bytes for a ddrescue size (e.g. '512', 'kB')"""
+    return int(float(value) * UNITS.get(unit, 1))
+
+
+class JobState:
+    """Thread-safe state of the current job"""
+
+    def __init__(self):
+        """initialise JobState instance"""
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Clear all job information"""
+        with self.lock:
+            self.identifier = ''
+            self.blockDevice = ''
+            self.readMethod = ''
+            self.imageFile = ''
+            self.phase = 'idle'
+            self.totalBytes = 0
+            self.bytesDone = 0
+            self.readErrors = 0
+            self.successFlag = None
+            self.jobStart = None
+            self.phaseStart = time.monotonic()
+            self.phaseStartBytes = 0
+
+    def begin(self, identifier, blockDevice, readMethod, imageFile, totalBytes):
+        """Register a new job"""
+        self.reset()
+        with self.lock:
+            self.identifier = identifier
+            self.blockDevice = blockDevice
+            self.readMethod = readMethod
+            self.imageFile = imageFile
+            self.totalBytes = totalBytes
+            self.jobStart = time.time()
+
+    def setPhase(self, phase):
+        """Start a new phase; bytesDone counts from zero again"""
+        with self.lock:
+            self.phase = phase
+            self.bytesDone = 0
+            self.phaseStart = time.monotonic()
+            self.phaseStartBytes = 0
+
+    def setBytes(self, noBytes):
+        """Set progress of current phase (e.g. from a resumed rescue map)"""
+        with self.lock:
+            if self.bytesDone == 0:
+                # Rate only counts what is read in this run
+                self.phaseStartBytes = noBytes
+            self.bytesDone = noBytes
+
+    def addBytes(self, noBytes):
+        """Add to progress of current phase"""
+        with self.lock:
+            self.bytesDone += noBytes
+
+    def setErrors(self, noErrors):
+        """Set number of read errors"""
+        with self.lock:
+            self.readErrors = noErrors
+
+    def addError(self):
+        """Count one read error"""
+        with self.lock:
+            self.readErrors += 1
+
+    def finish(self, successFlag):
+        """Mark job as finished"""
+        with self.lock:
+            self.phase = 'finished'
+            self.successFlag = successFlag
+
+    def snapshot(self):
+        """Return job status as dictionary"""
+        with self.lock:
+            state = {'identifier': self.identifier,
+                     'blockDevice': self.blockDevice,
+                     'readMethod': self.readMethod,
+                     'phase': self.phase,
+                     'totalBytes': self.totalBytes,
+                     'bytesDone': self.bytesDone,
+                     'readErrors': self.readErrors,
+                     'successFlag': self.successFlag,
+                     'jobStart': self.jobStart}
+            elapsed = time.monotonic() - self.phaseStart
+            phaseStartBytes = self.phaseStartBytes
+            imageFile = self.imageFile
+        if state['phase'] == 'reading' and state['readMethod'] == 'dd':
+            # dd doesn't report progress; the image grows as it is written
+            try:
+                state['bytesDone'] = os.path.getsize(imageFile)
+            except OSError:
+                pass
+        rate = 0.0
+        if elapsed > 0:
+            rate = max(0, state['bytesDone'] - phaseStartBytes) / elapsed
+        state['rate'] = round(rate)
+        state['eta'] = None
+        if rate > 0 and state['phase'] not in ['idle', 'finished'] and state['totalBytes']:
+            state['eta'] = round(max(0, state['totalBytes'] - state['bytesDone']) / rate)
+        return state
+
+
+class ThreadJobState:
+    """Passes calls on to the JobState that is bound to the calling thread,
+    or to the state of the job that runs in this process otherwise"""
+
+    def __init__(self):
+        """initialise ThreadJobState instance"""
+        self.default = JobState()
+        self.local = threading.local()
+
+    def bind(self, state, tag=None):
+        """Report progress of the calling thread to state (JobState, or None
+        for the default state), and tag the thread with tag (e.g. a job id)"""
+        self.local.state = state
+        self.local.tag = tag
+
+    def unbind(self):
+        """Report progress of the calling thread to the default state again"""
+        self.local.state = None
+        self.local.tag = None
+
+    @property
+    def tag(self):
+        """Return tag of the calling thread (None if it has none)"""
+        return getattr(self.local, 'tag', None)
+
+    def inherit(self, function):
+        """Return function that runs with the state and tag of the calling
+        thread, for use as the target of a thread that works for its job"""
+        state = getattr(self.local, 'state', None)
+        tag = self.tag
+        if state is None and tag is None:
+            return function
+
+        def bound(*args, **kwargs):
+            """Run function bound to the state and tag of the parent thread"""
+            self.bind(state, tag)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.unbind()
+        return bound
+
+    def __getattr__(self, name):
+        """Return attribute of the JobState of the calling thread"""
+        state = getattr(self.local, 'state', None)
+        if state is None:
+            state = self.default
+        return getattr(state, name)
+
+
+# State of the job that runs in this process
+job = ThreadJobState()
+
+
+def prometheusText(state):
+    """Return job status in Prometheus text exposition format"""
+    labels = ('identifier="' + escapeLabel(state['identifier']) + '",device="' +
+              escapeLabel(state['blockDevice']) + '",method="' +
+              escapeLabel(state['readMethod']) + '"')
+    lines = ['# HELP diskimgr_job_phase Current phase of the job (1 for the active phase)',
+             '# TYPE diskimgr_job_phase gauge']
+    for phase in PHASES:
+        lines.append('diskimgr_job_phase{' + labels + ',phase="' + phase + '"} ' +
+                     str(int(phase == state['phase'])))
+    metrics = [('bytes_done', 'Bytes processed in the current phase', state['bytesDone']),
+               ('bytes_total', 'Size of the medium in bytes', state['totalBytes']),
+               ('rate_bytes_per_second', 'Average rate of the current phase', state['rate']),
+               ('read_errors', 'Number of read errors', state['readErrors']),
+               ('eta_seconds', 'Estimated time left in the current phase',
+                state['eta'] if state['eta'] is not None else 'NaN')]
+    for name, helpText, value in metrics:
+        lines.append('# HELP diskimgr_' + name + ' ' + helpText)
+        lines.append('# TYPE diskimgr_' + name + ' gauge')
+        lines.append('diskimgr_' + name + '{' + labels + '} ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+
+def escapeLabel(value):
+    """Escape Prometheus label value"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+if __name__ == "__main__":
+    # The endpoint lives in its own module, so importing this one stays cheap
+    from .endpoint import main
+    main()
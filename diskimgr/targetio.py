@@ -0,0 +1,139 @@
+#! /usr/bin/env python3
+"""Target-side I/O management: preallocation of the image file,
+limits on write-behind and dropping written pages from the page cache"""
+
+import os
+import ctypes
+import ctypes.util
+import logging
+import functools
+
+# Flags from linux/falloc.h and linux/fs.h
+FALLOC_FL_KEEP_SIZE = 0x01
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+
+
+@functools.lru_cache(maxsize=None)
+def getLibc():
+    """Return C library with fallocate and sync_file_range, or None. Loaded
+    on first use, as find_library can be slow (it may run ldconfig)"""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.c_longlong, ctypes.c_longlong]
+        libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_longlong,
+                                         ctypes.c_longlong, ctypes.c_uint]
+    except (OSError, AttributeError):
+        libc = None
+    return libc
+
+
+def preallocate(fd, size):
+    """Reserve size bytes of disk space for fd, without changing the apparent
+    file size. Returns True on success, False if not supported"""
+
+    libc = getLibc()
+    if libc is None or size <= 0:
+        return False
+    if libc.fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+        errno = ctypes.get_errno()
+        logging.warning('cannot preallocate image file: ' + os.strerror(errno))
+        return False
+    return True
+
+
+def preallocateFile(path, size):
+    """Preallocate file at path (created if it doesn't exist)"""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644)
+    except OSError as e:
+        logging.warning('cannot preallocate ' + path + ': ' + str(e))
+        return False
+    try:
+        return preallocate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def syncRange(fd, offset, length, flags):
+    """Call sync_file_range, fall back to fdatasync if it is not available"""
+    libc = getLibc()
+    if libc is not None:
+        if libc.sync_file_range(fd, offset, length, flags) == 0:
+            return
+    if flags & SYNC_FILE_RANGE_WAIT_AFTER:
+        os.fdatasync(fd)
+
+
+def dropCache(fd, offset, length):
+    """Tell the kernel we won't need these (written back) pages again"""
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except (OSError, AttributeError):
+        pass
+
+
+class WriteBehind:
+    """Limits the amount of dirty data for a file that is written sequentially.
+
+    Every syncInterval bytes, writeback of the latest window is started
+    asynchronously, and the program waits for the previous window to be
+    on disk. At most two windows are dirty at any time, so throughput stays
+    flat instead of stalling once the kernel's dirty limits are hit.
+    Optionally, windows that are on disk are dropped from the page cache.
+    """
+
+    def __init__(self, fd, syncInterval, dropCacheFlag):
+        """initialise WriteBehind instance"""
+        self.fd = fd
+        self.syncInterval = syncInterval
+        self.dropCacheFlag = dropCacheFlag
+        self.windowStart = 0
+        self.windowEnd = 0
+        self.previous = None
+
+    def written(self, offset, length):
+        """Register a completed write"""
+        if self.syncInterval <= 0:
+            return
+        if offset != self.windowEnd:
+            # Not sequential: flush current window, start a new one here
+            self.flushWindow()
+            self.windowStart = offset
+        self.windowEnd = offset + length
+        if self.windowEnd - self.windowStart >= self.syncInterval:
+            self.flushWindow()
+
+    def flushWindow(self):
+        """Start writeback of current window, and retire the previous one"""
+        length = self.windowEnd - self.windowStart
+        if length > 0:
+            syncRange(self.fd, self.windowStart, length, SYNC_FILE_RANGE_WRITE)
+        self.retire()
+        if length > 0:
+            self.previous = (self.windowStart, length)
+        self.windowStart = self.windowEnd
+
+    def retire(self):
+        """Wait until previous window is on disk, then drop it from the cache"""
+        if self.previous is None:
+            return
+        offset, length = self.previous
+        syncRange(self.fd, offset, length, SYNC_FILE_RANGE_WAIT_BEFORE |
+                  SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+        if self.dropCacheFlag:
+            dropCache(self.fd, offset, length)
+        self.previous = None
+
+    def finish(self):
+        """Flush everything that is left"""
+        if self.syncInterval <= 0:
+            if self.dropCacheFlag:
+                os.fdatasync(self.fd)
+                dropCache(self.fd, 0, 0)
+            return
+        self.flushWindow()
+        self.retire()
+        os.fdatasync(self.fd)
@@ -0,0 +1,64 @@
+#! /usr/bin/env python3
+"""Token-bucket bandwidth limiting, shared between threads"""
+
+import time
+import errno
+import threading
+
+
+class TokenBucket:
+    """Limits throughput to rate bytes/s, allowing bursts of up to burst
+    bytes. A rate of 0 means unlimited"""
+
+    def __init__(self, rate, burst=None):
+        """initialise TokenBucket instance"""
+        self.rate = rate
+        if burst is None:
+            burst = rate
+        self.burst = burst
+        # Start empty, so the limit also holds for short runs
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.waitTime = 0.0
+
+    def consume(self, noBytes):
+        """Take noBytes from the bucket, sleeping until they are available.
+        The bucket may go into debt, so reads larger than burst still work"""
+        if self.rate <= 0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= noBytes
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waitTime += wait
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledSource:
+    """Wraps a pipeline source, so reads from it share the bandwidth of
+    bucket. Has no file descriptor, so kernel-side copies can't bypass it"""
+
+    def __init__(self, source, bucket):
+        """initialise ThrottledSource instance"""
+        self.source = source
+        self.bucket = bucket
+        self.path = source.path
+        self.size = source.size
+        self.direct = source.direct
+
+    def fileno(self):
+        """No file descriptor for kernel-side copies"""
+        raise OSError(errno.EBADF, 'throttled source has no file descriptor')
+
+    def readinto(self, view, offset):
+        """Read into view at offset, after waiting for bandwidth"""
+        self.bucket.consume(len(view))
+        return self.source.readinto(view, offset)
+
+    def close(self):
+        """Close wrapped source"""
+        self.source.close()
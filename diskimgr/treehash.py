@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+"""BLAKE2b tree hashing, for checksums of very large images.
+
+A single SHA-512 over an image is computed serially, so it is bounded by
+one core. The tree hash splits the image into leaves of leafSize bytes,
+hashes the leaves in parallel, and combines their digests into a root
+digest. It uses BLAKE2b's own tree parameters, so the value can be
+reproduced with any BLAKE2b implementation:
+
+    leaf i:  blake2b(data[i * leafSize:(i + 1) * leafSize], digest_size,
+                     fanout=0, depth=2, leaf_size=leafSize, node_offset=i,
+                     node_depth=0, inner_size=digest_size,
+                     last_node=(i is the last leaf))
+    root:    blake2b(digest of leaf 0 + digest of leaf 1 + ..., the same
+                     parameters, node_offset=0, node_depth=1, last_node=True)
+
+An empty file has one (empty) leaf. Running this module computes the tree
+hash of a file.
+"""
+
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import concurrent.futures
+from . import status
+
+ALGORITHM = 'BLAKE2b-tree'
+# Leaves are read and hashed in chunks of this size, so memory use
+# doesn't depend on the leaf size
+CHUNK_SIZE = 2**20
+
+
+def parameters(leafSize, digestSize=64):
+    """Return dictionary with the BLAKE2b tree parameters of the leaves"""
+    return {'digest_size': digestSize,
+            'fanout': 0,
+            'depth': 2,
+            'leaf_size': leafSize,
+            'inner_size': digestSize}
+
+
+def checkLeafSize(leafSize):
+    """Raise ValueError if leafSize is not a valid BLAKE2b leaf size"""
+    if not 0 < leafSize < 2**32:
+        raise ValueError('tree hash leaf size must be between 1 and 2^32 - 1 bytes')
+
+
+def newNode(leafSize, digestSize, nodeOffset, nodeDepth, lastNode):
+    """Return blake2b object for one node of the tree"""
+    return hashlib.blake2b(node_offset=nodeOffset, node_depth=nodeDepth, last_node=lastNode,
+                           **parameters(leafSize, digestSize))
+
+
+def hashLeaf(fd, leaf, noLeaves, leafSize, digestSize, bucket=None, cancelToken=None,
+             progress=None):
+    """Return digest of leaf of file fd, or None if cancelToken was cancelled"""
+    m = newNode(leafSize, digestSize, leaf, 0, leaf == noLeaves - 1)
+    offset = leaf * leafSize
+    end = offset + leafSize
+    while offset < end:
+        if cancelToken is not None and cancelToken.isCancelled():
+            return None
+        noBytes = min(CHUNK_SIZE, end - offset)
+        if bucket is not None:
+            bucket.consume(noBytes)
+        data = os.pread(fd, noBytes, offset)
+        if not data:
+            break
+        m.update(data)
+        offset += len(data)
+        if progress is not None:
+            progress(len(data))
+    return m.digest()
+
+
+def hashFile(fileIn, leafSize, digestSize=64, noWorkers=0, bucket=None, cancelToken=None,
+             progress=None):
+    """Return hexadecimal BLAKE2b tree hash of fileIn, or None if cancelToken
+    (cancel.CancelToken) was cancelled. Leaves are hashed by noWorkers
+    threads (0: number of cores). If bucket (throttle.TokenBucket) is set,
+    reads are limited to its bandwidth. progress is called with the number
+    of bytes of every chunk that was hashed. Raises OSError"""
+    checkLeafSize(leafSize)
+    if noWorkers <= 0:
+        noWorkers = os.cpu_count() or 1
+    fd = os.open(fileIn, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        noLeaves = max(1, -(-size // leafSize))
+        # hashlib releases the GIL for large buffers, so threads use all cores
+        with concurrent.futures.ThreadPoolExecutor(max_workers=noWorkers) as executor:
+            task = status.job.inherit(lambda leaf: hashLeaf(fd, leaf, noLeaves, leafSize,
+                                                            digestSize, bucket,
+                                                            cancelToken, progress))
+            digests = list(executor.map(task, range(noLeaves)))
+    finally:
+        os.close(fd)
+    if None in digests:
+        return None
+    root = newNode(leafSize, digestSize, 0, 1, True)
+    for digest in digests:
+        root.update(digest)
+    return root.hexdigest()
+
+
+def parseCommandLine(parser):
+    """Parse command line"""
+
+    parser.add_argument('files',
+                        action='store',
+                        nargs='+',
+                        help='files to hash')
+    parser.add_argument('--leaf-size', '-l',
+                        action='store',
+                        type=int,
+                        dest='leafSize',
+                        default=67108864,
+                        help='leaf size in bytes (default: 64 MiB)')
+    parser.add_argument('--digest-size', '-d',
+                        action='store',
+                        type=int,
+                        dest='digestSize',
+                        default=64,
+                        help='digest size in bytes (default: 64)')
+    parser.add_argument('--workers', '-w',
+                        action='store',
+                        type=int,
+                        dest='noWorkers',
+                        default=0,
+                        help='number of leaves that are hashed in parallel ' +
+                        '(default: number of cores)')
+    # Parse arguments
+    args = parser.parse_args()
+    return args
+
+
+def main():
+    """Compute BLAKE2b tree hash of files"""
+
+    parser = argparse.ArgumentParser(description='BLAKE2b tree hash of files')
+    args = parseCommandLine(parser)
+
+    result = {'algorithm': ALGORITHM,
+              'parameters': parameters(args.leafSize, args.digestSize),
+              'checksums': {},
+              'elapsed': {}}
+    try:
+        checkLeafSize(args.leafSize)
+        for fileIn in args.files:
+            t0 = time.perf_counter()
+            result['checksums'][fileIn] = hashFile(fileIn, args.leafSize, args.digestSize,
+                                                   args.noWorkers)
+            result['elapsed'][fileIn] = round(time.perf_counter() - t0, 3)
+    except (OSError, ValueError) as e:
+        sys.stderr.write('ERROR: ' + str(e) + '\n')
+        sys.exit(1)
+
+    json.dump(result, sys.stdout, indent=4)
+    sys.stdout.write('\n')
+
+
+if __name__ == "__main__":
+    main()
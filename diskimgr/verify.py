@@ -0,0 +1,226 @@
+#! /usr/bin/env python3
+"""Verification of an image against the medium it was read from.
+
+The device and the image are read concurrently by two reader threads,
+and compared block by block, so verification takes about as long as a
+single read of the device. If the image was already hashed while it was
+read, only the device is read and hashed, and the blocks are compared
+only if the digests differ (to locate the mismatches).
+"""
+
+import time
+import queue
+import logging
+import threading
+from . import cancel
+from . import pipeline
+from . import status
+from . import targetio
+from . import throttle
+
+# Maximum number of mismatching ranges that are reported
+MAX_MISMATCHES = 10
+
+
+class Verifier:
+    """Compares a source (device) against an image file"""
+
+    def __init__(self, source, imageFile, bufferSize, memoryBudget, sectorSize,
+                 bucket=None, cancelToken=None):
+        """initialise Verifier instance. If bucket is set, reads of the image
+        share its bandwidth (wrap source in a ThrottledSource as well)"""
+        self.source = source
+        self.bucket = bucket
+        self.imageFile = imageFile
+        self.bufferSize = bufferSize
+        self.memoryBudget = memoryBudget
+        self.sectorSize = sectorSize
+        self.mismatches = []
+        self.noMismatchingSectors = 0
+        self.readErrors = []
+        self.interrupted = False
+        self.abortFlag = False
+        if cancelToken is None:
+            cancelToken = cancel.CancelToken()
+        self.cancelToken = cancelToken
+        self.bytesCompared = 0
+        self.elapsed = 0.0
+
+    def readBlocks(self, source, ring, q, stats):
+        """Reader thread: read source into buffers from ring, in order"""
+        offset = 0
+        while offset < self.source.size and not self.abortFlag:
+            if self.cancelToken.isCancelled():
+                self.interrupted = True
+                self.abortFlag = True
+                break
+            slot = ring.acquire(stats)
+            noBytes = min(ring.bufferSize, self.source.size - offset)
+            try:
+                bytesRead = source.readinto(slot.view[:noBytes], offset)
+            except OSError as e:
+                self.readErrors.append((source.path, offset, str(e)))
+                ring.free.put(slot)
+                self.abortFlag = True
+                break
+            slot.offset = offset
+            slot.length = bytesRead
+            slot.refCount = 1
+            q.put(slot)
+            if bytesRead == 0:
+                break
+            offset += bytesRead
+        q.put(None)
+
+    def compareBlock(self, slotDevice, slotImage):
+        """Compare two buffers, and record mismatching sector ranges"""
+        length = slotDevice.length
+        if slotImage.length == length and length == len(slotDevice.buffer):
+            # Full buffers compare with a single memcmp
+            if slotDevice.buffer == slotImage.buffer:
+                return
+        elif slotImage.length == length:
+            if slotDevice.view[:length].tobytes() == slotImage.view[:length].tobytes():
+                return
+        # Locate mismatching sectors
+        for pos in range(0, length, self.sectorSize):
+            end = min(pos + self.sectorSize, length)
+            if slotDevice.view[pos:end] != slotImage.view[pos:min(end, slotImage.length)]:
+                self.addMismatch(slotDevice.offset + pos, end - pos)
+
+    def addMismatch(self, offset, size):
+        """Record mismatch, merging it with the previous one if adjacent"""
+        self.noMismatchingSectors += 1
+        if self.mismatches and sum(self.mismatches[-1]) == offset:
+            self.mismatches[-1][1] += size
+        elif len(self.mismatches) < MAX_MISMATCHES:
+            self.mismatches.append([offset, size])
+
+    def run(self):
+        """Compare source and image; returns True if they are identical"""
+        t0 = time.perf_counter()
+        try:
+            image = pipeline.BlockSource(self.imageFile)
+        except OSError as e:
+            self.readErrors.append((self.imageFile, 0, str(e)))
+            return False
+        # Make sure the image is read from disk, not from the page cache
+        targetio.dropCache(image.fileno(), 0, 0)
+        if self.bucket is not None:
+            image = throttle.ThrottledSource(image, self.bucket)
+
+        rings = [pipeline.BufferRing(self.bufferSize, self.memoryBudget // 2),
+                 pipeline.BufferRing(self.bufferSize, self.memoryBudget // 2)]
+        queues = [queue.Queue(), queue.Queue()]
+        self.stats = [pipeline.StageStats('device'), pipeline.StageStats('image')]
+        threads = [threading.Thread(target=status.job.inherit(self.readBlocks),
+                                    args=(source, rings[i], queues[i], self.stats[i]))
+                   for i, source in enumerate([self.source, image])]
+        for t in threads:
+            t.start()
+
+        compareStats = pipeline.StageStats('compare')
+        while True:
+            slotDevice = pipeline.timedGet(queues[0], compareStats)
+            slotImage = pipeline.timedGet(queues[1], compareStats)
+            if slotDevice is None or slotImage is None:
+                if slotDevice is not None or slotImage is not None:
+                    if not self.abortFlag:
+                        # Image is shorter than device
+                        self.addMismatch(self.bytesCompared, self.source.size - self.bytesCompared)
+                    self.abortFlag = True
+                # Drain queues, so the reader threads can finish
+                for q, ring, slot in zip(queues, rings, [slotDevice, slotImage]):
+                    while slot is not None:
+                        ring.free.put(slot)
+                        slot = q.get()
+                break
+            self.compareBlock(slotDevice, slotImage)
+            self.bytesCompared += slotDevice.length
+            status.job.addBytes(slotDevice.length)
+            rings[0].release(slotDevice)
+            rings[1].release(slotImage)
+
+        for t in threads:
+            t.join()
+        image.close()
+        self.elapsed = time.perf_counter() - t0
+        return not self.mismatches and not self.readErrors and not self.interrupted
+
+
+def verifyImage(devicePath, imageFile, bufferSize, memoryBudget, sectorSize,
+                imageChecksum=None, bandwidth=0, cancelToken=None):
+    """Verify imageFile against device, and log the result. If imageChecksum
+    (SHA-512 of image) is given, the device is hashed instead of compared.
+    Reads are limited to bandwidth bytes/s (0: unlimited), and stop when
+    cancelToken (cancel.CancelToken) is cancelled.
+    Returns verified flag and dictionary with verification results"""
+
+    result = {}
+    verifiedFlag = False
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
+    logging.info('*** Verifying image against medium ***')
+
+    try:
+        source = pipeline.openSource(devicePath)
+    except OSError as e:
+        logging.error('cannot open ' + devicePath + ': ' + str(e))
+        result['method'] = 'none'
+        result['verified'] = False
+        return verifiedFlag, result
+
+    try:
+        # Make sure the medium is read again, not the page cache
+        targetio.dropCache(source.fileno(), 0, 0)
+    except OSError:
+        pass
+    bucket = None
+    if bandwidth > 0:
+        bucket = throttle.TokenBucket(bandwidth, max(bandwidth, bufferSize))
+        source = throttle.ThrottledSource(source, bucket)
+
+    try:
+        if imageChecksum is not None:
+            hasher = pipeline.Hasher('sha512')
+            p = pipeline.Pipeline(source, [hasher], bufferSize, memoryBudget,
+                                  cancelToken=cancelToken)
+            p.run()
+            result['method'] = 'sha512'
+            result['elapsed'] = round(p.elapsed, 3)
+            if p.interrupted:
+                logging.warning('*** verification interrupted by user ***')
+                cancelToken.stopped('verification')
+            elif p.readErrors or p.bytesRead != source.size:
+                logging.error('could not read complete medium')
+            elif hasher.hexdigest() == imageChecksum:
+                verifiedFlag = True
+            else:
+                logging.error('SHA-512 of medium differs from image, '
+                              'comparing blocks to locate differences')
+                # Compare the blocks to find out where
+                imageChecksum = None
+        if imageChecksum is None and not verifiedFlag:
+            v = Verifier(source, imageFile, bufferSize, memoryBudget, sectorSize, bucket,
+                         cancelToken)
+            verifiedFlag = v.run()
+            result['method'] = 'compare'
+            result['elapsed'] = round(v.elapsed, 3)
+            result['bytesCompared'] = v.bytesCompared
+            result['mismatchingSectors'] = v.noMismatchingSectors
+            result['mismatches'] = v.mismatches
+            if v.interrupted:
+                logging.warning('*** verification interrupted by user ***')
+                cancelToken.stopped('verification')
+            for path, offset, error in v.readErrors:
+                logging.error('read error in ' + path + ' at offset ' + str(offset) + ': ' + error)
+            for offset, size in v.mismatches:
+                logging.error('image differs from medium at offset ' + str(offset) +
+                              ' (' + str(size) + ' bytes)')
+    finally:
+        source.close()
+
+    result['verified'] = verifiedFlag
+    logging.info('verification method: ' + result['method'])
+    logging.info('image verified: ' + str(verifiedFlag))
+    return verifiedFlag, result
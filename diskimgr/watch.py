@@ -0,0 +1,84 @@
+#! /usr/bin/env python3
+"""Watch for newly inserted media, for unattended batch imaging.
+
+Polls /sys/block (no udev needed) for physical block devices that appear,
+or whose size changes from 0 (a card reader or optical drive that gets a
+medium). A medium is reported once its size is the same in two successive
+polls, so it has settled, and a device is only reported again after its
+medium was removed. Media that are present when watching starts are left
+alone.
+"""
+
+import os
+import io
+import glob
+import fnmatch
+from os.path import basename, dirname
+
+SYS_BLOCK = '/sys/block'
+# Unit of the size attribute in sysfs
+SECTOR_SIZE = 512
+
+
+def readAttribute(sysBlock, deviceName, attribute):
+    """Return sysfs attribute of device as string ('' if it can't be read)"""
+    try:
+        with io.open(os.path.join(sysBlock, deviceName, attribute), 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return ''
+
+
+def scanDevices(sysBlock=SYS_BLOCK, includeFixed=False, pattern='*'):
+    """Return dictionary with size in bytes of every physical block device
+    whose name matches pattern and that holds a medium. Only removable
+    devices, unless includeFixed is True"""
+    devices = {}
+    # Same selection as shared.getBlockDevices: loop, RAM and device mapper
+    # devices have no device link
+    for d in glob.glob(os.path.join(sysBlock, '*', 'device')):
+        deviceName = basename(dirname(d))
+        if not fnmatch.fnmatch(deviceName, pattern):
+            continue
+        if not includeFixed and readAttribute(sysBlock, deviceName, 'removable') != '1':
+            continue
+        try:
+            noBytes = int(readAttribute(sysBlock, deviceName, 'size')) * SECTOR_SIZE
+        except ValueError:
+            continue
+        if noBytes > 0:
+            devices[deviceName] = noBytes
+    return devices
+
+
+class Watcher:
+    """Reports media that are inserted between polls"""
+
+    def __init__(self, sysBlock=SYS_BLOCK, includeFixed=False, pattern='*'):
+        """initialise Watcher instance"""
+        self.sysBlock = sysBlock
+        self.includeFixed = includeFixed
+        self.pattern = pattern
+        # Media that were present at the start, or were reported already
+        self.known = set(scanDevices(sysBlock, includeFixed, pattern))
+        # Size of new media at the last poll
+        self.pending = {}
+
+    def poll(self):
+        """Return list of (device path, size) of media that were inserted
+        and have settled since the last poll"""
+        devices = scanDevices(self.sysBlock, self.includeFixed, self.pattern)
+        # Removed media are reported again when a medium is inserted
+        self.known &= set(devices)
+        inserted = []
+        pending = {}
+        for deviceName, noBytes in sorted(devices.items()):
+            if deviceName in self.known:
+                continue
+            if self.pending.get(deviceName) == noBytes:
+                inserted.append(('/dev/' + deviceName, noBytes))
+                self.known.add(deviceName)
+            else:
+                pending[deviceName] = noBytes
+        self.pending = pending
+        return inserted
@@ -1,11 +1,20 @@
 #! /usr/bin/env python3
 """wrapper functions for readom and ddrescue"""
 
+import re
 import logging
 import time
-import signal
 import subprocess as sub
-from . import config
+from . import cancel
+from . import status
+
+def getRescuedBytes(rescueLine):
+    """parse ddrescue status line for number of rescued bytes, or None"""
+    match = re.search(r'(?<!pct )rescued:\s*([\d.]+)\s*(\w+)', rescueLine)
+    if match is None:
+        return None
+    return status.parseSize(match.group(1), match.group(2))
+
 
 def getReadErrors(rescueLine):
     """parse ddrescue output line for values of readErrors"""
@@ -21,11 +30,91 @@ def getReadErrors(rescueLine):
     return readErrors
 
 
-def dd(args):
-    """dd wapper function"""
+class ProgressFilter:
+    """Coalesces ddrescue status blocks: every other line is passed on, but
+    a status block is only passed on if interval seconds have passed since
+    the last one that was, or progress increased by step percent. The last
+    status block before any other line (and at the end, by finish()) is
+    always passed on. If interval is None, all lines are passed on"""
+
+    # Lines that belong to a status block, and the line that ends one
+    PROGRESS_KEYS = ['ipos:', 'opos:', 'non-tried:', 'rescued:', 'successful read']
+    BLOCK_END_KEY = 'successful read'
+    # Phase lines, e.g. 'Copying non-tried blocks... Pass 1 (forwards)'
+    PHASE_PATTERN = re.compile(r'^[A-Z][\w -]*\.\.\.')
+    PCT_PATTERN = re.compile(r'pct rescued:\s*([\d.]+)%')
+
+    def __init__(self, interval=None, step=None):
+        """initialise ProgressFilter instance"""
+        self.interval = interval
+        self.step = step
+        self.block = []
+        self.lastBlock = []
+        self.lastBlockLogged = True
+        self.lastLogTime = None
+        self.lastPct = None
+        self.pct = None
+        self.lastPhase = None
+        self.noSuppressed = 0
+
+    def isProgress(self, line):
+        """Return True if line is part of a status block"""
+        return any(key in line for key in self.PROGRESS_KEYS)
+
+    def feed(self, line):
+        """Return list of lines to log for this line of ddrescue output"""
+        if self.interval is None:
+            return [line]
+        if self.PHASE_PATTERN.match(line.strip()):
+            # Phase lines are repeated with every status block; only log changes
+            if line == self.lastPhase:
+                return []
+            self.lastPhase = line
+            return self.finish() + [line]
+        if not self.isProgress(line):
+            # Show the state that led up to this line first
+            return self.finish() + [line]
+        self.block.append(line)
+        match = self.PCT_PATTERN.search(line)
+        if match:
+            self.pct = float(match.group(1))
+        if self.BLOCK_END_KEY not in line:
+            return []
+        block = self.block
+        self.block = []
+        now = time.monotonic()
+        due = (self.lastLogTime is None or now - self.lastLogTime >= self.interval or
+               (self.step is not None and self.step > 0 and self.pct is not None and
+                self.lastPct is not None and self.pct - self.lastPct >= self.step))
+        self.lastBlock = block
+        if not due:
+            self.lastBlockLogged = False
+            self.noSuppressed += 1
+            return []
+        self.lastBlockLogged = True
+        self.lastLogTime = now
+        self.lastPct = self.pct
+        return block
+
+    def finish(self):
+        """Return the lines that are needed to show the final state"""
+        lines = self.block
+        if not lines and not self.lastBlockLogged:
+            lines = self.lastBlock
+            self.noSuppressed -= 1
+        self.block = []
+        self.lastBlockLogged = True
+        return lines
+
+
+def dd(args, cancelToken=None, termTimeout=10.0, killTimeout=10.0):
+    """dd wapper function. dd is stopped when cancelToken is cancelled (see
+    cancel.Supervisor for the deadlines)"""
 
     errorFlag = False
     interruptedFlag = False
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
 
     # Logging
     cmdName = args[0]
@@ -35,6 +124,9 @@ def dd(args):
     try:
         p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
                       shell=False, bufsize=1, universal_newlines=True)
+        # Stops dd on interrupt, whether it writes any output or not
+        supervisor = cancel.Supervisor(p, cancelToken, 'dd', termTimeout, killTimeout)
+        supervisor.start()
 
         # Processing of output adapted from DDRescue-GUI by Hamish McIntyre-Bhatty:
         # https://git.launchpad.net/ddrescue-gui/tree/DDRescue_GUI.py
@@ -69,15 +161,6 @@ def dd(args):
                 # Reset line.
                 line = ""
 
-                # Interrupt readom if config.interruptFlag is True
-                if config.interruptFlag:
-                    interruptedFlag = True
-                    logging.warning('*** readom execution interrupted by user ***')
-                    p.send_signal(signal.SIGINT)
-                    # Reset interruptFlag to avoid the above commands to be issued numerous
-                    # times while waiting
-                    config.interruptFlag = False
-
         # Parse any remaining lines afterwards.
         if line != "":
             tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
@@ -85,6 +168,10 @@ def dd(args):
 
         p.wait()
         exitStatus = p.returncode
+        supervisor.join()
+        interruptedFlag = supervisor.interrupted
+        if interruptedFlag:
+            cancelToken.stopped('dd')
 
     except Exception:
         raise
@@ -101,12 +188,19 @@ def dd(args):
     return cmdLine, exitStatus, errorFlag, interruptedFlag
 
 
-def ddrescue(args):
-    """ddrescue wapper function"""
+def ddrescue(args, progressInterval=None, progressStep=None, cancelToken=None,
+             termTimeout=10.0, killTimeout=10.0):
+    """ddrescue wapper function. Status updates are logged at most every
+    progressInterval seconds, or every progressStep percent (see ProgressFilter).
+    ddrescue is stopped when cancelToken is cancelled (see cancel.Supervisor
+    for the deadlines)"""
 
     errorFlag = False
     interruptedFlag = False
+    if cancelToken is None:
+        cancelToken = cancel.CancelToken()
     readErrors = 0
+    progressFilter = ProgressFilter(progressInterval, progressStep)
 
     # Logging
     cmdName = args[0]
@@ -116,6 +210,9 @@ def ddrescue(args):
     try:
         p = sub.Popen(args, stdout=sub.PIPE, stderr=sub.PIPE,
                       shell=False, bufsize=1, universal_newlines=True)
+        # Stops ddrescue on interrupt, whether it writes any output or not
+        supervisor = cancel.Supervisor(p, cancelToken, 'ddrescue', termTimeout, killTimeout)
+        supervisor.start()
 
         # Processing of output adapted from DDRescue-GUI by Hamish McIntyre-Bhatty:
         # https://git.launchpad.net/ddrescue-gui/tree/DDRescue_GUI.py
@@ -141,8 +238,14 @@ def ddrescue(args):
                     if "errors:" in tidy_line:
                         # Parse this line for value of read errors
                         readErrors = getReadErrors(tidy_line)
+                        status.job.setErrors(readErrors)
+                    if "rescued:" in tidy_line:
+                        rescuedBytes = getRescuedBytes(tidy_line)
+                        if rescuedBytes is not None:
+                            status.job.setBytes(rescuedBytes)
                     try:
-                        logging.info(tidy_line)
+                        for lineOut in progressFilter.feed(tidy_line):
+                            logging.info(lineOut)
                     except:
                         raise
                         # Handle unexpected errors. Can happen once in normal operation on
@@ -152,15 +255,6 @@ def ddrescue(args):
                 # Reset line.
                 line = ""
 
-                # Interrupt ddrescue if config.interruptFlag is True
-                if config.interruptFlag:
-                    interruptedFlag = True
-                    logging.warning('*** ddrescue execution interrupted by user ***')
-                    p.send_signal(signal.SIGINT)
-                    # Reset interruptFlag to avoid the above commands to be issued numerous
-                    # times while waiting
-                    config.interruptFlag = False
-
         # Parse any remaining lines afterwards.
         if line != "":
             tidy_line = line.replace("\n", "").replace("\r", "").replace("\x1b[A", "")
@@ -168,10 +262,21 @@ def ddrescue(args):
                 # Parse this line for value of read errors
                 readErrors = getReadErrors(tidy_line)
 
-            logging.info(tidy_line)
+            for lineOut in progressFilter.feed(tidy_line):
+                logging.info(lineOut)
+
+        # Always log the final state
+        for lineOut in progressFilter.finish():
+            logging.info(lineOut)
+        if progressFilter.noSuppressed > 0:
+            logging.info('(' + str(progressFilter.noSuppressed) + ' ddrescue status updates not logged)')
 
         p.wait()
         exitStatus = p.returncode
+        supervisor.join()
+        interruptedFlag = supervisor.interrupted
+        if interruptedFlag:
+            cancelToken.stopped('ddrescue')
 
     except Exception:
         raise
@@ -25,17 +25,22 @@ def find_version(*file_paths):
 
 INSTALL_REQUIRES = [
     'setuptools',
-    'pytz',
     'tkfilebrowser'
 ]
 
-PYTHON_REQUIRES = '>=3.2'
+# Optional: fast histograms for the entropy map
+EXTRAS_REQUIRE = {
+    'analysis': ['numpy']
+}
+
+PYTHON_REQUIRES = '>=3.9'
 
 setup(name='diskimgr',
       packages=find_packages(),
       version=find_version('diskimgr', 'diskimgr.py'),
       license='Apache License 2.0',
       install_requires=INSTALL_REQUIRES,
+      extras_require=EXTRAS_REQUIRE,
       python_requires=PYTHON_REQUIRES,
       platforms=['linux'],
       description='Optical media imager',
@@ -53,7 +58,13 @@ setup(name='diskimgr',
           'diskimgr = diskimgr.diskimgr:main'],
                     'console_scripts': [
                         'diskimgr = diskimgr.diskimgr:main',
-                        'diskimgr-config = diskimgr.configure:main']},
+                        'diskimgr-config = diskimgr.configure:main',
+                        'diskimgr-index = diskimgr.index:main',
+                        'diskimgr-audit = diskimgr.audit:main',
+                        'diskimgr-verify = diskimgr.manifest:main',
+                        'diskimgr-treehash = diskimgr.treehash:main',
+                        'diskimgr-entropy = diskimgr.entropy:main',
+                        'diskimgr-daemon = diskimgr.daemon:main']},
       classifiers=[
           'Programming Language :: Python :: 3',]
      )
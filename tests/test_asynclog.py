@@ -0,0 +1,62 @@
+"""Asynchronous log writing"""
+
+import io
+import json
+import logging
+import time
+
+from diskimgr import asynclog
+
+
+def test_log_files(tmp_path):
+    """Records end up in the log file, and with their structured fields in
+    the JSON-lines log"""
+    logFile = str(tmp_path / 'disc.log')
+    jsonLogFile = str(tmp_path / 'disc.jsonl')
+    listener = asynclog.startLogging(logFile, jsonLogFile, flushInterval=0.1)
+    try:
+        logging.info('started')
+        logging.warning('read error', extra={'event': 'readError', 'offset': 512,
+                                             'unknown': 'x'})
+    finally:
+        asynclog.stopLogging(listener)
+    with io.open(logFile, 'r', encoding='utf-8') as f:
+        lines = f.read().splitlines()
+    assert [line.split(' - ', 1)[1] for line in lines] == ['INFO - started',
+                                                          'WARNING - read error']
+    with io.open(jsonLogFile, 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert [(e['level'], e['event'], e['message']) for e in entries] == \
+        [('INFO', 'message', 'started'), ('WARNING', 'readError', 'read error')]
+    assert entries[1]['offset'] == 512
+    assert 'unknown' not in entries[1]
+    assert listener.queueHandler not in logging.getLogger().handlers
+
+
+def test_warnings_are_flushed(tmp_path):
+    """Warnings are in the file straight away, before the log is stopped"""
+    logFile = tmp_path / 'disc.log'
+    listener = asynclog.startLogging(str(logFile), flushInterval=60)
+    try:
+        logging.warning('device removed')
+        # The listener thread writes the record shortly after
+        deadline = time.monotonic() + 5
+        while 'device removed' not in logFile.read_text() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert 'device removed' in logFile.read_text()
+    finally:
+        asynclog.stopLogging(listener)
+
+
+def test_record_filter(tmp_path):
+    """Only records that pass the filter are written"""
+    logFile = tmp_path / 'disc.log'
+    listener = asynclog.startLogging(str(logFile),
+                                     recordFilter=lambda record: 'other' not in record.msg)
+    try:
+        logging.info('this job')
+        logging.info('other job')
+    finally:
+        asynclog.stopLogging(listener)
+    assert [line.split(' - ', 2)[2] for line in logFile.read_text().splitlines()] == \
+        ['this job']
@@ -0,0 +1,132 @@
+"""Fixity audit of existing acquisitions"""
+
+import hashlib
+import io
+import os
+import sqlite3
+
+from diskimgr import audit
+from diskimgr import cancel
+from diskimgr import throttle
+
+NAMES = ['a.img', 'b.img', 'c.img', 'd.img', 'e.img']
+
+
+def makeAcquisition(dirOut, badName='b.img'):
+    """Write files and checksum file to dirOut; the checksum of badName is wrong"""
+    os.makedirs(dirOut)
+    lines = []
+    for name in NAMES:
+        data = os.urandom(4096)
+        with open(os.path.join(dirOut, name), 'wb') as f:
+            f.write(data)
+        checksum = hashlib.sha512(data).hexdigest()
+        if name == badName:
+            checksum = hashlib.sha512(b'other').hexdigest()
+        lines.append(checksum + ' *' + name + '\n')
+    with io.open(os.path.join(dirOut, 'checksums.sha512'), 'w', encoding='utf-8') as f:
+        f.write(''.join(lines) + '\n')
+
+
+def watchChecks(monkeypatch, interruptAt=None):
+    """Record the names of the files that are checked; checking interruptAt
+    raises KeyboardInterrupt"""
+    checked = []
+    checkFile = audit.checkFile
+
+    def watchedCheck(path, *args):
+        name = os.path.basename(path)
+        if name == interruptAt:
+            raise KeyboardInterrupt
+        checked.append(name)
+        return checkFile(path, *args)
+
+    monkeypatch.setattr(audit, 'checkFile', watchedCheck)
+    return checked
+
+
+def test_audit(tmp_path):
+    """Every listed file is checked; mismatching and missing files fail"""
+    root = tmp_path / 'root'
+    makeAcquisition(str(root / 'x'))
+    os.remove(str(root / 'x' / 'e.img'))
+    indexFile = str(tmp_path / 'index.sqlite')
+    a = audit.Audit(indexFile, str(root), 'checksums.sha512', noWorkers=2)
+    assert not a.run()
+    report = a.report()
+    assert report['filesChecked'] == 5
+    assert report['bytesRead'] == 4 * 4096
+    assert sorted((os.path.basename(f['path']), f['result']) for f in report['failures']) == \
+        [('b.img', 'mismatch'), ('e.img', 'missing')]
+    conn = sqlite3.connect(indexFile)
+    assert conn.execute('SELECT noChecked, noFailed FROM audits').fetchall() == [(5, 2)]
+    conn.close()
+
+
+def test_since_skips_passed_files(tmp_path, monkeypatch):
+    """Files that passed an audit since the given date aren't hashed again"""
+    root = tmp_path / 'root'
+    makeAcquisition(str(root / 'x'))
+    indexFile = str(tmp_path / 'index.sqlite')
+    audit.Audit(indexFile, str(root), 'checksums.sha512').run()
+    checked = watchChecks(monkeypatch)
+    a = audit.Audit(indexFile, str(root), 'checksums.sha512', since='2000-01-01')
+    a.run()
+    assert checked == ['b.img']
+    assert a.report()['filesSkipped'] == 4
+
+
+def test_resume_checks_remaining_files(tmp_path, monkeypatch):
+    """A resumed audit only checks the files that the interrupted run didn't
+    pass"""
+    root = tmp_path / 'root'
+    makeAcquisition(str(root / 'x'))
+    indexFile = str(tmp_path / 'index.sqlite')
+    watchChecks(monkeypatch, interruptAt='d.img')
+    a = audit.Audit(indexFile, str(root), 'checksums.sha512', noWorkers=1)
+    assert not a.run()
+    assert a.report()['interrupted']
+    assert a.report()['finished'] is None
+    monkeypatch.undo()
+    checked = watchChecks(monkeypatch)
+    a = audit.Audit(indexFile, str(root), 'checksums.sha512', noWorkers=1, resume=True)
+    a.run()
+    # c.img and e.img may finish around the interrupt, and are checked if they
+    # weren't recorded
+    assert 'a.img' not in checked
+    assert set(checked) >= {'b.img', 'd.img'}
+    assert a.report()['finished'] is not None
+
+
+def test_resume_reports_earlier_runs(tmp_path, monkeypatch):
+    """The report and the audits table of a resumed audit include the files
+    checked by the interrupted runs"""
+    root = tmp_path / 'root'
+    makeAcquisition(str(root / 'x'))
+    indexFile = str(tmp_path / 'index.sqlite')
+    watchChecks(monkeypatch, interruptAt='d.img')
+    audit.Audit(indexFile, str(root), 'checksums.sha512', noWorkers=1).run()
+    monkeypatch.undo()
+    a = audit.Audit(indexFile, str(root), 'checksums.sha512', noWorkers=1, resume=True)
+    assert not a.run()
+    report = a.report()
+    assert report['resumed']
+    assert report['filesChecked'] == 5
+    assert report['filesCheckedBefore'] >= 1
+    assert report['filesSkipped'] == 0
+    assert [os.path.basename(f['path']) for f in report['failures']] == ['b.img']
+    conn = sqlite3.connect(indexFile)
+    assert conn.execute('SELECT noChecked, noFailed FROM audits').fetchall() == [(5, 1)]
+    conn.close()
+
+
+def test_cancelled_hash_stops(tmp_path):
+    """Hashing stops between chunks once the cancel token is cancelled"""
+    path = tmp_path / 'a.img'
+    path.write_bytes(os.urandom(65536))
+    token = cancel.CancelToken()
+    bucket = throttle.TokenBucket(0)
+    assert audit.hashFile(str(path), bucket, 4096, token)[0] == \
+        hashlib.sha512(path.read_bytes()).hexdigest()
+    token.cancel()
+    assert audit.hashFile(str(path), bucket, 4096, token) == (None, 0, 'cancelled')
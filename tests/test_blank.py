@@ -0,0 +1,80 @@
+"""Fast path for blank media"""
+
+import os
+import sys
+
+import pytest
+
+from diskimgr import blank
+from diskimgr import cancel
+
+MIB = 1048576
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    """Run test with NumPy (if installed) and with the fallback"""
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        # Makes 'import numpy' fail
+        monkeypatch.setitem(sys.modules, 'numpy', None)
+    return request.param
+
+
+def test_fill_byte(backend):
+    """Only uniform data have a fill byte"""
+    assert blank.fillByte(memoryview(bytes(4096))) == 0
+    assert blank.fillByte(memoryview(b'\xff' * 4097)) == 255
+    assert blank.fillByte(memoryview(bytes(4095) + b'\x01')) is None
+    assert blank.fillByte(memoryview(b'')) is None
+
+
+def test_check_medium(backend, tmp_path, monkeypatch):
+    """Blank media are confirmed by reading them in full; a single other
+    byte anywhere makes a medium not blank"""
+    monkeypatch.setattr(blank, 'READ_SIZE', MIB)
+    device = tmp_path / 'medium.img'
+    for fill in [0x00, 0xff]:
+        device.write_bytes(bytes([fill]) * (16 * MIB + 512))
+        result = blank.checkMedium(str(device))
+        assert result['size'] == 16 * MIB + 512
+        assert result['fillByte'] == '0x%02x' % fill
+    data = bytearray(16 * MIB + 512)
+    # Between the sampled regions, so only the full check finds it
+    data[7 * MIB + 12345] = 1
+    device.write_bytes(data)
+    assert blank.checkMedium(str(device)) is None
+    # At the start, which the pre-scan samples
+    data[0] = 1
+    device.write_bytes(data)
+    assert blank.checkMedium(str(device)) is None
+    device.write_bytes(b'')
+    assert blank.checkMedium(str(device)) is None
+    assert blank.checkMedium(str(tmp_path / 'missing.img')) is None
+
+
+def test_cancelled_check(tmp_path):
+    """A cancelled check doesn't confirm the medium"""
+    device = tmp_path / 'medium.img'
+    device.write_bytes(bytes(4 * MIB))
+    token = cancel.CancelToken()
+    token.cancel()
+    assert blank.checkMedium(str(device), token) is None
+
+
+def test_write_image(tmp_path):
+    """Zero-filled images can be sparse; other fills are written in full"""
+    image = str(tmp_path / 'disc.img')
+    size = 3 * MIB + 512
+    assert blank.writeImage(image, size, 0, 'none') == 'none'
+    assert not os.path.exists(image)
+    assert blank.writeImage(image, size, 0, 'sparse') == 'sparse'
+    assert os.path.getsize(image) == size
+    with open(image, 'rb') as f:
+        assert f.read() == bytes(size)
+    assert blank.writeImage(image, size, 0xff, 'sparse') == 'full'
+    with open(image, 'rb') as f:
+        assert f.read() == b'\xff' * size
+    assert blank.writeImage(image, size, 0, 'full') == 'full'
+    assert os.stat(image).st_blocks * 512 >= size
@@ -0,0 +1,75 @@
+"""Per-job cancellation, and escalation of signals to external tools"""
+
+import subprocess
+import sys
+import threading
+
+from diskimgr import cancel
+
+# Child that ignores the given signals, and then sleeps
+IGNORING_CODE = """
+import signal, sys, time
+for name in sys.argv[1:]:
+    signal.signal(getattr(signal, name), signal.SIG_IGN)
+print('ready', flush=True)
+time.sleep(30)
+"""
+
+
+def startChild(*ignored):
+    """Start child process that ignores signals ignored; returns it when it
+    is ready"""
+    p = subprocess.Popen([sys.executable, '-c', IGNORING_CODE] + list(ignored),
+                         stdout=subprocess.PIPE, universal_newlines=True)
+    assert p.stdout.readline() == 'ready\n'
+    return p
+
+
+def test_token():
+    """Only the first cancel request counts; reset clears it"""
+    token = cancel.CancelToken()
+    assert not token.isCancelled()
+    assert not token.wait(0.01)
+    assert token.stopped('dd') is None
+    token.cancel()
+    requestTime = token.requestTime
+    token.cancel()
+    assert token.requestTime == requestTime
+    assert token.wait(0)
+    latency = token.stopped('dd')
+    assert latency >= 0
+    assert token.stopped('dd') == latency
+    token.reset()
+    assert not token.isCancelled()
+    assert token.latency is None
+
+
+def test_process_that_exits():
+    """A process that exits by itself isn't signalled"""
+    p = subprocess.Popen([sys.executable, '-c', 'pass'])
+    token = cancel.CancelToken()
+    supervisor = cancel.Supervisor(p, token, 'test')
+    supervisor.start()
+    p.wait()
+    supervisor.join(5)
+    assert not supervisor.is_alive()
+    assert not supervisor.interrupted
+    assert token.signalsSent == []
+
+
+def test_escalation():
+    """SIGINT comes first, then SIGTERM and SIGKILL once the deadlines pass"""
+    for ignored, signalsSent in [((), ['SIGINT']),
+                                 (('SIGINT',), ['SIGINT', 'SIGTERM']),
+                                 (('SIGINT', 'SIGTERM'), ['SIGINT', 'SIGTERM', 'SIGKILL'])]:
+        p = startChild(*ignored)
+        token = cancel.CancelToken()
+        supervisor = cancel.Supervisor(p, token, 'test', termTimeout=0.2, killTimeout=0.2)
+        supervisor.start()
+        threading.Timer(0.05, token.cancel).start()
+        p.wait(10)
+        supervisor.join(5)
+        p.stdout.close()
+        assert supervisor.interrupted
+        assert token.signalsSent == signalsSent
+        assert token.stopped('test') < 5
@@ -0,0 +1,270 @@
+"""Imaging daemon: job queue, access checks and job runs"""
+
+import io
+import json
+import os
+import stat
+import threading
+import time
+
+from diskimgr import configure
+from diskimgr import daemon
+from diskimgr import status
+from diskimgr import wrappers
+from diskimgr.disk import Disk
+
+# User and group that own nothing in the test directories
+NOBODY = (65534, 65534)
+
+
+def makeDevice(tmp_path, name='medium', size=1048576):
+    """Write simulated device of size random bytes; returns its spec file"""
+    image = tmp_path / (name + '.img')
+    image.write_bytes(os.urandom(size))
+    device = str(tmp_path / (name + '.simdev.json'))
+    with io.open(device, 'w', encoding='utf-8') as f:
+        json.dump({'image': str(image)}, f)
+    return device
+
+
+def useConfiguration(tmp_path, monkeypatch):
+    """Let Disk instances read a default configuration file in tmp_path"""
+    configure.writeConfigFile(str(tmp_path), False)
+    configFile = str(tmp_path / 'diskimgr' / 'diskimgr.json')
+    with io.open(configFile, 'r', encoding='utf-8') as f:
+        settings = json.load(f)
+    settings['indexFile'] = str(tmp_path / 'index.sqlite')
+    with io.open(configFile, 'w', encoding='utf-8') as f:
+        json.dump(settings, f)
+    init = Disk.__init__
+
+    def initDisk(self):
+        init(self)
+        self.configFile = configFile
+
+    monkeypatch.setattr(Disk, '__init__', initDisk)
+    # dd and ddrescue need not be installed
+    monkeypatch.setattr(wrappers, 'getVersion', lambda args: '')
+
+
+def makeDaemon(tmp_path, **kwargs):
+    """Return Daemon with its socket and queue in tmp_path"""
+    return daemon.Daemon(str(tmp_path / 'daemon.sock'), str(tmp_path / 'queue.json'), **kwargs)
+
+
+def test_queue_after_restart(tmp_path):
+    """Running jobs are queued again on load (dd jobs overwrite their
+    partial image); finishing jobs fail, so their medium isn't read again"""
+    queueFile = str(tmp_path / 'queue.json')
+    jobQueue = daemon.JobQueue(queueFile)
+    for jobId, state, method in [('a', 'finished', 'native'), ('b', 'running', 'native'),
+                                 ('c', 'running', 'dd'), ('d', 'finishing', 'native'),
+                                 ('e', 'queued', 'ddrescue')]:
+        jobQueue.add({'id': jobId, 'state': state, 'readMethod': method})
+    assert not os.path.exists(queueFile + '.tmp')
+    jobQueue = daemon.JobQueue(queueFile)
+    jobQueue.load()
+    jobs = {job['id']: job for job in jobQueue.list()}
+    assert [jobs[jobId]['state'] for jobId in 'abcde'] == ['finished', 'queued', 'queued',
+                                                           'failed', 'queued']
+    assert not jobs['b'].get('overwrite', False)
+    assert jobs['c']['overwrite']
+    assert jobs['d']['errors']
+    assert jobQueue.next(0)['id'] == 'b'
+    # Jobs in a final state are never picked up
+    jobQueue.update('b', state='finished')
+    jobQueue.update('c', state='cancelled')
+    jobQueue.update('e', state='interrupted')
+    assert jobQueue.next(0) is None
+
+
+def test_submit_and_cancel(tmp_path):
+    """Queued jobs can be cancelled by their owner, the daemon's user and
+    root only"""
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+    os.chmod(dirOut, 0o777)
+    d = makeDaemon(tmp_path)
+    job = d.submit({'dirOut': dirOut, 'blockDevice': '/dev/sdb', 'unknown': 'x'}, NOBODY)
+    assert job['state'] == 'queued'
+    assert job['uid'] == NOBODY[0]
+    assert 'unknown' not in job
+    other = d.submit({'dirOut': dirOut, 'blockDevice': '/dev/sdc'})
+    assert not d.cancel(other['id'], NOBODY)
+    assert d.cancel(job['id'], NOBODY)
+    assert d.cancel(other['id'], (0, 0))
+    assert [j['state'] for j in d.queue.list()] == ['cancelled', 'cancelled']
+    # Cancelled jobs stay cancelled
+    assert not d.cancel(job['id'])
+    assert not d.cancel('missing')
+
+
+def test_path_errors(tmp_path):
+    """Jobs may only write to absolute paths where the submitting user may
+    write, below the output root if the daemon has one"""
+    root = tmp_path / 'root'
+    (root / 'private').mkdir(parents=True)
+    os.chmod(str(root / 'private'), 0o755)
+    (root / 'shared').mkdir()
+    os.chmod(str(root / 'shared'), 0o777)
+    d = makeDaemon(tmp_path, outputRoot=str(root))
+    uid, gid = os.getuid(), os.getgid()
+    assert d.pathErrors({'dirOut': str(root / 'new')}, uid, gid) == []
+    for fields in [{'dirOut': 'relative'},
+                   {'dirOut': str(tmp_path / 'elsewhere')},
+                   {'dirOut': str(root / '..' / 'elsewhere')},
+                   {'dirOut': str(root), 'identifier': '../x'},
+                   {'dirOut': str(root), 'prefix': '..'},
+                   {'dirOut': str(root), 'outputSinks': ['file:/tmp/{identifier}.img']}]:
+        assert len(d.pathErrors(fields, uid, gid)) == 1, fields
+    # Pipes are no paths
+    assert d.pathErrors({'dirOut': str(root), 'outputSinks': ['pipe:-']}, uid, gid) == []
+    if uid == 0:
+        # Other users can't write where only root can
+        assert len(d.pathErrors({'dirOut': str(root / 'private' / 'x')}, *NOBODY)) == 1
+        assert d.pathErrors({'dirOut': str(root / 'shared' / 'x')}, *NOBODY) == []
+
+
+def test_can_write(tmp_path):
+    """Write permission is judged by the owner, group and other bits of the
+    path, or of its nearest existing parent"""
+    uid, gid = os.getuid(), os.getgid()
+    path = tmp_path / 'dir'
+    path.mkdir()
+    os.chmod(str(path), 0o755)
+    assert daemon.canWrite(str(path / 'a' / 'b'), uid, gid)
+    assert daemon.canWrite(str(path), 0, 0)
+    assert not daemon.canWrite(str(path), *NOBODY)
+    os.chmod(str(path), 0o757)
+    assert daemon.canWrite(str(path / 'a'), *NOBODY)
+
+
+def test_serve(tmp_path, monkeypatch):
+    """Clients submit, list and cancel jobs over a socket that only the
+    owner and group can use"""
+    # Signal handlers are not changed in the test process
+    monkeypatch.setattr(daemon.signal, 'signal', lambda signum, handler: None)
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+    d = makeDaemon(tmp_path)
+    # Keep the runner from picking up the job
+    d.runJob = lambda job: None
+    results = {}
+
+    def client():
+        try:
+            while d.server is None or not daemon.isRunning(d.socketPath):
+                time.sleep(0.01)
+            results['mode'] = stat.S_IMODE(os.stat(d.socketPath).st_mode)
+            jobId = daemon.submitJob(d.socketPath, {'dirOut': dirOut,
+                                                    'blockDevice': '/dev/sdb'})
+            try:
+                daemon.submitJob(d.socketPath, {'dirOut': 'relative'})
+            except ValueError as e:
+                results['refused'] = str(e)
+            results['jobs'] = daemon.request(d.socketPath, {'command': 'list'})['jobs']
+            results['cancel'] = daemon.request(d.socketPath, {'command': 'cancel', 'id': jobId})
+        finally:
+            d.stopFlag = True
+            d.server.shutdown()
+
+    thread = threading.Thread(target=client)
+    thread.start()
+    d.serve()
+    thread.join()
+    assert results['mode'] == 0o660
+    assert results['refused'] == 'job refused: output directory must be an absolute ' + \
+        'path: relative'
+    assert [job['uid'] for job in results['jobs']] == [os.getuid()]
+    assert results['cancel'] == {'ok': True}
+    assert not os.path.exists(d.socketPath)
+    with io.open(str(tmp_path / 'queue.json'), 'r', encoding='utf-8') as f:
+        assert [job['state'] for job in json.load(f)['jobs']] == ['cancelled']
+
+
+def test_medium_is_checked_on_resume(tmp_path, monkeypatch):
+    """A job takes the fingerprint of its medium when it starts; when it is
+    run again, it fails if another medium is in the drive"""
+    useConfiguration(tmp_path, monkeypatch)
+    device = makeDevice(tmp_path)
+    dirOut = str(tmp_path / 'out')
+    os.mkdir(dirOut)
+    d = makeDaemon(tmp_path)
+    job = d.submit({'dirOut': dirOut, 'blockDevice': device, 'readMethod': 'native'})
+    assert d.checkMedium(d.queue.get(job['id'])) == []
+    job = d.queue.get(job['id'])
+    assert job['fingerprint']
+    assert d.checkMedium(job) == []
+    # Another medium
+    makeDevice(tmp_path)
+    assert len(d.checkMedium(job)) == 1
+    d.runJob(job)
+    job = d.queue.get(job['id'])
+    assert job['state'] == 'failed'
+    assert 'not the one this job started reading' in job['errors'][0]
+
+
+def test_auto_retry(tmp_path, monkeypatch):
+    """With autoRetry, a dd or native read with errors is finished, and read
+    again with ddrescue; dd's output moves to dd-failed"""
+    useConfiguration(tmp_path, monkeypatch)
+    # The device is never read, so it may be simulated
+    monkeypatch.setattr(Disk, 'validationErrors', lambda self: [])
+    calls = []
+
+    def readDisk(self):
+        calls.append(('read', self.readMethod, self.skipDuplicateCheck))
+        self.readErrorFlag = self.readMethod != 'ddrescue'
+        if self.readMethod == 'dd':
+            with open(self.imageFile, 'wb') as f:
+                f.write(b'dd')
+        return {}
+
+    def finishDisk(self, results):
+        calls.append(('finish', self.readMethod))
+        # Set by the real readDisk
+        self.metadataFile = os.path.join(self.dirOut, 'metadata.json')
+        with open(self.metadataFile, 'w') as f:
+            f.write('{}')
+
+    monkeypatch.setattr(Disk, 'readDisk', readDisk)
+    monkeypatch.setattr(Disk, 'finishDisk', finishDisk)
+    device = makeDevice(tmp_path)
+    for method in ['native', 'dd']:
+        dirOut = tmp_path / method
+        dirOut.mkdir()
+        d = makeDaemon(tmp_path)
+        job = d.submit({'dirOut': str(dirOut), 'blockDevice': device, 'readMethod': method,
+                        'identifier': 'x', 'autoRetry': 'True'})
+        del calls[:]
+        d.runJob(job)
+        assert calls == [('read', method, False), ('finish', method),
+                         ('read', 'ddrescue', True), ('finish', 'ddrescue')]
+        job = d.queue.get(job['id'])
+        assert job['state'] == 'finished'
+        assert job['readMethod'] == 'ddrescue'
+        assert job['autoRetried']
+        if method == 'dd':
+            assert sorted(os.listdir(str(dirOut / 'dd-failed'))) == ['disc.img',
+                                                                      'metadata.json']
+
+
+def test_log_records_go_to_their_job(tmp_path):
+    """Records of threads tagged with a job belong to that job; others to the
+    job that reads"""
+    d = makeDaemon(tmp_path)
+    d.runningJob = 'reader'
+    results = []
+
+    def finisher():
+        status.job.bind(status.JobState(), 'finisher')
+        try:
+            results.append(d.recordJob(None))
+        finally:
+            status.job.unbind()
+
+    thread = threading.Thread(target=finisher)
+    thread.start()
+    thread.join()
+    assert results == ['finisher']
+    assert d.recordJob(None) == 'reader'
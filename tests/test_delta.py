@@ -0,0 +1,107 @@
+"""Delta re-imaging against an earlier acquisition"""
+
+import hashlib
+import io
+import json
+import os
+
+import pytest
+
+from diskimgr import delta
+from diskimgr import manifest
+
+MIB = 1048576
+BLOCK_SIZE = 65536
+
+
+def makePrevious(tmp_path, data, withManifest, successFlag=True):
+    """Write earlier acquisition of data (with a block-hash manifest if
+    withManifest); returns its directory"""
+    previousDir = tmp_path / 'previous'
+    previousDir.mkdir()
+    (previousDir / 'disc.img').write_bytes(data)
+    with io.open(str(previousDir / 'metadata.json'), 'w', encoding='utf-8') as f:
+        json.dump({'identifier': 'previous', 'prefix': 'disc', 'extension': 'img',
+                   'successFlag': successFlag}, f)
+    if withManifest:
+        hasher = manifest.BlockHasher(BLOCK_SIZE)
+        hasher.update(data)
+        hasher.manifest().write(str(previousDir / 'disc.img') + manifest.MANIFEST_SUFFIX)
+    return str(previousDir)
+
+
+def runDelta(tmp_path, medium, previousDir):
+    """Image medium (bytes) against previousDir; returns (stats, image data)"""
+    device = tmp_path / 'medium.img'
+    device.write_bytes(medium)
+    imageFile = tmp_path / 'disc.img'
+    _, exitStatus, errorFlag, interruptedFlag, stats = \
+        delta.readDelta(str(device), str(imageFile), previousDir, 'metadata.json',
+                        BLOCK_SIZE, 8 * BLOCK_SIZE, ['sha512'])
+    assert (exitStatus, errorFlag, interruptedFlag) == (0, False, False)
+    image = imageFile.read_bytes()
+    assert stats['checksums']['sha512'] == hashlib.sha512(image).hexdigest()
+    return stats, image
+
+
+def test_changes_against_image(tmp_path):
+    """Without a manifest, blocks are compared against the earlier image;
+    only changed blocks are written, and a grown medium adds its tail"""
+    data = os.urandom(4 * MIB)
+    medium = bytearray(data + os.urandom(1000))
+    medium[MIB + 5] ^= 0xFF
+    stats, image = runDelta(tmp_path, medium, makePrevious(tmp_path, data, False))
+    assert image == medium
+    assert stats['delta']['compareMethod'] == 'image'
+    assert stats['delta']['changedRanges'] == [[MIB, MIB], [4 * MIB, 1000]]
+    assert stats['delta']['bytesChanged'] == MIB + 1000
+    assert stats['delta']['bytesCompared'] == len(medium)
+
+
+def test_changes_against_manifest(tmp_path):
+    """With a manifest, blocks of its block size are compared by digest; a
+    shrunk medium truncates the image"""
+    data = os.urandom(2 * MIB)
+    medium = bytearray(data[:MIB + BLOCK_SIZE])
+    for offset in [100, 101, 3 * BLOCK_SIZE, 4 * BLOCK_SIZE + 1]:
+        medium[offset] ^= 0xFF
+    stats, image = runDelta(tmp_path, medium, makePrevious(tmp_path, data, True))
+    assert image == medium
+    assert stats['delta']['compareMethod'] == 'manifest'
+    assert stats['delta']['compareSize'] == BLOCK_SIZE
+    assert stats['delta']['changedRanges'] == [[0, BLOCK_SIZE],
+                                               [3 * BLOCK_SIZE, 2 * BLOCK_SIZE]]
+    assert stats['delta']['repairedRanges'] == []
+
+
+def test_previous_acquisition(tmp_path):
+    """Unsuccessful earlier acquisitions can't be used"""
+    previousDir = makePrevious(tmp_path, b'x' * 512, False, successFlag=False)
+    with pytest.raises(ValueError):
+        delta.findPrevious(previousDir, 'metadata.json')
+    with pytest.raises(OSError):
+        delta.findPrevious(str(tmp_path), 'metadata.json')
+
+
+def test_clone_file(tmp_path):
+    """A clone has the same content, whatever method is used"""
+    data = os.urandom(3 * MIB + 5)
+    (tmp_path / 'a.img').write_bytes(data)
+    method = delta.cloneFile(str(tmp_path / 'a.img'), str(tmp_path / 'b.img'))
+    assert method in ['reflink', 'copy_file_range', 'copy']
+    assert (tmp_path / 'b.img').read_bytes() == data
+
+
+def test_damaged_copy_is_repaired(tmp_path):
+    """Blocks of the earlier image that no longer match its manifest are
+    taken from the medium, not inherited"""
+    data = os.urandom(MIB)
+    previousDir = makePrevious(tmp_path, data, True)
+    with open(os.path.join(previousDir, 'disc.img'), 'r+b') as f:
+        f.seek(5 * BLOCK_SIZE + 10)
+        f.write(b'rot')
+    stats, image = runDelta(tmp_path, data, previousDir)
+    assert image == data
+    assert stats['delta']['changedRanges'] == []
+    assert stats['delta']['repairedRanges'] == [[5 * BLOCK_SIZE, BLOCK_SIZE]]
+    assert stats['delta']['bytesRepaired'] == BLOCK_SIZE
@@ -0,0 +1,128 @@
+"""Entropy and fill map, with NumPy and with the pure-Python fallback"""
+
+import io
+import json
+import os
+
+import pytest
+
+from diskimgr import entropy
+
+REGION_SIZE = 65536
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def backend(request, monkeypatch):
+    """Run test with NumPy (if installed) and with the fallback"""
+    if request.param == 'numpy' and entropy.numpy is None:
+        pytest.skip('NumPy is not installed')
+    if request.param == 'python':
+        monkeypatch.setattr(entropy, 'numpy', None)
+    return request.param
+
+
+def makeMedium():
+    """Return data with a zero, an 0xFF, a text and a random region, and a
+    short last region of text"""
+    text = b'The quick brown fox jumps over the lazy dog. ' * 2000
+    return (bytes(REGION_SIZE) + b'\xff' * REGION_SIZE + text[:REGION_SIZE] +
+            os.urandom(REGION_SIZE) + text[:1000])
+
+
+def feed(mapper, data, chunkSize, skip=()):
+    """Feed data to mapper in chunks, leaving out the chunks that start at
+    the offsets in skip"""
+    view = memoryview(data)
+    for offset in range(0, len(data), chunkSize):
+        if offset not in skip:
+            mapper.process(view[offset:offset + chunkSize], offset)
+    mapper.close()
+
+
+def test_histogram(backend):
+    """Histograms count every byte, for odd and even sizes and uniform fills"""
+    for data in [os.urandom(1001), os.urandom(1000), b'\x07' * 999, b'']:
+        counts = entropy.histogram(memoryview(data))
+        assert [int(c) for c in counts] == [data.count(bytes([i])) for i in range(256)]
+
+
+def test_map(backend):
+    """Regions are classified by fill and entropy, whatever the chunk size"""
+    data = makeMedium()
+    for chunkSize in [4096, 10000, 1048576]:
+        mapper = entropy.EntropyMapper(REGION_SIZE)
+        feed(mapper, data, chunkSize)
+        result = mapper.result()
+        assert list(mapper.classes) == [entropy.ZERO, entropy.FF, entropy.DATA,
+                                        entropy.RANDOM, entropy.DATA]
+        assert result['noRegions'] == 5
+        assert result['bytes'] == {'unread': 0, 'zero': REGION_SIZE, 'ff': REGION_SIZE,
+                                   'data': REGION_SIZE + 1000, 'random': REGION_SIZE}
+        assert mapper.entropies[0] == 0
+        assert mapper.entropies[3] > entropy.RANDOM_THRESHOLD * entropy.ENTROPY_SCALE
+        assert 0 < result['meanEntropy'] < 8
+
+
+def test_backends_agree(monkeypatch):
+    """NumPy and the fallback give the same map"""
+    if entropy.numpy is None:
+        pytest.skip('NumPy is not installed')
+    data = makeMedium()
+    maps = []
+    for numpy in [entropy.numpy, None]:
+        monkeypatch.setattr(entropy, 'numpy', numpy)
+        mapper = entropy.EntropyMapper(REGION_SIZE)
+        feed(mapper, data, 10000)
+        result = mapper.result()
+        maps.append((list(mapper.classes), list(mapper.entropies), result['meanEntropy']))
+    assert maps[0] == maps[1]
+
+
+# Region 1 is missed, and region 3 is only partly seen
+SKIPPED = [REGION_SIZE + i * 16384 for i in range(4)] + [3 * REGION_SIZE + 16384]
+
+
+def test_missed_regions(backend):
+    """Regions that weren't fed are unread"""
+    data = makeMedium()
+    mapper = entropy.EntropyMapper(REGION_SIZE)
+    feed(mapper, data, 16384, SKIPPED)
+    result = mapper.result(len(data))
+    assert list(mapper.classes) == [entropy.ZERO, entropy.UNREAD, entropy.DATA,
+                                    entropy.RANDOM, entropy.DATA]
+    assert result['bytes']['unread'] == REGION_SIZE + 16384
+
+
+def test_regions_from_image(backend, tmp_path):
+    """Regions that were missed or only partly seen are read from the image,
+    except for the areas that couldn't be read"""
+    data = makeMedium()
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    mapper = entropy.EntropyMapper(REGION_SIZE)
+    feed(mapper, data, 16384, SKIPPED)
+    result = mapper.result(len(data), str(image), unreadAreas=[(REGION_SIZE, 4096)])
+    assert result['regionsFromImage'] == 2
+    assert list(mapper.classes) == [entropy.ZERO, entropy.FF, entropy.DATA, entropy.RANDOM,
+                                    entropy.DATA]
+    assert result['bytes'] == {'unread': 4096, 'zero': REGION_SIZE, 'ff': REGION_SIZE - 4096,
+                               'data': REGION_SIZE + 1000, 'random': REGION_SIZE}
+
+
+def test_map_file(tmp_path):
+    """The map file holds a header, the entropies and the classes"""
+    data = makeMedium()
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    mapper = entropy.mapFile(str(image), REGION_SIZE)
+    mapper.result()
+    path = str(image) + entropy.MAP_SUFFIX
+    mapper.write(path)
+    with io.open(path, 'rb') as f:
+        assert f.readline() == entropy.MAGIC
+        header = json.loads(f.readline().decode('utf-8'))
+        content = f.read()
+    assert header['noRegions'] == 5
+    assert header['imageSize'] == len(data)
+    assert header['classes'] == entropy.CLASSES
+    assert content == mapper.entropies.tobytes() + mapper.classes.tobytes()
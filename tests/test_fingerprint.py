@@ -0,0 +1,91 @@
+"""Quick fingerprints of media, and the duplicate check"""
+
+import hashlib
+import io
+import json
+import os
+
+from diskimgr import fingerprint
+from diskimgr import index
+from diskimgr import wrappers
+from diskimgr.disk import Disk
+
+MIB = 1048576
+
+
+def test_sample_regions():
+    """Samples stay on the device, on sector boundaries, and shrink with
+    small media"""
+    for size in [1474560, 700 * MIB, 4 * 1024 * MIB + 512]:
+        regions = fingerprint.sampleRegions(size)
+        assert len(regions) == fingerprint.NO_STRIDES + 2
+        for offset, length in regions:
+            assert offset % 512 == 0
+            assert 0 < length and offset + length <= size
+        assert regions[0][0] == 0
+        assert regions[-1][0] + regions[-1][1] == size
+    assert sum(length for _, length in fingerprint.sampleRegions(1474560)) < 200000
+
+
+def test_fingerprint(tmp_path):
+    """Same data give the same fingerprint; a change in a sampled region or
+    in the size gives another one"""
+    data = bytearray(os.urandom(8 * MIB))
+    image = tmp_path / 'a.img'
+    image.write_bytes(data)
+    first = fingerprint.computeFingerprint(str(image))
+    assert first.startswith(fingerprint.FINGERPRINT_VERSION + ':' + str(len(data)) + ':')
+    assert fingerprint.computeFingerprint(str(image)) == first
+    data[10] ^= 0xFF
+    image.write_bytes(data)
+    assert fingerprint.computeFingerprint(str(image)) != first
+    image.write_bytes(data + bytes(512))
+    assert fingerprint.computeFingerprint(str(image)) != first
+    assert fingerprint.fullHash(str(image), 65536, 4 * 65536) == \
+        hashlib.sha512(data + bytes(512)).hexdigest()
+
+
+def makeDisk(tmp_path, device, dirOut, indexFile):
+    """Return validated Disk for device, with output in dirOut"""
+    os.makedirs(dirOut, exist_ok=True)
+    disk = Disk()
+    disk.dirOut = dirOut
+    disk.blockDevice = device
+    disk.readMethod = 'native'
+    disk.indexFile = indexFile
+    disk.validateInput()
+    return disk
+
+
+def addAcquisition(indexFile, dirOut, fingerprintString, successFlag):
+    """Add acquisition in dirOut with fingerprintString to index"""
+    os.makedirs(dirOut, exist_ok=True)
+    metadataFile = os.path.join(dirOut, 'metadata.json')
+    with io.open(metadataFile, 'w', encoding='utf-8') as f:
+        json.dump({'identifier': os.path.basename(dirOut), 'successFlag': successFlag,
+                   'fingerprint': fingerprintString}, f)
+    index.updateIndex(indexFile, metadataFile)
+
+
+def test_duplicate_check(tmp_path, monkeypatch):
+    """A medium with the fingerprint of an earlier successful acquisition in
+    another directory is a duplicate; failed runs and earlier runs in the
+    same directory (retries) are not"""
+    # dd and ddrescue need not be installed
+    monkeypatch.setattr(wrappers, 'getVersion', lambda args: '')
+    image = tmp_path / 'medium.img'
+    image.write_bytes(os.urandom(MIB))
+    # A simulated device stands in for the block device
+    device = str(tmp_path / 'medium.simdev.json')
+    with io.open(device, 'w', encoding='utf-8') as f:
+        json.dump({'image': str(image)}, f)
+    indexFile = str(tmp_path / 'index.sqlite')
+    mediumFingerprint = fingerprint.computeFingerprint(device)
+    addAcquisition(indexFile, str(tmp_path / 'failed'), mediumFingerprint, False)
+    addAcquisition(indexFile, str(tmp_path / 'retry'), mediumFingerprint, True)
+    disk = makeDisk(tmp_path, device, str(tmp_path / 'retry'), indexFile)
+    assert disk.fingerprint == mediumFingerprint
+    assert disk.duplicates == []
+    addAcquisition(indexFile, str(tmp_path / 'earlier'), mediumFingerprint, True)
+    disk = makeDisk(tmp_path, device, str(tmp_path / 'new'), indexFile)
+    assert sorted(d['identifier'] for d in disk.duplicates) == ['earlier', 'retry']
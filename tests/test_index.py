@@ -0,0 +1,67 @@
+"""SQLite index of acquisitions"""
+
+import io
+import json
+import os
+
+from diskimgr import index
+
+
+def writeMetadata(dirOut, **metadata):
+    """Write metadata.json in dirOut (created if needed); returns its path"""
+    os.makedirs(dirOut, exist_ok=True)
+    metadataFile = os.path.join(dirOut, 'metadata.json')
+    with io.open(metadataFile, 'w', encoding='utf-8') as f:
+        json.dump(metadata, f)
+    return metadataFile
+
+
+def test_scan_is_incremental(tmp_path):
+    """Unchanged files are skipped, changed files are indexed again, and
+    removed or broken files are reported"""
+    root = tmp_path / 'root'
+    indexFile = str(tmp_path / 'index.sqlite')
+    writeMetadata(str(root / 'a'), identifier='a', successFlag=True)
+    writeMetadata(str(root / 'b' / 'c'), identifier='c', successFlag=False)
+    assert index.scanRoot(indexFile, str(root), 'metadata.json') == (2, 0, 0, 0)
+    assert index.scanRoot(indexFile, str(root), 'metadata.json') == (0, 2, 0, 0)
+    metadataFile = writeMetadata(str(root / 'a'), identifier='a2', successFlag=True)
+    st = os.stat(metadataFile)
+    os.utime(metadataFile, (st.st_atime, st.st_mtime + 10))
+    os.remove(str(root / 'b' / 'c' / 'metadata.json'))
+    (root / 'd').mkdir()
+    (root / 'd' / 'metadata.json').write_text('{broken')
+    assert index.scanRoot(indexFile, str(root), 'metadata.json') == (1, 0, 1, 1)
+    assert [m['identifier'] for m in index.query(indexFile)] == ['a2']
+
+
+def test_query(tmp_path):
+    """Queries combine criteria; dates are compared in UTC"""
+    root = tmp_path / 'root'
+    indexFile = str(tmp_path / 'index.sqlite')
+    writeMetadata(str(root / 'a'), identifier='a', successFlag=True, readMethod='dd',
+                  blockDevice='/dev/sdb', acquisitionStart='2024-01-01T12:00:00+02:00',
+                  checksums={'a.img': 'abc123'})
+    writeMetadata(str(root / 'b'), identifier='b', successFlag=False, readMethod='native',
+                  blockDevice='/dev/sdb', acquisitionStart='2024-01-01T11:00:00+00:00',
+                  checksums={'b.img': 'def456'})
+    index.scanRoot(indexFile, str(root), 'metadata.json')
+    # 10:00 UTC sorts before 11:00 UTC
+    assert [m['identifier'] for m in index.query(indexFile, blockDevice='/dev/sdb')] == \
+        ['a', 'b']
+    assert [m['identifier'] for m in index.query(indexFile, success=False)] == ['b']
+    assert [m['identifier'] for m in index.query(indexFile, readMethod='dd')] == ['a']
+    assert [m['identifier'] for m in index.query(indexFile, checksum='ABC123')] == ['a']
+    assert [m['identifier'] for m in index.query(indexFile, checksum='DEF456')] == ['b']
+    assert [m['identifier'] for m in index.query(indexFile, since='2024-01-01T10:30')] == \
+        ['b']
+    assert [m['dirOut'] for m in index.query(indexFile, identifier='a')] == \
+        [str(root / 'a')]
+
+
+def test_update_index(tmp_path):
+    """A single acquisition is added at the end of imaging"""
+    indexFile = str(tmp_path / 'sub' / 'index.sqlite')
+    metadataFile = writeMetadata(str(tmp_path / 'a'), identifier='x', successFlag=True)
+    index.updateIndex(indexFile, metadataFile)
+    assert [m['identifier'] for m in index.query(indexFile, success=True)] == ['x']
@@ -0,0 +1,36 @@
+"""I/O scheduling priorities"""
+
+import shutil
+
+import pytest
+
+from diskimgr import ioprio
+
+
+def test_parse_priority():
+    """Priority strings give (class, level); the level defaults to 4"""
+    assert ioprio.parsePriority('') is None
+    assert ioprio.parsePriority('be:0') == (2, 0)
+    assert ioprio.parsePriority('rt') == (1, 4)
+    assert ioprio.parsePriority('idle') == (3, 0)
+    assert ioprio.parsePriority('none:5') == (0, 0)
+    for priority in ['bulk:1', 'be:8', 'be:x']:
+        with pytest.raises(ValueError):
+            ioprio.parsePriority(priority)
+
+
+def test_ionice_args(monkeypatch):
+    """ionice takes a level only for the real time and best effort classes"""
+    monkeypatch.setattr(shutil, 'which', lambda name: '/usr/bin/' + name)
+    assert ioprio.ioniceArgs('') == []
+    assert ioprio.ioniceArgs('be:2') == ['ionice', '-c', '2', '-n', '2']
+    assert ioprio.ioniceArgs('idle') == ['ionice', '-c', '3']
+    monkeypatch.setattr(shutil, 'which', lambda name: None)
+    assert ioprio.ioniceArgs('be:2') == []
+
+
+def test_set_priority():
+    """An empty priority leaves the thread alone"""
+    assert ioprio.setPriority('')
+    with pytest.raises(ValueError):
+        ioprio.setPriority('fast')
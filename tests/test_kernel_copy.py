@@ -0,0 +1,48 @@
+"""Kernel-side copy mode of the native read method"""
+
+import errno
+import os
+
+from diskimgr import native
+from diskimgr import pipeline
+from diskimgr import targetio
+
+
+def test_kernel_copy(tmp_path):
+    """Kernel copy gives an exact image, without inline digests"""
+    data = os.urandom(700000)
+    sourceFile = tmp_path / 'source.img'
+    sourceFile.write_bytes(data)
+    imageFile = tmp_path / 'disc.img'
+    _, exitStatus, errorFlag, _, stats = native.readNative(
+        str(sourceFile), str(imageFile), 512, 65536, 4 * 65536, ['sha512'], kernelCopy=True)
+    assert (exitStatus, errorFlag) == (0, False)
+    assert imageFile.read_bytes() == data
+    assert stats['copyMethod'] in ['copy_file_range', 'sendfile', 'splice']
+    assert stats['checksums'] == {}
+
+
+def test_unsupported_method_falls_back(tmp_path):
+    """A primitive that isn't supported is skipped, and the next one
+    continues from the same offset"""
+    data = os.urandom(200000)
+    sourceFile = tmp_path / 'source.img'
+    sourceFile.write_bytes(data)
+    imageFile = tmp_path / 'disc.img'
+    source = pipeline.BlockSource(str(sourceFile))
+    fdOut = os.open(str(imageFile), os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        k = native.KernelCopy(source, fdOut, 65536, targetio.WriteBehind(fdOut, 0, False))
+
+        def unsupported(offset, count):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+
+        k.methods = [('unsupported', unsupported), ('sendfile', k.sendFile)]
+        k.run()
+    finally:
+        os.close(fdOut)
+        source.close()
+    assert k.method == 'sendfile'
+    assert k.bytesRead == len(data)
+    assert (k.readErrors, k.consumerErrors) == ([], [])
+    assert imageFile.read_bytes() == data
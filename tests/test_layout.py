@@ -0,0 +1,181 @@
+"""Partition table and file system detection"""
+
+import struct
+import uuid
+
+from diskimgr import layout
+
+SECTOR_SIZE = 512
+LINUX_GUID = '0fc63daf-8483-4772-8e79-3d69d8477de4'
+EFI_GUID = 'c12a7328-f81f-11d2-ba4b-00a0c93ec93b'
+
+
+def fat32(noSectors):
+    """Return FAT32 boot sector"""
+    data = bytearray(2048)
+    data[0] = 0xeb
+    struct.pack_into('<HBHB', data, 11, 512, 8, 32, 2)
+    struct.pack_into('<I', data, 32, noSectors)
+    struct.pack_into('<I', data, 67, 0x1234abcd)
+    data[71:82] = b'DISC       '
+    data[82:90] = b'FAT32   '
+    data[510:512] = b'\x55\xaa'
+    return data
+
+
+def ext4(noBlocks):
+    """Return start of ext4 volume with 4 KiB blocks"""
+    data = bytearray(2048)
+    struct.pack_into('<I', data, 1024 + 4, noBlocks)
+    struct.pack_into('<I', data, 1024 + 24, 2)
+    struct.pack_into('<H', data, 1024 + 56, 0xef53)
+    struct.pack_into('<II', data, 1024 + 92, 0x4, 0x40)
+    data[1024 + 104:1024 + 120] = uuid.UUID('12345678-1234-5678-1234-567812345678').bytes
+    data[1024 + 120:1024 + 126] = b'backup'
+    return data
+
+
+def hfsPlus(noBlocks):
+    """Return start of HFS+ volume with 4 KiB blocks"""
+    data = bytearray(2048)
+    data[1024:1026] = b'H+'
+    struct.pack_into('>II', data, 1024 + 40, 4096, noBlocks)
+    return data
+
+
+def ntfs(noSectors):
+    """Return NTFS boot sector"""
+    data = bytearray(2048)
+    data[3:11] = b'NTFS    '
+    struct.pack_into('<H', data, 11, 512)
+    struct.pack_into('<Q', data, 0x28, noSectors)
+    struct.pack_into('<Q', data, 0x48, 0xabcdef)
+    return data
+
+
+def iso9660(noBlocks):
+    """Return start of ISO 9660 volume"""
+    data = bytearray(34816)
+    data[32768] = 1
+    data[32769:32774] = b'CD001'
+    data[32768 + 40:32768 + 72] = b'MY_DISC'.ljust(32)
+    struct.pack_into('<I', data, 32768 + 80, noBlocks)
+    struct.pack_into('<H', data, 32768 + 128, 2048)
+    return data
+
+
+def partitionEntry(data, offset, index, partType, startLba, noSectors, bootable=False):
+    """Write MBR / EBR entry index"""
+    struct.pack_into('<B3xB3xII', data, offset + 446 + 16 * index,
+                     0x80 if bootable else 0, partType, startLba, noSectors)
+    data[offset + 510:offset + 512] = b'\x55\xaa'
+
+
+def mbrImage():
+    """Return medium with an MBR: a FAT32 partition, and an extended
+    partition with two logical partitions (ext4 and HFS+)"""
+    data = bytearray(12288 * SECTOR_SIZE)
+    struct.pack_into('<I', data, 440, 0xcafe)
+    partitionEntry(data, 0, 0, 0x0c, 2048, 2048, bootable=True)
+    partitionEntry(data, 0, 1, 0x0f, 4096, 8192)
+    # First EBR: logical partition relative to the EBR, link relative to
+    # the start of the extended partition
+    partitionEntry(data, 4096 * SECTOR_SIZE, 0, 0x83, 2048, 1024)
+    partitionEntry(data, 4096 * SECTOR_SIZE, 1, 0x05, 4096, 2048)
+    partitionEntry(data, 8192 * SECTOR_SIZE, 0, 0xaf, 2048, 1024)
+    for lba, volume in [(2048, fat32(2048)), (6144, ext4(128)), (10240, hfsPlus(128))]:
+        data[lba * SECTOR_SIZE:lba * SECTOR_SIZE + len(volume)] = volume
+    return data
+
+
+def gptImage():
+    """Return medium with a GPT: an EFI system partition with FAT32, and a
+    Linux partition with ext4"""
+    data = bytearray(8192 * SECTOR_SIZE)
+    partitionEntry(data, 0, 0, 0xee, 1, 8191)
+    header = SECTOR_SIZE
+    data[header:header + 8] = b'EFI PART'
+    data[header + 56:header + 72] = uuid.UUID('11111111-2222-3333-4444-555555555555').bytes_le
+    struct.pack_into('<QII', data, header + 72, 2, 128, 128)
+    for number, typeGuid, firstLba, lastLba, name in [(1, EFI_GUID, 2048, 4095, 'EFI'),
+                                                      (3, LINUX_GUID, 4096, 8191, 'root')]:
+        entry = 2 * SECTOR_SIZE + (number - 1) * 128
+        data[entry:entry + 16] = uuid.UUID(typeGuid).bytes_le
+        data[entry + 16:entry + 32] = uuid.uuid4().bytes_le
+        struct.pack_into('<QQ', data, entry + 32, firstLba, lastLba)
+        data[entry + 56:entry + 56 + 2 * len(name)] = name.encode('utf-16-le')
+    for lba, volume in [(2048, fat32(2048)), (4096, ext4(512))]:
+        data[lba * SECTOR_SIZE:lba * SECTOR_SIZE + len(volume)] = volume
+    return data
+
+
+def probe(data, chunkSize=65536, limit=None):
+    """Stream data (up to limit bytes) past a LayoutProbe in chunks; returns it"""
+    layoutProbe = layout.LayoutProbe(SECTOR_SIZE)
+    layoutProbe.open()
+    view = memoryview(data)
+    for offset in range(0, limit or len(data), chunkSize):
+        layoutProbe.process(view[offset:offset + chunkSize], offset)
+    layoutProbe.close()
+    return layoutProbe
+
+
+def test_mbr():
+    """MBR partitions, logical partitions in the EBR chain, and their file
+    systems are found, whatever the chunk size"""
+    for chunkSize in [4096, 65536, 1048576]:
+        result = probe(mbrImage(), chunkSize).result()
+        assert result['partitionTable'] == 'MBR'
+        assert result['diskSignature'] == '0000CAFE'
+        partitions = [(p['number'], p['offset'] // SECTOR_SIZE, p['size'] // SECTOR_SIZE,
+                       p['typeName']) for p in result['partitions']]
+        assert partitions == [(1, 2048, 2048, 'FAT32 (LBA)'), (2, 4096, 8192, 'Extended (LBA)'),
+                              (5, 6144, 1024, 'Linux'), (6, 10240, 1024, 'Apple HFS / HFS+')]
+        first, _, fifth, sixth = result['partitions']
+        assert first['bootable']
+        assert first['filesystem'] == {'type': 'FAT32', 'label': 'DISC', 'serial': '1234ABCD',
+                                       'size': 2048 * 512}
+        assert fifth['filesystem'] == {'type': 'ext4', 'size': 128 * 4096, 'label': 'backup',
+                                       'uuid': '12345678-1234-5678-1234-567812345678'}
+        assert sixth['filesystem'] == {'type': 'HFS+', 'size': 128 * 4096}
+
+
+def test_gpt():
+    """GPT partitions are found by their entries"""
+    result = probe(gptImage()).result()
+    assert result['partitionTable'] == 'GPT'
+    assert result['diskGUID'] == '11111111-2222-3333-4444-555555555555'
+    assert [(p['number'], p['typeName'], p['name'], p['filesystem']['type'])
+            for p in result['partitions']] == [(1, 'EFI system', 'EFI', 'FAT32'),
+                                               (3, 'Linux filesystem', 'root', 'ext4')]
+    assert result['partitions'][1]['size'] == 4096 * SECTOR_SIZE
+
+
+def test_whole_medium_file_systems():
+    """A file system on the whole medium means there is no partition table"""
+    for volume, fsType, size in [(ntfs(4096), 'NTFS', 4096 * 512),
+                                 (iso9660(100), 'ISO 9660', 100 * 2048),
+                                 (fat32(4096), 'FAT32', 4096 * 512)]:
+        data = bytearray(1048576)
+        data[:len(volume)] = volume
+        result = probe(data).result()
+        assert result['partitionTable'] is None
+        assert result['filesystem']['type'] == fsType
+        assert result['filesystem']['size'] == size
+    assert probe(bytearray(1048576)).result() == {'partitionTable': None,
+                                                  'filesystem': None, 'partitions': []}
+
+
+def test_missing_data_from_image(tmp_path):
+    """Regions that didn't stream past are read from the image"""
+    data = mbrImage()
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    layoutProbe = probe(data, limit=layout.HEAD_SIZE)
+    assert layoutProbe.layout['partitions'][0]['filesystem'] is None
+    result = layoutProbe.result(str(image))
+    assert [p['filesystem']['type'] for p in result['partitions'] if 'filesystem' in p] == \
+        ['FAT32', 'ext4', 'HFS+']
+    assert layout.summary(result)[0] == 'partition table: MBR'
+    assert layout.summary(result)[-1] == ('partition 6: offset 5242880, size 524288, ' +
+                                          'Apple HFS / HFS+, file system: HFS+')
@@ -0,0 +1,93 @@
+"""Block-hash manifests and partial image verification"""
+
+import hashlib
+import os
+
+import pytest
+
+from diskimgr import manifest
+
+
+def makeImage(tmp_path, size):
+    """Write image of size random bytes, and its manifest with 4 KiB blocks;
+    returns (image path, manifest)"""
+    data = os.urandom(size)
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    hasher = manifest.BlockHasher(4096)
+    # Fed in pieces that don't line up with the blocks
+    for offset in range(0, size, 3000):
+        hasher.update(data[offset:offset + 3000])
+    return str(image), hasher.manifest()
+
+
+def test_block_hasher(tmp_path):
+    """Every block has its digest; the last block may be shorter"""
+    image, m = makeImage(tmp_path, 10000)
+    with open(image, 'rb') as f:
+        data = f.read()
+    assert m.noBlocks() == 3
+    assert m.imageSize == 10000
+    assert m.blockRange(2) == (8192, 1808)
+    for block in range(3):
+        offset, size = m.blockRange(block)
+        assert m.digest(block) == hashlib.sha256(data[offset:offset + size]).digest()
+    assert list(m.blocksIn(4095, 4097)) == [0, 1]
+    assert list(m.blocksIn(9000, 20000)) == [2]
+    assert list(m.blocksIn(10000, 20000)) == []
+
+
+def test_manifest_file(tmp_path):
+    """Manifests survive a round trip; damaged files are refused"""
+    _, m = makeImage(tmp_path, 10000)
+    path = str(tmp_path / 'disc.img') + manifest.MANIFEST_SUFFIX
+    m.write(path)
+    copy = manifest.readManifest(path)
+    assert (copy.algorithm, copy.blockSize, copy.imageSize, copy.digests) == \
+        (m.algorithm, m.blockSize, m.imageSize, m.digests)
+    with open(path, 'rb') as f:
+        content = f.read()
+    with open(path, 'wb') as f:
+        f.write(content[:-1])
+    with pytest.raises(ValueError):
+        manifest.readManifest(path)
+    with open(path, 'wb') as f:
+        f.write(b'something else\n')
+    with pytest.raises(ValueError):
+        manifest.readManifest(path)
+
+
+def test_verify_image(tmp_path):
+    """Damaged blocks are found by offset; a range check only hashes the
+    blocks that overlap the range"""
+    image, m = makeImage(tmp_path, 1048576 + 100)
+    result = manifest.verifyImage(image, m, noWorkers=4)
+    assert result['verified']
+    assert result['blocksChecked'] == 257
+    with open(image, 'r+b') as f:
+        f.seek(5 * 4096 + 7)
+        f.write(b'\x00' * 5000)
+    result = manifest.verifyImage(image, m, noWorkers=4)
+    assert not result['verified']
+    assert [(b['block'], b['offset']) for b in result['damagedBlocks']] == \
+        [(5, 5 * 4096), (6, 6 * 4096)]
+    result = manifest.verifyImage(image, m, ranges=[(0, 4096), (100000, 100001)])
+    assert result['verified']
+    assert result['blocksChecked'] == 2
+    assert result['bytesChecked'] == 8192
+    # A truncated image doesn't verify
+    os.truncate(image, 1048576)
+    result = manifest.verifyImage(image, m)
+    assert not result['verified']
+    assert result['damagedBlocks'][-1] == {'block': 256, 'offset': 1048576, 'size': 100,
+                                           'error': 'image is truncated'}
+
+
+def test_parse_range():
+    """Ranges are START:END, with an exclusive end"""
+    assert manifest.parseRange('0:4096') == (0, 4096)
+    assert manifest.parseRange(':4096') == (0, 4096)
+    assert manifest.parseRange('4096:')[0] == 4096
+    for rangeString in ['4096', '10:5', 'a:b']:
+        with pytest.raises(ValueError):
+            manifest.parseRange(rangeString)
@@ -0,0 +1,71 @@
+"""Native read method on a simulated device with bad ranges"""
+
+import io
+import json
+
+from diskimgr import native
+from diskimgr import rescue
+
+MIB = 1048576
+PAGE_SIZE = 4096
+# One bad sector inside a page, and one bad range that is a whole page
+BAD_RANGES = [[MIB + 512, MIB + 1024], [3 * MIB, 3 * MIB + PAGE_SIZE]]
+ERROR_LATENCY = 0.05
+
+
+def readSimulated(tmp_path, direct):
+    """Read simulated device with native.readNative; returns (source data,
+    image data, rescue map, stats)"""
+    data = bytes(range(1, 256)) * (4 * MIB // 255 + 1)
+    data = data[:4 * MIB]
+    sourceImage = tmp_path / 'source.img'
+    sourceImage.write_bytes(data)
+    specFile = tmp_path / 'bad.simdev.json'
+    spec = {'image': str(sourceImage),
+            'badRanges': BAD_RANGES,
+            'latency': 0.0005,
+            'errorLatency': ERROR_LATENCY,
+            'throughput': 20000000,
+            'pageSize': PAGE_SIZE}
+    with io.open(specFile, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    imageFile = tmp_path / 'disc.img'
+    mapFile = tmp_path / 'disc.map'
+    _, exitStatus, errorFlag, _, stats = native.readNative(str(specFile), str(imageFile),
+                                                           512, MIB, 8 * MIB, [],
+                                                           mapFile=str(mapFile),
+                                                           retries=1, direct=direct)
+    assert errorFlag
+    rescueMap = rescue.RescueMap(len(data))
+    assert rescueMap.read(str(mapFile))
+    return data, imageFile.read_bytes(), rescueMap, stats
+
+
+def checkResult(data, image, rescueMap, stats, badAreas):
+    """Check image and map against the expected bad areas"""
+    assert rescueMap.areasWith(rescue.BAD) == badAreas
+    assert rescueMap.sizeWith(rescue.FINISHED) == len(data) - sum(s for _, s in badAreas)
+    assert len(image) == len(data)
+    pos = 0
+    for badPos, badSize in badAreas:
+        assert image[pos:badPos] == data[pos:badPos]
+        assert image[badPos:badPos + badSize] == bytes(badSize)
+        pos = badPos + badSize
+    assert image[pos:] == data[pos:]
+    # Every bad sector costs a few failed reads, not a pass over the medium
+    noBadSectors = sum(s for _, s in badAreas) // 512
+    assert stats['deviceTime'] < 4 * noBadSectors * ERROR_LATENCY + 2.0
+
+
+def test_page_cache_reads(tmp_path):
+    """Without direct mode, errors are widened to whole pages"""
+    data, image, rescueMap, stats = readSimulated(tmp_path, direct=False)
+    checkResult(data, image, rescueMap, stats,
+                [(MIB, PAGE_SIZE), (3 * MIB, PAGE_SIZE)])
+
+
+def test_direct_reads(tmp_path):
+    """In direct mode, only the bad sectors are lost"""
+    data, image, rescueMap, stats = readSimulated(tmp_path, direct=True)
+    checkResult(data, image, rescueMap, stats,
+                [(MIB + 512, 512), (3 * MIB, PAGE_SIZE)])
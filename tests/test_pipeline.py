@@ -0,0 +1,137 @@
+"""Buffer-ring pipeline and native read method on plain image files"""
+
+import hashlib
+import io
+import json
+import threading
+
+from diskimgr import disk
+from diskimgr import native
+from diskimgr import pipeline
+from diskimgr import wrappers
+
+MIB = 1048576
+
+
+def makeSource(tmp_path, size):
+    """Write source file of size bytes with a non-repeating pattern; returns
+    (path, data)"""
+    data = hashlib.sha512(b'seed').digest() * (size // 64 + 1)
+    data = bytes((b + i // 64) % 256 for i, b in enumerate(data[:size]))
+    path = tmp_path / 'source.img'
+    path.write_bytes(data)
+    return path, data
+
+
+class Recorder(pipeline.Consumer):
+    """Consumer that keeps a copy of every buffer, and the consumer thread"""
+
+    name = 'recorder'
+
+    def __init__(self):
+        """initialise Recorder instance"""
+        self.blocks = []
+        self.threads = set()
+
+    def process(self, view, offset):
+        """Copy buffer"""
+        self.blocks.append((offset, bytes(view)))
+        self.threads.add(threading.get_ident())
+
+
+class Failing(pipeline.Consumer):
+    """Consumer that fails on its second buffer"""
+
+    name = 'failing'
+
+    def __init__(self):
+        """initialise Failing instance"""
+        self.calls = 0
+
+    def process(self, view, offset):
+        """Fail on second call"""
+        self.calls += 1
+        if self.calls == 2:
+            raise OSError('disk full')
+
+
+def test_read_native_copies_and_hashes(tmp_path):
+    """Image is an exact copy, and the inline digest matches"""
+    sourceFile, data = makeSource(tmp_path, 3 * MIB + 1536)
+    imageFile = tmp_path / 'disc.img'
+    _, exitStatus, errorFlag, interruptedFlag, stats = native.readNative(
+        str(sourceFile), str(imageFile), 512, 65536, 4 * 65536, ['sha512'])
+    assert (exitStatus, errorFlag, interruptedFlag) == (0, False, False)
+    assert imageFile.read_bytes() == data
+    assert stats['bytesRead'] == len(data)
+    assert stats['noBuffers'] == 4
+    assert stats['checksums']['sha512'] == hashlib.sha512(data).hexdigest()
+    assert set(stats['stages']) >= {'reader', 'writer', 'hash-sha512'}
+
+
+def test_buffer_size_is_multiple_of_block_size(tmp_path):
+    """Buffer size is rounded down to a multiple of the block size"""
+    sourceFile, data = makeSource(tmp_path, 100000)
+    imageFile = tmp_path / 'disc.img'
+    stats = native.readNative(str(sourceFile), str(imageFile), 4096, 10000, 40000, [])[4]
+    assert stats['bufferSize'] == 8192
+    assert imageFile.read_bytes() == data
+
+
+def test_consumers_see_every_buffer_in_order(tmp_path):
+    """Every consumer gets all data of [start, end), each in its own thread"""
+    sourceFile, data = makeSource(tmp_path, MIB)
+    source = pipeline.BlockSource(str(sourceFile))
+    first = Recorder()
+    second = Recorder()
+    p = pipeline.Pipeline(source, [first, second], 65536, 3 * 65536, 1000, 900000)
+    try:
+        p.run()
+    finally:
+        source.close()
+    for recorder in [first, second]:
+        offsets = [offset for offset, _ in recorder.blocks]
+        assert offsets == sorted(offsets)
+        assert offsets[0] == 1000
+        assert b''.join(block for _, block in recorder.blocks) == data[1000:900000]
+    assert first.threads.isdisjoint(second.threads)
+    assert p.bytesRead == 899000
+    # Reader and consumers can only overlap with at least two buffers
+    assert pipeline.BufferRing(65536, 0).noBuffers == 2
+
+
+def test_consumer_error_stops_reading(tmp_path):
+    """A failing consumer is reported, and the reader stops without hanging"""
+    sourceFile, _ = makeSource(tmp_path, 4 * MIB)
+    source = pipeline.BlockSource(str(sourceFile))
+    recorder = Recorder()
+    p = pipeline.Pipeline(source, [Failing(), recorder], 65536, 2 * 65536)
+    try:
+        p.run()
+    finally:
+        source.close()
+    assert p.consumerErrors == [('failing', 'disk full')]
+    assert p.bytesRead < 4 * MIB
+
+
+def test_only_tools_of_read_method_are_needed(tmp_path, monkeypatch):
+    """Without dd and ddrescue, only the native read method (without
+    automatic ddrescue retries) passes validation"""
+    monkeypatch.setattr(disk, 'which', lambda name: None)
+    monkeypatch.setattr(wrappers, 'getVersion', lambda args: '')
+    image = tmp_path / 'medium.img'
+    image.write_bytes(bytes(4096))
+    specFile = str(tmp_path / 'medium.simdev.json')
+    with io.open(specFile, 'w', encoding='utf-8') as f:
+        json.dump({'image': str(image)}, f)
+    d = disk.Disk()
+    d.dirOut = str(tmp_path)
+    d.blockDevice = specFile
+    for readMethod, autoRetry, missing in [('native', False, []),
+                                           ('native', True, ['ddrescue']),
+                                           ('dd', False, ['dd']),
+                                           ('ddrescue', False, ['ddrescue'])]:
+        d.readMethod = readMethod
+        d.autoRetry = autoRetry
+        d.validateInput()
+        assert [e.split()[0] for e in d.validationErrors() if 'not installed' in e] == missing
@@ -0,0 +1,154 @@
+"""Skip-on-error read strategy and ddrescue map files"""
+
+import os
+
+from diskimgr import pipeline
+from diskimgr import rescue
+
+SECTOR_SIZE = 512
+
+
+class FaultySource:
+    """In-memory source with bad sectors, and sectors that fail a number of
+    times before they can be read"""
+
+    direct = False
+
+    def __init__(self, data, badSectors=(), flakySectors=None):
+        """initialise FaultySource instance"""
+        self.data = data
+        self.size = len(data)
+        self.badSectors = set(badSectors)
+        self.flakySectors = dict(flakySectors or {})
+        self.reads = []
+
+    def fileno(self):
+        """No file descriptor"""
+        return -1
+
+    def readinto(self, view, offset):
+        """Read into view at offset; fails if the range holds a bad sector"""
+        noBytes = min(len(view), self.size - offset)
+        self.reads.append((offset, noBytes))
+        sectors = range(offset // SECTOR_SIZE, (offset + noBytes - 1) // SECTOR_SIZE + 1)
+        for sector in sectors:
+            if sector in self.badSectors:
+                raise OSError(5, 'Input/output error')
+            if self.flakySectors.get(sector, 0) > 0:
+                self.flakySectors[sector] -= 1
+                raise OSError(5, 'Input/output error')
+        view[:noBytes] = self.data[offset:offset + noBytes]
+        return noBytes
+
+    def close(self):
+        """Nothing to close"""
+
+
+def runRescue(tmp_path, source, retries=1, rescueMap=None):
+    """Run rescue of source to disc.img; returns (Rescue, image data)"""
+    imageFile = tmp_path / 'disc.img'
+    mapFile = tmp_path / 'disc.map'
+    if rescueMap is None:
+        rescueMap = rescue.mapFromFile(str(mapFile), source.size)
+    writer = pipeline.FileWriter(str(imageFile))
+    r = rescue.Rescue(source, writer, rescueMap, str(mapFile), SECTOR_SIZE, 65536,
+                      4 * 65536, retries)
+    r.run()
+    return r, imageFile.read_bytes()
+
+
+def test_bad_sectors_are_isolated(tmp_path):
+    """Only the bad sectors are lost; everything else is in the image"""
+    data = os.urandom(2 * 1048576)
+    badSectors = [300, 2000, 2001, 3500]
+    source = FaultySource(data, badSectors)
+    r, image = runRescue(tmp_path, source)
+    assert r.map.areasWith(rescue.BAD) == [(300 * 512, 512), (2000 * 512, 1024),
+                                           (3500 * 512, 512)]
+    assert r.map.sizeWith(rescue.FINISHED) == len(data) - 4 * 512
+    for sector in range(len(data) // 512):
+        if sector not in badSectors:
+            assert image[sector * 512:(sector + 1) * 512] == data[sector * 512:(sector + 1) * 512]
+    assert r.stats()['badAreas'] == 3
+
+
+def test_copy_phase_skips_ahead(tmp_path):
+    """A large bad area doesn't cost a read per sector in the copy phase"""
+    data = bytes(4 * 1048576)
+    badSectors = range(2048, 4096)
+    source = FaultySource(data, badSectors)
+    r, _ = runRescue(tmp_path, source, retries=0)
+    assert r.map.sizeWith(rescue.BAD) == 1048576
+    # The good area after the bad one is read before the skipped blocks are
+    copyReads = [offset for offset, size in source.reads if size > SECTOR_SIZE]
+    firstAfter = min(i for i, offset in enumerate(copyReads) if offset >= 2 * 1048576)
+    lastInside = max(i for i, offset in enumerate(copyReads)
+                     if 1048576 <= offset < 2 * 1048576)
+    assert firstAfter < lastInside
+
+
+def test_flaky_sectors_are_retried(tmp_path):
+    """Sectors that fail a few times are read in the later phases"""
+    data = os.urandom(1048576)
+    source = FaultySource(data, flakySectors={10: 1, 700: 2})
+    r, image = runRescue(tmp_path, source, retries=3)
+    assert r.map.isFinished()
+    assert image == data
+
+
+def test_map_file_and_resume(tmp_path):
+    """The map file is in ddrescue format, and a resumed run only reads the
+    areas that aren't finished"""
+    data = os.urandom(1048576)
+    mapFile = tmp_path / 'disc.map'
+    r, _ = runRescue(tmp_path, FaultySource(data, [100]), retries=0)
+    lines = [line.split() for line in mapFile.read_text().splitlines()
+             if not line.startswith('#')]
+    assert [[int(pos, 0), int(size, 0), status] for pos, size, status in lines[1:]] == \
+        [[0, 51200, '+'], [51200, 512, '-'], [51712, 1048576 - 51712, '+']]
+    # Sector 100 can be read now
+    source = FaultySource(data)
+    r, image = runRescue(tmp_path, source, retries=1)
+    assert r.map.isFinished()
+    assert image == data
+    assert source.reads == [(51200, 512)]
+    # A map of another source size is ignored
+    assert not rescue.RescueMap(2048).read(str(mapFile))
+
+
+def test_map_mark_merges_areas():
+    """Marking splits areas, and merges neighbours with the same status"""
+    rescueMap = rescue.RescueMap(4096)
+    rescueMap.mark(1024, 1024, rescue.FINISHED)
+    rescueMap.mark(3072, 2048, rescue.BAD)
+    assert rescueMap.areas == [[0, 1024, '?'], [1024, 1024, '+'], [2048, 1024, '?'],
+                               [3072, 1024, '-']]
+    rescueMap.mark(0, 1024, rescue.FINISHED)
+    rescueMap.mark(2048, 1024, rescue.FINISHED)
+    assert rescueMap.areas == [[0, 3072, '+'], [3072, 1024, '-']]
+
+
+def test_map_saved_while_reading(tmp_path, monkeypatch):
+    """With a save interval of 0, the map is saved after every write, and a
+    saved map never claims data that aren't in the image yet"""
+    data = os.urandom(1048576)
+    imageFile = tmp_path / 'disc.img'
+    saves = []
+    write = rescue.RescueMap.write
+
+    def checkedWrite(self, mapFile, currentPos, currentStatus, currentPass):
+        # Called from the writer thread, so failures are collected
+        image = imageFile.read_bytes()
+        claimed = all(image[pos:pos + size] == data[pos:pos + size]
+                      for pos, size in self.areasWith(rescue.FINISHED))
+        saves.append((self.sizeWith(rescue.FINISHED), claimed))
+        write(self, mapFile, currentPos, currentStatus, currentPass)
+
+    monkeypatch.setattr(rescue, 'MAP_SAVE_INTERVAL', 0.0)
+    monkeypatch.setattr(rescue.RescueMap, 'write', checkedWrite)
+    r, _ = runRescue(tmp_path, FaultySource(data, [1000]), retries=0)
+    assert r.consumerErrors == []
+    assert len(saves) > 16
+    assert all(claimed for _, claimed in saves)
+    assert saves == sorted(saves)
+    assert not os.path.exists(str(tmp_path / 'disc.map.tmp'))
@@ -0,0 +1,115 @@
+"""Simulated block device with injected faults and latency"""
+
+import io
+import json
+import os
+
+import pytest
+
+from diskimgr import disk
+from diskimgr import simdevice
+from diskimgr import wrappers
+
+
+def makeSpec(tmp_path, **spec):
+    """Write 64 KiB image and spec file; returns (spec file, image data)"""
+    data = os.urandom(65536)
+    image = tmp_path / 'source.img'
+    image.write_bytes(data)
+    spec['image'] = str(image)
+    specFile = tmp_path / 'test.simdev.json'
+    with io.open(specFile, 'w', encoding='utf-8') as f:
+        json.dump(spec, f)
+    return str(specFile), data
+
+
+def test_spec_file(tmp_path):
+    """Spec files are recognised by name, and give the image size"""
+    specFile, data = makeSpec(tmp_path)
+    assert simdevice.isSpecFile(specFile)
+    assert not simdevice.isSpecFile(str(tmp_path / 'source.img'))
+    assert not simdevice.isSpecFile(str(tmp_path / 'missing.simdev.json'))
+    assert simdevice.deviceSize(specFile) == len(data)
+
+
+def test_bad_ranges(tmp_path):
+    """Reads that touch a bad range fail; through the page cache, the whole
+    page around a bad sector fails"""
+    specFile, data = makeSpec(tmp_path, badRanges=[[8192 + 512, 8192 + 1024]])
+    for direct, failing in [(True, [8704]), (False, [8192, 8704, 11776])]:
+        device = simdevice.fromSpecFile(specFile, direct)
+        view = memoryview(bytearray(512))
+        for offset in range(0, 16384, 512):
+            if offset in failing:
+                with pytest.raises(OSError):
+                    device.readinto(view, offset)
+            elif direct or not 8192 <= offset < 12288:
+                assert device.readinto(view, offset) == 512
+                assert bytes(view) == data[offset:offset + 512]
+        device.close()
+
+
+def test_simulated_clock(tmp_path):
+    """Reads cost latency plus transfer time, errors cost errorLatency, and
+    the clock is simulated, not slept"""
+    specFile, _ = makeSpec(tmp_path, badRanges=[[0, 512]], latency=0.01, errorLatency=2.0,
+                           throughput=1000000, pageSize=512)
+    device = simdevice.fromSpecFile(specFile)
+    view = memoryview(bytearray(10000))
+    assert device.readinto(view, 1024) == 10000
+    with pytest.raises(OSError):
+        device.readinto(view, 0)
+    device.close()
+    assert device.simulatedTime == pytest.approx(0.01 + 0.01 + 0.01 + 2.0)
+    assert device.stats()['failedReads'] == 1
+    # No file descriptor, so a kernel copy can't bypass the faults
+    with pytest.raises(OSError):
+        device.fileno()
+
+
+def test_intermittent_errors_are_repeatable(tmp_path):
+    """Intermittent errors follow the seed"""
+    specFile, _ = makeSpec(tmp_path, intermittentErrorRate=0.3, seed=7)
+
+    def failures():
+        device = simdevice.fromSpecFile(specFile)
+        result = []
+        for offset in range(0, 65536, 512):
+            try:
+                device.readinto(memoryview(bytearray(512)), offset)
+            except OSError:
+                result.append(offset)
+        device.close()
+        return result
+
+    first = failures()
+    assert 0 < len(first) < 128
+    assert failures() == first
+
+
+def test_benchmark(tmp_path):
+    """The benchmark runs every combination of block size and retries"""
+    specFile, _ = makeSpec(tmp_path, badRanges=[[4096, 4608]], errorLatency=0.1)
+    results = simdevice.benchmark(specFile, [512, 4096], [0, 2], True, True, 16384, 65536)
+    assert [(r['blockSize'], r['retries']) for r in results] == [(512, 0), (512, 2),
+                                                                 (4096, 0), (4096, 2)]
+    for result in results:
+        assert result['errorFlag']
+        # Sectors of blockSize bytes are lost
+        assert result['bad'] == result['blockSize']
+        assert result['deviceTime'] > 0.1
+
+
+def test_native_only(tmp_path, monkeypatch):
+    """Simulated devices are refused for dd, ddrescue and automatic retries"""
+    monkeypatch.setattr(wrappers, 'getVersion', lambda args: '')
+    specFile, _ = makeSpec(tmp_path)
+    d = disk.Disk()
+    d.dirOut = str(tmp_path)
+    d.blockDevice = specFile
+    for readMethod, autoRetry, refused in [('native', False, False), ('native', True, True),
+                                           ('dd', False, True), ('ddrescue', False, True)]:
+        d.readMethod = readMethod
+        d.autoRetry = autoRetry
+        d.validateInput()
+        assert any('Simulated devices' in e for e in d.validationErrors()) == refused
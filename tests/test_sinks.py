@@ -0,0 +1,170 @@
+"""Secondary output sinks"""
+
+import bz2
+import gzip
+import lzma
+import os
+import random
+import threading
+
+import pytest
+
+from diskimgr import sinks
+
+FIELDS = {'identifier': 'disc1', 'prefix': 'disc', 'extension': 'img', 'dirName': 'out'}
+SIZE = 3 * 1000003
+KINDS = ['file', 'split:777777', 'gzip', 'bz2', 'xz', 'pipe']
+OPENERS = {'gzip': gzip.open, 'bz2': bz2.open, 'xz': lzma.open}
+
+
+def makeImage(tmp_path):
+    """Write image of SIZE random bytes; returns (path, data)"""
+    data = random.Random(1).randbytes(SIZE)
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    return str(image), data
+
+
+def chunks(gaps=False):
+    """Return (offset, size) chunks of the stream; with gaps, about one in
+    five chunks is left out"""
+    result = []
+    pos = 0
+    rnd = random.Random(2)
+    while pos < SIZE:
+        noBytes = min(rnd.randint(1, 300000), SIZE - pos)
+        if not gaps or rnd.random() > 0.2:
+            result.append((pos, noBytes))
+        pos += noBytes
+    return result
+
+
+def runSink(tmp_path, kind, data, image, streamChunks, memoryBudget=10 ** 9):
+    """Feed streamChunks of data to a sink of kind, and finish it; returns
+    (result, output data)"""
+    path = str(tmp_path / kind.split(':')[0])
+    sink = sinks.fromSpec(kind + ':' + path, FIELDS, memoryBudget)
+    sink.open()
+    for offset, noBytes in streamChunks:
+        sink.process(memoryview(data)[offset:offset + noBytes], offset)
+    sink.close()
+    result = sink.finish(image, SIZE)
+    if kind.startswith('split'):
+        output = b''.join((tmp_path / f).read_bytes() for f in result['files'])
+    elif kind in OPENERS:
+        with OPENERS[kind](path) as f:
+            output = f.read()
+    else:
+        with open(path, 'rb') as f:
+            output = f.read()
+    return result, output
+
+
+def test_parse_spec():
+    """Specs are TYPE:PATH, or split:SIZE:PATH"""
+    assert sinks.parseSpec('file:/mnt/copy/{identifier}.img') == \
+        ('file', 0, '/mnt/copy/{identifier}.img')
+    assert sinks.parseSpec('split:1000:/mnt/x') == ('split', 1000, '/mnt/x')
+    assert sinks.parseSpec('pipe:-') == ('pipe', 0, '-')
+    for spec in ['/mnt/x', 'zip:/mnt/x', 'split:/mnt/x', 'split:0:/mnt/x', 'file:']:
+        with pytest.raises(ValueError):
+            sinks.parseSpec(spec)
+    assert sinks.fromSpec('gzip:/mnt/{identifier}.img.gz', FIELDS, 1).path == \
+        '/mnt/disc1.img.gz'
+    with pytest.raises(ValueError):
+        sinks.fromSpec('file:/mnt/{unknown}', FIELDS, 1)
+
+
+def test_stream_copies(tmp_path):
+    """Every kind of sink gets an exact copy from the stream alone"""
+    image, data = makeImage(tmp_path)
+    for kind in KINDS:
+        result, output = runSink(tmp_path, kind, data, image, chunks())
+        assert output == data, kind
+        assert result['complete']
+        assert (result['bytesFromStream'], result['bytesFromImage']) == (SIZE, 0)
+
+
+def test_catch_up_from_image(tmp_path):
+    """A sink that is more than its budget behind continues from the image"""
+    image, data = makeImage(tmp_path)
+    for kind in KINDS:
+        result, output = runSink(tmp_path, kind, data, image, chunks(), memoryBudget=400000)
+        assert output == data, kind
+        assert result['complete']
+        assert result['bytesFromStream'] + result['bytesFromImage'] == SIZE
+
+
+def test_gaps_in_stream(tmp_path):
+    """Gaps are filled in from the image, and sinks keep taking the stream
+    after a gap; data that arrive again are written in place by seekable
+    sinks, and ignored by sequential ones"""
+    image, data = makeImage(tmp_path)
+    streamChunks = chunks(gaps=True)
+    fromStream = sum(noBytes for _, noBytes in streamChunks)
+    again = (streamChunks[0][0], 1000)
+    for kind in KINDS:
+        result, output = runSink(tmp_path, kind, data, image, streamChunks + [again])
+        assert output == data, kind
+        assert result['complete']
+        rewritten = 1000 if kind in ['file', 'split:777777'] else 0
+        assert result['bytesFromStream'] == fromStream + rewritten
+        assert result['bytesFromImage'] == SIZE - fromStream
+
+
+def test_split_boundaries(tmp_path):
+    """Parts are splitSize bytes, except the last one; parts are written
+    again where gaps are filled in"""
+    image, data = makeImage(tmp_path)
+    result, _ = runSink(tmp_path, 'split:777777', data, image, chunks(gaps=True))
+    assert result['files'] == ['split.000', 'split.001', 'split.002', 'split.003']
+    sizes = [os.path.getsize(str(tmp_path / f)) for f in result['files']]
+    assert sizes == [777777, 777777, 777777, SIZE - 3 * 777777]
+
+
+def test_missing_ranges():
+    """Ranges merge as they are added, in any order"""
+    ranges = []
+    for start, end in [(0, 10), (10, 20), (50, 60), (30, 40), (35, 52)]:
+        sinks.addRange(ranges, start, end)
+    assert ranges == [[0, 20], [30, 60]]
+    assert sinks.missingRanges(ranges, 100) == [(20, 30), (60, 100)]
+    assert sinks.missingRanges(ranges, 50) == [(20, 30)]
+    assert sinks.missingRanges([], 5) == [(0, 5)]
+
+
+def test_named_pipe(tmp_path):
+    """A pipe sink streams to the reader of a named pipe"""
+    image, data = makeImage(tmp_path)
+    path = str(tmp_path / 'pipe')
+    os.mkfifo(path)
+    received = []
+
+    def reader():
+        with open(path, 'rb') as f:
+            received.append(f.read())
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    sink = sinks.fromSpec('pipe:' + path, FIELDS, 10 ** 9)
+    sink.open()
+    for offset, noBytes in chunks(gaps=True):
+        sink.process(memoryview(data)[offset:offset + noBytes], offset)
+    result = sink.finish(image, SIZE)
+    thread.join()
+    assert result['complete']
+    assert received == [data]
+
+
+def test_pipe_without_reader(tmp_path, monkeypatch):
+    """A pipe that nobody reads fails the sink instead of hanging it"""
+    monkeypatch.setattr(sinks, 'PIPE_OPEN_TIMEOUT', 0.5)
+    image, data = makeImage(tmp_path)
+    path = str(tmp_path / 'pipe')
+    os.mkfifo(path)
+    sink = sinks.fromSpec('pipe:' + path, FIELDS, 10 ** 9)
+    sink.open()
+    sink.process(memoryview(data)[:1000], 0)
+    result = sink.finish(image, SIZE)
+    assert not result['complete']
+    assert 'no reader' in result['error']
@@ -0,0 +1,16 @@
+"""Start-up time checks"""
+
+import os
+
+from diskimgr import startup
+
+
+def test_deferred_modules_are_not_imported(monkeypatch):
+    """Importing diskimgr.disk doesn't load the modules that are only needed
+    once imaging starts"""
+    packageRoot = os.path.dirname(os.path.dirname(os.path.abspath(startup.__file__)))
+    monkeypatch.setenv('PYTHONPATH', packageRoot)
+    importMs, loaded = startup.importTime('diskimgr.disk', 1)
+    assert importMs > 0
+    assert 'diskimgr.disk' in loaded
+    assert [m for m in startup.DEFERRED_MODULES if m in loaded] == []
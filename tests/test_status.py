@@ -0,0 +1,102 @@
+"""Job status and the local status endpoint"""
+
+import json
+import threading
+
+from diskimgr import endpoint
+from diskimgr import status
+
+
+def test_parse_size():
+    """ddrescue sizes use decimal and binary units"""
+    assert status.parseSize('512', 'B') == 512
+    assert status.parseSize('1048', 'kB') == 1048000
+    assert status.parseSize('1.5', 'MiB') == 1572864
+
+
+def test_snapshot(monkeypatch):
+    """Rate and time left are derived from the progress of the current
+    phase"""
+    clock = [1000.0]
+    monkeypatch.setattr(status.time, 'monotonic', lambda: clock[0])
+    state = status.JobState()
+    state.begin('disc1', '/dev/sdb', 'native', '/tmp/disc1.img', 1000000)
+    state.setPhase('reading')
+    # A resumed read starts at 200000 bytes; that doesn't count for the rate
+    state.setBytes(200000)
+    clock[0] += 2
+    state.addBytes(200000)
+    state.addError()
+    snapshot = state.snapshot()
+    assert snapshot['phase'] == 'reading'
+    assert snapshot['bytesDone'] == 400000
+    assert snapshot['rate'] == 100000
+    assert snapshot['eta'] == 6
+    assert snapshot['readErrors'] == 1
+    state.finish(True)
+    snapshot = state.snapshot()
+    assert snapshot['eta'] is None
+    assert snapshot['successFlag']
+
+
+def test_prometheus_text():
+    """Metrics carry the job labels; exactly one phase is active"""
+    state = status.JobState()
+    state.begin('disc "1"', '/dev/sdb', 'ddrescue', '', 0)
+    state.setPhase('checksumming')
+    text = status.prometheusText(state.snapshot())
+    labels = 'identifier="disc \\"1\\"",device="/dev/sdb",method="ddrescue"'
+    assert 'diskimgr_job_phase{' + labels + ',phase="checksumming"} 1\n' in text
+    assert sum(line.endswith(' 1') for line in text.splitlines()
+               if line.startswith('diskimgr_job_phase{')) == 1
+    assert 'diskimgr_eta_seconds{' + labels + '} NaN\n' in text
+    assert 'diskimgr_bytes_total{' + labels + '} 0\n' in text
+
+
+def test_endpoint(tmp_path):
+    """The endpoint serves status and metrics on a Unix socket"""
+    address = 'unix:' + str(tmp_path / 'status.socket')
+    server = endpoint.startServer(address)
+    try:
+        status.job.begin('disc1', '/dev/sdb', 'native', '', 4096)
+        state = json.loads(endpoint.query(address))
+        assert state['identifier'] == 'disc1'
+        assert state['totalBytes'] == 4096
+        assert 'diskimgr_read_errors' in endpoint.query(address, '/metrics')
+        assert '404' in endpoint.query(address, '/other')
+    finally:
+        server.shutdown()
+        server.server_close()
+        status.job.reset()
+
+
+def test_threads_report_to_their_own_job():
+    """Threads bound to a JobState report to it, and pass it (and their tag)
+    on to the threads they start through inherit"""
+    status.job.reset()
+    background = status.JobState()
+    results = {}
+
+    def worker():
+        status.job.addBytes(10)
+        results['tag'] = status.job.tag
+
+    def finisher():
+        status.job.bind(background, 'job2')
+        try:
+            thread = threading.Thread(target=status.job.inherit(worker))
+            thread.start()
+            thread.join()
+            status.job.addBytes(5)
+        finally:
+            status.job.unbind()
+
+    thread = threading.Thread(target=finisher)
+    thread.start()
+    thread.join()
+    assert background.bytesDone == 15
+    assert results['tag'] == 'job2'
+    assert status.job.bytesDone == 0
+    assert status.job.tag is None
+    # Unbound threads don't need wrapping
+    assert status.job.inherit(worker) is worker
@@ -0,0 +1,63 @@
+"""Preallocation and write-behind of the image file"""
+
+import os
+
+from diskimgr import native
+from diskimgr import targetio
+
+
+def test_preallocate_keeps_size(tmp_path):
+    """Preallocated space doesn't change the apparent file size"""
+    path = tmp_path / 'disc.img'
+    path.write_bytes(b'x' * 100)
+    if not targetio.preallocateFile(str(path), 1048576):
+        # File system without fallocate
+        return
+    st = os.stat(path)
+    assert st.st_size == 100
+    assert st.st_blocks * 512 >= 1048576
+
+
+def test_write_behind_windows(monkeypatch):
+    """Writeback starts every syncInterval bytes, and the program waits for
+    the window before, so at most two windows are dirty"""
+    calls = []
+    monkeypatch.setattr(targetio, 'syncRange',
+                        lambda fd, offset, length, flags: calls.append((offset, length, flags)))
+    monkeypatch.setattr(os, 'fdatasync', lambda fd: calls.append('fdatasync'))
+    w = targetio.WriteBehind(-1, 1000, False)
+    for offset in range(0, 2500, 250):
+        w.written(offset, 250)
+    wait = (targetio.SYNC_FILE_RANGE_WAIT_BEFORE | targetio.SYNC_FILE_RANGE_WRITE |
+            targetio.SYNC_FILE_RANGE_WAIT_AFTER)
+    assert calls == [(0, 1000, targetio.SYNC_FILE_RANGE_WRITE),
+                     (1000, 1000, targetio.SYNC_FILE_RANGE_WRITE),
+                     (0, 1000, wait)]
+    del calls[:]
+    w.finish()
+    assert calls == [(2000, 500, targetio.SYNC_FILE_RANGE_WRITE),
+                     (1000, 1000, wait),
+                     (2000, 500, wait),
+                     'fdatasync']
+
+
+def test_write_behind_disabled(monkeypatch):
+    """With syncInterval 0, writeback is left to the kernel"""
+    calls = []
+    monkeypatch.setattr(targetio, 'syncRange', lambda *args: calls.append(args))
+    w = targetio.WriteBehind(-1, 0, False)
+    w.written(0, 1 << 30)
+    w.finish()
+    assert calls == []
+
+
+def test_read_native_with_target_settings(tmp_path):
+    """Preallocation, write-behind and cache dropping don't change the image"""
+    data = os.urandom(300000)
+    sourceFile = tmp_path / 'source.img'
+    sourceFile.write_bytes(data)
+    imageFile = tmp_path / 'disc.img'
+    result = native.readNative(str(sourceFile), str(imageFile), 512, 65536, 4 * 65536, [],
+                               preallocate=True, syncInterval=65536, dropCache=True)
+    assert result[1:4] == (0, False, False)
+    assert imageFile.read_bytes() == data
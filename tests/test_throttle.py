@@ -0,0 +1,70 @@
+"""Token-bucket bandwidth limiting"""
+
+import errno
+import threading
+import time
+
+import pytest
+
+from diskimgr import throttle
+
+
+class Source:
+    """Source of zero bytes"""
+
+    path = 'zero'
+    size = 1048576
+    direct = False
+
+    def readinto(self, view, offset):
+        """Fill view with zero bytes"""
+        view[:] = bytes(len(view))
+        return len(view)
+
+    def close(self):
+        """Nothing to close"""
+
+
+def test_unlimited():
+    """A rate of 0 never waits"""
+    bucket = throttle.TokenBucket(0)
+    start = time.monotonic()
+    for _ in range(1000):
+        bucket.consume(1048576)
+    assert time.monotonic() - start < 0.5
+    assert bucket.waitTime == 0
+
+
+def test_rate_is_shared():
+    """Threads that share a bucket together stay within its rate"""
+    rate = 2000000
+    bucket = throttle.TokenBucket(rate, 100000)
+
+    def consume():
+        for _ in range(5):
+            bucket.consume(50000)
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=consume) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    # 1 MB at 2 MB/s, starting from an empty bucket
+    assert time.monotonic() - start >= 0.45
+    assert bucket.waitTime >= 0.45
+
+
+def test_throttled_source():
+    """A throttled source reads through its bucket, and has no file
+    descriptor"""
+    bucket = throttle.TokenBucket(1000000)
+    source = throttle.ThrottledSource(Source(), bucket)
+    assert source.size == Source.size
+    view = memoryview(bytearray(300000))
+    start = time.monotonic()
+    assert source.readinto(view, 0) == 300000
+    assert time.monotonic() - start >= 0.25
+    with pytest.raises(OSError) as excinfo:
+        source.fileno()
+    assert excinfo.value.errno == errno.EBADF
@@ -0,0 +1,58 @@
+"""BLAKE2b tree hashing"""
+
+import hashlib
+import os
+
+import pytest
+
+from diskimgr import cancel
+from diskimgr import treehash
+
+
+def referenceHash(data, leafSize, digestSize=64):
+    """Return tree hash of data, computed serially from the definition in
+    the treehash module"""
+    leaves = [data[i:i + leafSize] for i in range(0, len(data), leafSize)] or [b'']
+    params = dict(digest_size=digestSize, fanout=0, depth=2, leaf_size=leafSize,
+                  inner_size=digestSize)
+    root = hashlib.blake2b(node_offset=0, node_depth=1, last_node=True, **params)
+    for i, leaf in enumerate(leaves):
+        root.update(hashlib.blake2b(leaf, node_offset=i, node_depth=0,
+                                    last_node=i == len(leaves) - 1, **params).digest())
+    return root.hexdigest()
+
+
+def test_tree_hash(tmp_path):
+    """The tree hash doesn't depend on the number of workers, and matches
+    the definition"""
+    path = tmp_path / 'disc.img'
+    for size in [0, 1000, 65536, 65536 * 3 + 17]:
+        data = os.urandom(size)
+        path.write_bytes(data)
+        expected = referenceHash(data, 65536)
+        for noWorkers in [1, 4]:
+            assert treehash.hashFile(str(path), 65536, noWorkers=noWorkers) == expected
+    assert treehash.hashFile(str(path), 65536, digestSize=32) == \
+        referenceHash(data, 65536, 32)
+    # Another leaf size gives another hash
+    assert treehash.hashFile(str(path), 4096) != expected
+
+
+def test_progress_and_cancel(tmp_path):
+    """Progress is reported per chunk; a cancelled hash returns None"""
+    path = tmp_path / 'disc.img'
+    path.write_bytes(os.urandom(3 * treehash.CHUNK_SIZE))
+    done = []
+    treehash.hashFile(str(path), 2 * treehash.CHUNK_SIZE, noWorkers=2, progress=done.append)
+    assert sum(done) == 3 * treehash.CHUNK_SIZE
+    token = cancel.CancelToken()
+    token.cancel()
+    assert treehash.hashFile(str(path), treehash.CHUNK_SIZE, cancelToken=token) is None
+
+
+def test_leaf_size():
+    """Leaf sizes must fit in BLAKE2b's 32-bit field"""
+    for leafSize in [0, 2 ** 32]:
+        with pytest.raises(ValueError):
+            treehash.checkLeafSize(leafSize)
+    treehash.checkLeafSize(2 ** 32 - 1)
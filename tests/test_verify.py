@@ -0,0 +1,58 @@
+"""Verification of an image against the medium"""
+
+import hashlib
+import os
+
+from diskimgr import verify
+
+MIB = 1048576
+
+
+def makePair(tmp_path):
+    """Write device and identical image; returns (device path, image path, data)"""
+    data = bytearray(os.urandom(2 * MIB + 1024))
+    device = tmp_path / 'device.img'
+    device.write_bytes(data)
+    image = tmp_path / 'disc.img'
+    image.write_bytes(data)
+    return str(device), str(image), data
+
+
+def test_identical_image(tmp_path):
+    """An exact copy verifies, by comparison and by digest"""
+    device, image, data = makePair(tmp_path)
+    verifiedFlag, result = verify.verifyImage(device, image, 65536, 4 * 65536, 512)
+    assert verifiedFlag
+    assert result['method'] == 'compare'
+    assert result['bytesCompared'] == len(data)
+    assert result['mismatches'] == []
+    checksum = hashlib.sha512(data).hexdigest()
+    verifiedFlag, result = verify.verifyImage(device, image, 65536, 4 * 65536, 512, checksum)
+    assert verifiedFlag
+    assert result['method'] == 'sha512'
+
+
+def test_mismatches_are_located(tmp_path):
+    """Differing sectors are reported as merged ranges, also when the digest
+    of the medium doesn't match"""
+    device, image, data = makePair(tmp_path)
+    changed = bytearray(data)
+    for offset in [1000, 1030, MIB + 5]:
+        changed[offset] ^= 0xFF
+    with open(image, 'wb') as f:
+        f.write(changed)
+    checksum = hashlib.sha512(changed).hexdigest()
+    verifiedFlag, result = verify.verifyImage(device, image, 65536, 4 * 65536, 512, checksum)
+    assert not verifiedFlag
+    assert result['method'] == 'compare'
+    assert result['mismatches'] == [[512, 1024], [MIB, 512]]
+    assert result['mismatchingSectors'] == 3
+
+
+def test_short_image(tmp_path):
+    """An image that is shorter than the medium doesn't verify"""
+    device, image, data = makePair(tmp_path)
+    with open(image, 'wb') as f:
+        f.write(data[:MIB])
+    verifiedFlag, _ = verify.verifyImage(device, image, 65536, 4 * 65536, 512)
+    assert not verifiedFlag
@@ -0,0 +1,65 @@
+"""Watching for inserted media"""
+
+import shutil
+
+from diskimgr import watch
+
+
+def setDevice(sysBlock, deviceName, noSectors, removable=True, physical=True):
+    """Create or update device in fake /sys/block tree"""
+    path = sysBlock / deviceName
+    path.mkdir(parents=True, exist_ok=True)
+    if physical:
+        (path / 'device').mkdir(exist_ok=True)
+    (path / 'removable').write_text('1\n' if removable else '0\n')
+    (path / 'size').write_text(str(noSectors) + '\n')
+
+
+def test_scan_devices(tmp_path):
+    """Only physical, removable devices that hold a medium are listed, unless
+    fixed devices are included"""
+    sysBlock = tmp_path / 'block'
+    setDevice(sysBlock, 'sda', 1000, removable=False)
+    setDevice(sysBlock, 'sdb', 2000)
+    setDevice(sysBlock, 'sr0', 0)
+    setDevice(sysBlock, 'loop0', 3000, physical=False)
+    assert watch.scanDevices(str(sysBlock)) == {'sdb': 2000 * 512}
+    assert watch.scanDevices(str(sysBlock), includeFixed=True) == {'sda': 1000 * 512,
+                                                                   'sdb': 2000 * 512}
+    assert watch.scanDevices(str(sysBlock), pattern='sr*') == {}
+
+
+def test_inserted_media_settle(tmp_path):
+    """Media present at the start are left alone; a new medium is reported
+    once its size is the same in two polls, and only once"""
+    sysBlock = tmp_path / 'block'
+    setDevice(sysBlock, 'sdb', 2000)
+    setDevice(sysBlock, 'sr0', 0)
+    watcher = watch.Watcher(str(sysBlock))
+    assert watcher.poll() == []
+    setDevice(sysBlock, 'sr0', 100)
+    assert watcher.poll() == []
+    # Size still changing
+    setDevice(sysBlock, 'sr0', 5000)
+    assert watcher.poll() == []
+    assert watcher.poll() == [('/dev/sr0', 5000 * 512)]
+    assert watcher.poll() == []
+
+
+def test_removed_media_are_reported_again(tmp_path):
+    """A device is reported again after its medium was removed and another
+    one inserted; also a device that was present at the start"""
+    sysBlock = tmp_path / 'block'
+    setDevice(sysBlock, 'sdb', 2000)
+    watcher = watch.Watcher(str(sysBlock))
+    setDevice(sysBlock, 'sdb', 0)
+    assert watcher.poll() == []
+    setDevice(sysBlock, 'sdb', 3000)
+    assert watcher.poll() == []
+    assert watcher.poll() == [('/dev/sdb', 3000 * 512)]
+    # Card reader unplugged and plugged in again
+    shutil.rmtree(str(sysBlock / 'sdb'))
+    assert watcher.poll() == []
+    setDevice(sysBlock, 'sdb', 3000)
+    assert watcher.poll() == []
+    assert watcher.poll() == [('/dev/sdb', 3000 * 512)]
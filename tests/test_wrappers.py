@@ -0,0 +1,86 @@
+"""Handling of the output of the external tools"""
+
+from diskimgr import wrappers
+
+
+def statusBlock(pct):
+    """Return the lines of a ddrescue status block at pct percent"""
+    return ['     ipos:  1048 kB, non-trimmed:        0 B,  current rate:  1048 kB/s',
+            '     opos:  1048 kB, non-scraped:        0 B,  average rate:  1048 kB/s',
+            'non-tried:  1048 kB,  bad-sector:        0 B,    error rate:       0 B/s',
+            '  rescued:  1048 kB,   bad areas:        0,        run time:          1s',
+            'pct rescued:   ' + str(pct) + '%, read errors:        0,  ' +
+            'remaining time:         n/a',
+            '                              time since last successful read:         n/a']
+
+
+class Clock:
+    """Settable replacement for time.monotonic"""
+
+    def __init__(self):
+        """initialise Clock instance"""
+        self.now = 100.0
+
+    def __call__(self):
+        """Return current time"""
+        return self.now
+
+
+def test_all_lines_without_interval():
+    """Without an interval, every line is passed on"""
+    progressFilter = wrappers.ProgressFilter()
+    for line in statusBlock(1.0):
+        assert progressFilter.feed(line) == [line]
+
+
+def test_status_blocks_are_coalesced(monkeypatch):
+    """Status blocks are passed on once per interval, or when progress
+    increased by step; the last one is shown before other lines"""
+    clock = Clock()
+    monkeypatch.setattr(wrappers.time, 'monotonic', clock)
+    progressFilter = wrappers.ProgressFilter(interval=10, step=5)
+
+    def feedBlock(pct):
+        lines = []
+        for line in statusBlock(pct):
+            lines += progressFilter.feed(line)
+        return lines
+
+    # The first block is always passed on
+    assert feedBlock(1.0) == statusBlock(1.0)
+    clock.now += 1
+    assert feedBlock(2.0) == []
+    clock.now += 1
+    assert feedBlock(3.0) == []
+    # Progress step
+    clock.now += 1
+    assert feedBlock(6.5) == statusBlock(6.5)
+    clock.now += 1
+    assert feedBlock(7.0) == []
+    # Interval
+    clock.now += 10
+    assert feedBlock(8.0) == statusBlock(8.0)
+    clock.now += 1
+    assert feedBlock(9.0) == []
+    assert progressFilter.noSuppressed == 4
+    # Phase lines are only passed on when they change, after the last state
+    phase = 'Trimming failed blocks... (forwards)'
+    assert progressFilter.feed(phase) == statusBlock(9.0) + [phase]
+    assert progressFilter.feed(phase) == []
+    assert progressFilter.noSuppressed == 3
+    assert progressFilter.finish() == []
+
+
+def test_final_state(monkeypatch):
+    """finish() passes on the last suppressed block, or an unfinished one"""
+    clock = Clock()
+    monkeypatch.setattr(wrappers.time, 'monotonic', clock)
+    progressFilter = wrappers.ProgressFilter(interval=10)
+    for pct in [1.0, 2.0]:
+        for line in statusBlock(pct):
+            progressFilter.feed(line)
+    assert progressFilter.finish() == statusBlock(2.0)
+    for line in statusBlock(3.0)[:3]:
+        assert progressFilter.feed(line) == []
+    assert progressFilter.finish() == statusBlock(3.0)[:3]
+    assert progressFilter.feed('Finished') == ['Finished']